@@ -21,7 +21,7 @@ import synapseutils
 from synapseclient import Activity
 from synapseclient.wiki import Wiki
 from synapseclient.annotations import Annotations
-from synapseclient.core import utils
+from synapseclient.core import hashing, utils
 from synapseclient.core.exceptions import (
     SynapseAuthenticationError,
     SynapseHTTPError,
@@ -122,7 +122,7 @@ def get(args, syn):
 def sync(args, syn):
     synapseutils.syncToSynapse(syn, manifestFile=args.manifestFile,
                                dryRun=args.dryRun, sendMessages=args.sendMessages,
-                               retries=args.retries)
+                               retries=args.retries, dedupe=args.dedupe)
 
 
 def store(args, syn):
@@ -233,11 +233,12 @@ def cat(args, syn):
         # SIGILL, SIGINT, SIGSEGV, or SIGTERM. A ValueError will be raised
         # in any other case."
         pass
-    entity = syn.get(args.id, version=args.version)
-    if 'path' in entity:
-        with open(entity.path) as inputfile:
-            for line in inputfile:
-                sys.stdout.write(line)
+    # the file is streamed straight to stdout rather than downloaded to the cache first
+    out = sys.stdout.buffer
+    max_threads = syn.max_threads if args.parallel else 1
+    for chunk in syn.iter_content(args.id, version=args.version, max_threads=max_threads):
+        out.write(chunk)
+    out.flush()
 
 
 def ls(args, syn):
@@ -465,6 +466,36 @@ def get_sts_token(args, syn):
     print(sts_string)
 
 
+def index_checksums(args, syn):
+    """Record the checksums of local files ahead of them being uploaded"""
+    file_count = hashing.index_files(args.paths, syn.cache.checksum_index, max_workers=args.threads)
+    print(f"Indexed the checksums of {file_count} files")
+
+
+def cache_stats(args, syn):
+    """Report the size and usage of the local file cache"""
+    size = syn.cache.size()
+    statistics = syn.cache.statistics()
+    if size is None or statistics is None:
+        raise ValueError(f"The cache index in {syn.cache.cache_root_dir} can't be used")
+
+    lookups = statistics['hits'] + statistics['misses']
+    hit_rate = f"{statistics['hits'] / lookups:.1%}" if lookups else 'n/a'
+    max_size = utils.humanizeBytes(syn.cache.max_size) if syn.cache.max_size is not None else 'unlimited'
+    print(f"Cache location: {syn.cache.cache_root_dir}")
+    print(f"Size: {utils.humanizeBytes(size)} of {max_size}")
+    print(f"Hits: {statistics['hits']}, misses: {statistics['misses']}, hit rate: {hit_rate}")
+    print(f"Evicted {statistics['evicted_files']} files,"
+          f" reclaiming {utils.humanizeBytes(statistics['evicted_bytes'])}")
+
+
+def cache_evict(args, syn):
+    """Evict the least recently used files from the local file cache"""
+    max_size = utils.parse_bytes(args.max_size) if args.max_size is not None else None
+    evicted_files, evicted_bytes = syn.cache.evict(max_size)
+    print(f"Evicted {evicted_files} files, reclaiming {utils.humanizeBytes(evicted_bytes)}")
+
+
 def migrate(args, syn):
     """Migrate Synapse entities to a new storage location"""
     _init_console_Logging()
@@ -587,6 +618,10 @@ def build_parser():
                              help='Send notifications via Synapse messaging (email) at specific intervals, '
                                   'on errors and on completion.')
     parser_sync.add_argument('--retries', metavar='INT', type=int, default=4)
+    parser_sync.add_argument('--dedupe', choices=['copy'], default=None,
+                             help='With "copy", files whose content is already stored in Synapse in the same storage '
+                                  'location are not uploaded again, a copy of the existing file handle is stored '
+                                  'instead.')
     parser_sync.add_argument('manifestFile', metavar='FILE', type=str,
                              help='A tsv file with file locations and metadata to be pushed to Synapse.')
     parser_sync.set_defaults(func=sync)
@@ -781,6 +816,9 @@ def build_parser():
                             help='Synapse ID of form syn123 of desired data object')
     parser_cat.add_argument('-v', '--version', metavar='VERSION', type=int, default=None,
                             help='Synapse version number of entity to display. Defaults to most recent version.')
+    parser_cat.add_argument('--parallel', action='store_true', default=False,
+                            help='Fetch ranges of the file in parallel ahead of writing them, using the'
+                                 ' configured max_threads')
     parser_cat.set_defaults(func=cat)
 
     parser_list = subparsers.add_parser('list',
@@ -952,6 +990,34 @@ def build_parser():
 
     parser_migrate.set_defaults(func=migrate)
 
+    parser_index_checksums = subparsers.add_parser(
+        'index-checksums',
+        help='Compute and record the MD5s of local files so that storing or syncing them later needn\'t read them again'
+    )
+    parser_index_checksums.add_argument('paths', metavar='path', type=str, nargs='+',
+                                        help='Files, and directories whose files are indexed recursively')
+    parser_index_checksums.add_argument('--threads', type=int, default=None,
+                                        help='The number of files hashed at once, by default the number of'
+                                             ' processors')
+    parser_index_checksums.set_defaults(func=index_checksums)
+
+    parser_cache = subparsers.add_parser('cache', help='Report on or reduce the size of the local file cache')
+    cache_subparsers = parser_cache.add_subparsers(title='cache commands', dest='cache_command', metavar='COMMAND',
+                                                   required=True)
+    parser_cache_stats = cache_subparsers.add_parser(
+        'stats',
+        help='Print the size of the cache, its hit rate, and the files evicted from it'
+    )
+    parser_cache_stats.set_defaults(func=cache_stats)
+    parser_cache_evict = cache_subparsers.add_parser(
+        'evict',
+        help='Remove the least recently used files from the cache until it is no larger than its maximum size'
+    )
+    parser_cache_evict.add_argument('--max-size', dest='max_size', type=str, default=None,
+                                    help='The size to reduce the cache to, e.g. 50GB, by default the max_size of the'
+                                         ' cache section of the configuration file')
+    parser_cache_evict.set_defaults(func=cache_evict)
+
     return parser
 
 
@@ -1005,8 +1071,9 @@ def main():
     args = build_parser().parse_args()
     synapseclient.USER_AGENT['User-Agent'] = "synapsecommandlineclient " + synapseclient.USER_AGENT['User-Agent']
     syn = synapseclient.Synapse(debug=args.debug, skip_checks=args.skip_checks, configPath=args.configPath)
-    if not ('func' in args and args.func == login):
-        # if we're not executing the "login" operation, automatically authenticate before running operation
+    if not ('func' in args and args.func in (login, index_checksums, cache_stats, cache_evict)):
+        # if we're not executing the "login" operation or one that only works with local files,
+        # automatically authenticate before running operation
         login_with_prompt(syn, args.synapseUser, args.synapsePassword, silent=True)
     perform_main(args, syn)
 
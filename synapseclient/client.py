@@ -35,6 +35,7 @@ import errno
 import functools
 import getpass
 import hashlib
+import io
 import json
 import logging
 import mimetypes
@@ -43,6 +44,7 @@ import requests
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import typing
 import urllib.parse as urllib_urlparse
@@ -62,7 +64,7 @@ from .evaluation import Evaluation, Submission, SubmissionStatus
 from .table import Schema, SchemaBase, Column, TableQueryResult, CsvFileTable, EntityViewSchema, SubmissionViewSchema
 from .team import UserProfile, Team, TeamMember, UserGroupHeader
 from .wiki import Wiki, WikiAttachment
-from synapseclient.core import cache, exceptions, utils
+from synapseclient.core import cache, download_urls, exceptions, file_copy, remote_file, utils
 from synapseclient.core.constants import config_file_constants
 from synapseclient.core.constants import concrete_types
 from synapseclient.core import cumulative_transfer_progress
@@ -81,14 +83,18 @@ from synapseclient.core.exceptions import (
 )
 from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME, DEBUG_LOGGER_NAME
 from synapseclient.core.version_check import version_check
+from synapseclient.core import pool_provider
 from synapseclient.core.pool_provider import DEFAULT_NUM_THREADS
 from synapseclient.core.utils import id_of, get_properties, MB, memoize, is_json, extract_synapse_id_from_query, \
     find_data_file_handle, extract_zip_file_to_directory, is_integer, require_param
 from synapseclient.core.retry import with_retry
 from synapseclient.core import sts_transfer
+from synapseclient.core.transfer_scheduler import get_transfer_job
 from synapseclient.core.upload.multipart_upload import multipart_upload_file, multipart_upload_string
+from synapseclient.core.upload.multipart_upload import shared_executor as upload_shared_executor
 from synapseclient.core.remote_file_storage_wrappers import S3ClientWrapper, SFTPWrapper
-from synapseclient.core.upload.upload_functions import upload_file_handle, upload_synapse_s3
+from synapseclient.core.upload.upload_destinations import UploadDestinationCache
+from synapseclient.core.upload.upload_functions import check_dedupe_mode, upload_file_handle, upload_synapse_s3
 from synapseclient.core.dozer import doze
 
 
@@ -143,6 +149,16 @@ mimetypes.add_type('text/x-markdown', '.markdown', strict=False)
 DEFAULT_STORAGE_LOCATION_ID = 1
 
 
+class StoreResult(typing.NamedTuple):
+    """The outcome of storing one of the entities given to :py:meth:`Synapse.store_many`"""
+    entity: typing.Any
+    """the entity as given to store_many"""
+    stored: typing.Optional[Entity]
+    """the stored Entity, or None if it couldn't be stored"""
+    error: typing.Optional[Exception]
+    """the error storing the entity, or None if it was stored"""
+
+
 def login(*args, **kwargs):
     """
     Convenience method to create a Synapse object and login.
@@ -207,8 +223,10 @@ class Synapse(object):
         if debug is None:
             debug = config_debug if config_debug is not None else DEBUG_DEFAULT
 
-        self.cache = cache.Cache(cache_root_dir)
+        self.cache = cache.Cache(cache_root_dir, **self._get_cache_config())
         self._sts_token_store = sts_transfer.StsTokenStore()
+        self._download_url_store = download_urls.PresignedUrlStore()
+        self._upload_destination_cache = UploadDestinationCache()
 
         self.setEndpoints(repoEndpoint, authEndpoint, fileHandleEndpoint, portalEndpoint, skip_checks)
 
@@ -227,6 +245,8 @@ class Synapse(object):
         transfer_config = self._get_transfer_config()
         self.max_threads = transfer_config['max_threads']
         self.use_boto_sts_transfers = transfer_config['use_boto_sts']
+        # if set to True, multi threaded downloads duplicate requests for parts that are much slower than the others
+        self.hedge_downloads = transfer_config['hedge_downloads']
 
         # TODO: remove once most clients are no longer on versions <= 1.7.5
         cached_sessions.migrate_old_session_file_credentials_if_necessary(self)
@@ -428,7 +448,8 @@ class Synapse(object):
         # defaults
         transfer_config = {
             'max_threads': DEFAULT_NUM_THREADS,
-            'use_boto_sts': False
+            'use_boto_sts': False,
+            'hedge_downloads': False,
         }
 
         for k, v in self._get_config_section_dict('transfer').items():
@@ -439,15 +460,46 @@ class Synapse(object):
                     except ValueError as cause:
                         raise ValueError(f"Invalid transfer.max_threads config setting {v}") from cause
 
-                elif k == 'use_boto_sts':
+                elif k in ('use_boto_sts', 'hedge_downloads'):
                     lower_v = v.lower()
                     if lower_v not in ('true', 'false'):
-                        raise ValueError(f"Invalid transfer.use_boto_sts config setting {v}")
+                        raise ValueError(f"Invalid transfer.{k} config setting {v}")
 
-                    transfer_config['use_boto_sts'] = 'true' == lower_v
+                    transfer_config[k] = 'true' == lower_v
 
         return transfer_config
 
+    def _get_cache_config(self):
+        # defaults
+        cache_config = {
+            'write_cache_maps': False,
+            'max_size': None,
+            'copy_mode': file_copy.COPY_MODE_COPY,
+        }
+
+        for k, v in self._get_config_section_dict('cache').items():
+            if v:
+                if k == 'write_cache_maps':
+                    lower_v = v.lower()
+                    if lower_v not in ('true', 'false'):
+                        raise ValueError(f"Invalid cache.{k} config setting {v}")
+
+                    cache_config[k] = 'true' == lower_v
+
+                elif k == 'max_size':
+                    try:
+                        cache_config[k] = utils.parse_bytes(v)
+                    except ValueError as cause:
+                        raise ValueError(f"Invalid cache.{k} config setting {v}") from cause
+
+                elif k == 'copy_mode':
+                    if v not in file_copy.COPY_MODES:
+                        raise ValueError(f"Invalid cache.{k} config setting {v}")
+
+                    cache_config[k] = v
+
+        return cache_config
+
     def _getSessionToken(self, email, password):
         """Returns a validated session token."""
         try:
@@ -681,7 +733,8 @@ class Synapse(object):
         :param filepath:        path to local file
         :param limitSearch:     Limits the places in Synapse where the file is searched for.
         """
-        results = self.restGET('/entity/md5/%s' % utils.md5_for_file(filepath).hexdigest())['results']
+        md5 = utils.md5_for_file(filepath, index=self.cache.checksum_index).hexdigest()
+        results = self.restGET('/entity/md5/%s' % md5)['results']
         if limitSearch is not None:
             # Go through and find the path of every entity found
             paths = [self.restGET('/entity/%s/path' % ent['id']) for ent in results]
@@ -704,6 +757,97 @@ class Synapse(object):
 
         return bundle
 
+    def open(self, entity, mode='rb', *, version=None, encoding=None, **kwargs):
+        """
+        Opens the file of a Synapse File entity for reading without downloading it. Only the parts of the file
+        that are read are fetched, so e.g. the footer and a few columns of a large Parquet file can be read
+        without transferring the rest of it. If the file is already in the local cache the cached copy is opened.
+
+        :param entity:      A Synapse ID, or a File entity
+        :param mode:        'rb' to read bytes or 'r' to read text
+        :param version:     The specific version of the file to open, defaults to the most recent version
+        :param encoding:    The encoding of the file when opened in text mode
+        :param block_size:  The size of the ranges of the file that are fetched and cached in memory
+
+        :returns: A seekable, read only file object
+
+        Example::
+
+            with syn.open('syn1906479') as f:
+                f.seek(-8, os.SEEK_END)
+                footer = f.read()
+        """
+        if mode not in ('rb', 'r'):
+            raise ValueError(f"Unsupported mode '{mode}', files can only be opened for reading with 'rb' or 'r'")
+
+        entity = self._get_file_entity_to_read(entity, version)
+
+        cached_file_path = self.cache.get(entity.dataFileHandleId)
+        if cached_file_path is not None:
+            raw = io.FileIO(cached_file_path, 'rb')
+        else:
+            raw = remote_file.open_remote_file(self, self._remote_read_request(entity), **kwargs)
+
+        if mode == 'r':
+            return io.TextIOWrapper(io.BufferedReader(raw), encoding=encoding)
+        return raw
+
+    def iter_content(self, entity, chunk_size=remote_file.DEFAULT_CHUNK_SIZE, *, version=None, max_threads=1):
+        """
+        Streams the content of the file of a Synapse File entity without writing it to disk, e.g. to pipe it to
+        another program or upload it elsewhere. If the file is already in the local cache the cached copy is read.
+
+        :param entity:      A Synapse ID, or a File entity
+        :param chunk_size:  The size in bytes of the chunks of the file to yield
+        :param version:     The specific version of the file to stream, defaults to the most recent version
+        :param max_threads: With more than one thread, ranges of the file are fetched in parallel ahead of the
+                            chunks being consumed. Otherwise the file is streamed with a single request.
+
+        :returns: A generator of the bytes of the file, in order. The MD5 of the content is checked once the
+                  last chunk has been consumed.
+
+        Example::
+
+            with open('/dev/null', 'wb') as out:
+                for chunk in syn.iter_content('syn1906479'):
+                    out.write(chunk)
+        """
+        entity = self._get_file_entity_to_read(entity, version)
+
+        cached_file_path = self.cache.get(entity.dataFileHandleId)
+        if cached_file_path is not None:
+            return self._iter_local_content(cached_file_path, chunk_size)
+
+        return remote_file.iter_remote_content(
+            self,
+            self._remote_read_request(entity),
+            chunk_size,
+            max_threads=max_threads,
+            expected_md5=entity._file_handle.get('contentMd5'),
+        )
+
+    @staticmethod
+    def _iter_local_content(path, chunk_size):
+        with open(path, 'rb') as f:
+            yield from iter(functools.partial(f.read, chunk_size), b'')
+
+    def _get_file_entity_to_read(self, entity, version):
+        if not (isinstance(entity, File) and entity.get('dataFileHandleId')):
+            entity = self.get(entity, version=version, downloadFile=False)
+        if not isinstance(entity, File):
+            raise ValueError(f"{id_of(entity)} is not a File and can't be read")
+        return entity
+
+    @staticmethod
+    def _remote_read_request(entity):
+        return multithread_download.DownloadRequest(
+            file_handle_id=int(entity.dataFileHandleId),
+            object_id=entity.id,
+            object_type='FileEntity',
+            path=None,
+            file_size=entity._file_handle.get('contentSize'),
+        )
+
     def move(self, entity, new_parent):
         """
         Move a Synapse entity to a new container.
@@ -831,7 +975,7 @@ class Synapse(object):
                 # create the foider if it does not exist already
                 if not os.path.exists(downloadLocation):
                     os.makedirs(downloadLocation)
-                shutil.copy(cached_file_path, downloadPath)
+                self.cache.copy(entity.dataFileHandleId, cached_file_path, downloadPath)
 
         else:  # download the file from URL (could be a local file)
             objectType = 'FileEntity' if submission is None else 'SubmissionAttachment'
@@ -878,7 +1022,8 @@ class Synapse(object):
         return downloadPath
 
     def store(self, obj, *, createOrUpdate=True, forceVersion=True, versionLabel=None, isRestricted=False,
-              activity=None, used=None, executed=None, activityName=None, activityDescription=None):
+              activity=None, used=None, executed=None, activityName=None, activityDescription=None,
+              returnFresh=True, dedupe=None):
         """
         Creates a new Entity or updates an existing Entity, uploading any files in the process.
 
@@ -899,6 +1044,15 @@ class Synapse(object):
                                     the process of adding terms-of-use or review board approval for this entity.
                                     You will be contacted with regards to the specific data being restricted and the
                                     requirements of access.
+        :param returnFresh:         Indicates whether a stored Entity is returned as retrieved again from Synapse.
+                                    If False, the returned Entity is built from the responses of storing it and the
+                                    store makes fewer requests, e.g. when storing many files, and a File with no id
+                                    stored with createOrUpdate=False isn't looked up in Synapse before its upload.
+                                    Defaults to True.
+        :param dedupe:              If 'copy', a File whose content is already stored in Synapse in the storage
+                                    location it would be uploaded to, in a file that the caller can download, isn't
+                                    uploaded again and is stored with a copy of the existing file handle instead.
+                                    Defaults to None, which always uploads the file of a new or changed File.
 
         :returns: A Synapse Entity, Evaluation, or Wiki
 
@@ -957,10 +1111,192 @@ class Synapse(object):
                     return obj
                 raise
 
-        # If the input object is an Entity or a dictionary
-        entity = obj
+        check_dedupe_mode(dedupe)
+        activity = self._provenance_activity(activity, used, executed, activityName, activityDescription)
+
+        # When not returning a fresh Entity the Activity is stored first and set as the Entity's provenance
+        # as the Entity is created or updated, so that its etag isn't changed afterwards
+        generatedBy = None
+        if activity and not returnFresh:
+            generatedBy = self._saveActivity(activity)['id']
+            activity = None
+
+        return self._store_entity(
+            obj,
+            createOrUpdate=createOrUpdate,
+            forceVersion=forceVersion,
+            versionLabel=versionLabel,
+            isRestricted=isRestricted,
+            activity=activity,
+            generatedBy=generatedBy,
+            returnFresh=returnFresh,
+            dedupe=dedupe,
+        )
+
+    def store_many(self, entities, *, max_workers=None, createOrUpdate=True, forceVersion=True, activity=None,
+                   used=None, executed=None, activityName=None, activityDescription=None):
+        """
+        Creates or updates many Entities, uploading any files in the process, with fewer requests than storing each
+        of them with :py:meth:`store`.
+
+        The children of each parent are listed once so that new Entities are created without being looked up first,
+        and the upload destination of each parent is retrieved once. The Entities are stored concurrently, their files
+        uploaded on a shared transfer job. Any provenance is stored once, as a single Activity that generated all of
+        the Entities, which is only kept if at least one of them is stored. Synapse has no bulk operations for creating
+        Entities or setting their annotations, so those are still a request for each Entity.
+
+        An error storing one of the Entities doesn't stop the others from being stored.
+
+        :param entities:            The Entities to store, e.g. Files and Folders. Objects that store themselves, such
+                                    as Tables, are stored as by :py:meth:`store`, and can't be stored with provenance
+        :param max_workers:         The maximum number of Entities stored at once, by default the client's max_threads
+        :param createOrUpdate:      Indicates whether an Entity that conflicts with an existing Synapse object is
+                                    updated, as by :py:meth:`store`.  Defaults to True.
+        :param forceVersion:        Indicates whether the versions of the Entities are incremented even if nothing has
+                                    changed.  Defaults to True.
+        :param activity:            Activity object specifying the provenance of all the Entities.
+        :param used:                The Entity, Synapse ID, or URL used to create all the Entities (can also be a list
+                                    of these)
+        :param executed:            The Entity, Synapse ID, or URL representing code executed to create all the
+                                    Entities (can also be a list of these)
+        :param activityName:        Activity name to be used in conjunction with *used* and *executed*.
+        :param activityDescription: Activity description to be used in conjunction with *used* and *executed*.
+
+        :returns: a list of a :py:class:`StoreResult` for each of the entities, in the order they were given.
+                  The stored Entities are built from the responses of storing them, as by store with returnFresh=False
+
+        Example::
+
+            from synapseclient import File
+
+            files = [File(path, parent='syn123') for path in paths]
+            for result in syn.store_many(files, used='syn456'):
+                if result.error:
+                    print(f"{result.entity.path} couldn't be stored: {result.error}")
+        """
+        entities = list(entities)
+        max_workers = max_workers or self.max_threads
+
+        activity = self._provenance_activity(activity, used, executed, activityName, activityDescription)
+        plain_entities = [e for e in entities if self._is_plain_entity(e)]
+        if activity and len(plain_entities) < len(entities):
+            raise ValueError(
+                "Provenance can only be stored by store_many for Files, Folders and other Entities without their own"
+                " store, store any other objects with store"
+            )
+
+        # the Activity is saved as the first Entity is stored, and deleted if none of them are
+        activity_lock = threading.Lock()
+        saved_activity = {}
+
+        def generated_by():
+            if activity is None:
+                return None
+            with activity_lock:
+                if 'id' not in saved_activity:
+                    saved_activity['id'] = self._saveActivity(activity)['id']
+            return saved_activity['id']
+
+        with pool_provider.get_executor(max_workers) as executor:
+            child_names = {}
+            if createOrUpdate:
+                parent_ids = {e['parentId'] for e in plain_entities if 'id' not in e and e.get('parentId')}
+                child_names = dict(zip(parent_ids, executor.map(self._get_child_names, parent_ids)))
+
+            file_parent_ids = {
+                e['parentId'] for e in plain_entities
+                if e.get('path') and e.get('synapseStore', True) and e.get('parentId')
+            }
+            upload_destinations = dict(zip(
+                file_parent_ids,
+                executor.map(self._get_default_upload_destination_or_none, file_parent_ids),
+            ))
+
+        with get_transfer_job(self.max_threads, max_concurrent_files=max_workers) as job:
+            futures = []
+            for entity in entities:
+                if self._is_plain_entity(entity):
+                    # an entity whose name isn't among the children of its parent is new
+                    names = child_names.get(entity.get('parentId'))
+                    known_new = names is not None and 'id' not in entity and entity.get('name') not in names
+
+                    futures.append(job.submit_file(
+                        self._store_many_entity,
+                        job,
+                        entity,
+                        known_new,
+                        generated_by,
+                        createOrUpdate=createOrUpdate,
+                        forceVersion=forceVersion,
+                        returnFresh=False,
+                        upload_destination=upload_destinations.get(entity.get('parentId')),
+                    ))
+                else:
+                    futures.append(job.submit_file(
+                        self.store,
+                        entity,
+                        createOrUpdate=createOrUpdate,
+                        forceVersion=forceVersion,
+                    ))
+
+        results = []
+        for entity, future in zip(entities, futures):
+            error = future.exception()
+            results.append(StoreResult(entity, None if error else future.result(), error))
+
+        if 'id' in saved_activity and all(result.error for result in results):
+            try:
+                self.restDELETE('/activity/%s' % saved_activity['id'])
+            except SynapseHTTPError as ex:
+                self.logger.warning("The Activity %s of Entities that couldn't be stored wasn't deleted: %s",
+                                    saved_activity['id'], ex)
+        return results
+
+    @staticmethod
+    def _is_plain_entity(obj):
+        # whether an object is stored as an Entity by store, rather than by its own hooks
+        return (isinstance(obj, Entity) or type(obj) is dict) \
+            and not hasattr(obj, '_before_synapse_store') \
+            and not hasattr(obj, '_synapse_store')
+
+    def _get_child_names(self, parent_id):
+        try:
+            return {child['name'] for child in self.getChildren(parent_id)}
+        except SynapseHTTPError:
+            # the entities of the parent are looked up as they are stored
+            return None
+
+    def _get_default_upload_destination_or_none(self, parent_id):
+        try:
+            return self._getDefaultUploadDestination(parent_id)
+        except SynapseHTTPError:
+            # any error is raised storing the files of the parent
+            return None
+
+    def _store_many_entity(self, job, entity, known_new, generated_by, **kwargs):
+        with upload_shared_executor(job.executor):
+            # any multipart uploads share the transfer job of the store_many
+            return self._store_entity(entity, known_new=known_new, generatedBy=generated_by(), **kwargs)
+
+    def _store_entity(self, entity, *, createOrUpdate=True, forceVersion=True, versionLabel=None, isRestricted=False,
+                      activity=None, generatedBy=None, returnFresh=True, upload_destination=None, dedupe=None,
+                      known_new=False, bundle=None):
+        """
+        Creates or updates an Entity or a dictionary, as described by :py:meth:`store`.
+
+        :param activity:            an Activity to set as the provenance of the Entity after it is stored
+        :param generatedBy:         the id of a stored Activity to set as the provenance of the Entity as it is stored
+        :param upload_destination:  the UploadDestination of the Entity's parent, if already known
+        :param dedupe:              whether a file handle with the same content is copied instead of uploading the file
+        :param known_new:           whether the Entity is known to be new, e.g. because the children of its parent were
+                                    just listed, so that it isn't looked up before it is created. If it was created by
+                                    someone else in the meantime it is updated as a conflict, if createOrUpdate
+        :param bundle:              the entity bundle of the Entity, if it was already retrieved, so that it isn't
+                                    looked up again
+
+        :returns: A Synapse Entity
+        """
         properties, annotations, local_state = split_entity_namespaces(entity)
-        bundle = None
         # Anything with a path is treated as a cache-able item
         if entity.get('path', False):
             if 'concreteType' not in properties:
@@ -968,8 +1304,10 @@ class Synapse(object):
             # Make sure the path is fully resolved
             entity['path'] = os.path.expanduser(entity['path'])
 
-            # Check if the File already exists in Synapse by fetching metadata on it
-            bundle = self._getEntityBundle(entity)
+            # Check if the File already exists in Synapse by fetching metadata on it,
+            # unless it is known to be new because it can't be an update
+            if not bundle and not known_new and (returnFresh or createOrUpdate or 'id' in properties):
+                bundle = self._getEntityBundle(entity)
 
             if bundle:
                 if createOrUpdate:
@@ -977,25 +1315,7 @@ class Synapse(object):
                     # enough to process this as an entity update.
                     properties = {**bundle['entity'], **properties}
 
-                # Check if the file should be uploaded
-                fileHandle = find_data_file_handle(bundle)
-                if fileHandle \
-                        and fileHandle['concreteType'] == "org.sagebionetworks.repo.model.file.ExternalFileHandle":
-                    # switching away from ExternalFileHandle or the url was updated
-                    needs_upload = entity['synapseStore'] or (fileHandle['externalURL'] != entity['externalURL'])
-                else:
-                    # Check if we need to upload a new version of an existing
-                    # file. If the file referred to by entity['path'] has been
-                    # modified, we want to upload the new version.
-                    # If synapeStore is false then we must upload a ExternalFileHandle
-                    needs_upload = not entity['synapseStore'] \
-                                   or not self.cache.contains(bundle['entity']['dataFileHandleId'], entity['path'])
-            elif entity.get('dataFileHandleId', None) is not None:
-                needs_upload = False
-            else:
-                needs_upload = True
-
-            if needs_upload:
+            if self._file_entity_needs_upload(entity, bundle):
                 local_state_fh = local_state.get('_file_handle', {})
                 synapseStore = local_state.get('synapseStore', True)
                 fileHandle = upload_file_handle(self,
@@ -1007,7 +1327,9 @@ class Synapse(object):
                                                 md5=local_state_fh.get('contentMd5'),
                                                 file_size=local_state_fh.get('contentSize'),
                                                 mimetype=local_state_fh.get('contentType'),
-                                                max_threads=self.max_threads)
+                                                max_threads=self.max_threads,
+                                                upload_destination=upload_destination,
+                                                dedupe=dedupe)
                 properties['dataFileHandleId'] = fileHandle['id']
                 local_state['_file_handle'] = fileHandle
 
@@ -1037,7 +1359,7 @@ class Synapse(object):
 
         # Create or update Entity in Synapse
         if 'id' in properties:
-            properties = self._updateEntity(properties, forceVersion, versionLabel)
+            properties = self._updateEntity(properties, forceVersion, versionLabel, generatedBy=generatedBy)
         else:
             # If Link, get the target name, version number and concrete type and store in link properties
             if properties['concreteType'] == "org.sagebionetworks.repo.model.Link":
@@ -1051,7 +1373,7 @@ class Synapse(object):
                     properties['linksTo']['targetVersionNumber'] = target_properties['versionNumber']
                 properties['name'] = target_properties['name']
             try:
-                properties = self._createEntity(properties)
+                properties = self._createEntity(properties, generatedBy=generatedBy)
             except SynapseHTTPError as ex:
                 if createOrUpdate and ex.response.status_code == 409:
                     # Get the existing Entity's ID via the name and parent
@@ -1072,7 +1394,7 @@ class Synapse(object):
                     # rather than an intentionally deleted annotation.
                     annotations = {**from_synapse_annotations(bundle['annotations']), **annotations}
 
-                    properties = self._updateEntity(properties, forceVersion, versionLabel)
+                    properties = self._updateEntity(properties, forceVersion, versionLabel, generatedBy=generatedBy)
 
                 else:
                     raise
@@ -1085,15 +1407,6 @@ class Synapse(object):
         annotations = self.set_annotations(Annotations(properties['id'], properties['etag'], annotations))
         properties['etag'] = annotations.etag
 
-        # If the parameters 'used' or 'executed' are given, create an Activity object
-        if used or executed:
-            if activity is not None:
-                raise SynapseProvenanceError(
-                    'Provenance can be specified as an Activity object or as used/executed'
-                    ' item(s), but not both.'
-                )
-            activity = Activity(name=activityName, description=activityDescription, used=used, executed=executed)
-
         # If we have an Activity, set it as the Entity's provenance record
         if activity:
             self.setProvenance(properties, activity)
@@ -1103,7 +1416,35 @@ class Synapse(object):
 
         # Return the updated Entity object
         entity = Entity.create(properties, annotations, local_state)
-        return self.get(entity, downloadFile=False)
+        return self.get(entity, downloadFile=False) if returnFresh else entity
+
+    def _file_entity_needs_upload(self, entity, bundle):
+        """
+        Checks whether the file of a File entity must be uploaded to store the entity.
+
+        :param entity:  a File entity or dictionary with a fully resolved path
+        :param bundle:  the entity bundle of the entity if it already exists in Synapse, otherwise None
+
+        :returns: True if a new file handle must be created for the file, False otherwise
+        """
+        if not bundle:
+            return entity.get('dataFileHandleId', None) is None
+
+        fileHandle = find_data_file_handle(bundle)
+        if fileHandle \
+                and fileHandle['concreteType'] == "org.sagebionetworks.repo.model.file.ExternalFileHandle":
+            # switching away from ExternalFileHandle or the url was updated
+            return entity['synapseStore'] or (fileHandle['externalURL'] != entity['externalURL'])
+
+        # Check if we need to upload a new version of an existing
+        # file. If the file referred to by entity['path'] has been
+        # modified, we want to upload the new version, unless it was already
+        # uploaded to the file handle the entity now refers to.
+        # If synapeStore is false then we must upload a ExternalFileHandle
+        file_handle_ids = (bundle['entity']['dataFileHandleId'], entity.get('dataFileHandleId', None))
+        return not entity['synapseStore'] or not any(self.cache.contains_many(
+            (file_handle_id, entity['path']) for file_handle_id in file_handle_ids if file_handle_id is not None
+        ))
 
     def _createAccessRequirementIfNone(self, entity):
         """
@@ -1636,13 +1977,7 @@ class Synapse(object):
         :returns: An updated :py:class:`synapseclient.activity.Activity` object
         """
 
-        # Assert that the entity was generated by a given Activity.
-        if 'id' in activity:
-            # We're updating provenance
-            uri = '/activity/%s' % activity['id']
-            activity = Activity(data=self.restPUT(uri, json.dumps(activity)))
-        else:
-            activity = self.restPOST('/activity', body=json.dumps(activity))
+        activity = self._saveActivity(activity)
 
         # assert that an entity is generated by an activity
         uri = '/entity/%s/generatedBy?generatedBy=%s' % (id_of(entity), activity['id'])
@@ -1650,6 +1985,34 @@ class Synapse(object):
 
         return activity
 
+    @staticmethod
+    def _provenance_activity(activity, used, executed, activityName, activityDescription):
+        # If the parameters 'used' or 'executed' are given, create an Activity object
+        if used or executed:
+            if activity is not None:
+                raise SynapseProvenanceError(
+                    'Provenance can be specified as an Activity object or as used/executed'
+                    ' item(s), but not both.'
+                )
+            activity = Activity(name=activityName, description=activityDescription, used=used, executed=executed)
+
+        return activity
+
+    def _saveActivity(self, activity):
+        """
+        Creates an Activity or, if it has an id, updates it.
+
+        :param activity: a :py:class:`synapseclient.activity.Activity`
+
+        :returns: The stored Activity
+        """
+        if 'id' in activity:
+            # We're updating provenance
+            uri = '/activity/%s' % activity['id']
+            return Activity(data=self.restPUT(uri, json.dumps(activity)))
+
+        return self.restPOST('/activity', body=json.dumps(activity))
+
     def deleteProvenance(self, entity):
         """
         Removes provenance information from an Entity and deletes the associated Activity.
@@ -1703,13 +2066,13 @@ class Synapse(object):
 
         :returns: dictionary with keys: fileHandle, fileHandleId and preSignedURL
         """
-        body = {'includeFileHandles': True, 'includePreSignedURLs': True,
-                'requestedFiles': [{'fileHandleId': fileHandleId,
-                                    'associateObjectId': objectId,
-                                    'associateObjectType': objectType or 'FileEntity'}]}
-        response = self.restPOST('/fileHandle/batch', body=json.dumps(body),
-                                 endpoint=self.fileHandleEndpoint)
-        result = response['requestedFiles'][0]
+        # a url already resolved as part of a batch (see get_download_urls) is used if it is not about to expire
+        result = self._download_url_store.get_urls(self, [(fileHandleId, objectId, objectType)])[0]
+        self._raise_for_file_result_failure(result, fileHandleId, objectId, objectType)
+        return result
+
+    @staticmethod
+    def _raise_for_file_result_failure(result, fileHandleId, objectId, objectType):
         failure = result.get('failureCode')
         if failure == 'NOT_FOUND':
             raise SynapseFileNotFoundError("The fileHandleId %s could not be found" % fileHandleId)
@@ -1718,7 +2081,47 @@ class Synapse(object):
                 "You are not authorized to access fileHandleId %s associated with the Synapse"
                 " %s: %s" % (fileHandleId, objectType, objectId)
             )
-        return result
+
+    def get_download_urls(self, requested_files, *, min_remaining_life=None):
+        """
+        Gets the presigned urls to download many files, requesting them from Synapse in batches rather than
+        one file at a time. The urls are kept so that a subsequent download of one of the files (e.g. with
+        :py:func:`Synapse.get`) can use its url, as long as it hasn't expired, without another request.
+
+        :param requested_files:     An iterable of (fileHandleId, objectId, objectType) tuples of the file handles
+                                    to download along with the Synapse object each is associated with, e.g.
+                                    [(entity.dataFileHandleId, entity.id, 'FileEntity')]. The objectType can be
+                                    omitted for files associated with a FileEntity.
+        :param min_remaining_life:  A datetime.timedelta, urls that will expire sooner than this are requested again.
+                                    By default 10 seconds.
+
+        :returns: a list with a dictionary for each requested file, in the order requested, with the keys
+                  fileHandleId, fileHandle, and preSignedURL, or failureCode (e.g. NOT_FOUND or UNAUTHORIZED) if
+                  the url of the file could not be obtained. See:
+                  https://rest-docs.synapse.org/rest/org/sagebionetworks/repo/model/file/FileResult.html
+        """
+        return self._download_url_store.get_urls(self, requested_files, min_remaining_life=min_remaining_life)
+
+    def _get_multi_threaded_download_size(self, file_result):
+        """
+        :param file_result: the FileResult of the file handle to download, with its url
+        :returns: the size of the file if it should be downloaded in ranges by multiple threads, otherwise None
+        """
+        if not self.multi_threaded:
+            return None
+
+        file_handle = file_result['fileHandle']
+        file_size = file_handle.get('contentSize')
+        if file_size is not None and file_size <= multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE:
+            return None
+
+        if file_handle['concreteType'] != concrete_types.S3_FILE_HANDLE:
+            # the files of any other server (e.g. an external url, Google Cloud Storage) are
+            # downloaded in ranges if the server honors range requests
+            file_size = multithread_download.probe_range_support(file_result['preSignedURL'], file_size=file_size)
+
+        return file_size if file_size and file_size > multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE \
+            else None
 
     @staticmethod
     def _is_retryable_download_error(ex):
@@ -1778,28 +2181,33 @@ class Synapse(object):
                         'read_only',
                     )
 
-                elif self.multi_threaded and \
-                        concreteType == concrete_types.S3_FILE_HANDLE and \
-                        fileHandle.get('contentSize', 0) > multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE:
+                else:
                     # run the download multi threaded if the file supports it, we're configured to do so,
                     # and the file is large enough that it would be broken into parts to take advantage of
                     # multiple downloading threads. otherwise it's more efficient to run the download as a simple
                     # single threaded URL download.
-                    downloaded_path = self._download_from_url_multi_threaded(fileHandleId,
-                                                                             objectId,
-                                                                             objectType,
-                                                                             destination,
-                                                                             expected_md5=fileHandle.get('contentMd5'))
-
-                else:
-                    downloaded_path = self._download_from_URL(fileResult['preSignedURL'],
-                                                              destination,
-                                                              fileHandle['id'],
-                                                              expected_md5=fileHandle.get('contentMd5'))
+                    multi_threaded_file_size = self._get_multi_threaded_download_size(fileResult)
+                    if multi_threaded_file_size is not None:
+                        downloaded_path = self._download_from_url_multi_threaded(
+                            fileHandleId,
+                            objectId,
+                            objectType,
+                            destination,
+                            expected_md5=fileHandle.get('contentMd5'),
+                            file_size=multi_threaded_file_size,
+                        )
+                    else:
+                        downloaded_path = self._download_from_URL(fileResult['preSignedURL'],
+                                                                  destination,
+                                                                  fileHandle['id'],
+                                                                  expected_md5=fileHandle.get('contentMd5'))
                 self.cache.add(fileHandle['id'], downloaded_path)
                 return downloaded_path
 
             except Exception as ex:
+                # don't retry with a url that we may have already had cached
+                self._download_url_store.invalidate((fileHandleId, objectId, objectType))
+
                 if not self._is_retryable_download_error(ex):
                     raise
 
@@ -1821,19 +2229,21 @@ class Synapse(object):
                                           object_type,
                                           destination,
                                           *,
-                                          expected_md5=None):
+                                          expected_md5=None,
+                                          file_size=None):
         destination = os.path.abspath(destination)
         temp_destination = utils.temp_download_filename(destination, file_handle_id)
 
         request = multithread_download.DownloadRequest(file_handle_id=int(file_handle_id),
                                                        object_id=object_id,
                                                        object_type=object_type,
-                                                       path=temp_destination)
+                                                       path=temp_destination,
+                                                       file_size=file_size)
 
-        multithread_download.download_file(self, request)
+        # the md5 is computed as the parts are downloaded, so we don't need to read the file again to check it
+        actual_md5 = multithread_download.download_file(self, request)
 
         if expected_md5:  # if md5 not set (should be the case for all except http download)
-            actual_md5 = utils.md5_for_file(temp_destination).hexdigest()
             # check md5 if given
             if actual_md5 != expected_md5:
                 try:
@@ -1889,6 +2299,9 @@ class Synapse(object):
                 # if a partial download exists with the temporary name,
                 # find it and restart the download from where it left off
                 temp_destination = utils.temp_download_filename(destination, fileHandleId)
+                # an interrupted multi threaded download of the same file handle leaves a file with gaps
+                # rather than a contiguous prefix of the file, which can't be resumed by appending to it
+                multithread_download.discard_partial_download(temp_destination)
                 range_header = {"Range": "bytes={start}-".format(start=os.path.getsize(temp_destination))} \
                     if os.path.exists(temp_destination) else {}
                 response = with_retry(
@@ -2020,7 +2433,7 @@ class Synapse(object):
             'concreteType': concrete_types.EXTERNAL_OBJECT_STORE_FILE_HANDLE,
             'fileKey': s3_file_key,
             'fileName': os.path.basename(file_path),
-            'contentMd5': utils.md5_for_file(file_path).hexdigest(),
+            'contentMd5': utils.md5_for_file(file_path, index=self.cache.checksum_index).hexdigest(),
             'contentSize': os.stat(file_path).st_size,
             'storageLocationId': storage_location_id,
             'contentType': mimetype
@@ -2062,7 +2475,7 @@ class Synapse(object):
             'key': s3_file_key,
             'bucketName': bucket_name,
             'fileName': os.path.basename(file_path),
-            'contentMd5': utils.md5_for_file(file_path).hexdigest(),
+            'contentMd5': utils.md5_for_file(file_path, index=self.cache.checksum_index).hexdigest(),
             'contentSize': os.stat(file_path).st_size,
             'storageLocationId': storage_location_id,
             'contentType': mimetype
@@ -2095,8 +2508,27 @@ class Synapse(object):
     ############################################################
 
     def _getDefaultUploadDestination(self, parent_entity):
-        return self.restGET('/entity/%s/uploadDestination' % id_of(parent_entity),
-                            endpoint=self.fileHandleEndpoint)
+        return self._get_upload_destination(id_of(parent_entity))
+
+    def _get_upload_destination(self, entity_id, storage_location_id=None):
+        """
+        Get an UploadDestination of a container, cached for a few minutes since every file uploaded to the
+        container needs it.
+
+        :param entity_id:           the id of the container
+        :param storage_location_id: the storage location of the UploadDestination, or None for the default one
+
+        :returns: the UploadDestination as a dict
+        """
+        uri = '/entity/%s/uploadDestination' % entity_id
+        if storage_location_id is not None:
+            uri += '/%s' % storage_location_id
+
+        return self._upload_destination_cache.get(
+            entity_id,
+            storage_location_id,
+            lambda: self.restGET(uri, endpoint=self.fileHandleEndpoint),
+        )
 
     def _getUserCredentials(self, url, username=None, password=None):
         """Get user credentials for a specified URL by either looking in the configFile or querying the user.
@@ -2196,20 +2628,25 @@ class Synapse(object):
             storage_location_id = DEFAULT_STORAGE_LOCATION_ID
         locations = storage_location_id if isinstance(storage_location_id, list) else [storage_location_id]
 
-        existing_setting = self.getProjectSetting(entity, 'upload')
-        if existing_setting is not None:
-            existing_setting['locations'] = locations
-            self.restPUT('/projectSettings', body=json.dumps(existing_setting))
-            return self.getProjectSetting(entity, 'upload')
-        else:
-            project_destination = {'concreteType':
-                                   'org.sagebionetworks.repo.model.project.UploadDestinationListSetting',
-                                   'settingsType': 'upload',
-                                   'locations': locations,
-                                   'projectId': id_of(entity)
-                                   }
-
-            return self.restPOST('/projectSettings', body=json.dumps(project_destination))
+        try:
+            existing_setting = self.getProjectSetting(entity, 'upload')
+            if existing_setting is not None:
+                existing_setting['locations'] = locations
+                self.restPUT('/projectSettings', body=json.dumps(existing_setting))
+                return self.getProjectSetting(entity, 'upload')
+            else:
+                project_destination = {'concreteType':
+                                       'org.sagebionetworks.repo.model.project.UploadDestinationListSetting',
+                                       'settingsType': 'upload',
+                                       'locations': locations,
+                                       'projectId': id_of(entity)
+                                       }
+
+                return self.restPOST('/projectSettings', body=json.dumps(project_destination))
+        finally:
+            # the UploadDestinations of the entity and everything it contains change with the setting. they are
+            # discarded once it is saved, so that one retrieved by a concurrent upload before then isn't kept
+            self._upload_destination_cache.clear()
 
     def getProjectSetting(self, project, setting_type):
         """
@@ -3558,24 +3995,33 @@ class Synapse(object):
             raise ValueError("Columns not found: " + ", ".join('"' + col + '"' for col in cols_not_found))
         col_indices = [i for i, h in enumerate(table.headers) if h.name in columns]
         # see: http://docs.synapse.org/rest/org/sagebionetworks/repo/model/file/BulkFileDownloadRequest.html
-        file_handle_associations = []
-        file_handle_to_path_map = collections.OrderedDict()
-        seen_file_handle_ids = set()  # ensure not sending duplicate requests for the same FileHandle IDs
+        file_handle_ids = []
         for row in table:
             for col_index in col_indices:
                 file_handle_id = row[col_index]
                 if is_integer(file_handle_id):
-                    path_to_cached_file = self.cache.get(file_handle_id, path=downloadLocation)
-                    if path_to_cached_file:
-                        file_handle_to_path_map[file_handle_id] = path_to_cached_file
-                    elif file_handle_id not in seen_file_handle_ids:
-                        file_handle_associations.append(dict(
-                            associateObjectType="TableEntity",
-                            fileHandleId=file_handle_id,
-                            associateObjectId=table.tableId))
-                    seen_file_handle_ids.add(file_handle_id)
+                    file_handle_ids.append(file_handle_id)
                 else:
                     warnings.warn("Weird file handle: %s" % file_handle_id)
+
+        # look up all the file handles in the cache at once rather than one at a time
+        unique_file_handle_ids = list(collections.OrderedDict.fromkeys(file_handle_ids))
+        cached_paths = dict(zip(
+            unique_file_handle_ids,
+            self.cache.get_many(unique_file_handle_ids, path=downloadLocation)
+        ))
+
+        file_handle_associations = []
+        file_handle_to_path_map = collections.OrderedDict()
+        for file_handle_id in unique_file_handle_ids:
+            path_to_cached_file = cached_paths[file_handle_id]
+            if path_to_cached_file:
+                file_handle_to_path_map[file_handle_id] = path_to_cached_file
+            else:
+                file_handle_associations.append(dict(
+                    associateObjectType="TableEntity",
+                    fileHandleId=file_handle_id,
+                    associateObjectId=table.tableId))
         return file_handle_associations, file_handle_to_path_map
 
     def _get_default_view_columns(self, view_type, view_type_mask=None):
@@ -3638,24 +4084,27 @@ class Synapse(object):
             uri += '/version/%d' % version
         return self.restGET(uri)
 
-    def _createEntity(self, entity):
+    def _createEntity(self, entity, generatedBy=None):
         """
         Create a new entity in Synapse.
 
         :param entity: A dictionary representing an Entity or a Synapse Entity object
+        :param generatedBy: the id of an Activity to set as the entity's provenance
 
         :returns: A dictionary containing an Entity's properties
         """
 
-        return self.restPOST(uri='/entity', body=json.dumps(get_properties(entity)))
+        params = {'generatedBy': generatedBy} if generatedBy else {}
+        return self.restPOST(uri='/entity', body=json.dumps(get_properties(entity)), params=params)
 
-    def _updateEntity(self, entity, incrementVersion=True, versionLabel=None):
+    def _updateEntity(self, entity, incrementVersion=True, versionLabel=None, generatedBy=None):
         """
         Update an existing entity in Synapse.
 
         :param entity: A dictionary representing an Entity or a Synapse Entity object
         :param incrementVersion: whether to increment the entity version (if Versionable)
         :param versionLabel: a label for the entity version (if Versionable)
+        :param generatedBy: the id of an Activity to set as the entity's provenance
 
 
         :returns: A dictionary containing an Entity's properties
@@ -3663,7 +4112,7 @@ class Synapse(object):
 
         uri = '/entity/%s' % id_of(entity)
 
-        params = {}
+        params = {'generatedBy': generatedBy} if generatedBy else {}
         if is_versionable(entity):
             if versionLabel:
                 # a versionLabel implicitly implies incrementing
@@ -3675,7 +4124,11 @@ class Synapse(object):
                 entity['versionLabel'] = versionLabel
                 params['newVersion'] = 'true'
 
-        return self.restPUT(uri, body=json.dumps(get_properties(entity)), params=params)
+        properties = self.restPUT(uri, body=json.dumps(get_properties(entity)), params=params)
+        if is_container(entity):
+            # a container may have been moved, changing the UploadDestinations of it and everything it contains
+            self._upload_destination_cache.clear()
+        return properties
 
     def findEntityId(self, name, parent=None):
         """
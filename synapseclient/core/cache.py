@@ -12,6 +12,7 @@ This is part of the internal implementation of the client and should not be acce
 
 import collections.abc
 import datetime
+import functools
 import json
 import operator
 import os
@@ -19,12 +20,22 @@ import re
 import shutil
 import math
 
-from synapseclient.core.lock import Lock
-from synapseclient.core import utils
+from synapseclient.core.lock import FILE_LOCKS_SUPPORTED, FileLock, Lock
+from synapseclient.core import cache_index, checksum_index, file_copy, utils
 
 
 CACHE_ROOT_DIR = os.path.join('~', '.synapseCache')
 
+# when a cache that is limited in size is full, the least recently used files are evicted until it is this fraction
+# of its maximum size, so that files aren't evicted every time another is added to it
+EVICTION_TARGET_FRACTION = 0.9
+
+# the number of least recently used files considered for eviction at once
+EVICTION_BATCH_SIZE = 100
+
+# the name of the FileLock of the cached files in a cache directory
+CACHED_FILES_LOCK_NAME = '.cachedFiles'
+
 
 def epoch_time_to_iso(epoch_time):
     """
@@ -60,14 +71,31 @@ def compare_timestamps(modified_time, cached_time):
 
 
 def _get_modified_time(path):
-    if os.path.exists(path):
+    try:
         return os.path.getmtime(path)
-    return None
+    except OSError:
+        return None
 
 
 class Cache:
     """
     Represent a cache in which files are accessed by file handle ID.
+
+    The cached copies of each file handle are recorded in a SQLite index under the cache root. Older clients, and
+    other clients such as the R client, record them in a .cacheMap file in the cache directory of the file handle,
+    which is used instead if the index can't be used, and which is also written if write_cache_maps is True so
+    that the other clients sharing the cache can find the files cached by this one.
+
+    If the cache has a max_size, the least recently used files in the cache root are evicted when files added to it
+    make it larger than that. Cached copies outside the cache root, e.g. in a download location, are never evicted.
+    A file isn't evicted while it is being copied out of the cache by copy, but files returned by get aren't locked,
+    so a file in the cache root may be evicted while a caller is reading it.
+
+    The copy_mode is how cached files are copied to the locations they are downloaded to, one of
+    file_copy.COPY_MODES.
+
+    The checksum_index is a checksum_index.ChecksumIndex under the cache root, in which the MD5s of local files
+    hashed by the clients using the cache are recorded.
     """
 
     def __setattr__(self, key, value):
@@ -77,16 +105,32 @@ class Cache:
             # create the cache_root_dir if it does not already exist
             if not os.path.exists(value):
                 os.makedirs(value)
+            if '_index' in self.__dict__:
+                self._index.flush()
+            self.__dict__['_index'] = cache_index.CacheIndex(
+                os.path.join(value, cache_index.CACHE_INDEX_FILE_NAME),
+                utils.normalize_path(value),
+                legacy_entries=self._legacy_entries,
+            )
+            self.__dict__['checksum_index'] = checksum_index.ChecksumIndex(
+                os.path.join(value, checksum_index.CHECKSUM_INDEX_FILE_NAME),
+            )
         self.__dict__[key] = value
 
-    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000):
+    def __init__(self, cache_root_dir=CACHE_ROOT_DIR, fanout=1000, write_cache_maps=False, max_size=None,
+                 copy_mode=file_copy.COPY_MODE_COPY):
         # set root dir of cache in which meta data will be stored and files
         # will be stored here by default, but other locations can be specified
         self.cache_root_dir = cache_root_dir
         self.fanout = fanout
         self.cache_map_file_name = ".cacheMap"
+        self.write_cache_maps = write_cache_maps
+        self.max_size = max_size
+        file_copy.check_copy_mode(copy_mode)
+        self.copy_mode = copy_mode
 
-    def get_cache_dir(self, file_handle_id):
+    @staticmethod
+    def _file_handle_id(file_handle_id):
         if isinstance(file_handle_id, collections.abc.Mapping):
             if 'dataFileHandleId' in file_handle_id:
                 file_handle_id = file_handle_id['dataFileHandleId']
@@ -94,7 +138,11 @@ class Cache:
                     and 'id' in file_handle_id \
                     and file_handle_id['concreteType'].startswith('org.sagebionetworks.repo.model.file'):
                 file_handle_id = file_handle_id['id']
-        return os.path.join(self.cache_root_dir, str(int(file_handle_id) % self.fanout), str(file_handle_id))
+        return str(file_handle_id)
+
+    def get_cache_dir(self, file_handle_id):
+        file_handle_id = self._file_handle_id(file_handle_id)
+        return os.path.join(self.cache_root_dir, str(int(file_handle_id) % self.fanout), file_handle_id)
 
     def _read_cache_map(self, cache_dir):
         cache_map_file = os.path.join(cache_dir, self.cache_map_file_name)
@@ -116,6 +164,101 @@ class Cache:
             json.dump(cache_map, f)
             f.write('\n')  # For compatibility with R's JSON parser
 
+    def _cache_map_lock(self, cache_dir):
+        """
+        :returns: the lock of the .cacheMap file of a cache directory, which is held to read or write it
+        """
+        # other clients sharing the .cacheMap files, e.g. the R client, only use lock directories
+        return Lock(self.cache_map_file_name, dir=cache_dir)
+
+    def _file_lock(self, cache_dir, shared=False):
+        """
+        :returns: the lock of the cached files in a cache directory, which is held shared while they are copied out of
+                    the cache and exclusively while they are evicted, or None if file locks aren't supported
+        """
+        if FILE_LOCKS_SUPPORTED:
+            return FileLock(CACHED_FILES_LOCK_NAME, dir=cache_dir, shared=shared)
+        return None
+
+    def _legacy_entries(self):
+        # the entries of the .cacheMap files to import into a new index
+        for cache_dir in self._cache_dirs():
+            try:
+                cache_map = self._read_cache_map(cache_dir)
+                written = os.path.getmtime(os.path.join(cache_dir, self.cache_map_file_name)) if cache_map else None
+            except (OSError, ValueError):
+                continue
+
+            for path, cached_time in cache_map.items():
+                yield os.path.basename(cache_dir), path, cached_time, written
+
+    def _get_cache_map(self, file_handle_id):
+        """
+        :returns: the paths of the cached copies of the file handle mapped to their cached modification times
+        """
+        cache_map = self._index.get(file_handle_id)
+        if cache_map is None or (not cache_map and self.write_cache_maps):
+            # the index can't be used, or other clients sharing the .cacheMap files may have cached the file
+            cache_dir = self.get_cache_dir(file_handle_id)
+            if not os.path.exists(cache_dir):
+                return cache_map or {}
+
+            with self._cache_map_lock(cache_dir):
+                legacy_cache_map = self._read_cache_map(cache_dir)
+
+            if cache_map is not None and legacy_cache_map:
+                self._index.put(file_handle_id, ((path, cached_time, None)
+                                                 for path, cached_time in legacy_cache_map.items()))
+            cache_map = legacy_cache_map
+
+        return cache_map
+
+    def _get_cache_maps(self, file_handle_ids):
+        """
+        :returns: the file handle ids mapped to the paths of their cached copies mapped to their cached modification
+                    times, as _get_cache_map returns for each of them
+        """
+        cache_maps = self._index.get_many(file_handle_ids)
+        if cache_maps is None or self.write_cache_maps:
+            cache_maps = cache_maps or {}
+            for file_handle_id in file_handle_ids:
+                if not cache_maps.get(file_handle_id):
+                    cache_maps[file_handle_id] = self._get_cache_map(file_handle_id)
+        return cache_maps
+
+    def _update_cache_map(self, file_handle_id, update):
+        """
+        Update the .cacheMap file of a file handle
+
+        :param update: a function that updates the cache map of the file handle in place
+        """
+        cache_dir = self.get_cache_dir(file_handle_id)
+        with self._cache_map_lock(cache_dir):
+            cache_map = self._read_cache_map(cache_dir)
+            result = update(cache_map)
+            self._write_cache_map(cache_dir, cache_map)
+        return result
+
+    def _remove_entries(self, file_handle_id, paths=None):
+        """
+        :param paths: the paths of the cached copies to remove, or None to remove all the copies of the file handle
+        :returns: the paths removed
+        """
+        removed = self._index.remove(file_handle_id, paths)
+        if removed is None or self.write_cache_maps:
+            def remove(cache_map):
+                removed_paths = [path for path in cache_map if paths is None or path in paths]
+                for path in removed_paths:
+                    del cache_map[path]
+                return removed_paths
+
+            legacy_removed = self._update_cache_map(file_handle_id, remove)
+            removed = legacy_removed if removed is None else removed + [
+                path for path in legacy_removed if path not in removed
+            ]
+
+        return removed
+
     def contains(self, file_handle_id, path):
         """
         Given a file and file_handle_id, return True if an unmodified cached
@@ -123,20 +266,45 @@ class Cache:
         :param file_handle_id:
         :param path: file path at which to look for a cached copy
         """
-        cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
-            return False
-
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+        file_handle_id = self._file_handle_id(file_handle_id)
+        cache_map = self._get_cache_map(file_handle_id)
 
-            path = utils.normalize_path(path)
+        path = utils.normalize_path(path)
 
-            cached_time = cache_map.get(path, None)
-            if cached_time:
-                return compare_timestamps(_get_modified_time(path), cached_time)
+        cached_time = cache_map.get(path, None)
+        if cached_time and compare_timestamps(_get_modified_time(path), cached_time):
+            self._index.accessed(file_handle_id, path)
+            return True
         return False
 
+    def contains_many(self, file_handle_ids_and_paths):
+        """
+        Check whether unmodified cached copies of many files exist, as contains does for each of them, looking up all
+        of their file handles at once and checking the modification time of each path only once.
+
+        :param file_handle_ids_and_paths: pairs of file handle ids and the file paths at which to look for their cached
+                                          copies
+
+        :returns: a list of whether an unmodified cached copy of each file exists at its path
+        """
+        file_handle_ids_and_paths = [
+            (self._file_handle_id(file_handle_id), utils.normalize_path(path))
+            for file_handle_id, path in file_handle_ids_and_paths
+        ]
+        cache_maps = self._get_cache_maps([file_handle_id for file_handle_id, _ in file_handle_ids_and_paths])
+        modified_time = functools.lru_cache(maxsize=None)(_get_modified_time)
+
+        contained = []
+        for file_handle_id, path in file_handle_ids_and_paths:
+            cached_time = cache_maps[file_handle_id].get(path, None)
+            contained.append(bool(cached_time) and compare_timestamps(modified_time(path), cached_time))
+
+        self._index.accessed_many(
+            (file_handle_id_and_path for file_handle_id_and_path, is_contained
+             in zip(file_handle_ids_and_paths, contained) if is_contained)
+        )
+        return contained
+
     def get(self, file_handle_id, path=None):
         """
         Retrieve a file with the given file handle from the cache.
@@ -151,60 +319,91 @@ class Cache:
         :returns: Either a file path, if an unmodified cached copy of the file
                   exists in the specified location or None if it does not
         """
-        cache_dir = self.get_cache_dir(file_handle_id)
-        if not os.path.exists(cache_dir):
-            return None
+        file_handle_id = self._file_handle_id(file_handle_id)
+        cached_file_path = self._get(file_handle_id, path)
+        self._index.accessed(file_handle_id, cached_file_path, lookup=True)
+        return cached_file_path
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
-
-            path = utils.normalize_path(path)
-
-            # If the caller specifies a path and that path exists in the cache
-            # but has been modified, we need to indicate no match by returning
-            # None. The logic for updating a synapse entity depends on this to
-            # determine the need to upload a new file.
-
-            if path is not None:
-                # If we're given a path to a directory, look for a cached file in that directory
-                if os.path.isdir(path):
-                    matching_unmodified_directory = None
-                    removed_entry_from_cache = False  # determines if cache_map needs to be rewritten to disk
-
-                    # iterate a copy of cache_map to allow modifying original cache_map
-                    for cached_file_path, cached_time in dict(cache_map).items():
-                        if path == os.path.dirname(cached_file_path):
-                            # compare_timestamps has an implicit check for whether the path exists
-                            if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                                # "break" instead of "return" to write removed invalid entries to disk if necessary
-                                matching_unmodified_directory = cached_file_path
-                                break
-                            else:
-                                # remove invalid cache entries pointing to files that that no longer exist
-                                # or have been modified
-                                del cache_map[cached_file_path]
-                                removed_entry_from_cache = True
-
-                    if removed_entry_from_cache:
-                        # write cache_map with non-existent entries removed
-                        self._write_cache_map(cache_dir, cache_map)
+    def get_many(self, file_handle_ids, path=None):
+        """
+        Retrieve the files with the given file handles from the cache, as get does for each of them, looking up all of
+        the file handles at once and checking the modification time of each cached copy only once.
 
-                    if matching_unmodified_directory is not None:
-                        return matching_unmodified_directory
+        :param file_handle_ids: the file handle ids, or Files or file handles
+        :param path:            where to look for the cached copies, as for get
 
-                # if we're given a full file path, look up a matching file in the cache
-                else:
-                    cached_time = cache_map.get(path, None)
-                    if cached_time:
-                        return path if compare_timestamps(_get_modified_time(path), cached_time) else None
-
-            # return most recently cached and unmodified file OR
-            # None if there are no unmodified files
-            for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
-                if compare_timestamps(_get_modified_time(cached_file_path), cached_time):
-                    return cached_file_path
+        :returns: a list of the paths of unmodified cached copies of the files in the specified location, or None
+                  for each file that has none
+        """
+        file_handle_ids = [self._file_handle_id(file_handle_id) for file_handle_id in file_handle_ids]
+        cache_maps = self._get_cache_maps(file_handle_ids)
+
+        path = utils.normalize_path(path)
+        path_is_dir = path is not None and os.path.isdir(path)
+        modified_time = functools.lru_cache(maxsize=None)(_get_modified_time)
+
+        cached_file_paths = [
+            self._get(file_handle_id, path, cache_map=cache_maps[file_handle_id], path_is_dir=path_is_dir,
+                      modified_time=modified_time)
+            for file_handle_id in file_handle_ids
+        ]
+        self._index.accessed_many(zip(file_handle_ids, cached_file_paths), lookup=True)
+        return cached_file_paths
+
+    def _get(self, file_handle_id, path, cache_map=None, path_is_dir=None, modified_time=None):
+        if cache_map is None:
+            cache_map = self._get_cache_map(file_handle_id)
+        if not cache_map:
             return None
 
+        path = utils.normalize_path(path)
+        if path_is_dir is None:
+            path_is_dir = path is not None and os.path.isdir(path)
+        if modified_time is None:
+            modified_time = _get_modified_time
+
+        # If the caller specifies a path and that path exists in the cache
+        # but has been modified, we need to indicate no match by returning
+        # None. The logic for updating a synapse entity depends on this to
+        # determine the need to upload a new file.
+
+        if path is not None:
+            # If we're given a path to a directory, look for a cached file in that directory
+            if path_is_dir:
+                matching_unmodified_directory = None
+                invalid_paths = []
+
+                for cached_file_path, cached_time in cache_map.items():
+                    if path == os.path.dirname(cached_file_path):
+                        # compare_timestamps has an implicit check for whether the path exists
+                        if compare_timestamps(modified_time(cached_file_path), cached_time):
+                            # "break" instead of "return" to remove invalid entries if necessary
+                            matching_unmodified_directory = cached_file_path
+                            break
+                        else:
+                            # remove invalid cache entries pointing to files that that no longer exist
+                            # or have been modified
+                            invalid_paths.append(cached_file_path)
+
+                if invalid_paths:
+                    self._remove_entries(file_handle_id, invalid_paths)
+
+                if matching_unmodified_directory is not None:
+                    return matching_unmodified_directory
+
+            # if we're given a full file path, look up a matching file in the cache
+            else:
+                cached_time = cache_map.get(path, None)
+                if cached_time:
+                    return path if compare_timestamps(modified_time(path), cached_time) else None
+
+        # return most recently cached and unmodified file OR
+        # None if there are no unmodified files
+        for cached_file_path, cached_time in sorted(cache_map.items(), key=operator.itemgetter(1), reverse=True):
+            if compare_timestamps(modified_time(cached_file_path), cached_time):
+                return cached_file_path
+        return None
+
     def add(self, file_handle_id, path):
         """
         Add a file to the cache
@@ -212,16 +411,47 @@ class Cache:
         if not path or not os.path.exists(path):
             raise ValueError("Can't find file \"%s\"" % path)
 
-        cache_dir = self.get_cache_dir(file_handle_id)
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
+        file_handle_id = self._file_handle_id(file_handle_id)
+        path = utils.normalize_path(path)
+        # write .000 milliseconds for backward compatibility
+        cached_time = epoch_time_to_iso(math.floor(_get_modified_time(path)))
 
-            path = utils.normalize_path(path)
-            # write .000 milliseconds for backward compatibility
-            cache_map[path] = epoch_time_to_iso(math.floor(_get_modified_time(path)))
-            self._write_cache_map(cache_dir, cache_map)
+        indexed = self._index.put(file_handle_id, [(path, cached_time, os.path.getsize(path))])
+        if not indexed or self.write_cache_maps:
+            self._update_cache_map(file_handle_id, lambda cache_map: cache_map.update({path: cached_time}))
 
-        return cache_map
+        if indexed and self.max_size is not None:
+            # the running total of the size of the cache is checked, rather than summing the sizes of its files
+            size = self._index.size()
+            if size is not None and size > self.max_size:
+                self._evict(size, int(self.max_size * EVICTION_TARGET_FRACTION), keep=path)
+
+        return self._get_cache_map(file_handle_id)
+
+    def copy(self, file_handle_id, cached_path, path):
+        """
+        Copy a cached file to another path, sharing its data if the copy mode of the cache allows it, and add the copy
+        to the cache.
+
+        :param file_handle_id:  the file handle id of the cached file
+        :param cached_path:     the path of the cached file
+        :param path:            the path to copy it to
+
+        :returns: the way the file was copied, see file_copy.copy_file
+        """
+        # the cached file isn't evicted while it is being copied
+        cache_dir = self.get_cache_dir(file_handle_id)
+        file_lock = self._file_lock(cache_dir, shared=True) if os.path.isdir(cache_dir) else None
+        if file_lock is not None:
+            file_lock.blocking_acquire()
+        try:
+            copied = file_copy.copy_file(cached_path, path, self.copy_mode)
+        finally:
+            if file_lock is not None:
+                file_lock.release()
+
+        self.add(file_handle_id, path)
+        return copied
 
     def remove(self, file_handle_id, path=None, delete=None):
         """
@@ -234,34 +464,106 @@ class Cache:
 
         :returns: A list of files removed
         """
-        removed = []
-        cache_dir = self.get_cache_dir(file_handle_id)
-
         # if we've passed an entity and not a path, get path from entity
         if path is None and isinstance(file_handle_id, collections.abc.Mapping) and 'path' in file_handle_id:
             path = file_handle_id['path']
 
-        with Lock(self.cache_map_file_name, dir=cache_dir):
-            cache_map = self._read_cache_map(cache_dir)
-
-            if path is None:
-                for path in cache_map:
-                    if delete is True and os.path.exists(path):
-                        os.remove(path)
-                    removed.append(path)
-                cache_map = {}
-            else:
-                path = utils.normalize_path(path)
-                if path in cache_map:
-                    if delete is True and os.path.exists(path):
-                        os.remove(path)
-                    del cache_map[path]
-                    removed.append(path)
+        file_handle_id = self._file_handle_id(file_handle_id)
+        removed = self._remove_entries(file_handle_id, None if path is None else [utils.normalize_path(path)])
 
-            self._write_cache_map(cache_dir, cache_map)
+        if delete is True:
+            for removed_path in removed:
+                if os.path.exists(removed_path):
+                    os.remove(removed_path)
 
         return removed
 
+    def _normalized_root(self):
+        return utils.normalize_path(self.cache_root_dir)
+
+    def size(self):
+        """
+        :returns: the total size in bytes of the cached files in the cache root, or None if the cache index can't be
+                    used
+        """
+        return self._index.size()
+
+    def statistics(self):
+        """
+        :returns: the numbers of cache hits and misses of lookups of cached files (hits, misses), and the numbers of
+                    files and bytes evicted from the cache (evicted_files, evicted_bytes), or None if the cache index
+                    can't be used
+        """
+        return self._index.statistics()
+
+    def evict(self, max_size=None):
+        """
+        Evict the least recently used files in the cache root until their total size is at most the given size.
+
+        :param max_size: the size in bytes to reduce the cache to, by default the maximum size of the cache
+
+        :returns: the number of files evicted and the number of bytes reclaimed
+        """
+        max_size = self.max_size if max_size is None else max_size
+        if max_size is None:
+            raise ValueError("A maximum size is needed to evict files from the cache")
+
+        size = self.size()
+        return self._evict(size, max_size) if size is not None and size > max_size else (0, 0)
+
+    def _evict(self, size, target_size, keep=None):
+        root = self._normalized_root()
+        evicted_files = evicted_bytes = 0
+        skipped = 0
+        while size > target_size:
+            candidates = self._index.least_recently_used(root, EVICTION_BATCH_SIZE, offset=skipped)
+            if not candidates:
+                break
+
+            for path, file_handle_ids, file_size in candidates:
+                if size <= target_size:
+                    break
+
+                if path != keep and self._evict_file(path, file_handle_ids, file_size):
+                    size -= file_size
+                    evicted_files += 1
+                    evicted_bytes += file_size
+                else:
+                    skipped += 1
+
+        return evicted_files, evicted_bytes
+
+    def _evict_file(self, path, file_handle_ids, file_size):
+        # the file isn't evicted while it is being copied out of the cache, or while the .cacheMap of any of the file
+        # handles it is a copy of is being read or written
+        locks = []
+        for file_handle_id in file_handle_ids:
+            cache_dir = self.get_cache_dir(file_handle_id)
+            file_lock = self._file_lock(cache_dir)
+            if file_lock is not None:
+                locks.append(file_lock)
+            locks.append(self._cache_map_lock(cache_dir))
+        try:
+            for lock in locks:
+                if not lock.acquire(break_old_locks=False):
+                    return False
+
+            if os.path.exists(path):
+                os.remove(path)
+            self._index.evicted(path, file_size)
+
+            if self.write_cache_maps:
+                for file_handle_id in file_handle_ids:
+                    cache_dir = self.get_cache_dir(file_handle_id)
+                    cache_map = self._read_cache_map(cache_dir)
+                    if cache_map.pop(path, None) is not None:
+                        self._write_cache_map(cache_dir, cache_map)
+            return True
+
+        finally:
+            for lock in locks:
+                lock.release()
+
     def _cache_dirs(self):
         """
         Generate a list of all cache dirs, directories of the form:
@@ -286,14 +588,17 @@ class Cache:
             before_date = utils.to_unix_epoch_time_secs(before_date)
         count = 0
         for cache_dir in self._cache_dirs():
-            # _get_modified_time returns None if the cache map file doesn't
-            # exist and n > None evaluates to True in python 2.7(wtf?). I'm guessing it's
-            # OK to purge directories in the cache that have no .cacheMap file
-            last_modified_time = _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
+            file_handle_id = os.path.basename(cache_dir)
+            # a file handle whose cached copies are only recorded in its .cacheMap, or which has no record of
+            # cached copies at all, was last updated when its .cacheMap was, if it has one. _get_modified_time
+            # returns None if the cache map file doesn't exist, it's OK to purge those directories
+            last_modified_time = self._index.last_added(file_handle_id) or \
+                _get_modified_time(os.path.join(cache_dir, self.cache_map_file_name))
             if last_modified_time is None or before_date > last_modified_time:
                 if dry_run:
                     print(cache_dir)
                 else:
                     shutil.rmtree(cache_dir)
+                    self._index.remove(file_handle_id)
                 count += 1
         return count
@@ -0,0 +1,530 @@
+"""
+A SQLite index of the files in the local file cache, used in place of reading and rewriting a JSON .cacheMap file
+under a directory lock for every cache lookup.
+
+Each cached copy of a file handle is a row of the file handle id, the path of the copy and the modification time of
+the copy when it was cached (in the same ISO format as the .cacheMap files), along with when it was added to the
+cache and last accessed and its size, so that the least recently used files can be evicted from a cache that is
+limited in size. When the index is created the entries of any existing .cacheMap files are imported into it.
+
+The index also counts the cache hits and misses of lookups of cached files, and the files evicted from the cache,
+and keeps a running total of the size of the files cached in the cache root, which is updated in the same transaction
+as the entries, so that the size of the cache is known without summing the sizes of all its files.
+
+The access times of cached copies and the hits and misses of lookups are buffered in memory and written in batches,
+so that a lookup doesn't wait for a write transaction. They are written before the least recently used files or the
+statistics are read, and when the process exits.
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+import weakref
+
+from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME
+
+CACHE_INDEX_FILE_NAME = '.cacheIndex.sqlite'
+
+# the user_version of an index database whose schema is up to date, version 1 is the schema into which existing
+# .cacheMap files are imported, version 2 adds the sizes of the cached files and the statistics of the cache,
+# and version 3 adds the running total of the size of the cache
+SCHEMA_VERSION = 3
+
+STATISTICS = ('hits', 'misses', 'evicted_files', 'evicted_bytes')
+
+# the number of times opening the index, or a transaction on it, is attempted while its database is locked
+CONNECT_ATTEMPTS = 5
+CONNECT_RETRY_WAIT_SECONDS = 0.1
+
+# the buffered accesses of cached copies are written once there are this many, or the oldest is this old
+ACCESS_FLUSH_SIZE = 1000
+ACCESS_FLUSH_SECONDS = 30
+
+# errors other than sqlite3.DatabaseError itself that mean the database is corrupt or doesn't have the schema of
+# the index, rather than that it couldn't be used at the moment (e.g. while it is locked or the disk is full)
+UNUSABLE_DATABASE_MESSAGES = ('malformed', 'not a database', 'no such table', 'no such column', 'has no column')
+
+# the most file handle ids looked up by one query, well under SQLite's limit on the number of parameters of a query
+MAX_QUERY_FILE_HANDLE_IDS = 500
+
+# an entry of a .cacheMap file to import into the index:
+# the file handle id, the path of the cached copy, its cached modification time, and when the .cacheMap was written
+LegacyEntry = typing.Tuple[str, str, str, float]
+
+
+def _path_range(root: str) -> typing.Tuple[str, str]:
+    # the bounds of the paths of the files under a directory, so that they can be found with the index on path.
+    # paths are normalized to use forward slashes, and '0' is the character after '/'
+    root = root.rstrip('/')
+    return root + '/', root + '0'
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# the indexes that may have buffered accesses, which are written when the interpreter exits
+_unflushed_indexes = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    for index in list(_unflushed_indexes):
+        index.flush()
+
+
+def _increment(connection: sqlite3.Connection, name: str, amount: int):
+    connection.execute('UPDATE cache_statistics SET value = value + ? WHERE name = ?', (amount, name))
+
+
+def _is_locked(ex: sqlite3.Error) -> bool:
+    return isinstance(ex, sqlite3.OperationalError) and ('locked' in str(ex) or 'busy' in str(ex))
+
+
+def _is_unusable(ex: sqlite3.Error) -> bool:
+    return type(ex) is sqlite3.DatabaseError or any(message in str(ex) for message in UNUSABLE_DATABASE_MESSAGES)
+
+
+class CacheIndex:
+    """
+    A SQLite backed index of the cached copies of file handles that can be shared by threads and processes.
+    If the database can't be used (e.g. it is on a file system that doesn't support SQLite's locking, or is corrupt)
+    the index is disabled for the rest of the process, which its methods indicate by returning None. They also
+    return None if the database couldn't be used at the time, e.g. if it stayed locked by other processes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        root: str,
+        legacy_entries: typing.Callable[[], typing.Iterable[LegacyEntry]] = None,
+    ):
+        """
+        :param path:            the path of the index database
+        :param root:            the normalized path of the cache root, whose size is kept as a running total
+        :param legacy_entries:  a function returning the entries of existing .cacheMap files,
+                                which are imported when the index database is created
+        """
+        self.path = path
+        self.root = root
+        self._legacy_entries = legacy_entries
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._disabled = False
+        self._accesses_lock = threading.Lock()
+        self._reset_accesses()
+
+    def _reset_accesses(self):
+        # the last access time of each buffered (file handle id, path), and the buffered counts of hits and misses
+        self._accesses = {}
+        self._lookups = {'hits': 0, 'misses': 0}
+        self._accesses_since = None
+        self._accesses_pid = os.getpid()
+
+    def _connect(self) -> typing.Optional[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            # a connection can't be used by a process forked after it was opened
+            self._connection = None
+            self._pid = os.getpid()
+
+        attempt = 1
+        while self._connection is None and not self._disabled:
+            connection = None
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                self._create_schema(connection)
+                self._connection = connection
+            except sqlite3.OperationalError as ex:
+                if connection is not None:
+                    connection.close()
+                # changing the journal mode doesn't wait for a busy database, which it may be while other processes
+                # are opening the index for the first time
+                if 'locked' in str(ex) and attempt < CONNECT_ATTEMPTS:
+                    time.sleep(CONNECT_RETRY_WAIT_SECONDS * attempt)
+                    attempt += 1
+                else:
+                    self._disable(ex)
+            except (sqlite3.Error, OSError) as ex:
+                if connection is not None:
+                    connection.close()
+                self._disable(ex)
+        return self._connection
+
+    def _disable(self, ex: Exception):
+        self._disabled = True
+        logger.warning("The cache index %s can't be used, .cacheMap files will be used instead: %s", self.path, ex)
+
+    def _create_schema(self, connection: sqlite3.Connection):
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # only one process creates or upgrades the schema, others wait for it to finish
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            user_version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if user_version < 1:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache_entries ('
+                    ' file_handle_id TEXT NOT NULL,'
+                    ' path TEXT NOT NULL,'
+                    ' mtime TEXT NOT NULL,'
+                    ' added REAL NOT NULL,'
+                    ' last_access REAL NOT NULL,'
+                    ' PRIMARY KEY (file_handle_id, path))'
+                )
+                connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_path ON cache_entries (path)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access)'
+                )
+
+                if self._legacy_entries is not None:
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO cache_entries VALUES (?, ?, ?, ?, ?)',
+                        (
+                            (file_handle_id, path, cached_time, written, written)
+                            for file_handle_id, path, cached_time, written in self._legacy_entries()
+                        )
+                    )
+
+            if user_version < 2:
+                # the sizes of files cached before they were recorded are filled in when they are first needed
+                connection.execute('ALTER TABLE cache_entries ADD COLUMN size INTEGER')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache_statistics ('
+                    ' name TEXT NOT NULL PRIMARY KEY,'
+                    ' value INTEGER NOT NULL)'
+                )
+                connection.executemany(
+                    'INSERT OR IGNORE INTO cache_statistics VALUES (?, 0)',
+                    ((name,) for name in STATISTICS)
+                )
+
+            if user_version < 3:
+                # the total of a root is summed from its entries when it is first needed
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache_size ('
+                    ' root TEXT NOT NULL PRIMARY KEY,'
+                    ' size INTEGER NOT NULL)'
+                )
+
+            if user_version < SCHEMA_VERSION:
+                connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+    def _execute(self, statements: typing.Callable[[sqlite3.Connection], typing.Any]):
+        # the statements are run in a transaction, which is rolled back and run again while the database is locked,
+        # e.g. when a deferred transaction of this process and a transaction of another process both try to write
+        attempt = 1
+        with self._lock:
+            while True:
+                connection = self._connect()
+                if connection is None:
+                    return None
+                try:
+                    with connection:
+                        return statements(connection)
+                except sqlite3.Error as ex:
+                    if _is_locked(ex) and attempt < CONNECT_ATTEMPTS:
+                        time.sleep(CONNECT_RETRY_WAIT_SECONDS * attempt)
+                        attempt += 1
+                    elif _is_unusable(ex):
+                        self._disable(ex)
+                        self._connection = None
+                        connection.close()
+                        return None
+                    else:
+                        # the database may be usable again later, e.g. once other processes release their locks
+                        return None
+
+    def _update_size(self, connection: sqlite3.Connection, paths: typing.Iterable[str], change: typing.Callable):
+        # make a change to the entries of the given paths, updating the running total of the size of the cache root
+        # by the change in the sizes of the paths in it
+        lower, upper = _path_range(self.root)
+        paths = [path for path in set(paths) if lower < path < upper]
+        if not paths:
+            return change()
+
+        if not connection.in_transaction:
+            # the sizes are read and the total updated by one writer at a time
+            connection.execute('BEGIN IMMEDIATE')
+
+        def paths_size():
+            return sum(
+                connection.execute('SELECT COALESCE(MAX(size), 0) FROM cache_entries WHERE path = ?', (path,))
+                .fetchone()[0]
+                for path in paths
+            )
+
+        size_before = paths_size()
+        result = change()
+        connection.execute(
+            'UPDATE cache_size SET size = size + ? WHERE root = ?',
+            (paths_size() - size_before, self.root)
+        )
+        return result
+
+    def get(self, file_handle_id: str) -> typing.Optional[typing.Dict[str, str]]:
+        """
+        :param file_handle_id:  the id of a file handle
+        :returns: the paths of the cached copies of the file handle mapped to their cached modification times
+        """
+        rows = self._execute(lambda connection: connection.execute(
+            'SELECT path, mtime FROM cache_entries WHERE file_handle_id = ?',
+            (file_handle_id,)
+        ).fetchall())
+        return None if rows is None else dict(rows)
+
+    def get_many(
+        self,
+        file_handle_ids: typing.Iterable[str],
+    ) -> typing.Optional[typing.Dict[str, typing.Dict[str, str]]]:
+        """
+        :param file_handle_ids: the ids of file handles
+        :returns: the ids of the file handles mapped to the paths of their cached copies mapped to their cached
+                    modification times
+        """
+        file_handle_ids = list(dict.fromkeys(file_handle_ids))
+
+        def get_many(connection):
+            cache_maps = {file_handle_id: {} for file_handle_id in file_handle_ids}
+            for i in range(0, len(file_handle_ids), MAX_QUERY_FILE_HANDLE_IDS):
+                batch = file_handle_ids[i:i + MAX_QUERY_FILE_HANDLE_IDS]
+                for file_handle_id, path, cached_time in connection.execute(
+                    'SELECT file_handle_id, path, mtime FROM cache_entries WHERE file_handle_id IN (%s)'
+                    % ', '.join('?' * len(batch)),
+                    batch
+                ):
+                    cache_maps[file_handle_id][path] = cached_time
+            return cache_maps
+
+        return self._execute(get_many)
+
+    def put(
+        self,
+        file_handle_id: str,
+        entries: typing.Iterable[typing.Tuple[str, str, typing.Optional[int]]],
+    ) -> typing.Optional[bool]:
+        """
+        Record cached copies of a file handle, replacing any earlier entries with the same paths.
+
+        :param file_handle_id:  the id of the file handle
+        :param entries:         the paths of the cached copies, their cached modification times, and their sizes
+                                if known, otherwise they are read from the files
+        :returns: True, or None if the index is disabled
+        """
+        entries = [
+            (path, cached_time, _file_size(path) if size is None else size)
+            for path, cached_time, size in entries
+        ]
+
+        def put(connection):
+            now = time.time()
+            self._update_size(connection, (path for path, _, _ in entries), lambda: connection.executemany(
+                'INSERT OR REPLACE INTO cache_entries (file_handle_id, path, mtime, added, last_access, size)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                ((file_handle_id, path, cached_time, now, now, size) for path, cached_time, size in entries)
+            ))
+            return True
+
+        return self._execute(put)
+
+    def remove(self, file_handle_id: str, paths: typing.Iterable[str] = None) -> typing.Optional[typing.List[str]]:
+        """
+        Remove cached copies of a file handle from the index.
+
+        :param file_handle_id:  the id of the file handle
+        :param paths:           the paths of the copies to remove, or None to remove all of them
+        :returns: the paths of the copies removed
+        """
+        def remove(connection):
+            removed = [
+                path for path, in connection.execute(
+                    'SELECT path FROM cache_entries WHERE file_handle_id = ?',
+                    (file_handle_id,)
+                )
+                if paths is None or path in paths
+            ]
+            self._update_size(connection, removed, lambda: connection.executemany(
+                'DELETE FROM cache_entries WHERE file_handle_id = ? AND path = ?',
+                ((file_handle_id, path) for path in removed)
+            ))
+            return removed
+
+        if paths is not None:
+            paths = set(paths)
+        return self._execute(remove)
+
+    def accessed(self, file_handle_id: str, path: typing.Optional[str], lookup: bool = False):
+        """
+        Record that a cached copy of a file handle was used. The access is buffered until the index is flushed.
+
+        :param file_handle_id:  the id of the file handle
+        :param path:            the path of the copy used, or None if there was no copy to use
+        :param lookup:          whether the copy was looked for to use in place of a download, which is counted as a
+                                cache hit or miss
+        """
+        self.accessed_many([(file_handle_id, path)], lookup=lookup)
+
+    def accessed_many(
+        self,
+        accesses: typing.Iterable[typing.Tuple[str, typing.Optional[str]]],
+        lookup: bool = False,
+    ):
+        """
+        Record that cached copies of file handles were used, as accessed does for each of them.
+
+        :param accesses:    the ids of the file handles and the paths of the copies used, or None if there was no
+                            copy to use
+        :param lookup:      whether the copies were looked for to use in place of downloads
+        """
+        accesses = list(accesses)
+        if not accesses:
+            return
+
+        now = time.time()
+        with self._accesses_lock:
+            if self._accesses_pid != os.getpid():
+                # the accesses buffered before the process was forked are written by its parent
+                self._reset_accesses()
+
+            for file_handle_id, path in accesses:
+                if path is not None:
+                    self._accesses[(file_handle_id, path)] = now
+            if lookup:
+                hits = sum(1 for _, path in accesses if path is not None)
+                self._lookups['hits'] += hits
+                self._lookups['misses'] += len(accesses) - hits
+
+            if self._accesses_since is None:
+                self._accesses_since = now
+            flush = len(self._accesses) >= ACCESS_FLUSH_SIZE or now - self._accesses_since >= ACCESS_FLUSH_SECONDS
+
+        _unflushed_indexes.add(self)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered access times of cached copies, and counts of cache hits and misses, to the index."""
+        with self._accesses_lock:
+            if self._accesses_pid != os.getpid():
+                self._reset_accesses()
+            accesses, lookups = self._accesses, self._lookups
+            self._reset_accesses()
+
+        def flush(connection):
+            # a copy may have been added again since it was accessed, which is a later access
+            connection.executemany(
+                'UPDATE cache_entries SET last_access = MAX(last_access, ?) WHERE file_handle_id = ? AND path = ?',
+                ((access_time, file_handle_id, path) for (file_handle_id, path), access_time in accesses.items())
+            )
+            for name, count in lookups.items():
+                if count:
+                    _increment(connection, name, count)
+
+        if accesses or any(lookups.values()):
+            self._execute(flush)
+
+    def size(self) -> typing.Optional[int]:
+        """
+        :returns: the total size of the cached files in the cache root
+        """
+        def size(connection):
+            row = connection.execute('SELECT size FROM cache_size WHERE root = ?', (self.root,)).fetchone()
+            if row is not None:
+                return row[0]
+
+            # the total is summed once, by one process, after which it is updated as entries change
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT size FROM cache_size WHERE root = ?', (self.root,)).fetchone()
+            if row is not None:
+                return row[0]
+
+            # fill in the sizes of the files that were cached before sizes were recorded
+            unknown_sizes = connection.execute(
+                'SELECT DISTINCT path FROM cache_entries WHERE size IS NULL AND path > ? AND path < ?',
+                _path_range(self.root)
+            ).fetchall()
+            connection.executemany(
+                'UPDATE cache_entries SET size = ? WHERE path = ?',
+                ((_file_size(path), path) for path, in unknown_sizes)
+            )
+
+            # the same file can be a cached copy of more than one file handle
+            total = connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM'
+                ' (SELECT path, MAX(size) AS size FROM cache_entries WHERE path > ? AND path < ? GROUP BY path)',
+                _path_range(self.root)
+            ).fetchone()[0]
+            connection.execute('INSERT INTO cache_size VALUES (?, ?)', (self.root, total))
+            return total
+
+        return self._execute(size)
+
+    def least_recently_used(
+        self,
+        root: str,
+        limit: int,
+        offset: int = 0,
+    ) -> typing.Optional[typing.List[typing.Tuple[str, typing.List[str], int]]]:
+        """
+        :param root:    a directory
+        :param limit:   the most files to return
+        :param offset:  the number of least recently used files to skip
+        :returns: the cached files in the directory that were least recently used, as their paths, the ids of the
+                    file handles they are copies of, and their sizes
+        """
+        self.flush()
+        rows = self._execute(lambda connection: connection.execute(
+            'SELECT path, GROUP_CONCAT(file_handle_id), MAX(size) FROM cache_entries'
+            ' WHERE path > ? AND path < ? GROUP BY path ORDER BY MAX(last_access), path LIMIT ? OFFSET ?',
+            _path_range(root) + (limit, offset)
+        ).fetchall())
+        return None if rows is None else [
+            (path, file_handle_ids.split(','), size or 0) for path, file_handle_ids, size in rows
+        ]
+
+    def evicted(self, path: str, size: int):
+        """Remove a file evicted from the cache from the index, and count its eviction."""
+        def evicted(connection):
+            self._update_size(connection, [path], lambda: connection.execute(
+                'DELETE FROM cache_entries WHERE path = ?', (path,)
+            ))
+            _increment(connection, 'evicted_files', 1)
+            _increment(connection, 'evicted_bytes', size)
+
+        self._execute(evicted)
+
+    def statistics(self) -> typing.Optional[typing.Dict[str, int]]:
+        """:returns: the cache statistics, the counts of the cache hits, misses, and evicted files and bytes"""
+        self.flush()
+        rows = self._execute(lambda connection: connection.execute(
+            'SELECT name, value FROM cache_statistics'
+        ).fetchall())
+        return None if rows is None else dict(rows)
+
+    def last_added(self, file_handle_id: str) -> typing.Optional[float]:
+        """
+        :param file_handle_id:  the id of a file handle
+        :returns: the time a copy of the file handle was last added to the cache, or None if it has no copies
+        """
+        rows = self._execute(lambda connection: connection.execute(
+            'SELECT MAX(added) FROM cache_entries WHERE file_handle_id = ?',
+            (file_handle_id,)
+        ).fetchall())
+        return rows[0][0] if rows else None
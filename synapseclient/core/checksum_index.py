@@ -0,0 +1,246 @@
+"""
+A persistent index of the MD5 checksums of local files, so that a file that hasn't changed since it was
+last hashed (e.g. when a sync of a large directory is run again) doesn't need to be read again.
+
+Checksums are kept in a SQLite database under the cache root of each Cache, keyed by the device and inode of
+the file along with its size and modification time in nanoseconds. A checksum is only used if all four still
+match the file, and is only recorded if the file was unchanged while it was hashed and wasn't modified
+so recently that a later modification could leave its size and modification time the same.
+
+The path each checksum was recorded for is kept with it, and about once a day the checksums of files that no
+longer exist at their paths, or whose paths are now other files, are pruned so that the index doesn't keep growing
+as files are deleted or replaced.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+CHECKSUM_INDEX_FILE_NAME = '.checksums.sqlite'
+
+# hashing a file smaller than this is quicker than looking up and recording its checksum
+MIN_INDEXED_SIZE = 1 * 2 ** 20
+
+# a file modified less than this long before it is hashed could be modified again without its size
+# or modification time changing (e.g. on a file system with coarse timestamps), so it isn't recorded
+RACY_MODIFICATION_SECONDS = 2
+
+DEFAULT_BLOCK_SIZE = 2 * 2 ** 20
+
+# the user_version of an index database whose schema is up to date, version 1 is the schema of the checksums,
+# and version 2 adds the paths of the files and the time the index was last pruned
+SCHEMA_VERSION = 2
+
+PRUNE_INTERVAL_SECONDS = 24 * 60 * 60
+
+# the most rows deleted by one statement while pruning
+PRUNE_BATCH_SIZE = 500
+
+
+def _stat_key(file_stat: os.stat_result) -> typing.Tuple[int, int, int, int]:
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _hash_file(filename, block_size=DEFAULT_BLOCK_SIZE):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            md5.update(data)
+    return md5
+
+
+class ChecksumIndex:
+    """
+    A SQLite backed index of file checksums that can be shared by threads and processes.
+    If the database can't be used (e.g. it is on a file system that doesn't support SQLite's locking)
+    the index is disabled for the rest of the process and files are always hashed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._disabled = False
+        self._prune_checked = False
+
+    def _connect(self) -> typing.Optional[sqlite3.Connection]:
+        if self._connection is None and not self._disabled:
+            connection = None
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                self._create_schema(connection)
+                self._connection = connection
+            except (sqlite3.Error, OSError):
+                if connection is not None:
+                    connection.close()
+                self._disabled = True
+        return self._connection
+
+    @staticmethod
+    def _create_schema(connection: sqlite3.Connection):
+        if connection.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # only one process creates or upgrades the schema, others wait for it to finish
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            user_version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if user_version < 1:
+                # the table may already exist without a user_version, from before the schema was versioned
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS md5 ('
+                    ' device INTEGER NOT NULL,'
+                    ' inode INTEGER NOT NULL,'
+                    ' size INTEGER NOT NULL,'
+                    ' mtime_ns INTEGER NOT NULL,'
+                    ' md5 TEXT NOT NULL,'
+                    ' PRIMARY KEY (device, inode))'
+                )
+
+            if user_version < 2:
+                # checksums recorded before their paths were are pruned, since their files can't be found
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(md5)')]
+                if 'path' not in columns:
+                    connection.execute('ALTER TABLE md5 ADD COLUMN path TEXT')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS checksum_index_state ('
+                    ' name TEXT NOT NULL PRIMARY KEY,'
+                    ' value REAL NOT NULL)'
+                )
+
+            connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+    def _execute(self, sql, parameters=(), many=False) -> typing.List[tuple]:
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return []
+            try:
+                with connection:
+                    if many:
+                        connection.executemany(sql, parameters)
+                        return []
+                    return connection.execute(sql, parameters).fetchall()
+            except sqlite3.Error:
+                self._disabled = True
+                self._connection = None
+                connection.close()
+                return []
+
+    def prune(self) -> int:
+        """
+        Remove the checksums of files that no longer exist at the paths they were recorded for, or whose paths are
+        now other files.
+
+        :return: the number of checksums removed
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO checksum_index_state VALUES (?, ?)',
+            ('last_pruned', time.time()),
+        )
+
+        stale = []
+        for device, inode, path in self._execute('SELECT device, inode, path FROM md5'):
+            try:
+                file_stat = os.stat(path) if path is not None else None
+            except (OSError, ValueError):
+                file_stat = None
+            if file_stat is None or (file_stat.st_dev, file_stat.st_ino) != (device, inode):
+                stale.append((device, inode, path))
+
+        # the files are checked outside of a transaction, so a checksum recorded for another path since then is kept
+        for i in range(0, len(stale), PRUNE_BATCH_SIZE):
+            self._execute(
+                'DELETE FROM md5 WHERE device = ? AND inode = ? AND path IS ?',
+                stale[i:i + PRUNE_BATCH_SIZE],
+                many=True,
+            )
+        return len(stale)
+
+    def _prune_if_due(self):
+        # checked once by each index object, e.g. once in each process
+        if self._prune_checked:
+            return
+        self._prune_checked = True
+
+        rows = self._execute("SELECT value FROM checksum_index_state WHERE name = 'last_pruned'")
+        if not rows or time.time() - rows[0][0] > PRUNE_INTERVAL_SECONDS:
+            self.prune()
+
+    def get(self, file_stat: os.stat_result) -> typing.Optional[str]:
+        """
+        :param file_stat:   the stat of a file
+        :return: the MD5 hex digest recorded for the file, if it hasn't changed since it was recorded
+        """
+        self._prune_if_due()
+        rows = self._execute(
+            'SELECT md5 FROM md5 WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+            _stat_key(file_stat),
+        )
+        return rows[0][0] if rows else None
+
+    def put(self, file_stat: os.stat_result, md5_hex: str, path: str):
+        """
+        Record the MD5 of a file, replacing any MD5 recorded for an earlier version of the file.
+
+        :param file_stat:   the stat of the file when it was hashed
+        :param md5_hex:     the MD5 hex digest of the file
+        :param path:        the path of the file
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO md5 (device, inode, size, mtime_ns, md5, path) VALUES (?, ?, ?, ?, ?, ?)',
+            _stat_key(file_stat) + (md5_hex, os.path.abspath(path)),
+        )
+
+    def clear(self):
+        """Remove every recorded checksum."""
+        self._execute('DELETE FROM md5')
+
+    def record(self, filename, file_stat: os.stat_result, md5_hex: str):
+        """
+        Record the MD5 of a file that was hashed, unless it may have changed since its stat was taken.
+
+        :param filename:    the file that was hashed
+        :param file_stat:   the stat of the file taken before it was hashed
+        :param md5_hex:     the MD5 hex digest of the file
+        """
+        try:
+            # the file may have been modified while it was read
+            unchanged = _stat_key(os.stat(filename)) == _stat_key(file_stat)
+        except OSError:
+            unchanged = False
+
+        if unchanged and time.time_ns() - file_stat.st_mtime_ns > RACY_MODIFICATION_SECONDS * 10 ** 9:
+            self.put(file_stat, md5_hex, filename)
+
+    def md5_for_file(self, filename, block_size=DEFAULT_BLOCK_SIZE) -> str:
+        """
+        Get the MD5 of a file from the index, or hash the file and record its MD5.
+
+        :param filename:    the file to hash
+        :param block_size:  how much of the file to read at once when it is hashed
+        :return: the MD5 hex digest of the file
+        """
+        file_stat = os.stat(filename)
+        if file_stat.st_size < MIN_INDEXED_SIZE:
+            return _hash_file(filename, block_size).hexdigest()
+
+        md5_hex = self.get(file_stat)
+        if md5_hex is None:
+            md5_hex = _hash_file(filename, block_size).hexdigest()
+            self.record(filename, file_stat, md5_hex)
+
+        return md5_hex
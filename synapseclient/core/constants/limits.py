@@ -1 +1,2 @@
 MAX_FILE_HANDLE_PER_COPY_REQUEST = 100  # The maximum number of FilesHandles that can be copied in a single request
+MAX_FILE_HANDLES_PER_BATCH_REQUEST = 100  # The maximum number of files that can be requested from /fileHandle/batch
@@ -0,0 +1,184 @@
+"""
+Resolution of the presigned urls used to download Synapse file handles.
+
+Urls are requested through the /fileHandle/batch service many file handles at a time, and
+are cached in memory so that a url resolved ahead of a download (e.g. as part of a batch)
+can be used by the download rather than requiring another call to Synapse.
+"""
+
+import collections
+import datetime
+import json
+import threading
+import typing
+from urllib.parse import urlparse, parse_qs
+
+from synapseclient.core.constants.limits import MAX_FILE_HANDLES_PER_BATCH_REQUEST
+
+SIGNED_URL_DATE_FORMAT = '%Y%m%dT%H%M%SZ'
+
+# (date, expires) query parameters of the signed url schemes whose expiration we can determine
+_SIGNED_URL_EXPIRATION_PARAMS = [
+    ('X-Amz-Date', 'X-Amz-Expires'),    # AWS S3 SigV4
+    ('X-Goog-Date', 'X-Goog-Expires'),  # Google Cloud Storage V4
+]
+
+# default minimum life left on a cached url that we'll hand out, urls closer to expiring are refreshed
+DEFAULT_MIN_LIFE = datetime.timedelta(seconds=10)
+
+
+class DownloadUrlRequest(typing.NamedTuple):
+    """
+    A file handle to resolve a download url for, along with the Synapse object it is associated with.
+
+    Attributes
+    ----------
+    file_handle_id : str
+        The id of the file handle
+    object_id : str
+        The id of the object associated with the file e.g. syn123
+    object_type : str
+        The type of the object associated with the file e.g. FileEntity, TableEntity, WikiAttachment
+    """
+    file_handle_id: str
+    object_id: str
+    object_type: str = 'FileEntity'
+
+    @classmethod
+    def of(cls, requested_file) -> 'DownloadUrlRequest':
+        """
+        :param requested_file: a (file handle id, object id[, object type]) tuple or a DownloadUrlRequest
+        """
+        file_handle_id, object_id, *object_type = requested_file
+        return cls(str(file_handle_id), object_id, object_type[0] if object_type and object_type[0] else 'FileEntity')
+
+
+def url_expiration_time(url: str) -> typing.Optional[datetime.datetime]:
+    """
+    Returns the time at which a signed url will expire.
+
+    :param url: A presigned download url
+    :return: datetime in UTC of when the url will expire, or None if the url isn't signed in a way we recognize
+    """
+    parsed_query = parse_qs(urlparse(url).query)
+    for date_param, expires_param in _SIGNED_URL_EXPIRATION_PARAMS:
+        if date_param in parsed_query and expires_param in parsed_query:
+            signed_at = datetime.datetime.strptime(parsed_query[date_param][0], SIGNED_URL_DATE_FORMAT)
+            return signed_at + datetime.timedelta(seconds=int(parsed_query[expires_param][0]))
+
+    return None
+
+
+class _UrlCache(collections.OrderedDict):
+    """A self pruning dictionary of (expiration, result) tuples of resolved urls.
+    It will prune itself as new keys are added, removing the oldest if the
+    max_size is exceeded, and always removing urls that have expired."""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        # a refreshed url moves to the end, keeping the dictionary in the order the urls were resolved
+        self.move_to_end(key)
+        self._prune()
+
+    def _prune(self):
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+        # urls are (near enough) in order of expiration so we can stop at the first unexpired url
+        to_delete = []
+        utcnow = datetime.datetime.utcnow()
+        for key, (expiration, _) in self.items():
+            if expiration <= utcnow:
+                to_delete.append(key)
+            else:
+                break
+
+        for key in to_delete:
+            del self[key]
+
+
+class PresignedUrlStore:
+    """
+    Cache presigned download urls in memory, fetching any that aren't cached (or are about to expire)
+    from Synapse in batches.
+
+    Only urls with a recognizable expiration are cached, others (e.g. the urls of external file handles)
+    are resolved each time they're requested.
+    """
+
+    # a resolved url with its file handle is ~1k, limit the number we hold on to since
+    # there's no bound on how many files a long lived Synapse object may download
+    DEFAULT_URL_CACHE_SIZE = 10000
+
+    def __init__(self, max_url_cache_size=DEFAULT_URL_CACHE_SIZE):
+        self._urls = _UrlCache(max_url_cache_size)
+        self._lock = threading.Lock()
+
+    def get_urls(self, syn, requested_files: typing.Iterable, min_remaining_life: datetime.timedelta = None):
+        """
+        Get the download urls of the requested files, fetching any that aren't already cached.
+
+        :param syn:                 A Synapse object
+        :param requested_files:     An iterable of DownloadUrlRequest (or equivalent tuples)
+        :param min_remaining_life:  A cached url with less than this remaining life is fetched again
+
+        :return: a list of the /fileHandle/batch FileResult of each requested file, in the order requested
+        """
+        requests = [DownloadUrlRequest.of(f) for f in requested_files]
+        min_remaining_life = min_remaining_life if min_remaining_life is not None else DEFAULT_MIN_LIFE
+
+        results = {}
+        with self._lock:
+            fresh_after = datetime.datetime.utcnow() + min_remaining_life
+            for request in requests:
+                cached = self._urls.get(request)
+                if cached and cached[0] > fresh_after:
+                    results[request] = cached[1]
+
+        to_fetch = list(dict.fromkeys(r for r in requests if r not in results))
+        for i in range(0, len(to_fetch), MAX_FILE_HANDLES_PER_BATCH_REQUEST):
+            batch = to_fetch[i:i + MAX_FILE_HANDLES_PER_BATCH_REQUEST]
+            batch_results = self._fetch_urls(syn, batch)
+
+            with self._lock:
+                for request, result in zip(batch, batch_results):
+                    results[request] = result
+
+                    url = result.get('preSignedURL')
+                    expiration = url_expiration_time(url) if url else None
+                    if expiration:
+                        self._urls[request] = (expiration, result)
+
+        return [results[request] for request in requests]
+
+    def invalidate(self, requested_file):
+        """
+        Remove the cached url of a file, e.g. because a download using it failed.
+
+        :param requested_file: A DownloadUrlRequest (or equivalent tuple)
+        """
+        with self._lock:
+            self._urls.pop(DownloadUrlRequest.of(requested_file), None)
+
+    @staticmethod
+    def _fetch_urls(syn, requests: typing.List[DownloadUrlRequest]):
+        body = {
+            'includeFileHandles': True,
+            'includePreSignedURLs': True,
+            'requestedFiles': [
+                {
+                    'fileHandleId': request.file_handle_id,
+                    'associateObjectId': request.object_id,
+                    'associateObjectType': request.object_type,
+                }
+                for request in requests
+            ]
+        }
+        response = syn.restPOST('/fileHandle/batch', body=json.dumps(body), endpoint=syn.fileHandleEndpoint)
+
+        # results are returned in the order requested
+        return response['requestedFiles']
@@ -0,0 +1,140 @@
+"""
+Copying of cached files to the locations they are downloaded to.
+
+A plain copy of a cached file duplicates its data, which for large files on the same file system as the cache takes
+a long time and doubles the space used. Where the file system supports it a copy can instead share the data of the
+cached file:
+
+    - a reflink (FICLONE) is a copy on write clone of the cached file, which is an independent copy that is made
+      almost instantly and only uses more space as either file is changed
+    - a hardlink is another name of the cached file itself, so it is made read only, since changing it would also
+      change the cached file
+    - copy_file_range copies the data within the kernel, which some file systems (e.g. NFS) do on the server side
+
+Each copy mode tries these in turn and falls back to a plain copy when none of them can be used, e.g. when the
+download location is on a different file system than the cache.
+
+A copy is made at a temporary name next to the download location and then renamed over it, rather than written
+into any existing file there, which may be a hardlink of another cached file that writing to it would change.
+"""
+
+import os
+import shutil
+import stat
+import sys
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the default mode makes a plain copy, 'clone' makes an independent copy sharing the data of the cached file where
+# possible, and 'link' also falls back to a read only hardlink of the cached file
+COPY_MODE_COPY = 'copy'
+COPY_MODE_CLONE = 'clone'
+COPY_MODE_LINK = 'link'
+COPY_MODES = (COPY_MODE_COPY, COPY_MODE_CLONE, COPY_MODE_LINK)
+
+# the FICLONE ioctl of Linux, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# the most bytes copied by one copy_file_range call
+COPY_FILE_RANGE_CHUNK_SIZE = 2 ** 30
+
+
+def check_copy_mode(copy_mode):
+    if copy_mode not in COPY_MODES:
+        raise ValueError("Invalid copy mode {}, must be one of {}".format(copy_mode, ', '.join(COPY_MODES)))
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _reflink(src, dst):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        # e.g. the file system doesn't support reflinks, or the files are on different file systems
+        _remove_if_exists(dst)
+        return False
+    shutil.copymode(src, dst)
+    return True
+
+
+def _hardlink(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        return False
+
+    # both names are the same file, so writes to the link would change the cached file
+    mode = stat.S_IMODE(os.stat(dst).st_mode)
+    os.chmod(dst, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    return True
+
+
+def _copy_file_range(src, dst):
+    if not hasattr(os, 'copy_file_range'):
+        # added in Python 3.8
+        return False
+
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            while os.copy_file_range(src_file.fileno(), dst_file.fileno(), COPY_FILE_RANGE_CHUNK_SIZE):
+                pass
+    except OSError:
+        _remove_if_exists(dst)
+        return False
+    shutil.copymode(src, dst)
+    return True
+
+
+def _copy_to(src, dst, copy_mode):
+    # copy to a path where there is no file
+    if copy_mode != COPY_MODE_COPY:
+        if _reflink(src, dst):
+            return 'reflink'
+        if copy_mode == COPY_MODE_LINK and _hardlink(src, dst):
+            return 'hardlink'
+        if _copy_file_range(src, dst):
+            return 'copy_file_range'
+
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+def copy_file(src, dst, copy_mode=COPY_MODE_COPY):
+    """
+    Copy a file, e.g. a cached file to a download location, sharing its data where the copy mode allows it.
+
+    :param src:         the path of the file to copy
+    :param dst:         the path to copy it to, any existing file there is replaced
+    :param copy_mode:   one of COPY_MODES
+
+    :returns: the way the file was copied, 'reflink', 'hardlink', 'copy_file_range' or 'copy', or None if dst is
+                already the same file as src
+    """
+    check_copy_mode(copy_mode)
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # e.g. dst is already a hardlink of src, which a copy would fail to overwrite
+        return None
+
+    # an existing file at dst is replaced rather than written to, since it may be a hardlink of another file
+    temp_path = os.path.join(os.path.dirname(dst), '.{}.{}'.format(os.path.basename(dst), uuid.uuid4().hex))
+    try:
+        copied = _copy_to(src, temp_path, copy_mode)
+        os.replace(temp_path, dst)
+    except BaseException:
+        _remove_if_exists(temp_path)
+        raise
+    return copied
@@ -0,0 +1,175 @@
+"""
+Hashing of many local files in parallel, e.g. the files of a sync, on a pool of threads. Reading a file and
+hashing a large buffer of it both release the GIL, so the threads use every core without holding up the threads
+transferring other files. A pool of processes isn't used since starting one re-runs the __main__ module of a
+script without an ``if __name__ == '__main__'`` guard in every process, on platforms that spawn processes.
+
+A HashService returns a future of the MD5 of each file submitted to it, so that an upload can wait
+for the MD5 of its file while the files after it are still being hashed. MD5s already recorded in the
+checksum index are returned without the file being read, and the MD5s computed are recorded in it.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import threading
+import typing
+
+from synapseclient.core import checksum_index, pool_provider
+from synapseclient.core.pool_provider import SingleThreadExecutor
+
+# a multiple of the page size, read into a reused buffer, large enough that hashing it releases the GIL
+HASH_BLOCK_SIZE = 8 * 2 ** 20
+
+# files smaller than this are hashed on the submitting thread, which is quicker than queueing them for the pool
+INLINE_HASH_SIZE = checksum_index.MIN_INDEXED_SIZE
+
+
+def md5_of_file(filename, block_size: int = HASH_BLOCK_SIZE) -> str:
+    """
+    :param filename:    the file to hash
+    :param block_size:  how much of the file to read at once
+    :return: the MD5 hex digest of the file
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            md5.update(view[:count])
+
+    return md5.hexdigest()
+
+
+def _completed_future(result=None, exception=None) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class HashService:
+    """
+    Hashes files on a pool of threads that is started when the first large file is submitted.
+    Can be used as a context manager to shut down the pool when the files have been hashed.
+    """
+
+    def __init__(self, max_workers: int = None, index: checksum_index.ChecksumIndex = None):
+        """
+        :param max_workers: the number of threads hashing files, by default the number of processors
+        :param index:       the index MD5s are taken from and recorded in, by default none is used unless one is
+                            submitted with a file
+        """
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._index = index
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = pool_provider.get_executor(self._max_workers)
+            return self._executor
+
+    def submit(self, filename, index: checksum_index.ChecksumIndex = None) -> concurrent.futures.Future:
+        """
+        :param filename:    the file to hash
+        :param index:       the index the MD5 is taken from and recorded in, by default the index of the service
+        :return: a Future of the MD5 hex digest of the file
+        """
+        index = index or self._index
+        try:
+            file_stat = os.stat(filename)
+        except OSError as ex:
+            return _completed_future(exception=ex)
+
+        if file_stat.st_size < INLINE_HASH_SIZE:
+            return SingleThreadExecutor().submit(md5_of_file, filename)
+
+        if index is None:
+            return self._get_executor().submit(md5_of_file, filename)
+
+        md5_hex = index.get(file_stat)
+        if md5_hex is not None:
+            return _completed_future(md5_hex)
+
+        future = self._get_executor().submit(md5_of_file, filename)
+
+        # the returned future is only completed once the MD5 is recorded in the index,
+        # so that anything waiting on it finds the MD5 there
+        recorded_future = concurrent.futures.Future()
+
+        def record(f):
+            if recorded_future.cancelled():
+                return
+            elif f.cancelled():
+                recorded_future.cancel()
+            elif f.exception() is not None:
+                recorded_future.set_exception(f.exception())
+            else:
+                index.record(filename, file_stat, f.result())
+                recorded_future.set_result(f.result())
+
+        future.add_done_callback(record)
+        return recorded_future
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None)
+
+
+def _iter_files(paths: typing.Iterable[str]) -> typing.Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def index_files(paths: typing.Iterable[str], index: checksum_index.ChecksumIndex, max_workers: int = None) -> int:
+    """
+    Hash the files in the given paths in parallel and record their MD5s in a checksum index,
+    e.g. ahead of syncing a directory.
+
+    :param paths:       files, and directories whose files (recursively) should be hashed
+    :param index:       the index the MD5s are recorded in, e.g. the checksum_index of a Cache
+    :param max_workers: the number of threads hashing files, by default the number of processors
+    :return: the number of files hashed
+    """
+    with HashService(max_workers, index=index) as service:
+        futures = [service.submit(file_path) for file_path in _iter_files(paths)]
+        for future in futures:
+            future.result()
+
+    return len(futures)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_hash_service() -> HashService:
+    """:return: the process wide HashService, with a thread for each processor"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = HashService()
+        return _service
@@ -5,6 +5,12 @@ import sys
 import time
 import datetime
 
+try:
+    import fcntl
+except ImportError:
+    # e.g. on Windows, which only has directory locks
+    fcntl = None
+
 from synapseclient.core.exceptions import SynapseFileCacheError
 from synapseclient.core.dozer import doze
 
@@ -13,6 +19,10 @@ DEFAULT_BLOCKING_TIMEOUT = datetime.timedelta(seconds=70)
 CACHE_UNLOCK_WAIT_TIME = 0.5
 
 
+# whether FileLocks can be used on this platform
+FILE_LOCKS_SUPPORTED = fcntl is not None
+
+
 class LockedException(Exception):
     pass
 
@@ -98,3 +108,98 @@ class Lock(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.release()
+
+
+class FileLock(object):
+    """
+    Implements a lock with a kernel advisory lock (flock) of a file named [lockname].flock.
+
+    Unlike a Lock, a process waiting for a FileLock is woken by the kernel as soon as the lock is released rather
+    than polling for it, and a FileLock is released by the kernel when the process holding it exits, so a crashed
+    process can't leave behind a lock that has to be broken. A shared FileLock can be held by any number of holders
+    at once, e.g. readers, while an exclusive one is only held by one holder at a time.
+
+    FileLocks and Lock directories don't exclude each other, so a resource shared with other clients that only use
+    Lock directories, e.g. a .cacheMap file shared with the R client, must be locked with a Lock.
+    """
+    SUFFIX = 'flock'
+
+    def __init__(self, name, dir=None, shared=False, default_blocking_timeout=None):
+        """
+        :param name:                        the name of the lock
+        :param dir:                         the directory of the lock file, by default the current directory
+        :param shared:                      whether the lock is shared rather than exclusive
+        :param default_blocking_timeout:    how long a blocking acquire waits for the lock by default, None to wait
+                                            until it is released
+        """
+        if not FILE_LOCKS_SUPPORTED:
+            raise NotImplementedError("File locks are not supported on this platform")
+
+        self.name = name
+        self.held = False
+        self.dir = dir if dir else os.getcwd()
+        self.lock_file_path = os.path.join(self.dir, ".".join([name, FileLock.SUFFIX]))
+        self.shared = shared
+        self.default_blocking_timeout = default_blocking_timeout
+        self._fd = None
+
+    def _lock(self, blocking):
+        os.makedirs(self.dir, exist_ok=True)
+        fd = os.open(self.lock_file_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+        self.held = True
+        return True
+
+    def acquire(self, break_old_locks=True):
+        """
+        Try to acquire lock. Return True on success or False otherwise.
+        Locks are released by the kernel rather than broken, so break_old_locks is ignored.
+        """
+        if self.held:
+            return True
+        return self._lock(blocking=False)
+
+    def blocking_acquire(self, timeout=None, break_old_locks=True):
+        if self.held:
+            return True
+        if timeout is None:
+            timeout = self.default_blocking_timeout
+        if timeout is None:
+            # the kernel wakes us when the lock is released
+            return self._lock(blocking=True)
+
+        # flock has no timeout, so a timed wait retries the lock until the timeout
+        tryLockStartTime = time.time()
+        while not self._lock(blocking=False):
+            if time.time() - tryLockStartTime >= timeout.total_seconds():
+                raise SynapseFileCacheError(
+                    "Could not obtain a lock on the file cache within timeout: %s  "
+                    "Please try again later" % str(timeout)
+                )
+            doze(min(CACHE_UNLOCK_WAIT_TIME, timeout.total_seconds() / 10))
+        return True
+
+    def release(self):
+        """Release lock or do nothing if lock is not held"""
+        if self.held:
+            # closing the file releases its lock. the lock file isn't deleted, since another process may have opened
+            # it to wait for the lock, and would then hold a lock on a file that a third process can't open
+            os.close(self._fd)
+            self._fd = None
+            self.held = False
+
+    # Make the lock object a Context Manager
+    def __enter__(self):
+        self.blocking_acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
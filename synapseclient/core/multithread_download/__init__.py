@@ -1,8 +1,17 @@
 from .download_threads import (
     DownloadRequest,
+    discard_partial_download,
     download_file,
+    probe_range_support,
     shared_executor,
     SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE,
 )
 
-__all__ = ['DownloadRequest', 'download_file', 'shared_executor', 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE']
+__all__ = [
+    'DownloadRequest',
+    'discard_partial_download',
+    'download_file',
+    'probe_range_support',
+    'shared_executor',
+    'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE',
+]
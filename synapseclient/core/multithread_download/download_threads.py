@@ -6,17 +6,20 @@ import datetime
 
 import concurrent.futures
 from contextlib import contextmanager
+import hashlib
 from http import HTTPStatus
 import os
 from requests import Session, Response
+from requests.exceptions import RequestException
 from requests.adapters import HTTPAdapter
-from typing import Generator, NamedTuple
-from urllib.parse import urlparse, parse_qs
+from typing import Callable, Generator, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
 from urllib3.util.retry import Retry
 import time
 
+from synapseclient.core.download_urls import url_expiration_time
 from synapseclient.core.exceptions import SynapseError
-from synapseclient.core.pool_provider import get_executor
+from synapseclient.core.transfer_scheduler import get_transfer_job
 from synapseclient.core.cumulative_transfer_progress import printTransferProgress
 
 # constants
@@ -24,6 +27,16 @@ MAX_QUEUE_SIZE: int = 20
 MAX_RETRIES: int = 20
 MiB: int = 2 ** 20
 SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE: int = 8 * MiB
+MAX_DOWNLOAD_PART_SIZE: int = 64 * MiB
+PART_WRITE_BUFFER_SIZE: int = 1 * MiB
+# parts that download faster than this spend a significant share of their time on request latency
+TARGET_PART_SECONDS: float = 4.0
+# when hedging, a part is hedged once it has taken longer than this percentile of completed parts (scaled by size)
+HEDGE_LATENCY_PERCENTILE: float = 0.95
+# the number of completed parts needed before the latency percentile is considered meaningful
+HEDGE_MIN_SAMPLES: int = 5
+# how often in flight parts are checked for stragglers
+HEDGE_CHECK_SECONDS: float = 0.5
 ISO_AWS_STR_FORMAT: str = '%Y%m%dT%H%M%SZ'
 CONNECT_FACTOR: int = 3
 BACK_OFF_FACTOR: float = 0.5
@@ -60,11 +73,15 @@ class DownloadRequest(NamedTuple):
     path : str
         The local path to download the file to.
         This path can be either absolute path or relative path from where the code is executed to the download location.
+    file_size : int
+        The size of the file in bytes if already known (e.g. the contentSize of its file handle),
+        otherwise it is determined from the presigned url before downloading.
     """
     file_handle_id: int
     object_id: str
     object_type: str
     path: str
+    file_size: int = None
 
 
 class TransferStatus(object):
@@ -133,6 +150,19 @@ class PresignedUrlProvider(object):
 
             return self._cached_info
 
+    def refresh_info(self) -> PresignedUrlInfo:
+        """
+        Get a new pre-signed url regardless of the expiration of the current one,
+        e.g. because the current url was rejected before it was expected to expire.
+        """
+        with self._lock:
+            # noinspection PyProtectedMember
+            self.client._download_url_store.invalidate(
+                (self.request.file_handle_id, self.request.object_id, self.request.object_type)
+            )
+            self._cached_info = self._get_pre_signed_info()
+            return self._cached_info
+
     def _get_pre_signed_info(self) -> PresignedUrlInfo:
         """
         Returns the file_name and pre-signed url for download as specified in request
@@ -150,33 +180,524 @@ class PresignedUrlProvider(object):
         return PresignedUrlInfo(file_name, pre_signed_url, _pre_signed_url_expiration_time(pre_signed_url))
 
 
+class _PartJournal:
+    """
+    A sidecar file kept next to a partially downloaded file that records the byte ranges of the file
+    that have been completely written. If a download is interrupted the journal allows a later attempt,
+    whether in this process or another, to request only the ranges that are still missing.
+
+    The journal is a header line recording the expected size of the file followed by one
+    "start end" line (inclusive) per completed range.
+    """
+
+    SUFFIX = '.parts'
+    _HEADER_PREFIX = 'synapse-download-parts'
+
+    def __init__(self, path: str, file_size: int):
+        """
+        :param path:        The path of the file being downloaded
+        :param file_size:   The expected size of the downloaded file
+        """
+        self.path = path + _PartJournal.SUFFIX
+        self._file_path = path
+        self._file_size = file_size
+        self._journal_file = None
+
+    def _header(self) -> str:
+        return f"{_PartJournal._HEADER_PREFIX} {self._file_size}\n"
+
+    def load(self) -> List[Tuple[int, int]]:
+        """
+        Read the completed ranges recorded by a previous download attempt. The ranges are only trusted if
+        the journal was recorded for a file of the same size and the partially downloaded file is still
+        present at its full allocated size, otherwise no ranges are returned.
+
+        :return: a sorted list of inclusive (start, end) ranges that have already been downloaded
+        """
+        try:
+            if os.path.getsize(self._file_path) != self._file_size:
+                return []
+
+            with open(self.path, 'r') as journal_file:
+                if journal_file.readline() != self._header():
+                    return []
+
+                ranges = []
+                for line in journal_file:
+                    # the last line may be incomplete if the process was killed while it was written
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        start, end = (int(x) for x in line.split())
+                    except ValueError:
+                        return []
+                    if not 0 <= start <= end < self._file_size:
+                        return []
+                    ranges.append((start, end))
+
+        except FileNotFoundError:
+            return []
+
+        return _merge_ranges(ranges)
+
+    def open(self, resume: bool):
+        """
+        Open the journal for recording completed ranges.
+
+        :param resume:  True to append to the ranges already recorded, False to start a new journal
+        """
+        if resume:
+            self._journal_file = open(self.path, 'a')
+        else:
+            self._journal_file = open(self.path, 'w')
+            self._journal_file.write(self._header())
+            self._journal_file.flush()
+
+    def record(self, start: int, end: int):
+        """
+        Record that the inclusive byte range has been completely written to the file.
+        """
+        self._journal_file.write(f"{start} {end}\n")
+        self._journal_file.flush()
+
+    def close(self):
+        if self._journal_file:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def delete(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _InOrderMd5:
+    """
+    Computes the MD5 of a file whose parts are written out of order, so that the checksum is ready as soon
+    as the last part is written rather than requiring the whole file to be read again afterwards.
+
+    As each part completes the contiguous prefix of completed parts is extended and any newly contiguous
+    parts are read back and hashed. Since parts are scheduled in order only a few of them are ever waiting
+    on an earlier part, and those are read back while they are still likely to be in the page cache.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the file being downloaded
+        """
+        self._path = path
+        self._md5 = hashlib.md5()
+        self._hashed_offset = 0
+        self._pending_ranges = {}
+        self._file = None
+
+    def add(self, start: int, end: int):
+        """
+        Add an inclusive byte range that has been completely written to the file.
+        """
+        self._pending_ranges[start] = end
+        while self._hashed_offset in self._pending_ranges:
+            range_end = self._pending_ranges.pop(self._hashed_offset)
+            self._hash_through(range_end)
+
+    def _hash_through(self, end: int):
+        if self._file is None:
+            self._file = open(self._path, 'rb')
+
+        buffer = _get_thread_buffer()
+        self._file.seek(self._hashed_offset)
+        while self._hashed_offset <= end:
+            read_count = self._file.readinto(buffer[:end - self._hashed_offset + 1])
+            if not read_count:
+                raise ValueError(f"{self._path} ended at {self._hashed_offset} before the range ending at {end}")
+            self._md5.update(buffer[:read_count])
+            self._hashed_offset += read_count
+
+    def hexdigest(self, file_size: int) -> str:
+        """
+        :param file_size: The size of the file
+        :return: The MD5 of the file as a hex string
+        """
+        if self._hashed_offset != file_size:
+            raise ValueError(f"Only {self._hashed_offset} of {file_size} bytes of {self._path} have been hashed")
+        return self._md5.hexdigest()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def discard_partial_download(path: str):
+    """
+    Removes a partially completed multithreaded download of path and its part journal, if one exists.
+    A multithreaded partial download is not a contiguous prefix of the file, so it must not be resumed
+    by a download that appends to whatever bytes are already present.
+
+    :param path: The path of the (temporary) file being downloaded
+    """
+    try:
+        os.remove(path + _PartJournal.SUFFIX)
+    except FileNotFoundError:
+        # no journal, so this is not a multithreaded partial download
+        return
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Merge overlapping or adjacent inclusive byte ranges.
+
+    :param ranges: An iterable of inclusive (start, end) byte ranges
+    :return: A sorted list of non overlapping inclusive ranges covering the same bytes
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class _HedgingCounters:
+    """
+    Process wide counts of how often straggling parts were hedged with a duplicate request,
+    and how often the duplicate request finished first.
+    """
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self.parts = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def add(self, parts: int, hedged: int, hedges_won: int):
+        with self._lock:
+            self.parts += parts
+            self.hedged += hedged
+            self.hedges_won += hedges_won
+
+
+hedging_counters = _HedgingCounters()
+
+
+class _PartAttempt:
+    """
+    The state of one request for a part, shared between the thread downloading the part and the entrant thread.
+    """
+
+    def __init__(self, start: int, end: int, hedge: bool = False):
+        self.start = start
+        self.end = end
+        self.hedge = hedge
+        self.started_at = None
+        self.elapsed = None
+        # set by the entrant thread when another attempt at the same part finished first
+        self.stopped = _threading.Event()
+
+
+class _StragglerHedger:
+    """
+    Tracks the in flight part downloads of a file and issues a duplicate request, on a new connection, for any
+    part that has been downloading longer than a percentile of the time taken by the parts completed so far
+    (scaled by part size). Whichever request for a part finishes first is kept and the other is stopped.
+
+    Since an abandoned request may still be writing when the download finishes, each request is given its
+    own duplicate of the file descriptor, closed once the request is done.
+    """
+
+    def __init__(self, executor, download_fn, url_provider, fd, controller,
+                 percentile: float = None, min_samples: int = None):
+        self._executor = executor
+        self._download_fn = download_fn
+        self._url_provider = url_provider
+        self._fd = fd
+        self._controller = controller
+        self._percentile = percentile or HEDGE_LATENCY_PERCENTILE
+        self._min_samples = min_samples or HEDGE_MIN_SAMPLES
+
+        self._attempts = {}
+        self._part_futures = {}
+        self._seconds_per_byte = []
+
+        self.parts = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def submit(self, start: int, end: int, hedge: bool = False) -> concurrent.futures.Future:
+        attempt = _PartAttempt(start, end, hedge=hedge)
+        attempt_fd = os.dup(self._fd)
+        try:
+            future = self._executor.submit(
+                self._download_fn,
+                self._url_provider,
+                attempt_fd,
+                start,
+                end,
+                self._controller,
+                attempt,
+            )
+        except BaseException:
+            os.close(attempt_fd)
+            raise
+
+        # closes the descriptor after the attempt finishes or if it is cancelled before it runs
+        future.add_done_callback(lambda f: os.close(attempt_fd))
+
+        self._attempts[future] = attempt
+        self._part_futures.setdefault(start, set()).add(future)
+        if not hedge:
+            self.parts += 1
+        return future
+
+    def wait(self, pending_futures):
+        """
+        Wait for in flight part downloads to complete, hedging any stragglers.
+
+        :return: a tuple of the futures that completed a part, and the futures still pending, like
+                 concurrent.futures.wait
+        """
+        completed_futures, pending_futures = concurrent.futures.wait(
+            pending_futures,
+            timeout=HEDGE_CHECK_SECONDS,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+
+        part_completed_futures = set()
+        for future in completed_futures:
+            attempt = self._attempts.pop(future, None)
+            if attempt is None:
+                # another attempt at the same part completed in the same batch
+                continue
+
+            siblings = self._part_futures[attempt.start]
+            siblings.discard(future)
+            if future.exception() and siblings:
+                # another attempt at this part is still running and may yet succeed
+                continue
+
+            del self._part_futures[attempt.start]
+            for sibling in siblings:
+                self._attempts.pop(sibling).stopped.set()
+                sibling.cancel()
+                pending_futures.discard(sibling)
+
+            if not future.exception():
+                if attempt.hedge:
+                    self.hedges_won += 1
+                self._seconds_per_byte.append(attempt.elapsed / (attempt.end - attempt.start + 1))
+
+            part_completed_futures.add(future)
+
+        pending_futures.update(self._hedge_stragglers())
+        return part_completed_futures, pending_futures
+
+    def _latency_threshold(self):
+        if len(self._seconds_per_byte) < self._min_samples:
+            return None
+        samples = sorted(self._seconds_per_byte)
+        return samples[min(int(self._percentile * len(samples)), len(samples) - 1)]
+
+    def _hedge_stragglers(self):
+        seconds_per_byte = self._latency_threshold()
+        if seconds_per_byte is None:
+            return set()
+
+        now = time.time()
+        hedge_futures = set()
+        for start, futures in list(self._part_futures.items()):
+            if len(futures) > 1:
+                # already hedged
+                continue
+
+            attempt = self._attempts[next(iter(futures))]
+            if attempt.started_at is not None and \
+                    now - attempt.started_at > seconds_per_byte * (attempt.end - attempt.start + 1):
+                hedge_futures.add(self.submit(attempt.start, attempt.end, hedge=True))
+                self.hedged += 1
+
+        return hedge_futures
+
+    def stop(self):
+        """
+        Stop any attempts that are still running, each stops after writing the data it has already read.
+        """
+        for attempt in self._attempts.values():
+            attempt.stopped.set()
+
+    def close(self, logger=None):
+        self.stop()
+        hedging_counters.add(self.parts, self.hedged, self.hedges_won)
+        if logger and self.hedged:
+            logger.debug(f"Hedged {self.hedged} of {self.parts} parts,"
+                         f" the hedge finished first {self.hedges_won} times")
+
+
 def _generate_chunk_ranges(file_size: int,
+                           completed_ranges: Iterable[Tuple[int, int]] = (),
+                           part_size_provider: Callable[[], int] = None,
                            ) -> Generator:
     """
     Creates a generator which yields byte ranges and meta data required to make a range request download of url and
     write the data to file_name located at path. Download chunk sizes are 8MB by default.
 
-    :param file_size: The size of the file
+    :param file_size:           The size of the file
+    :param completed_ranges:    Sorted, non overlapping inclusive byte ranges that are already downloaded and
+                                should be skipped
+    :param part_size_provider:  Optional callable consulted for the size of each range as it is generated,
+                                allowing the part size to change over the course of the download
     :return: A generator of byte ranges and meta data needed to download the file in a multi-threaded manner
     """
-    for start in range(0, file_size, SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE):
-        # the start and end of a range in HTTP are both inclusive
-        end = min(start + SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE, file_size) - 1
-        yield start, end
+    gap_start = 0
+    for completed_start, completed_end in list(completed_ranges) + [(file_size, file_size)]:
+        start = gap_start
+        while start < completed_start:
+            part_size = part_size_provider() if part_size_provider else SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE
+            # the start and end of a range in HTTP are both inclusive
+            end = min(start + part_size, completed_start) - 1
+            yield start, end
+            start = end + 1
+        gap_start = completed_end + 1
+
+
+class _AdaptiveTransferController:
+    """
+    Chooses the number of parts to download concurrently and the size of each part based on the observed
+    throughput and error rate of the download, using an additive increase / multiplicative decrease policy.
+
+    Parts are evaluated in windows of as many parts as are downloading concurrently. After each window:
+
+    * if any requests in the window failed or were refused (e.g. a 503 Slow Down) the concurrency and the
+      part size are halved.
+    * otherwise the concurrency is increased by one if the throughput of the window was no worse than the
+      previous window, or decreased by one if the last increase made the throughput worse.
+    * otherwise the part size is doubled if parts are completing so quickly that the latency of each request
+      is a significant fraction of its time, as on high bandwidth delay product links.
+
+    Access is thread safe, parts report their outcomes from the threads that download them.
+    """
+
+    # a window whose throughput is within this fraction of the previous window is not considered worse
+    _THROUGHPUT_TOLERANCE = 0.9
+
+    def __init__(self,
+                 max_concurrency: int,
+                 *,
+                 part_size: int = None,
+                 min_part_size: int = None,
+                 max_part_size: int = None,
+                 logger=None):
+        """
+        :param max_concurrency:     The maximum number of parts to download concurrently, this is also the
+                                    initial concurrency
+        :param part_size:           The initial part size, defaults to SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE
+        :param min_part_size:       The smallest part size to shrink to, defaults to the initial part size
+        :param max_part_size:       The largest part size to grow to, defaults to MAX_DOWNLOAD_PART_SIZE
+        :param logger:              Optional logger to which changes to the chosen parameters are logged at debug
+        """
+        self._lock = _threading.Lock()
+        self._max_concurrency = max(max_concurrency, 1)
+        self._concurrency = self._max_concurrency
+        self._part_size = part_size or SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE
+        self._min_part_size = min_part_size or self._part_size
+        self._max_part_size = max(max_part_size or MAX_DOWNLOAD_PART_SIZE, self._part_size)
+        self._logger = logger
+
+        self._previous_throughput = None
+        self._increased = False
+        self._start_window()
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    @property
+    def part_size(self) -> int:
+        return self._part_size
+
+    def _start_window(self):
+        self._window_start = time.time()
+        self._window_parts = 0
+        self._window_bytes = 0
+        self._window_part_seconds = 0.0
+        self._window_errors = 0
+
+    def part_completed(self, byte_count: int, elapsed: float):
+        """
+        Record that a part was downloaded successfully.
+
+        :param byte_count:  The size of the part
+        :param elapsed:     The number of seconds it took to download the part
+        """
+        with self._lock:
+            self._window_parts += 1
+            self._window_bytes += byte_count
+            self._window_part_seconds += elapsed
+            if self._window_parts >= self._concurrency:
+                self._adjust()
+
+    def part_failed(self):
+        """
+        Record that a request for a part failed or was refused and had to be retried.
+        """
+        with self._lock:
+            self._window_errors += 1
+
+    def _adjust(self):
+        window_seconds = max(time.time() - self._window_start, 1e-6)
+        throughput = self._window_bytes / window_seconds
+        mean_part_seconds = self._window_part_seconds / self._window_parts
+
+        concurrency = self._concurrency
+        part_size = self._part_size
+        if self._window_errors:
+            concurrency = max(concurrency // 2, 1)
+            part_size = max(part_size // 2, self._min_part_size)
+            self._increased = False
+
+        elif self._previous_throughput is None or \
+                throughput >= self._previous_throughput * self._THROUGHPUT_TOLERANCE:
+            self._increased = concurrency < self._max_concurrency
+            concurrency = min(concurrency + 1, self._max_concurrency)
+            if mean_part_seconds < TARGET_PART_SECONDS / 2:
+                part_size = min(part_size * 2, self._max_part_size)
+
+        elif self._increased:
+            # adding the last connection made things worse
+            concurrency = max(concurrency - 1, 1)
+            self._increased = False
+
+        if self._logger and (concurrency, part_size) != (self._concurrency, self._part_size):
+            self._logger.debug(
+                f"Download throughput {throughput / MiB:.1f} MiB/s with {self._window_errors} errors over"
+                f" {self._window_parts} parts, concurrent parts {self._concurrency} -> {concurrency},"
+                f" part size {self._part_size // MiB} -> {part_size // MiB} MiB"
+            )
+
+        self._concurrency = concurrency
+        self._part_size = part_size
+        # after backing off for errors the next window starts a new baseline rather
+        # than being compared to the throughput achieved with more connections
+        self._previous_throughput = None if self._window_errors else throughput
+        self._start_window()
 
 
 def _pre_signed_url_expiration_time(url: str) -> datetime:
     """
     Returns time at which a presigned url will expire
 
-    :param url: A pre-signed download url from AWS
-    :return: datetime in UTC of when the url will expire
+    :param url: A pre-signed download url
+    :return: datetime in UTC of when the url will expire, urls that aren't signed in a way we recognize
+             (e.g. the urls of external file handles) are treated as never expiring
     """
-    parsed_query: dict = parse_qs(urlparse(url).query)
-    time_made: str = parsed_query['X-Amz-Date'][0]
-    time_made_datetime: datetime.datetime = datetime.datetime.strptime(time_made, ISO_AWS_STR_FORMAT)
-    expires: str = parsed_query['X-Amz-Expires'][0]
-    return time_made_datetime + datetime.timedelta(seconds=int(expires))
+    return url_expiration_time(url) or datetime.datetime.max
 
 
 def _get_new_session() -> Session:
@@ -192,15 +713,75 @@ def _get_new_session() -> Session:
     return session
 
 
-def _get_file_size(url: str) -> int:
+def _get_file_size(url: str, session: Session = None) -> int:
     """
-    Gets the size of the file located at url
-    :param url: The pre-signed url of the file
+    Gets the size of the file located at url by requesting only its first byte.
+    A HEAD request can't be used since a presigned url is only signed for GET.
+
+    :param url:     The pre-signed url of the file
+    :param session: The requests.Session to make the request with, by default the calling thread's session
     :return: The size of the file in bytes
     """
-    session = _get_new_session()
-    res_get = session.get(url, stream=True)
-    return int(res_get.headers['Content-Length'])
+    session = session or _get_thread_session()
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as response:
+        if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+            # e.g. "bytes 0-0/12345", reading the single byte body releases the connection back to the pool
+            response.content
+            return int(response.headers['Content-Range'].rsplit('/', 1)[1])
+
+        # the range was ignored, the response is the entire file so we only look at its length
+        return int(response.headers['Content-Length'])
+
+
+# whether the hosts probed by probe_range_support honor byte range requests, keyed by scheme and host
+_range_support_by_host = {}
+_range_support_lock = _threading.Lock()
+
+
+def probe_range_support(url: str, file_size: int = None, session: Session = None) -> Optional[int]:
+    """
+    Determine whether the file at a url can be downloaded in byte ranges (i.e. using download_file).
+    The first url from a host is probed with a single byte range request and the result is remembered
+    for the host, later urls from the same host are only requested if their size isn't already known.
+
+    :param url:         The url of the file
+    :param file_size:   The size of the file if it is already known
+    :param session:     The requests.Session to make the request with, by default the calling thread's session
+
+    :return: the size of the file if its server supports range requests, otherwise None
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme not in ('http', 'https'):
+        return None
+
+    host = (parsed_url.scheme, parsed_url.netloc)
+    with _range_support_lock:
+        supported = _range_support_by_host.get(host)
+    if supported is False or (supported and file_size is not None):
+        return file_size if supported else None
+
+    session = session or _get_thread_session()
+    try:
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as response:
+            if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+                # e.g. "bytes 0-0/12345", an unknown total size ("bytes 0-0/*") can't be split into ranges
+                total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                supported = total.isdigit()
+                if supported:
+                    response.content
+                    file_size = int(total)
+            elif response.status_code == HTTPStatus.OK:
+                # the range was ignored, closing the response abandons the rest of the body
+                supported = False
+            else:
+                # e.g. an expired url tells us nothing about the host
+                return None
+    except RequestException:
+        return None
+
+    with _range_support_lock:
+        _range_support_by_host[host] = supported
+    return file_size if supported else None
 
 
 def download_file(
@@ -216,20 +797,23 @@ def download_file(
     :param client: A synapseclient
     :param download_request: A batch of DownloadRequest objects specifying what Synapse files to download
     :param max_concurrent_parts: The maximum concurrent number parts to download at once when downloading this file
+
+    :return: The MD5 of the downloaded file as a hex string
     """
 
     # we obtain an executor from a thread local if we are in the context of a Synapse sync
-    # and wan't to re-use the same threadpool as was created for that
+    # and wan't to share the transfer job of that sync, otherwise the download is its own job
+    # on the process wide transfer scheduler
     executor = getattr(_thread_local, 'executor', None)
     shutdown_after = False
     if not executor:
         shutdown_after = True
-        executor = get_executor(client.max_threads)
+        executor = get_transfer_job(client.max_threads).executor
 
     max_concurrent_parts = max_concurrent_parts or client.max_threads
     try:
-        downloader = _MultithreadedDownloader(client, executor, max_concurrent_parts)
-        downloader.download_file(download_request)
+        downloader = _MultithreadedDownloader(client, executor, max_concurrent_parts, hedge=client.hedge_downloads)
+        return downloader.download_file(download_request)
     finally:
         # if we created the Executor for the purposes of processing this download we also
         # shut it down. if it was passed in from the outside then it's managed by the caller
@@ -237,6 +821,42 @@ def download_file(
             executor.shutdown()
 
 
+def _get_thread_buffer() -> memoryview:
+    # get a lazily initialized buffer that a thread reuses for every part it streams to disk.
+    # reading each response into a fixed buffer rather than materializing whole parts keeps
+    # memory use bounded by the number of threads rather than the number of in flight parts.
+    buffer = getattr(_thread_local, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_local.buffer = memoryview(bytearray(PART_WRITE_BUFFER_SIZE))
+    return buffer
+
+
+_seek_write_lock = _threading.Lock()
+
+
+def _write_at(fd: int, data: memoryview, offset: int):
+    """
+    Write all of data to the file descriptor at the given offset without disturbing any other
+    concurrent writers to the same descriptor.
+
+    :param fd:      An open file descriptor
+    :param data:    The bytes to write
+    :param offset:  The offset in the file at which to write the bytes
+    """
+    while data:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, offset)
+        else:
+            # platforms without pwrite (i.e. Windows) share the file position
+            # so the seek and write must happen atomically
+            with _seek_write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, data)
+
+        data = data[written:]
+        offset += written
+
+
 def _get_thread_session():
     # get a lazily initialized requests.Session from the thread.
     # we want to share a requests.Session over the course of a thread
@@ -256,7 +876,7 @@ class _MultithreadedDownloader:
     that supports range headers.
     """
 
-    def __init__(self, syn, executor, max_concurrent_parts):
+    def __init__(self, syn, executor, max_concurrent_parts, *, hedge=False):
         """
         :param syn:                     A synapseclient
         :param executor:                An ExecutorService that will be used to run part downloads in separate threads
@@ -264,71 +884,132 @@ class _MultithreadedDownloader:
                                         downloaded at once. If there are more parts than can be run concurrently
                                         they will be scheduled in the executor when previously running part downloads
                                         complete.
+        :param hedge:                   True to issue a duplicate request for any part that is taking much longer
+                                        than the others, keeping whichever finishes first
         """
         self._syn = syn
         self._executor = executor
         self._max_concurrent_parts = max_concurrent_parts
+        self._hedge = hedge
 
     def download_file(self, request):
         url_provider = PresignedUrlProvider(self._syn, request)
 
         url_info = url_provider.get_info()
-        file_size = _get_file_size(url_info.url)
-        chunk_range_generator = _generate_chunk_ranges(file_size)
+        file_size = request.file_size
+        if file_size is None:
+            file_size = _get_file_size(url_info.url)
+
+        # if a previous attempt to download this file was interrupted we resume it,
+        # only downloading the parts that it did not complete
+        journal = _PartJournal(request.path, file_size)
+        completed_ranges = journal.load()
+        if not completed_ranges:
+            self._prep_file(request, file_size)
+        journal.open(resume=bool(completed_ranges))
+
+        controller = _AdaptiveTransferController(self._max_concurrent_parts, logger=self._syn.logger)
+        chunk_range_generator = _generate_chunk_ranges(
+            file_size,
+            completed_ranges,
+            part_size_provider=lambda: controller.part_size,
+        )
 
-        self._prep_file(request)
+        # the MD5 is computed as the download progresses, beginning with any parts that were previously completed
+        md5 = _InOrderMd5(request.path)
 
         transfer_status = TransferStatus(file_size)
+        transfer_status.transferred = previously_transferred = sum(
+            end - start + 1 for start, end in completed_ranges
+        )
 
+        # the worker threads stream their parts directly to their offsets in the file,
         # the entrant thread runs in a loop doing the following:
         # 1. scheduling any additional part downloads as previous parts are completed
-        # 2. writing any completed parts out to the local disk
+        # 2. recording and reporting the progress of any completed parts
         # 3. waiting for additional parts to complete
         pending_futures = set()
         completed_futures = set()
+        fd = None
+        hedger = None
         try:
+            for start, end in completed_ranges:
+                md5.add(start, end)
+
+            fd = os.open(request.path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            if self._hedge:
+                hedger = _StragglerHedger(self._executor, self._download_part, url_provider, fd, controller)
+
             while True:
                 submitted_futures = self._submit_chunks(
                     url_provider,
+                    fd,
+                    controller,
                     chunk_range_generator,
                     pending_futures,
+                    hedger=hedger,
                 )
 
-                self._write_chunks(request, completed_futures, transfer_status)
+                self._update_progress(request, journal, md5, completed_futures, transfer_status)
 
                 # once there is nothing else pending we are done with the file download
                 pending_futures = pending_futures.union(submitted_futures)
                 if not pending_futures:
                     break
 
-                completed_futures, pending_futures = concurrent.futures.wait(
-                    pending_futures,
-                    return_when=concurrent.futures.FIRST_COMPLETED
-                )
+                if hedger:
+                    completed_futures, pending_futures = hedger.wait(pending_futures)
+                else:
+                    completed_futures, pending_futures = concurrent.futures.wait(
+                        pending_futures,
+                        return_when=concurrent.futures.FIRST_COMPLETED
+                    )
 
                 self._check_for_errors(request, completed_futures)
 
-        except BaseException:
+        except BaseException as ex:
             # on any exception (e.g. KeyboardInterrupt), attempt to cancel any pending futures.
             # if they are already running this won't have any effect though
             for future in pending_futures:
                 future.cancel()
 
-            try:
-                os.remove(request.path)
-            except FileNotFoundError:
-                pass
+            # parts that are already running still hold the file descriptor,
+            # wait for them to finish before closing it out from under them
+            concurrent.futures.wait(pending_futures)
 
+            # the partially downloaded file is kept along with its journal of the parts
+            # that did complete so that a subsequent attempt can resume the download
+            self._record_completed_parts(journal, completed_futures.union(pending_futures), transfer_status)
+            ex.progress = transfer_status.transferred - previously_transferred
             raise
 
+        else:
+            journal.delete()
+            self._syn.logger.debug(
+                f"Downloaded {request.path} finishing with {controller.concurrency} concurrent parts"
+                f" of {controller.part_size // MiB} MiB"
+            )
+            return md5.hexdigest(file_size)
+
+        finally:
+            if hedger:
+                hedger.close(self._syn.logger)
+            if fd is not None:
+                os.close(fd)
+            journal.close()
+            md5.close()
+
     @staticmethod
-    def _get_response_with_retry(presigned_url_provider, start: int, end: int) -> Response:
-        session = _get_thread_session()
+    def _get_response_with_retry(presigned_url_provider, start: int, end: int, controller=None,
+                                 session=None) -> Response:
+        session = session or _get_thread_session()
         range_header = {'Range': f'bytes={start}-{end}'}
         response = session.get(presigned_url_provider.get_info().url, headers=range_header, stream=True)
         # try request until successful or out of retries
         try_counter = 1
         while response.status_code != HTTPStatus.PARTIAL_CONTENT:
+            if controller:
+                controller.part_failed()
             if try_counter >= MAX_RETRIES:
                 raise SynapseError(
                     f'Could not download the file: {presigned_url_provider.get_info().file_name},'
@@ -337,25 +1018,91 @@ class _MultithreadedDownloader:
             try_counter += 1
         return start, response
 
+    @classmethod
+    def _download_part(cls, presigned_url_provider, fd: int, start: int, end: int, controller=None, attempt=None):
+        """
+        Download the given inclusive byte range and stream it directly to its offset in the file.
+
+        :param attempt: Optional _PartAttempt when the part may be hedged. The download stops early
+                        if the attempt is stopped and a hedge is made over a new connection.
+
+        :return: a tuple of the start of the range and the number of bytes written
+        """
+        if attempt:
+            if attempt.stopped.is_set():
+                return start, 0
+            attempt.started_at = time.time()
+
+        # a hedge makes its request over a new connection in case it was the connection that was slow
+        session = _get_new_session() if attempt and attempt.hedge else None
+
+        buffer = _get_thread_buffer()
+        offset = start
+        try_counter = 0
+        t0 = time.time()
+        try:
+            while offset <= end:
+                if try_counter >= MAX_RETRIES:
+                    raise SynapseError(
+                        f'Could not download the file: {presigned_url_provider.get_info().file_name},'
+                        f' please try again.')
+                if try_counter and controller:
+                    controller.part_failed()
+                try_counter += 1
+
+                # if the connection ends before the whole range has been read we
+                # resume the part by requesting only the remaining bytes
+                _, response = cls._get_response_with_retry(presigned_url_provider, offset, end, controller, session)
+                with response:
+                    while offset <= end:
+                        if attempt and attempt.stopped.is_set():
+                            # another attempt at this part finished first
+                            return start, offset - start
+
+                        read_count = response.raw.readinto(buffer[:end - offset + 1])
+                        if not read_count:
+                            break
+                        _write_at(fd, buffer[:read_count], offset)
+                        offset += read_count
+
+        finally:
+            if session:
+                session.close()
+
+        elapsed = time.time() - t0
+        if attempt:
+            attempt.elapsed = elapsed
+        if controller:
+            controller.part_completed(offset - start, elapsed)
+        return start, offset - start
+
     @staticmethod
-    def _prep_file(request):
-        # upon receiving the parts of the file we'll open the file
-        # and write the specific byte ranges, but to open it in
-        # r+ mode we need to to exist and be empty
-        open(request.path, 'wb').close()
-
-    def _submit_chunks(self, url_provider, chunk_range_generator, pending_futures):
-        submit_count = self._max_concurrent_parts - len(pending_futures)
+    def _prep_file(request, file_size: int):
+        # create the file at its full size so that each part
+        # can be written independently at its own offset
+        with open(request.path, 'wb') as f:
+            f.truncate(file_size)
+
+    def _submit_chunks(self, url_provider, fd, controller, chunk_range_generator, pending_futures, hedger=None):
+        submit_count = controller.concurrency - len(pending_futures)
         submitted_futures = set()
+        if submit_count <= 0:
+            # the controller has reduced the concurrency below the number of parts already in flight
+            return submitted_futures
 
         for chunk_range in chunk_range_generator:
             start, end = chunk_range
-            chunk_future = self._executor.submit(
-                self._get_response_with_retry,
-                url_provider,
-                start,
-                end,
-            )
+            if hedger:
+                chunk_future = hedger.submit(start, end)
+            else:
+                chunk_future = self._executor.submit(
+                    self._download_part,
+                    url_provider,
+                    fd,
+                    start,
+                    end,
+                    controller,
+                )
             submitted_futures.add(chunk_future)
 
             if len(submitted_futures) == submit_count:
@@ -364,20 +1111,28 @@ class _MultithreadedDownloader:
         return submitted_futures
 
     @staticmethod
-    def _write_chunks(request, completed_futures, transfer_status):
-        if completed_futures:
-            with open(request.path, 'rb+') as file_write:
-                for chunk_future in completed_futures:
-                    start, chunk_response = chunk_future.result()
-                    chunk_data = chunk_response.content
-                    file_write.seek(start)
-                    file_write.write(chunk_response.content)
-
-                    transfer_status.transferred += len(chunk_data)
-                    printTransferProgress(transfer_status.transferred,
-                                          transfer_status.total_bytes_to_be_transferred,
-                                          'Downloading ', os.path.basename(request.path),
-                                          dt=transfer_status.elapsed_time())
+    def _update_progress(request, journal, md5, completed_futures, transfer_status):
+        for chunk_future in completed_futures:
+            start, bytes_written = chunk_future.result()
+            journal.record(start, start + bytes_written - 1)
+            md5.add(start, start + bytes_written - 1)
+
+            transfer_status.transferred += bytes_written
+            printTransferProgress(transfer_status.transferred,
+                                  transfer_status.total_bytes_to_be_transferred,
+                                  'Downloading ', os.path.basename(request.path),
+                                  dt=transfer_status.elapsed_time())
+
+    @staticmethod
+    def _record_completed_parts(journal, futures, transfer_status):
+        # record any parts that finished successfully but were not yet recorded when the download was aborted
+        for future in futures:
+            if future.done() and not future.cancelled() and not future.exception():
+                # a stopped part may have written only some of its range
+                start, bytes_written = future.result()
+                if bytes_written:
+                    journal.record(start, start + bytes_written - 1)
+                    transfer_status.transferred += bytes_written
 
     @staticmethod
     def _check_for_errors(request, completed_futures):
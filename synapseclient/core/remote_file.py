@@ -0,0 +1,295 @@
+"""
+Random access reads of a file stored in Synapse without downloading the whole file.
+
+A RemoteFile is a read only, seekable file object that fetches the byte ranges that are read
+from the file's presigned url. Ranges are fetched a block at a time and the most recently used
+blocks are kept in memory, so small reads that are near each other (e.g. reading the footer of
+a Parquet file then some of its row groups) don't each require a request. When the file is read
+sequentially increasingly large runs of blocks are fetched ahead of the reads in a single request.
+
+The content of a file can also be streamed in order without being written to disk, e.g. to pipe it
+to another program, optionally fetching ranges of the file in parallel ahead of the consumer.
+"""
+
+import collections
+import hashlib
+import io
+import itertools
+import typing
+from http import HTTPStatus
+
+from synapseclient.core.exceptions import SynapseError, SynapseMd5MismatchError, _raise_for_status
+from synapseclient.core.multithread_download.download_threads import (
+    DownloadRequest,
+    PresignedUrlProvider,
+    SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE,
+    _get_file_size,
+    _get_new_session,
+    _get_thread_session,
+)
+from synapseclient.core.transfer_scheduler import get_transfer_job
+
+MiB = 2 ** 20
+DEFAULT_BLOCK_SIZE = 1 * MiB
+# the number of blocks kept in memory
+DEFAULT_CACHE_BLOCKS = 64
+# the largest number of blocks fetched ahead of a sequential read, must be less than the number cached
+DEFAULT_MAX_READ_AHEAD_BLOCKS = 16
+DEFAULT_CHUNK_SIZE = 1 * MiB
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A read only, seekable file object over HTTP range requests to a presigned url.
+    The url is refreshed when it is about to expire, or if it is rejected before then.
+    """
+
+    def __init__(self,
+                 url_provider: PresignedUrlProvider,
+                 file_size: int,
+                 *,
+                 name: str = None,
+                 block_size: int = DEFAULT_BLOCK_SIZE,
+                 cache_blocks: int = DEFAULT_CACHE_BLOCKS,
+                 max_read_ahead_blocks: int = DEFAULT_MAX_READ_AHEAD_BLOCKS):
+        """
+        :param url_provider:            provides an unexpired presigned url of the file
+        :param file_size:               the size of the file in bytes
+        :param name:                    the name of the file
+        :param block_size:              the size of the ranges fetched and cached
+        :param cache_blocks:            the number of most recently used blocks kept in memory
+        :param max_read_ahead_blocks:   the most blocks fetched ahead of a sequential read
+        """
+        super().__init__()
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+
+        self.name = name
+        self._url_provider = url_provider
+        self._size = file_size
+        self._block_size = block_size
+        self._cache_blocks = max(cache_blocks, 1)
+        self._max_read_ahead = max(min(max_read_ahead_blocks, self._cache_blocks - 1), 0)
+
+        self._position = 0
+        self._blocks = collections.OrderedDict()
+        self._last_block = None
+        self._read_ahead = 0
+        self._session = _get_new_session()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        self._check_not_closed()
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._check_not_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+
+        self._position = position
+        return position
+
+    def readinto(self, b) -> int:
+        self._check_not_closed()
+        view = memoryview(b).cast('B')
+
+        count = 0
+        while count < len(view) and self._position < self._size:
+            index, offset = divmod(self._position, self._block_size)
+            block = self._get_block(index)
+
+            length = min(len(block) - offset, len(view) - count)
+            view[count:count + length] = block[offset:offset + length]
+            count += length
+            self._position += length
+
+        return count
+
+    def close(self):
+        if not self.closed:
+            self._blocks.clear()
+            self._session.close()
+        super().close()
+
+    def _check_not_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+    def _get_block(self, index: int) -> memoryview:
+        if self._last_block is not None and index == self._last_block + 1:
+            # sequential reads fetch twice as far ahead each time they need to make a request
+            read_ahead = min(max(self._read_ahead * 2, 1), self._max_read_ahead)
+        elif index == self._last_block:
+            read_ahead = self._read_ahead
+        else:
+            read_ahead = 0
+        self._last_block = index
+
+        block = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+
+        self._read_ahead = read_ahead
+        last_index = min(index + read_ahead, (self._size - 1) // self._block_size)
+        # blocks that are already cached are fetched again rather than splitting the request
+        data = memoryview(self._fetch(index * self._block_size, min((last_index + 1) * self._block_size, self._size)))
+
+        for i in range(last_index - index + 1):
+            self._blocks[index + i] = data[i * self._block_size:(i + 1) * self._block_size]
+            self._blocks.move_to_end(index + i)
+        while len(self._blocks) > self._cache_blocks:
+            self._blocks.popitem(last=False)
+
+        return self._blocks[index]
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        return _fetch_range(self._session, self._url_provider, start, end)
+
+
+def _fetch_range(session, url_provider: PresignedUrlProvider, start: int, end: int) -> bytes:
+    """Fetch the bytes of a file from start (inclusive) to end (exclusive)"""
+    url_info = url_provider.get_info()
+    refreshed = False
+    while True:
+        headers = {'Range': f"bytes={start}-{end - 1}"}
+        with session.get(url_info.url, headers=headers, stream=True) as response:
+            if response.status_code == HTTPStatus.FORBIDDEN and not refreshed:
+                # the url may have been invalidated before its expiration, try again with a new one
+                url_info = url_provider.refresh_info()
+                refreshed = True
+                continue
+
+            if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+                data = response.content
+                if len(data) != end - start:
+                    raise SynapseError(
+                        f"Expected {end - start} bytes of {url_info.file_name} from offset {start}"
+                        f" but received {len(data)}"
+                    )
+                return data
+
+            _raise_for_status(response)
+
+            # the entire file would be returned rather than the requested range
+            raise SynapseError(f"The server storing {url_info.file_name} does not support range requests")
+
+
+def open_remote_file(client, request: DownloadRequest, **kwargs) -> RemoteFile:
+    """
+    Open a file stored in Synapse for random access reads.
+
+    :param client:      A Synapse client
+    :param request:     The file to open, if its file_size is None it is looked up
+    :param kwargs:      passed to the RemoteFile
+
+    :return: a RemoteFile
+    """
+    url_provider = PresignedUrlProvider(client, request)
+    file_size = request.file_size
+    if file_size is None:
+        file_size = _get_file_size(url_provider.get_info().url)
+
+    return RemoteFile(url_provider, file_size, name=url_provider.get_info().file_name, **kwargs)
+
+
+def iter_remote_content(client,
+                        request: DownloadRequest,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        *,
+                        max_threads: int = 1,
+                        expected_md5: str = None) -> typing.Iterator[bytes]:
+    """
+    Stream the content of a file stored in Synapse, in order, without writing it to disk.
+
+    :param client:          A Synapse client
+    :param request:         The file to stream, if its file_size is None it is looked up when needed
+    :param chunk_size:      The size of the chunks of the file yielded
+    :param max_threads:     With more than one thread ranges of the file are fetched in parallel ahead of
+                            the chunks being consumed, otherwise the file is streamed with a single request
+    :param expected_md5:    If given, the MD5 of the streamed content is checked once it has all been yielded
+
+    :return: a generator of the bytes of the file
+    """
+    url_provider = PresignedUrlProvider(client, request)
+    if max_threads > 1:
+        file_size = request.file_size
+        if file_size is None:
+            file_size = _get_file_size(url_provider.get_info().url)
+        chunks = _iter_prefetched_ranges(url_provider, file_size, chunk_size, max_threads)
+    else:
+        chunks = _iter_stream(url_provider, chunk_size)
+
+    return _iter_checked(chunks, url_provider.get_info().file_name, expected_md5) if expected_md5 else chunks
+
+
+def _iter_checked(chunks: typing.Iterator[bytes], file_name: str, expected_md5: str) -> typing.Iterator[bytes]:
+    md5 = hashlib.md5()
+    for chunk in chunks:
+        md5.update(chunk)
+        yield chunk
+
+    if md5.hexdigest() != expected_md5:
+        raise SynapseMd5MismatchError(
+            f"The streamed content of {file_name} has an md5 of {md5.hexdigest()}"
+            f" which does not match the expected md5 of {expected_md5}"
+        )
+
+
+def _iter_stream(url_provider: PresignedUrlProvider, chunk_size: int) -> typing.Iterator[bytes]:
+    with _get_new_session() as session, \
+            session.get(url_provider.get_info().url, stream=True) as response:
+        _raise_for_status(response)
+        yield from response.iter_content(chunk_size)
+
+
+def _iter_prefetched_ranges(url_provider: PresignedUrlProvider,
+                            file_size: int,
+                            chunk_size: int,
+                            max_threads: int) -> typing.Iterator[bytes]:
+    # ranges are fetched on the threads of the transfer scheduler but yielded in order, so at most
+    # max_threads ranges are held in memory waiting for the ranges before them to be consumed
+    part_size = max(SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE, chunk_size)
+    ranges = ((start, min(start + part_size, file_size)) for start in range(0, file_size, part_size))
+
+    executor = get_transfer_job(max_threads).executor
+    pending = collections.deque()
+
+    def fetch(start, end):
+        return _fetch_range(_get_thread_session(), url_provider, start, end)
+
+    try:
+        for start, end in itertools.islice(ranges, max_threads):
+            pending.append(executor.submit(fetch, start, end))
+
+        while pending:
+            data = pending.popleft().result()
+            for start, end in itertools.islice(ranges, 1):
+                pending.append(executor.submit(fetch, start, end))
+
+            for offset in range(0, len(data), chunk_size):
+                yield data[offset:offset + chunk_size]
+    finally:
+        # the consumer may stop early, e.g. when the end of a pipe is closed
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
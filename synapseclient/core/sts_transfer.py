@@ -229,9 +229,6 @@ def is_storage_location_sts_enabled(syn, entity_id, location):
 
     else:
         # otherwise treat it as a storage location id,
-        destination = syn.restGET(
-            f'/entity/{entity_id}/uploadDestination/{location}',
-            endpoint=syn.fileHandleEndpoint
-        )
+        destination = syn._get_upload_destination(entity_id, location)
 
     return destination.get('stsEnabled', False)
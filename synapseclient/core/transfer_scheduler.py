@@ -0,0 +1,336 @@
+"""
+A process wide scheduler for the tasks that move bytes to and from Synapse.
+
+Transfers are organized into jobs (e.g. a syncFromSynapse, a migration, or the download of a single file).
+A job submits file tasks, each of which coordinates the transfer of one file, and part tasks, each of which
+moves some of the bytes of a file and never waits on another task. File tasks and part tasks are run by
+separate sets of threads, so a file task waiting on its parts can never take the thread its parts need.
+Previously that was prevented by limiting the number of concurrent files to half of a shared thread pool.
+
+Threads are shared fairly between the jobs running at once, the next task run is taken from the job with
+the fewest of its tasks running. Within a job file tasks run in order of the priority they're submitted
+with (e.g. their size, to transfer small files first) and part tasks run in the order their files were
+started, so that files already in progress are finished before the parts of files started later.
+
+To use these wrappers for single thread environment, set the following:
+
+    synapseclient.config.single_threaded = True
+"""
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import typing
+
+from synapseclient.core import config
+from synapseclient.core.pool_provider import DEFAULT_NUM_THREADS, SingleThreadExecutor
+
+FILE_TASK = 'file'
+PART_TASK = 'part'
+
+_thread_local = threading.local()
+
+
+class _Task:
+
+    def __init__(self, job: 'TransferJob', kind: str, priority, fn, args, kwargs):
+        self.job = job
+        self.kind = kind
+        self.priority = priority
+        self.future = concurrent.futures.Future()
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            # cancelled while it was queued
+            return
+
+        previous_context = getattr(_thread_local, 'context', None)
+        # the parts submitted by a file task are ordered by when the file task started
+        _thread_local.context = (self.job, self.job._next_order() if self.kind == FILE_TASK else None)
+        try:
+            result = self._fn(*self._args, **self._kwargs)
+        except BaseException as ex:
+            self.future.set_exception(ex)
+        else:
+            self.future.set_result(result)
+        finally:
+            _thread_local.context = previous_context
+
+
+class _FairQueue:
+    """
+    The queued tasks of one kind from every job. Tasks are taken from the job with the fewest tasks of that
+    kind running (among the jobs that are below their own limit), taking turns between jobs that are tied,
+    and in order of priority within a job.
+    """
+
+    def __init__(self, kind):
+        self._kind = kind
+        self._jobs = collections.OrderedDict()
+        self._counter = itertools.count()
+
+    def put(self, task: _Task):
+        heapq.heappush(self._jobs.setdefault(task.job, []), (task.priority, next(self._counter), task))
+
+    def get(self) -> typing.Optional[_Task]:
+        selected = None
+        for job, tasks in self._jobs.items():
+            running = job._running[self._kind]
+            if running < job._max_concurrent[self._kind] and \
+                    (selected is None or running < selected._running[self._kind]):
+                selected = job
+
+        if selected is None:
+            return None
+
+        tasks = self._jobs.pop(selected)
+        _, _, task = heapq.heappop(tasks)
+        if tasks:
+            # the job goes to the back of the line
+            self._jobs[selected] = tasks
+        return task
+
+    def remove(self, job) -> typing.List[_Task]:
+        return [task for _, _, task in self._jobs.pop(job, [])]
+
+
+class TransferScheduler:
+    """
+    Runs the file and part tasks of transfer jobs on two sets of daemon threads, each sized to
+    the largest number of threads requested by a job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {kind: _FairQueue(kind) for kind in (FILE_TASK, PART_TASK)}
+        self._conditions = {kind: threading.Condition(self._lock) for kind in (FILE_TASK, PART_TASK)}
+        self._threads = {kind: [] for kind in (FILE_TASK, PART_TASK)}
+
+    def job(self, max_threads: int = DEFAULT_NUM_THREADS, *, max_concurrent_files: int = None) -> 'TransferJob':
+        """
+        Start a new job.
+
+        :param max_threads:             the maximum number of part tasks of the job run at once
+        :param max_concurrent_files:    the maximum number of file tasks of the job run at once,
+                                        by default max_threads
+        """
+        max_threads = max(max_threads, 1)
+        max_concurrent_files = max(max_concurrent_files or max_threads, 1)
+        with self._lock:
+            self._start_threads(PART_TASK, max_threads)
+            self._start_threads(FILE_TASK, max_concurrent_files)
+
+        return TransferJob(self, max_threads, max_concurrent_files)
+
+    def _start_threads(self, kind, count):
+        threads = self._threads[kind]
+        while len(threads) < count:
+            thread = threading.Thread(
+                target=self._work,
+                args=(kind,),
+                name=f"synapse-transfer-{kind}-{len(threads)}",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+
+    def _submit(self, task: _Task):
+        with self._lock:
+            self._queues[task.kind].put(task)
+            self._conditions[task.kind].notify()
+
+    def _cancel(self, job):
+        with self._lock:
+            tasks = [task for queue in self._queues.values() for task in queue.remove(job)]
+        for task in tasks:
+            task.future.cancel()
+
+    def _work(self, kind):
+        _thread_local.worker_kind = kind
+
+        queue = self._queues[kind]
+        condition = self._conditions[kind]
+        while True:
+            with condition:
+                task = queue.get()
+                while task is None:
+                    condition.wait()
+                    task = queue.get()
+                task.job._running[kind] += 1
+
+            try:
+                task.run()
+            finally:
+                # if the job was at its limit this thread will pick up its next task
+                with condition:
+                    task.job._running[kind] -= 1
+
+
+class TransferJob:
+    """
+    A group of related transfers whose tasks are scheduled together, e.g. all the files of a sync.
+
+    Used as a context manager the job waits for all of its tasks when the context exits,
+    cancelling any that haven't started if the context exits with an error.
+    """
+
+    def __init__(self, scheduler: typing.Optional[TransferScheduler], max_threads: int, max_concurrent_files: int):
+        """
+        :param scheduler:               the scheduler running the job, or None to run each task as it is submitted
+        :param max_threads:             the maximum number of part tasks of the job run at once
+        :param max_concurrent_files:    the maximum number of file tasks of the job run at once
+        """
+        self._scheduler = scheduler
+        self._max_concurrent = {FILE_TASK: max_concurrent_files, PART_TASK: max_threads}
+        self._running = {FILE_TASK: 0, PART_TASK: 0}
+        self._order = itertools.count()
+        self._executor = _JobExecutor(self)
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def _next_order(self):
+        return next(self._order)
+
+    @property
+    def executor(self) -> concurrent.futures.Executor:
+        """An Executor that submits part tasks to this job, e.g. for use as a shared_executor."""
+        return self._executor
+
+    def submit_file(self, fn, *args, priority=0, **kwargs) -> concurrent.futures.Future:
+        """
+        Submit a task that transfers a file, which may submit and wait for part tasks.
+
+        :param fn:          the function to run
+        :param priority:    file tasks with a lower priority are run first, e.g. the size of the file
+                            to transfer smaller files first
+
+        :return: a Future of the result of fn
+        """
+        return self._submit(FILE_TASK, priority, fn, args, kwargs)
+
+    def submit_part(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Submit a task that transfers part of a file. A part task should never wait on another task.
+
+        :param fn:  the function to run
+
+        :return: a Future of the result of fn
+        """
+        if getattr(_thread_local, 'worker_kind', None) == PART_TASK:
+            # a part task that submits another part is run immediately rather than risk
+            # every part thread waiting on a part that can't be run
+            return SingleThreadExecutor().submit(fn, *args, **kwargs)
+
+        context = getattr(_thread_local, 'context', None)
+        file_order = context[1] if context and context[0] is self and context[1] is not None else -1
+        return self._submit(PART_TASK, file_order, fn, args, kwargs)
+
+    def _submit(self, kind, priority, fn, args, kwargs):
+        if self._scheduler is None:
+            return SingleThreadExecutor().submit(fn, *args, **kwargs)
+
+        task = _Task(self, kind, priority, fn, args, kwargs)
+        with self._futures_lock:
+            self._futures.add(task.future)
+        task.future.add_done_callback(self._discard)
+
+        self._scheduler._submit(task)
+        return task.future
+
+    def _discard(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def cancel(self):
+        """Cancel all of the tasks of this job that haven't started running."""
+        if self._scheduler is not None:
+            self._scheduler._cancel(self)
+
+    def wait(self):
+        """Wait for all of the tasks of this job, including any submitted while waiting, to finish."""
+        while True:
+            with self._futures_lock:
+                futures = list(self._futures)
+            if not futures:
+                return
+            concurrent.futures.wait(futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+        self.wait()
+
+
+class _JobExecutor(concurrent.futures.Executor):
+    """
+    An Executor for the part tasks of a TransferJob. Shutting it down only waits for the tasks
+    submitted through it, the threads belong to the process wide scheduler.
+    """
+
+    def __init__(self, job: TransferJob):
+        self._job = job
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+
+            future = self._job.submit_part(fn, *args, **kwargs)
+            self._futures.add(future)
+
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            concurrent.futures.wait(futures)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> TransferScheduler:
+    """:return: the process wide TransferScheduler"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TransferScheduler()
+        return _scheduler
+
+
+def get_transfer_job(max_threads: int = DEFAULT_NUM_THREADS, *, max_concurrent_files: int = None) -> TransferJob:
+    """
+    Start a new job on the process wide TransferScheduler, or a job that runs each task as it
+    is submitted if the client is configured to be single threaded.
+
+    :param max_threads:             the maximum number of part tasks of the job run at once
+    :param max_concurrent_files:    the maximum number of file tasks of the job run at once, by default max_threads
+
+    :return: a TransferJob
+    """
+    if config.single_threaded:
+        return TransferJob(None, 1, 1)
+    return get_scheduler().job(max_threads, max_concurrent_files=max_concurrent_files)
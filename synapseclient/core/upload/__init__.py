@@ -4,4 +4,4 @@
 # Please use them at your own risk.
 
 from .upload_functions import upload_file_handle, upload_synapse_s3  # noqa
-from .multipart_upload import multipart_copy, multipart_upload_file, multipart_upload_string  # noqa
+from .multipart_upload import multipart_copy, multipart_upload_file, multipart_upload_stream, multipart_upload_string  # noqa
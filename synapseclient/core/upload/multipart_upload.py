@@ -14,13 +14,18 @@ not need to call any of these functions directly.
 
 import concurrent.futures
 from contextlib import contextmanager
+import functools
 import hashlib
+import io
 import json
 import math
 import mimetypes
+import mmap
 import os
+import queue
 import re
 import requests
+import tempfile
 import threading
 import time
 from typing import List, Mapping
@@ -34,6 +39,7 @@ from synapseclient.core.exceptions import (
     SynapseUploadAbortedException,
     SynapseUploadFailedException,
 )
+from synapseclient.core.transfer_scheduler import get_transfer_job
 from synapseclient.core.utils import md5_for_file, MB
 
 # AWS limits
@@ -62,7 +68,7 @@ def shared_executor(executor):
 @contextmanager
 def _executor(max_threads, shutdown_wait):
     """Yields an executor for running some asynchronous code, either obtaining the executor
-    from the shared_executor or otherwise creating one.
+    from the shared_executor or otherwise starting a job on the process wide transfer scheduler.
 
     :param max_threads: the maxmimum number of threads a created executor should use
     :param shutdown_wait: whether a created executor should shutdown after running the yielded to code
@@ -71,7 +77,7 @@ def _executor(max_threads, shutdown_wait):
     shutdown_after = False
     if not executor:
         shutdown_after = True
-        executor = pool_provider.get_executor(thread_count=max_threads)
+        executor = get_transfer_job(max_threads).executor
 
     try:
         yield executor
@@ -281,7 +287,7 @@ class UploadAttempt:
         with self._lock:
             del self._pre_signed_part_urls[part_number]
 
-        return part_number
+        return part_number, len(body) if body is not None else 0
 
     def _upload_parts(self, part_count, remaining_part_numbers):
         time_upload_started = time.time()
@@ -402,6 +408,65 @@ def _get_file_chunk(file_path, part_number, chunk_size):
         return f.read(chunk_size)
 
 
+class _FilePartProvider:
+    """
+    Provides the parts of a file as memoryviews of a read only memory map of the file, so the bytes
+    of a part are hashed and sent from the page cache without being copied into a new bytes object
+    for each part. Files that can't be mapped (e.g. empty files, or a file system that doesn't support it)
+    fall back to reading each part.
+
+    Reading a page of the map that is beyond the end of the file raises SIGBUS, which kills the process, so a
+    part is only provided from the map if the file hasn't been truncated since it was mapped, otherwise the part
+    is read from the file, and the upload fails with an MD5 mismatch. A file truncated while a part that was
+    already provided is being read can still raise SIGBUS, so files must not be truncated while being uploaded.
+
+    Used as a context manager the map is closed when the context exits.
+    """
+
+    def __init__(self, file_path, part_size):
+        self._file_path = file_path
+        self._part_size = part_size
+        self._mmap = None
+        self._view = None
+
+        try:
+            with open(file_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        except (OSError, ValueError, OverflowError):
+            # the map keeps its own handle to the file so it remains valid once the file is closed
+            self._mmap = None
+
+    def get_part(self, part_number):
+        if self._view is None:
+            return _get_file_chunk(self._file_path, part_number, self._part_size)
+
+        start = (part_number - 1) * self._part_size
+        end = min(start + self._part_size, len(self._view))
+        if self._mmap.size() < end:
+            # the file was truncated since it was mapped
+            return _get_file_chunk(self._file_path, part_number, self._part_size)
+        return self._view[start:end]
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a part is still referenced somewhere (e.g. by an exception's traceback),
+                # the map is closed when it is garbage collected instead
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def _get_data_chunk(data, part_number, chunk_size):
     """
     Return the nth chunk of a buffer.
@@ -472,7 +537,7 @@ def multipart_upload_file(
         mime_type, _ = mimetypes.guess_type(file_path, strict=False)
         content_type = mime_type or 'application/octet-stream'
 
-    md5_hex = md5_for_file(file_path).hexdigest()
+    md5_hex = md5_for_file(file_path, index=syn.cache.checksum_index).hexdigest()
 
     part_size = _get_part_size(part_size, file_size)
 
@@ -487,25 +552,23 @@ def multipart_upload_file(
         'storageLocationId': storage_location_id,
     }
 
-    def part_fn(part_number):
-        return _get_file_chunk(file_path, part_number, part_size)
-
     def md5_fn(part, _):
         md5 = hashlib.md5()
         md5.update(part)
         return md5.hexdigest()
 
-    return _multipart_upload(
-        syn,
-        dest_file_name,
+    with _FilePartProvider(file_path, part_size) as part_provider:
+        return _multipart_upload(
+            syn,
+            dest_file_name,
 
-        upload_request,
-        part_fn,
-        md5_fn,
+            upload_request,
+            part_provider.get_part,
+            md5_fn,
 
-        force_restart=force_restart,
-        max_threads=max_threads,
-    )
+            force_restart=force_restart,
+            max_threads=max_threads,
+        )
 
 
 def multipart_upload_string(
@@ -590,6 +653,346 @@ def multipart_upload_string(
     )
 
 
+class _ChunkReader(io.RawIOBase):
+    """Adapts an iterable of bytes to a readable file object."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk).cast('B')
+
+        count = min(len(b), len(self._pending))
+        b[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+def _as_readinto(readable):
+    """
+    :param readable: a binary file object or an iterable of bytes
+    :return: a file object with a readinto method
+    """
+    if hasattr(readable, 'readinto'):
+        return readable
+    if hasattr(readable, 'read'):
+        return _ChunkReader(iter(lambda: readable.read(DEFAULT_PART_SIZE), b''))
+    return _ChunkReader(readable)
+
+
+def _read_fully(readable, view) -> int:
+    """Fill the view from the readable, it is only partially filled at the end of the stream."""
+    count = 0
+    while count < len(view):
+        read = readable.readinto(view[count:])
+        if not read:
+            break
+        count += read
+    return count
+
+
+class _StreamPartBuffers:
+    """
+    A bounded ring of part buffers that are filled in order from a stream. Reading a part waits for
+    a buffer to be released by a part whose upload has finished, so no more than the given number of
+    parts are held in memory at once. The MD5 of the whole stream is computed as its parts are read.
+    """
+
+    def __init__(self, readable, part_size: int, buffer_count: int):
+        self._readable = _as_readinto(readable)
+        self._part_size = part_size
+        self._free = queue.Queue()
+        for _ in range(buffer_count):
+            self._free.put(bytearray(part_size))
+        self._parts = {}
+        self._lock = threading.Lock()
+
+        self.md5 = hashlib.md5()
+        self.bytes_read = 0
+
+    def read_part(self, part_number: int) -> memoryview:
+        buffer = self._free.get()
+        length = _read_fully(self._readable, memoryview(buffer))
+        part = memoryview(buffer)[:length]
+
+        self.md5.update(part)
+        self.bytes_read += length
+        with self._lock:
+            self._parts[part_number] = (buffer, part)
+        return part
+
+    def get_part(self, part_number: int) -> memoryview:
+        with self._lock:
+            return self._parts[part_number][1]
+
+    def release(self, part_number: int):
+        with self._lock:
+            buffer, _ = self._parts.pop(part_number)
+        self._free.put(buffer)
+
+    def at_end(self) -> bool:
+        return _read_fully(self._readable, memoryview(bytearray(1))) == 0
+
+
+class _StreamUploadAttempt(UploadAttempt):
+    """
+    An UploadAttempt whose parts are read once, in order, from a stream rather than on demand.
+
+    Since a part can't be read again each part is retried on its own rather than by retrying the
+    whole upload, and the MD5 and size of the stream are checked before the upload is completed.
+    Parts that were already uploaded by an earlier attempt of the same upload are read but skipped.
+    """
+
+    def __init__(self, syn, dest_file_name, upload_request_payload, part_buffers: _StreamPartBuffers, max_threads):
+        super().__init__(
+            syn,
+            dest_file_name,
+            upload_request_payload,
+            part_buffers.get_part,
+            _md5_of_part,
+            max_threads,
+            False,
+        )
+        self._part_buffers = part_buffers
+        self._failure = None
+
+    def _handle_part_with_retry(self, part_number):
+        retry = 0
+        while True:
+            try:
+                return self._handle_part(part_number)
+            except SynapseUploadAbortedException:
+                raise
+            except Exception:
+                if retry >= MAX_RETRIES:
+                    raise
+                retry += 1
+                self._syn.logger.debug(f"Retrying upload of part {part_number} of {self._dest_file_name}")
+
+    def _part_done(self, part_number, future):
+        self._part_buffers.release(part_number)
+        if not future.cancelled() and future.exception() is not None:
+            with self._lock:
+                self._failure = self._failure or future.exception()
+                self._aborted = True
+
+    def _upload_parts(self, part_count, remaining_part_numbers):
+        time_upload_started = time.time()
+        file_size = self._upload_request_payload['fileSizeBytes']
+        remaining_part_numbers = set(remaining_part_numbers)
+
+        self._pre_signed_part_urls = self._fetch_pre_signed_part_urls(
+            self._upload_id,
+            sorted(remaining_part_numbers),
+        )
+
+        futures = []
+        try:
+            with _executor(self._max_threads, False) as executor:
+                for part_number in range(1, part_count + 1):
+                    if self._aborted:
+                        break
+
+                    part = self._part_buffers.read_part(part_number)
+                    if len(part) < self._part_size and part_number < part_count:
+                        raise SynapseUploadFailedException(
+                            f"The stream ended after {self._part_buffers.bytes_read} bytes,"
+                            f" {file_size} were expected"
+                        )
+
+                    if part_number in remaining_part_numbers:
+                        future = executor.submit(self._handle_part_with_retry, part_number)
+                        future.add_done_callback(functools.partial(self._part_done, part_number))
+                        futures.append(future)
+                    else:
+                        self._part_buffers.release(part_number)
+
+                    printTransferProgress(
+                        self._part_buffers.bytes_read,
+                        file_size,
+                        prefix='Uploading',
+                        postfix=self._dest_file_name,
+                        dt=time.time() - time_upload_started,
+                    )
+        except (Exception, KeyboardInterrupt):
+            with self._lock:
+                self._aborted = True
+            raise
+        finally:
+            # don't return control while there are still threads from this upload running
+            concurrent.futures.wait(futures)
+
+        if self._failure is not None:
+            raise SynapseUploadFailedException("Part upload failed") from self._failure
+
+        md5_hex = self._part_buffers.md5.hexdigest()
+        if self._part_buffers.bytes_read != file_size or not self._part_buffers.at_end():
+            raise SynapseUploadFailedException(
+                f"The stream did not contain the expected {file_size} bytes, the upload will not be completed"
+            )
+        if md5_hex != self._upload_request_payload['contentMD5Hex']:
+            raise SynapseUploadFailedException(
+                f"The MD5 of the stream {md5_hex} does not match the expected"
+                f" {self._upload_request_payload['contentMD5Hex']}, the upload will not be completed"
+            )
+
+
+def _md5_of_part(part, _):
+    return hashlib.md5(part).hexdigest()
+
+
+def multipart_upload_stream(
+    syn,
+    readable,
+    dest_file_name: str,
+    *,
+    file_size: int = None,
+    md5_hex: str = None,
+    content_type: str = None,
+    part_size: int = None,
+    storage_location_id: str = None,
+    preview: bool = True,
+    max_threads: int = None,
+    spool_dir: str = None,
+) -> str:
+    """
+    Upload the content of a stream (e.g. a pipe, or the output of another process) to a Synapse upload
+    destination in chunks, reading the stream only once.
+
+    Synapse requires the size and MD5 of a file when its upload is started. If they are given the stream
+    is uploaded as it is read, holding no more than a part per upload thread in memory, and its size and
+    MD5 are checked before the upload is completed. Otherwise the stream is first copied to a temporary
+    file in spool_dir, computing its MD5 as it is copied, and the temporary file is uploaded.
+
+    :param syn:                 a Synapse object
+    :param readable:            a binary file object or an iterable of bytes
+    :param dest_file_name:      the name of the uploaded file
+    :param file_size:           the number of bytes in the stream, if known
+    :param md5_hex:             the MD5 of the bytes in the stream, if known
+    :param content_type:        contentType`_
+    :param part_size:           number of bytes per part. Minimum 5MB.
+    :param storage_location_id: an id indicating where the file should be
+                                stored. Retrieved from Synapse's
+                                UploadDestination
+    :param preview:             True to generate a preview
+    :param max_threads:         number of concurrent threads to devote
+                                to upload
+    :param spool_dir:           the directory of the temporary file used when the size or MD5 is not given,
+                                by default the system temporary directory
+
+    :return: a File Handle ID
+
+    .. _contentType:
+     https://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.17
+    """
+    if content_type is None:
+        mime_type, _ = mimetypes.guess_type(dest_file_name, strict=False)
+        content_type = mime_type or 'application/octet-stream'
+
+    if file_size is None or md5_hex is None:
+        return _multipart_upload_spooled(
+            syn,
+            readable,
+            dest_file_name,
+            content_type=content_type,
+            part_size=part_size,
+            storage_location_id=storage_location_id,
+            preview=preview,
+            max_threads=max_threads,
+            spool_dir=spool_dir,
+        )
+
+    part_size = _get_part_size(part_size, file_size)
+    max_threads = max(max_threads or pool_provider.DEFAULT_NUM_THREADS, 1)
+
+    upload_request = {
+        'concreteType': concrete_types.MULTIPART_UPLOAD_REQUEST,
+        'contentType': content_type,
+        'contentMD5Hex': md5_hex,
+        'fileName': dest_file_name,
+        'fileSizeBytes': file_size,
+        'generatePreview': preview,
+        'partSizeBytes': part_size,
+        'storageLocationId': storage_location_id,
+    }
+
+    # one buffer is filled from the stream while the others are uploaded
+    part_buffers = _StreamPartBuffers(readable, part_size, max_threads + 1)
+    upload_status_response = _StreamUploadAttempt(
+        syn,
+        dest_file_name,
+        upload_request,
+        part_buffers,
+        max_threads,
+    )()
+    return upload_status_response['resultFileHandleId']
+
+
+def _multipart_upload_spooled(
+    syn,
+    readable,
+    dest_file_name,
+    *,
+    content_type,
+    part_size,
+    storage_location_id,
+    preview,
+    max_threads,
+    spool_dir,
+):
+    reader = _as_readinto(readable)
+    buffer = bytearray(DEFAULT_PART_SIZE)
+    md5 = hashlib.md5()
+
+    with tempfile.NamedTemporaryFile(dir=spool_dir, delete=False) as spool_file:
+        spool_path = spool_file.name
+    try:
+        with open(spool_path, 'wb') as spool_file:
+            while True:
+                length = _read_fully(reader, memoryview(buffer))
+                if not length:
+                    break
+                chunk = memoryview(buffer)[:length]
+                md5.update(chunk)
+                spool_file.write(chunk)
+
+        file_size = os.path.getsize(spool_path)
+        part_size = _get_part_size(part_size, file_size)
+        upload_request = {
+            'concreteType': concrete_types.MULTIPART_UPLOAD_REQUEST,
+            'contentType': content_type,
+            'contentMD5Hex': md5.hexdigest(),
+            'fileName': dest_file_name,
+            'fileSizeBytes': file_size,
+            'generatePreview': preview,
+            'partSizeBytes': part_size,
+            'storageLocationId': storage_location_id,
+        }
+
+        with _FilePartProvider(spool_path, part_size) as part_provider:
+            return _multipart_upload(
+                syn,
+                dest_file_name,
+
+                upload_request,
+                part_provider.get_part,
+                _md5_of_part,
+
+                max_threads=max_threads,
+            )
+    finally:
+        os.remove(spool_path)
+
+
 def multipart_copy(
     syn,
     source_file_handle_association,
@@ -0,0 +1,88 @@
+"""
+An in memory cache of the UploadDestinations of Synapse containers.
+
+Every file uploaded to a container needs the container's UploadDestination, both to upload the file and to check
+whether its storage location is enabled for STS, so bulk uploads of small files would otherwise spend a round trip
+or two per file retrieving the same destination. The files of a container always share its destination, which only
+changes when the storage location settings of the container or one of its ancestors change, or the container is
+moved, so destinations are cached for a limited time and the cache is cleared whenever this client has changed a
+storage location setting or updated a container.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+import typing
+
+# an UploadDestination is cached for a few minutes so that changes to storage locations made
+# by other clients are seen soon, while bulk uploads still only retrieve each destination once
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_MAX_SIZE = 5000
+
+
+class UploadDestinationCache:
+    """
+    A thread safe cache of UploadDestinations keyed by entity id and storage location id, where a storage location
+    id of None identifies the default UploadDestination of the entity.
+
+    Only one thread retrieves a missing UploadDestination, any others wanting it at the same time wait for it.
+    """
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        :param ttl_seconds: the number of seconds an UploadDestination is cached for
+        :param max_size:    the maximum number of UploadDestinations cached, the oldest are discarded first
+        """
+        self._ttl_seconds = ttl_seconds
+        self._max_size = max_size
+
+        # (entity id, storage location id) -> (time cached, Future of the UploadDestination)
+        self._destinations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entity_id: str, storage_location_id, fetch: typing.Callable[[], typing.Mapping]) -> dict:
+        """
+        :param entity_id:           the id of the entity
+        :param storage_location_id: the storage location id of the UploadDestination, or None for the default
+        :param fetch:               a function that retrieves the UploadDestination if it isn't cached
+
+        :returns: a copy of the UploadDestination
+        """
+        key = (entity_id, storage_location_id)
+        with self._lock:
+            self._prune(time.monotonic())
+
+            cached = self._destinations.get(key)
+            retrieve = cached is None
+            if retrieve:
+                cached = self._destinations[key] = (time.monotonic(), concurrent.futures.Future())
+                if len(self._destinations) > self._max_size:
+                    self._destinations.popitem(last=False)
+
+        future = cached[1]
+        if retrieve:
+            try:
+                future.set_result(fetch())
+            except Exception as ex:
+                # errors aren't cached, the next request retrieves the destination again
+                with self._lock:
+                    if self._destinations.get(key) is cached:
+                        del self._destinations[key]
+                future.set_exception(ex)
+
+        return dict(future.result())
+
+    def _prune(self, now):
+        # entries are ordered by the time they were cached, so expired entries are at the front
+        expired = now - self._ttl_seconds
+        while self._destinations:
+            cached_time, _ = next(iter(self._destinations.values()))
+            if cached_time > expired:
+                break
+            self._destinations.popitem(last=False)
+
+    def clear(self):
+        """Discard all cached UploadDestinations, e.g. after a storage location setting is changed."""
+        with self._lock:
+            self._destinations.clear()
@@ -1,14 +1,23 @@
+import json
+import mimetypes
 import os
 import urllib.parse as urllib_parse
 import uuid
 
-from synapseclient.core.utils import is_url, md5_for_file, as_url, file_url_to_path, id_of
+from synapseclient.core.utils import is_url, md5_for_file, as_url, file_url_to_path, id_of, find_data_file_handle
 from synapseclient.core import cumulative_transfer_progress
 from synapseclient.core.constants import concrete_types
 from synapseclient.core.remote_file_storage_wrappers import S3ClientWrapper, SFTPWrapper
 from synapseclient.core import sts_transfer
 from synapseclient.core.upload.multipart_upload import multipart_upload_file
-from synapseclient.core.exceptions import SynapseMd5MismatchError
+from synapseclient.core.exceptions import SynapseHTTPError, SynapseMd5MismatchError
+
+# the values of the dedupe option of uploads, 'copy' copies an existing file handle with the same content
+# instead of uploading the file again
+DEDUPE_MODES = (None, 'copy')
+
+# the most entities with the MD5 of an uploaded file that are checked for a file handle that can be copied
+MAX_DEDUPE_CANDIDATES = 10
 
 
 def log_upload_message(syn, message):
@@ -27,6 +36,8 @@ def upload_file_handle(
         file_size=None,
         mimetype=None,
         max_threads=None,
+        upload_destination=None,
+        dedupe=None,
 ):
     """Uploads the file in the provided path (if necessary) to a storage location based on project settings.
     Returns a new FileHandle as a dict to represent the stored file.
@@ -42,9 +53,15 @@ def upload_file_handle(
                             automatically.
     :param file_size:       The MIME type the file, if known. Otherwise if the file is a local file, it will be
                             calculated automatically.
+    :param upload_destination:  The UploadDestination of the parent entity, if already known.
+                                Otherwise it is retrieved from Synapse.
+    :param dedupe:          If 'copy', a file whose content is already stored in Synapse in the same storage location,
+                            in a file the caller can download, isn't uploaded and a copy of the existing file handle is
+                            returned instead. Defaults to None, which always uploads the file.
 
     :returns: a dict of a new FileHandle as a dict that represents the uploaded file
     """
+    check_dedupe_mode(dedupe)
     if path is None:
         raise ValueError('path can not be None')
 
@@ -58,9 +75,25 @@ def upload_file_handle(
     entity_parent_id = id_of(parent_entity)
 
     # determine the upload function based on the UploadDestination
-    location = syn._getDefaultUploadDestination(entity_parent_id)
+    location = upload_destination or syn._getDefaultUploadDestination(entity_parent_id)
     upload_destination_type = location['concreteType']
 
+    if dedupe == 'copy' and upload_destination_type in (
+        concrete_types.SYNAPSE_S3_UPLOAD_DESTINATION,
+        concrete_types.EXTERNAL_S3_UPLOAD_DESTINATION,
+    ):
+        file_handle = copy_existing_file_handle(
+            syn,
+            location,
+            expanded_upload_path,
+            md5=md5,
+            file_size=file_size,
+            mimetype=mimetype,
+        )
+        if file_handle is not None:
+            log_upload_message(syn, 'Copied existing file handle %s for %s' % (file_handle['id'], path))
+            return file_handle
+
     if sts_transfer.is_boto_sts_transfer_enabled(syn) and \
        sts_transfer.is_storage_location_sts_enabled(syn, entity_parent_id, location) and \
        upload_destination_type == concrete_types.EXTERNAL_S3_UPLOAD_DESTINATION:
@@ -131,13 +164,81 @@ def upload_file_handle(
         return upload_synapse_s3(syn, expanded_upload_path, None, mimetype=mimetype, max_threads=max_threads)
 
 
+def check_dedupe_mode(dedupe):
+    if dedupe not in DEDUPE_MODES:
+        raise ValueError('dedupe must be one of %s' % (DEDUPE_MODES,))
+
+
+def copy_existing_file_handle(syn, location, path, md5=None, file_size=None, mimetype=None):
+    """Copies a file handle of a File entity that has the same content as the file at the path,
+    if one is stored in the storage location of the UploadDestination and the caller can download it.
+
+    :param location:    The UploadDestination the file would be uploaded to
+    :param path:        The path of the local file
+    :param md5:         The MD5 of the file, if known
+    :param file_size:   The size of the file, if known
+    :param mimetype:    The MIME type of the file, if known. Otherwise it is guessed from the file name.
+
+    :returns: a dict of the copied FileHandle, or None if no file handle could be copied
+    """
+    md5 = md5 or md5_for_file(path, index=syn.cache.checksum_index).hexdigest()
+    file_size = file_size if file_size is not None else os.path.getsize(path)
+    file_name = os.path.basename(path)
+    if mimetype is None:
+        mimetype, _ = mimetypes.guess_type(file_name, strict=False)
+
+    for entity_header in syn.md5Query(md5)[:MAX_DEDUPE_CANDIDATES]:
+        try:
+            # the file handles of the bundle are only included if the caller can download the file
+            bundle = syn._getEntityBundle(
+                entity_header['id'],
+                version=entity_header.get('versionNumber'),
+                requestedObjects={'includeEntity': True, 'includeFileHandles': True},
+            )
+        except SynapseHTTPError:
+            continue
+
+        file_handle = find_data_file_handle(bundle)
+        if not (
+            file_handle and
+            file_handle.get('concreteType') == concrete_types.S3_FILE_HANDLE and
+            file_handle.get('storageLocationId') == location.get('storageLocationId') and
+            file_handle.get('contentMd5') == md5 and
+            file_handle.get('contentSize') == file_size
+        ):
+            continue
+
+        copy_request = {
+            'copyRequests': [{
+                'originalFile': {
+                    'fileHandleId': file_handle['id'],
+                    'associateObjectId': bundle['entity']['id'],
+                    'associateObjectType': 'FileEntity',
+                },
+                'newContentType': mimetype,
+                'newFileName': file_name,
+            }]
+        }
+        copy_result = syn.restPOST(
+            '/filehandles/copy',
+            body=json.dumps(copy_request),
+            endpoint=syn.fileHandleEndpoint,
+        )['copyResults'][0]
+        if copy_result.get('failureCode') is None:
+            new_file_handle = copy_result['newFileHandle']
+            syn.cache.add(new_file_handle['id'], path)
+            return new_file_handle
+
+    return None
+
+
 def create_external_file_handle(syn, path, mimetype=None, md5=None, file_size=None):
     is_local_file = False  # defaults to false
     url = as_url(os.path.expandvars(os.path.expanduser(path)))
     if is_url(url):
         parsed_url = urllib_parse.urlparse(url)
         if parsed_url.scheme == 'file' and os.path.isfile(parsed_url.path):
-            actual_md5 = md5_for_file(parsed_url.path).hexdigest()
+            actual_md5 = md5_for_file(parsed_url.path, index=syn.cache.checksum_index).hexdigest()
             if md5 is not None and md5 != actual_md5:
                 raise SynapseMd5MismatchError(
                     "The specified md5 [%s] does not match the calculated md5 [%s] for local file [%s]", md5,
@@ -159,8 +260,8 @@ def upload_external_file_handle_sftp(syn, file_path, sftp_url, mimetype=None):
     username, password = syn._getUserCredentials(sftp_url)
     uploaded_url = SFTPWrapper.upload_file(file_path, urllib_parse.unquote(sftp_url), username, password)
 
-    file_handle = syn._createExternalFileHandle(uploaded_url, mimetype=mimetype,
-                                                md5=md5_for_file(file_path).hexdigest(),
+    md5 = md5_for_file(file_path, index=syn.cache.checksum_index).hexdigest()
+    file_handle = syn._createExternalFileHandle(uploaded_url, mimetype=mimetype, md5=md5,
                                                 fileSize=os.stat(file_path).st_size)
     syn.cache.add(file_handle['id'], file_path)
     return file_handle
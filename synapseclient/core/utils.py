@@ -38,7 +38,7 @@ KB = 2**10
 BUFFER_SIZE = 8*KB
 
 
-def md5_for_file(filename, block_size=2*MB):
+def md5_for_file(filename, block_size=2*MB, *, index=None):
     """
     Calculates the MD5 of the given file.
     See `source <http://stackoverflow.com/questions/1131220/get-md5-hash-of-a-files-without-open-it-in-python>`_.
@@ -46,9 +46,15 @@ def md5_for_file(filename, block_size=2*MB):
     :param filename:   The file to read in
     :param block_size: How much of the file to read in at once (bytes).
                        Defaults to 2 MB
+    :param index:      A checksum_index.ChecksumIndex the MD5 may be taken from (and recorded in) rather than
+                       the file read, e.g. the checksum_index of a Cache, in which case the MD5 returned can't
+                       be updated. Defaults to None
     :returns: The MD5
     """
 
+    if index is not None:
+        return _Md5Digest(index.md5_for_file(filename, block_size))
+
     md5 = hashlib.md5()
     with open(filename, 'rb') as f:
         while True:
@@ -59,6 +65,22 @@ def md5_for_file(filename, block_size=2*MB):
     return md5
 
 
+class _Md5Digest:
+    """The finished MD5 of a file, with the digest methods of a hashlib md5"""
+
+    name = 'md5'
+    digest_size = 16
+
+    def __init__(self, md5_hex):
+        self._md5_hex = md5_hex
+
+    def hexdigest(self):
+        return self._md5_hex
+
+    def digest(self):
+        return bytes.fromhex(self._md5_hex)
+
+
 def download_file(url, localFilepath=None):
     """
     Downloads a remote file.
@@ -694,6 +716,27 @@ def humanizeBytes(num_bytes):
     return 'Oops larger than Exabytes'
 
 
+def parse_bytes(size):
+    """
+    Parse a number of bytes, optionally followed by a unit as output by humanizeBytes, e.g. '500MB' or '1.5 TB'.
+    Units are powers of 1024 and are case insensitive.
+
+    :returns: the number of bytes as an int
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*', str(size))
+    units = ['bytes', 'kb', 'mb', 'gb', 'tb', 'pb', 'eb']
+    unit = match.group(2).lower() if match else None
+    if unit == '' or unit == 'b':
+        unit = 'bytes'
+    elif unit and len(unit) == 1:
+        unit += 'b'
+
+    if unit not in units:
+        raise ValueError(f"Invalid size {size}")
+
+    return int(float(match.group(1)) * 1024 ** units.index(unit))
+
+
 def touch(path, times=None):
     """
     Make sure a file exists. Update its access and modified times.
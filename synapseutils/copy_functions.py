@@ -166,11 +166,12 @@ def _batch_iterator_generator(iterables, batch_size):
 
 def _copy_cached_file_handles(cache, copiedFileHandles):
     # type: (Cache , dict) -> None
-    for copy_result in copiedFileHandles:
-        if copy_result.get('failureCode') is None:  # sucessfully copied
-            original_cache_path = cache.get(copy_result['originalFileHandleId'])
-            if original_cache_path:
-                cache.add(copy_result['newFileHandle']['id'], original_cache_path)
+    copied = [copy_result for copy_result in copiedFileHandles
+              if copy_result.get('failureCode') is None]  # sucessfully copied
+    original_cache_paths = cache.get_many(copy_result['originalFileHandleId'] for copy_result in copied)
+    for copy_result, original_cache_path in zip(copied, original_cache_paths):
+        if original_cache_path:
+            cache.add(copy_result['newFileHandle']['id'], original_cache_path)
 
 
 def changeFileMetaData(syn, entity, downloadAs=None, contentType=None):
@@ -661,8 +662,11 @@ def copyWiki(syn, entity, destinationId, entitySubPageId=None, destinationSubPag
         if not wiki.get('attachmentFileHandleIds'):
             new_file_handles = []
         else:
-            results = [syn._getFileHandleDownload(filehandleId, wiki.id, objectType='WikiAttachment')
-                       for filehandleId in wiki['attachmentFileHandleIds']]
+            results = syn.get_download_urls(
+                [(filehandleId, wiki.id, 'WikiAttachment') for filehandleId in wiki['attachmentFileHandleIds']]
+            )
+            for filehandleId, result in zip(wiki['attachmentFileHandleIds'], results):
+                syn._raise_for_file_result_failure(result, filehandleId, wiki.id, 'WikiAttachment')
             # Get rid of the previews
             nopreviews = [attach['fileHandle'] for attach in results
                           if not attach['fileHandle']['isPreview']]
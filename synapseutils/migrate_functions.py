@@ -10,8 +10,8 @@ import typing
 import synapseclient
 from synapseclient.core.logging_setup import DEFAULT_LOGGER_NAME
 from synapseclient.core.constants import concrete_types
-from synapseclient.core import pool_provider
 from synapseclient.core import utils
+from synapseclient.core.transfer_scheduler import get_transfer_job
 from synapseclient.core.upload.multipart_upload import multipart_copy, shared_executor
 
 """
@@ -288,15 +288,15 @@ class MigrationResult:
                 csv_writer.writerow(row_data)
 
 
-def _get_executor(syn):
-    executor = pool_provider.get_executor(thread_count=syn.max_threads)
+def _get_transfer_job(syn):
+    job = get_transfer_job(syn.max_threads)
 
-    # default the number of concurrent file copies to half the number of threads in the pool.
-    # since we share the same thread pool between managing entity copies and the multipart
-    # upload, we have to prevent thread starvation if all threads are consumed by the entity
-    # code leaving none for the multipart copies
-    max_concurrent_file_copies = max(int(syn.max_threads / 2), 1)
-    return executor, max_concurrent_file_copies
+    # the entity copies are file tasks and the multipart copies are part tasks of the job, which the
+    # transfer scheduler runs on separate threads so the entity copies can't starve the multipart copies.
+    # we only keep as many entity copies in flight as can be running at once so that we aren't reading
+    # more rows from the index than we are ready to migrate.
+    max_concurrent_file_copies = max(syn.max_threads, 1)
+    return job, max_concurrent_file_copies
 
 
 def _get_batch_size():
@@ -555,7 +555,7 @@ def migrate_indexed_files(
 
     :return:                        A MigrationResult object that can be used to inspect the results of the migration.
     """
-    executor, max_concurrent_file_copies = _get_executor(syn)
+    job, max_concurrent_file_copies = _get_transfer_job(syn)
 
     test_import_sqlite3()
     import sqlite3
@@ -661,7 +661,7 @@ def migrate_indexed_files(
                     raise ValueError("Unexpected type {} with id {}".format(key.type, key.id))
 
                 def migration_task(syn, key, from_file_handle_id, storage_location_id):
-                    with shared_executor(executor):
+                    with shared_executor(job.executor):
                         try:
                             # instrument the shared executor in this thread so that we won't
                             # create a new executor to perform the multipart copy
@@ -670,7 +670,7 @@ def migrate_indexed_files(
                         except Exception as ex:
                             raise _MigrationError(key) from ex
 
-                future = executor.submit(migration_task, syn, key, from_file_handle_id, storage_location_id)
+                future = job.submit_file(migration_task, syn, key, from_file_handle_id, storage_location_id)
                 futures.add(future)
 
             if row_count == 0:
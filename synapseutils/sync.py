@@ -1,47 +1,39 @@
+import collections
 import csv
 import concurrent.futures
-from contextlib import contextmanager
 import io
 import os
+import queue
 import sys
 import threading
 import typing
 
 from .monitor import notifyMe
 from synapseclient.entity import is_container
-from synapseclient.core import config
 from synapseclient.core.utils import id_of, is_url, is_synapse_id
 from synapseclient import File, table
-from synapseclient.core.pool_provider import SingleThreadExecutor
-from synapseclient.core import utils
+from synapseclient.core import hashing, pool_provider, utils
 from synapseclient.core.cumulative_transfer_progress import CumulativeTransferProgress
 from synapseclient.core.exceptions import SynapseFileNotFoundError, SynapseHTTPError, SynapseProvenanceError
 from synapseclient.core.multithread_download.download_threads import shared_executor as download_shared_executor
+from synapseclient.core.transfer_scheduler import get_transfer_job, TransferJob
 from synapseclient.core.upload.multipart_upload import shared_executor as upload_shared_executor
+from synapseclient.core.upload.upload_functions import check_dedupe_mode, upload_file_handle
 
 REQUIRED_FIELDS = ['path', 'parent']
 FILE_CONSTRUCTOR_FIELDS = ['name', 'synapseStore', 'contentType']
 STORE_FUNCTION_FIELDS = ['activityName', 'activityDescription', 'forceVersion']
 PROVENANCE_FIELDS = ['used', 'executed']
 MAX_RETRIES = 4
+UPLOAD_METADATA_THREADS = 8
+UPLOAD_MAX_PENDING_ITEMS = 1000
 MANIFEST_FILENAME = 'SYNAPSE_METADATA_MANIFEST.tsv'
 DEFAULT_GENERATED_MANIFEST_KEYS = ['path', 'parent', 'name', 'synapseStore', 'contentType', 'used', 'executed',
                                    'activityName', 'activityDescription']
 
-
-@contextmanager
-def _sync_executor(syn):
-    """Use this context manager to run some sync code with an executor that will
-    be created and then shutdown once the context completes."""
-    if syn.max_threads < 2 or config.single_threaded:
-        executor = SingleThreadExecutor()
-    else:
-        executor = concurrent.futures.ThreadPoolExecutor(syn.max_threads)
-
-    try:
-        yield executor
-    finally:
-        executor.shutdown()
+_PREPARE_STAGE = 'prepare'
+_UPLOAD_STAGE = 'upload'
+_COMMIT_STAGE = 'commit'
 
 
 def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFiles=None, followLink=False):
@@ -86,13 +78,12 @@ def syncFromSynapse(syn, entity, path=None, ifcollision='overwrite.local', allFi
     # we'll have the following threads:
     # 1. the entrant thread to this function walks the folder hierarchy and schedules files for download,
     #    and then waits for all the file downloads to complete
-    # 2. each file download will run in a separate thread in an Executor
+    # 2. each file download will run as a file task of a job on the transfer scheduler
     # 3. downloads that support S3 multipart concurrent downloads will be scheduled by the thread in #2 and have
-    #    their parts downloaded in additional threads in the same Executor
-    # To support multipart downloads in #3 using the same Executor as the download thread #2, we need at least
-    # 2 threads always, if those aren't available then we'll run single threaded to avoid a deadlock
-    with _sync_executor(syn) as executor:
-        sync_from_synapse = _SyncDownloader(syn, executor)
+    #    their parts downloaded as part tasks of the same job. since the scheduler runs part tasks on
+    #    different threads than file tasks a file download can't starve its parts of threads
+    with get_transfer_job(syn.max_threads) as job:
+        sync_from_synapse = _SyncDownloader(syn, job)
         files = sync_from_synapse.sync(entity, path, ifcollision, followLink)
 
     # the allFiles parameter used to be passed in as part of the recursive implementation of this function
@@ -198,19 +189,15 @@ class _SyncDownloader:
     Manages the downloads associated associated with a syncFromSynapse call concurrently.
     """
 
-    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_downloads=None):
+    def __init__(self, syn, job: TransferJob):
         """
         :param syn:         A synapse client
-        :param executor:    An ExecutorService in which concurrent file downlaods can be scheduled
+        :param job:         The TransferJob in which concurrent file downloads can be scheduled.
+                            the parts of the files already being downloaded are prioritized over starting
+                            further files so we concentrate on a few files at a time so those files complete faster.
         """
         self._syn = syn
-        self._executor = executor
-
-        # by default limit the number of concurrent file downloads that can happen at once to some proportion
-        # of the available threads. otherwise we could end up downloading a single part from many files at once
-        # rather than concentrating our download threads on a few files at a time so those files complete faster.
-        max_concurrent_file_downloads = max(int(max_concurrent_file_downloads or self._syn.max_threads / 2), 1)
-        self._file_semaphore = threading.BoundedSemaphore(max_concurrent_file_downloads)
+        self._job = job
 
     def sync(self, entity, path, ifcollision, followLink):
         progress = CumulativeTransferProgress('Downloaded')
@@ -250,7 +237,7 @@ class _SyncDownloader:
             # when conducting that download (shared progress bar, ExecutorService shared
             # by all multi threaded downloads in this sync)
             with progress.accumulate_progress(), \
-                    download_shared_executor(self._executor):
+                    download_shared_executor(self._job.executor):
 
                 entity = self._syn.get(
                     entity_id,
@@ -285,9 +272,6 @@ class _SyncDownloader:
             # download, reasonable recovery should be handled within the file download code.
             parent_folder_sync.set_exception(ex)
 
-        finally:
-            self._file_semaphore.release()
-
     def _sync_root(self, root, root_path, ifcollision, followLink, progress):
         # stack elements are a 3-tuple of:
         # 1. the folder entity/dict
@@ -344,8 +328,7 @@ class _SyncDownloader:
 
             else:
                 for child_file_id in child_file_ids:
-                    self._file_semaphore.acquire()
-                    self._executor.submit(
+                    self._job.submit_file(
                         self._sync_file,
                         child_file_id,
                         folder_sync,
@@ -361,33 +344,6 @@ class _SyncDownloader:
         return root_folder_sync
 
 
-class _PendingProvenance:
-    def __init__(self):
-        self._pending = set()
-        self._pending_count = 0
-
-    def update(self, pending: set):
-        """Add pending items"""
-        self._pending_count += len(pending.difference(self._pending))
-        self._pending.update(pending)
-
-    def finished(self, provenance):
-        """Remove the given provenance after it is finished uploading"""
-        self._pending.remove(provenance)
-
-    def has_pending(self):
-        """Return whether any pending provenance was recorded"""
-        return self._pending_count > 0
-
-    def has_finished_provenance(self):
-        """Return whether any of the pending provenance has finished"""
-        return len(self._pending) < self._pending_count
-
-    def reset_count(self):
-        """Reset the pending count to reflect the current pending state"""
-        self._pending_count = len(self._pending)
-
-
 class _SyncUploadItem(typing.NamedTuple):
     """Represents a single file being uploaded"""
     entity: File
@@ -399,19 +355,65 @@ class _SyncUploadItem(typing.NamedTuple):
 class _SyncUploader:
     """
     Manages the uploads associated associated with a syncToSynapse call.
-    Files will be uploaded concurrently and in an order that honors any interdependent provenance.
+
+    Each file passes through a pipeline of stages that run concurrently with each other:
+
+    1. hashing, on a pool of threads so that the MD5 of the file is known by the time it is uploaded
+    2. preparation, checking whether the file is already stored in Synapse and resolving the
+       upload destination of its parent
+    3. the upload of the bytes of the file, as file tasks of the TransferJob
+    4. commit, storing the entity with its annotations and provenance, once any files in its provenance
+       have themselves been committed. The entity bundle retrieved by the preparation is reused, so the
+       entity isn't looked up again
+
+    Preparation and commit each make their REST calls on their own threads, so the latency of those calls
+    overlaps the upload of other files. No more than max_pending_items files are between preparation and
+    commit at once, which bounds the work queued for every stage.
     """
 
-    def __init__(self, syn, executor: concurrent.futures.Executor, max_concurrent_file_transfers=None):
+    def __init__(
+        self,
+        syn,
+        job: TransferJob,
+        hash_service: hashing.HashService = None,
+        metadata_threads: int = UPLOAD_METADATA_THREADS,
+        max_pending_items: int = UPLOAD_MAX_PENDING_ITEMS,
+        dedupe: str = None,
+    ):
         """
-        :param syn:         A synapse client
-        :param executor:    An ExecutorService in which concurrent file downlaods can be scheduled
+        :param syn:                 A synapse client
+        :param job:                 The TransferJob in which concurrent file uploads can be scheduled
+        :param hash_service:        The HashService that hashes the files ahead of their upload,
+                                    by default the process wide service
+        :param metadata_threads:    The number of threads each of the preparation and commit stages uses
+        :param max_pending_items:   The maximum number of files that have started preparation but not
+                                    finished their commit
+        :param dedupe:              If 'copy', files already stored in Synapse are copied instead of uploaded
         """
         self._syn = syn
+        self._job = job
+        self._hash_service = hash_service
+        self._metadata_threads = metadata_threads
+        self._max_pending_items = max_pending_items
+        self._dedupe = dedupe
 
-        max_concurrent_file_transfers = max(int(max_concurrent_file_transfers or self._syn.max_threads / 2), 1)
-        self._executor = executor
-        self._file_semaphore = threading.BoundedSemaphore(max_concurrent_file_transfers)
+    @staticmethod
+    def _upload_priority(item):
+        # smaller files are uploaded first so that more files are finished sooner
+        try:
+            return os.path.getsize(item.entity.path)
+        except (OSError, TypeError):
+            return 0
+
+    def _hash_items(self, items):
+        # start hashing the files on a pool of threads, so that the MD5 of a file is already in the checksum
+        # index by the time it is uploaded. small files are quicker to hash on the uploading thread
+        hash_service = self._hash_service or hashing.get_hash_service()
+        return {
+            item.entity.path: hash_service.submit(item.entity.path, self._syn.cache.checksum_index)
+            for item in items
+            if item.entity.synapseStore and self._upload_priority(item) >= hashing.INLINE_HASH_SIZE
+        }
 
     @staticmethod
     def _order_items(items):
@@ -462,7 +464,8 @@ class _SyncUploader:
         exception = None
         for future in futures:
             if future.done():
-                exception = exception or future.exception()
+                if not future.cancelled():
+                    exception = exception or future.exception()
             else:
                 future.cancel()
 
@@ -473,124 +476,158 @@ class _SyncUploader:
     def upload(self, items: typing.Iterable[_SyncUploadItem]):
         progress = CumulativeTransferProgress('Uploaded')
 
-        # flag to set in a child in an upload thread if an error occurs to signal to the entrant
-        # thread to stop processing.
-        abort_event = threading.Event()
-
-        # used to lock around shared state and to notify when dependencies are resolved
-        # so that provenance dependent files can be uploaded
-        dependency_condition = threading.Condition()
-
-        pending_provenance = _PendingProvenance()
-        finished_items = {}
-
-        ordered_items = self._order_items([i for i in items])
+        ordered_items = collections.deque(self._order_items([i for i in items]))
+        hash_futures = self._hash_items(ordered_items)
 
+        # each stage reports the completion of an item to this thread, which submits the item to its next stage.
+        # only this thread reads or modifies the state below
+        completed = queue.Queue()
         futures = []
-        while ordered_items:
-            skipped_items = []
-            for item in ordered_items:
-                if abort_event.is_set():
-                    # if this flag is set, one of the upload threads failed and we should raise
-                    # it's error and cancel any remaining futures
+        finished_items = {}
+        bundles = {}
+        uncommitted_items = []
+        pending_count = 0
+
+        def submit(stage, item, submit_fn, fn, *args, **kwargs):
+            future = submit_fn(fn, *args, **kwargs)
+            futures.append(future)
+            future.add_done_callback(lambda f: completed.put((stage, item, f)))
+
+        with pool_provider.get_executor(self._metadata_threads) as prepare_executor, \
+                pool_provider.get_executor(self._metadata_threads) as commit_executor:
+
+            while ordered_items or pending_count:
+                while ordered_items and pending_count < self._max_pending_items:
+                    # items enter the pipeline in provenance order, so any item another depends
+                    # on is always ahead of it and the pipeline can't fill with items that can't commit
+                    item = ordered_items.popleft()
+                    pending_count += 1
+                    submit(_PREPARE_STAGE, item, prepare_executor.submit, self._prepare_item, item)
+
+                stage, item, future = completed.get()
+                if future.cancelled() or future.exception():
                     self._abort(futures)
 
-                with dependency_condition:
-                    used, used_pending = self._convert_provenance(item.used, finished_items)
-                    executed, executed_pending = self._convert_provenance(item.executed, finished_items)
+                if stage == _PREPARE_STAGE:
+                    bundles[item.entity.path], upload_destination = future.result()
+                    if upload_destination is not None:
+                        # the job runs no more than its configured maximum number of files at once,
+                        # further files are queued until one of the existing file uploads completes
+                        submit(
+                            _UPLOAD_STAGE,
+                            item,
+                            self._job.submit_file,
+                            self._upload_item,
+                            item,
+                            upload_destination,
+                            progress,
+                            hash_future=hash_futures.get(item.entity.path),
+                            priority=self._upload_priority(item),
+                        )
+                    else:
+                        uncommitted_items.append(item)
 
-                    if used_pending or executed_pending:
-                        # we can't upload this item yet, it has provenance that hasn't yet been uploaded
-                        skipped_items.append(item)
-                        pending_provenance.update(used_pending.union(executed_pending))
-
-                        # skip uploading because dependent provenance hasn't finished uploading
-                        continue
-
-                # else not continued above due to pending provenance
-                # all provenance that this item depends on has already been uploaded
-                # so we can go ahead and upload this item
-
-                # we acquire the semaphore to ensure that we aren't uploading more than
-                # our configured maximum number of files here at once. once we reach the limit
-                # we'll block here until one of the existing file uploads completes
-                self._file_semaphore.acquire()
-                future = self._executor.submit(
-                    self._upload_item,
-                    item,
-                    used,
-                    executed,
-                    finished_items,
-                    pending_provenance,
-                    dependency_condition,
-                    abort_event,
-                    progress,
-                )
-                futures.append(future)
+                elif stage == _UPLOAD_STAGE:
+                    uncommitted_items.append(item)
 
-            with dependency_condition:
-                if pending_provenance.has_pending():
-                    # skipped_items contains all the items that we couldn't upload the previous time through
-                    # the loop because they depended on another item for provenance. wait until there
-                    # at least one those items finishes before continuing another time through the loop.
-                    if not abort_event.is_set():
-                        dependency_condition.wait_for(lambda: (
-                            pending_provenance.has_finished_provenance() or abort_event.is_set()
-                        ))
+                else:
+                    finished_items[item.entity.path] = future.result()
+                    pending_count -= 1
 
-                pending_provenance.reset_count()
+                # commit any uploaded items whose provenance has been committed
+                waiting_items = []
+                for uncommitted_item in uncommitted_items:
+                    used, used_pending = self._convert_provenance(uncommitted_item.used, finished_items)
+                    executed, executed_pending = self._convert_provenance(uncommitted_item.executed, finished_items)
 
-            ordered_items = skipped_items
+                    if used_pending or executed_pending:
+                        waiting_items.append(uncommitted_item)
+                    else:
+                        submit(
+                            _COMMIT_STAGE,
+                            uncommitted_item,
+                            commit_executor.submit,
+                            self._commit_item,
+                            uncommitted_item,
+                            bundles.pop(uncommitted_item.entity.path),
+                            used,
+                            executed,
+                            progress,
+                        )
 
-        # all items have been submitted for upload
+                uncommitted_items = waiting_items
 
-        concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
-        if abort_event.is_set():
-            # at least one item failed to upload
-            self._abort(futures)
+    def _prepare_item(self, item):
+        """
+        :returns: a tuple of the entity bundle of the item if it is already in Synapse, otherwise None,
+                    and the UploadDestination to upload the file of the item to,
+                    or None if it is committed without an upload stage
+        """
+        entity = item.entity
+        bundle = self._syn._getEntityBundle(entity)
+        if not entity.synapseStore:
+            # there are no bytes to upload, a link to the file is created by the store
+            return bundle, None
+
+        if not self._syn._file_entity_needs_upload(entity, bundle):
+            # the file is already in Synapse
+            return bundle, None
+
+        return bundle, self._syn._getDefaultUploadDestination(entity.parentId)
+
+    def _upload_item(self, item, upload_destination, progress, hash_future=None):
+        if hash_future is not None:
+            # any error hashing the file is raised by the upload
+            concurrent.futures.wait([hash_future])
+
+        entity = item.entity
+        with upload_shared_executor(self._job.executor):
+            # we configure an upload thread local shared executor so that any multipart
+            # uploads that result from this upload will share the transfer job of this sync
+            # rather than starting their own.
+
+            with progress.accumulate_progress():
+                file_handle = upload_file_handle(
+                    self._syn,
+                    entity.parentId,
+                    entity.path,
+                    md5=entity._file_handle.get('contentMd5'),
+                    file_size=entity._file_handle.get('contentSize'),
+                    mimetype=entity._file_handle.get('contentType'),
+                    max_threads=self._syn.max_threads,
+                    upload_destination=upload_destination,
+                    dedupe=self._dedupe,
+                )
 
-    def _upload_item(
-        self,
-        item,
-        used,
-        executed,
-        finished_items,
-        pending_provenance,
-        dependency_condition,
-        abort_event,
-        progress,
-    ):
-        try:
-            with upload_shared_executor(self._executor):
-                # we configure an upload thread local shared executor so that any multipart
-                # uploads that result from this upload will share the executor of this sync
-                # rather than creating their own threadpool.
-
-                with progress.accumulate_progress():
-                    entity = self._syn.store(item.entity, used=used, executed=executed, **item.store_kwargs)
-
-                with dependency_condition:
-                    finished_items[item.entity.path] = entity
-                    try:
-                        pending_provenance.finished(item.entity.path)
-
-                        # this item was defined as provenance for another item, now that
-                        # it's finished we may be able to upload that depending item, so
-                        # wake up he central thread
-                        dependency_condition.notifyAll()
-
-                    except KeyError:
-                        # this item is not used in provenance of another item, that's fine
-                        pass
-
-        except Exception:
-            with dependency_condition:
-                abort_event.set()
-                dependency_condition.notifyAll()
-            raise
+        # the store will find the file already uploaded to this file handle
+        entity.dataFileHandleId = file_handle['id']
+        entity._file_handle = file_handle
+
+    def _commit_item(self, item, bundle, used, executed, progress):
+        store_kwargs = dict(item.store_kwargs)
+        activity = self._syn._provenance_activity(
+            None,
+            used,
+            executed,
+            store_kwargs.pop('activityName', None),
+            store_kwargs.pop('activityDescription', None),
+        )
 
-        finally:
-            self._file_semaphore.release()
+        with upload_shared_executor(self._job.executor), progress.accumulate_progress():
+            # as when storing with returnFresh=False the Activity is set as the provenance of the entity
+            # as it is stored
+            generatedBy = self._syn._saveActivity(activity)['id'] if activity else None
+
+            # the entity was looked up by its preparation, and the stored entities are only used as the
+            # provenance of other items, so there's no need to retrieve them again before or after they are stored
+            return self._syn._store_entity(
+                item.entity,
+                generatedBy=generatedBy,
+                returnFresh=False,
+                bundle=bundle,
+                known_new=bundle is None,
+                **store_kwargs
+            )
 
 
 def generateManifest(syn, allFiles, filename, provenance_cache=None):
@@ -789,7 +826,7 @@ def readManifestFile(syn, manifestFile):
     return df
 
 
-def syncToSynapse(syn, manifestFile, dryRun=False, sendMessages=True, retries=MAX_RETRIES):
+def syncToSynapse(syn, manifestFile, dryRun=False, sendMessages=True, retries=MAX_RETRIES, dedupe=None):
     """Synchronizes files specified in the manifest file to Synapse
 
     :param syn:             A synapse object as obtained with syn = synapseclient.login()
@@ -799,6 +836,10 @@ def syncToSynapse(syn, manifestFile, dryRun=False, sendMessages=True, retries=MA
 
     :param dryRun: Performs validation without uploading if set to True (default is False)
 
+    :param dedupe:  If 'copy', files whose content is already stored in Synapse in the storage location they would be
+                    uploaded to, in files that you can download, are not uploaded again and are stored with copies of
+                    the existing file handles instead (default is None)
+
     Given a file describing all of the uploads uploads the content to Synapse and optionally notifies you via Synapse
     messagging (email) at specific intervals, on errors and on completion.
 
@@ -868,6 +909,7 @@ def syncToSynapse(syn, manifestFile, dryRun=False, sendMessages=True, retries=MA
     ===============   ========    =======   =======   ===========================    ============================
 
     """
+    check_dedupe_mode(dedupe)
     df = readManifestFile(syn, manifestFile)
     sizes = [os.stat(os.path.expandvars(os.path.expanduser(f))).st_size for f in df.path if not is_url(f)]
     # Write output on what is getting pushed and estimated times - send out message.
@@ -883,12 +925,12 @@ def syncToSynapse(syn, manifestFile, dryRun=False, sendMessages=True, retries=MA
     if sendMessages:
         notify_decorator = notifyMe(syn, 'Upload of %s' % manifestFile, retries=retries)
         upload = notify_decorator(_manifest_upload)
-        upload(syn, df)
+        upload(syn, df, dedupe=dedupe)
     else:
-        _manifest_upload(syn, df)
+        _manifest_upload(syn, df, dedupe=dedupe)
 
 
-def _manifest_upload(syn, df):
+def _manifest_upload(syn, df, dedupe=None):
     items = []
     for i, row in df.iterrows():
         file = File(
@@ -914,8 +956,8 @@ def _manifest_upload(syn, df):
         )
         items.append(item)
 
-    with _sync_executor(syn) as executor:
-        uploader = _SyncUploader(syn, executor)
+    with get_transfer_job(syn.max_threads) as job:
+        uploader = _SyncUploader(syn, job, dedupe=dedupe)
         uploader.upload(items)
 
     return True
@@ -1,7 +1,12 @@
 import concurrent.futures
 import datetime
+import hashlib
+import io
 import os
 import requests
+import shutil
+import tempfile
+import time
 
 import pytest
 from unittest import TestCase
@@ -10,6 +15,7 @@ import unittest.mock as mock
 import synapseclient.core.multithread_download.download_threads as download_threads
 from synapseclient.core.multithread_download.download_threads import (
     _MultithreadedDownloader,
+    MiB,
     download_file,
     DownloadRequest,
     PresignedUrlInfo,
@@ -95,6 +101,21 @@ class TestPresignedUrlProvider(object):
                 objectType=self.download_request.object_type,
             )
 
+    def test_refresh_info(self):
+        """A refresh gets a new url even though the current one hasn't expired, bypassing the client's url cache"""
+        utc_now = datetime.datetime.utcnow()
+        info = PresignedUrlInfo("myFile.txt", "https://synapse.org/somefile.txt",
+                                expiration_utc=utc_now + datetime.timedelta(hours=1))
+        refreshed_info = info._replace(url="https://synapse.org/somefile.txt?refreshed")
+        self.mock_synapse_client._download_url_store = mock.Mock()
+
+        with mock.patch.object(PresignedUrlProvider, '_get_pre_signed_info', side_effect=[info, refreshed_info]):
+            presigned_url_provider = PresignedUrlProvider(self.mock_synapse_client, self.download_request)
+            assert refreshed_info == presigned_url_provider.refresh_info()
+            assert refreshed_info == presigned_url_provider.get_info()
+
+        self.mock_synapse_client._download_url_store.invalidate.assert_called_once_with((123, '456', 'FileEntity'))
+
 
 def test_generate_chunk_ranges():
     # test using smaller chunk size
@@ -107,6 +128,344 @@ def test_generate_chunk_ranges():
     assert expected == result
 
 
+def test_generate_chunk_ranges__completed_ranges():
+    """Verify that ranges that were already downloaded are skipped"""
+    with mock.patch.object(download_threads, 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE', 8):
+        result = [x for x in download_threads._generate_chunk_ranges(40, [(0, 7), (12, 29)])]
+
+    expected = [(8, 11), (30, 37), (38, 39)]
+
+    assert expected == result
+
+
+def test_generate_chunk_ranges__part_size_provider():
+    """Verify that the part size is consulted as each range is generated"""
+    part_sizes = iter([4, 4, 8, 2])
+    result = [x for x in download_threads._generate_chunk_ranges(20, [(8, 9)], part_size_provider=lambda: next(
+        part_sizes))]
+
+    expected = [(0, 3), (4, 7), (10, 17), (18, 19)]
+
+    assert expected == result
+
+
+class TestAdaptiveTransferController:
+
+    def _complete_window(self, controller, byte_count=MiB, elapsed=0.1):
+        for _ in range(controller.concurrency):
+            controller.part_completed(byte_count, elapsed)
+
+    def test_initial(self):
+        controller = download_threads._AdaptiveTransferController(4)
+        assert 4 == controller.concurrency
+        assert download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE == controller.part_size
+
+    def test_errors_decrease(self):
+        """Errors halve both the concurrency and the part size, down to their minimums"""
+        controller = download_threads._AdaptiveTransferController(8, part_size=32 * MiB, min_part_size=8 * MiB)
+
+        controller.part_failed()
+        self._complete_window(controller)
+        assert 4 == controller.concurrency
+        assert 16 * MiB == controller.part_size
+
+        for _ in range(5):
+            controller.part_failed()
+            self._complete_window(controller)
+        assert 1 == controller.concurrency
+        assert 8 * MiB == controller.part_size
+
+    def test_fast_parts_increase(self):
+        """Without errors the concurrency grows additively up to its max and
+        quickly completing parts double the part size up to its max"""
+        logger = mock.Mock()
+        controller = download_threads._AdaptiveTransferController(8, part_size=8 * MiB, max_part_size=32 * MiB,
+                                                                  logger=logger)
+        controller.part_failed()
+        self._complete_window(controller)
+        assert 4 == controller.concurrency
+
+        with mock.patch.object(download_threads, 'time') as mock_time:
+            mock_time.time.return_value = 0
+            controller._start_window()
+            for i in range(10):
+                # the same throughput in each window
+                mock_time.time.return_value = i + 1
+                self._complete_window(controller, byte_count=MiB, elapsed=0.1)
+
+        assert 8 == controller.concurrency
+        assert 32 * MiB == controller.part_size
+
+        # the changes were logged
+        assert logger.debug.called
+
+    def test_slow_parts_keep_part_size(self):
+        controller = download_threads._AdaptiveTransferController(4)
+        self._complete_window(controller, elapsed=download_threads.TARGET_PART_SECONDS)
+        assert download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE == controller.part_size
+
+    def test_throughput_drop_after_increase(self):
+        """If adding a connection reduced throughput it is removed again"""
+        controller = download_threads._AdaptiveTransferController(8)
+        controller.part_failed()
+        self._complete_window(controller, elapsed=download_threads.TARGET_PART_SECONDS)
+        assert 4 == controller.concurrency
+
+        with mock.patch.object(download_threads, 'time') as mock_time:
+            mock_time.time.return_value = 0
+            controller._start_window()
+
+            # a window at 4 concurrent parts
+            mock_time.time.return_value = 1
+            self._complete_window(controller, byte_count=MiB, elapsed=download_threads.TARGET_PART_SECONDS)
+            assert 5 == controller.concurrency
+
+            # a much slower window at 5 concurrent parts
+            mock_time.time.return_value = 11
+            self._complete_window(controller, byte_count=MiB, elapsed=download_threads.TARGET_PART_SECONDS)
+            assert 4 == controller.concurrency
+
+
+class TestStragglerHedger:
+
+    def setup(self):
+        self.executor = mock.Mock()
+        self.executor.submit.side_effect = lambda *args: mock.create_autospec(concurrent.futures.Future)
+        self.download_fn = mock.Mock()
+        self.url_provider = mock.Mock()
+        self.controller = mock.Mock()
+        self.file = tempfile.TemporaryFile()
+
+        self.hedger = download_threads._StragglerHedger(self.executor, self.download_fn, self.url_provider,
+                                                        self.file.fileno(), self.controller, min_samples=2)
+
+    def teardown(self):
+        self.file.close()
+
+    @staticmethod
+    def _complete(future, result, elapsed=1.0, exception=None):
+        future.exception.return_value = exception
+        future.result.return_value = result
+
+    def test_submit(self):
+        future = self.hedger.submit(0, 9)
+
+        args = self.executor.submit.call_args[0]
+        assert (self.download_fn, self.url_provider) == args[:2]
+        attempt_fd = args[2]
+        assert self.file.fileno() != attempt_fd
+        assert (0, 9, self.controller) == args[3:6]
+        assert not args[6].hedge
+
+        # the attempt's duplicated descriptor is closed once the future is done
+        callback = future.add_done_callback.call_args[0][0]
+        callback(future)
+        with pytest.raises(OSError):
+            os.fstat(attempt_fd)
+
+    def test_wait__hedges_straggler(self):
+        """A part taking longer than completed parts is hedged, and whichever attempt finishes first is kept"""
+        futures = [self.hedger.submit(i * 10, i * 10 + 9) for i in range(4)]
+        attempts = [self.hedger._attempts[f] for f in futures]
+        now = time.time()
+        for attempt in attempts:
+            attempt.started_at = now - 100
+
+        # the first two parts take a second, the other two are stragglers
+        for future, attempt in zip(futures[:2], attempts[:2]):
+            attempt.elapsed = 1.0
+            self._complete(future, (attempt.start, 10))
+
+        with mock.patch.object(download_threads.concurrent.futures, 'wait') as mock_wait:
+            mock_wait.return_value = (set(futures[:2]), set(futures[2:]))
+            completed, pending = self.hedger.wait(set(futures))
+
+        mock_wait.assert_called_once_with(set(futures), timeout=download_threads.HEDGE_CHECK_SECONDS,
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        assert set(futures[:2]) == completed
+        assert 2 == self.hedger.hedged
+        hedges = pending - set(futures)
+        assert 2 == len(hedges)
+        hedge_attempts = {self.hedger._attempts[h].start: h for h in hedges}
+        assert {20, 30} == set(hedge_attempts)
+        assert all(self.hedger._attempts[h].hedge for h in hedges)
+
+        # the hedge for part 20 finishes first, the original for part 30 finishes first
+        hedge_20 = hedge_attempts[20]
+        self.hedger._attempts[hedge_20].elapsed = 1.0
+        self._complete(hedge_20, (20, 10))
+        attempts[3].elapsed = 1.0
+        self._complete(futures[3], (30, 10))
+
+        with mock.patch.object(download_threads.concurrent.futures, 'wait') as mock_wait:
+            mock_wait.return_value = (set([hedge_20, futures[3]]), set([futures[2], hedge_attempts[30]]))
+            completed, pending = self.hedger.wait(pending)
+
+        assert set([hedge_20, futures[3]]) == completed
+        assert set() == pending
+        assert attempts[2].stopped.is_set()
+        futures[2].cancel.assert_called_once_with()
+        hedge_attempts[30].cancel.assert_called_once_with()
+        assert 1 == self.hedger.hedges_won
+
+        hedging_counters = download_threads._HedgingCounters()
+        logger = mock.Mock()
+        with mock.patch.object(download_threads, 'hedging_counters', hedging_counters):
+            self.hedger.close(logger)
+        assert (4, 2, 1) == (hedging_counters.parts, hedging_counters.hedged, hedging_counters.hedges_won)
+        assert logger.debug.called
+
+    def test_wait__not_enough_samples(self):
+        futures = [self.hedger.submit(i * 10, i * 10 + 9) for i in range(3)]
+        for future in futures:
+            self.hedger._attempts[future].started_at = 0
+        first_attempt = self.hedger._attempts[futures[0]]
+        first_attempt.elapsed = 1.0
+        self._complete(futures[0], (0, 10))
+
+        with mock.patch.object(download_threads.concurrent.futures, 'wait') as mock_wait:
+            mock_wait.return_value = (set(futures[:1]), set(futures[1:]))
+            completed, pending = self.hedger.wait(set(futures))
+
+        assert set(futures[1:]) == pending
+        assert 0 == self.hedger.hedged
+
+    def test_wait__failed_attempt_with_running_sibling(self):
+        """A failed attempt is not surfaced while another attempt at the same part may still succeed"""
+        original = self.hedger.submit(0, 9)
+        hedge = self.hedger.submit(0, 9, hedge=True)
+        self._complete(hedge, None, exception=ValueError('failed'))
+
+        with mock.patch.object(download_threads.concurrent.futures, 'wait') as mock_wait:
+            mock_wait.return_value = (set([hedge]), set([original]))
+            completed, pending = self.hedger.wait(set([original, hedge]))
+
+        assert set() == completed
+        assert set([original]) == pending
+        assert not self.hedger._attempts[original].stopped.is_set()
+
+
+def test_merge_ranges():
+    assert [(0, 9), (12, 20)] == download_threads._merge_ranges([(12, 15), (5, 9), (0, 4), (14, 20), (3, 6)])
+
+
+class TestPartJournal:
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'foo')
+        self.file_size = 100
+        with open(self.path, 'wb') as f:
+            f.truncate(self.file_size)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_journal(self, ranges):
+        journal = download_threads._PartJournal(self.path, self.file_size)
+        journal.open(resume=False)
+        for start, end in ranges:
+            journal.record(start, end)
+        journal.close()
+        return journal
+
+    def test_load__no_journal(self):
+        assert [] == download_threads._PartJournal(self.path, self.file_size).load()
+
+    def test_load(self):
+        """Ranges recorded across multiple sessions are read back merged"""
+        self._write_journal([(10, 19), (0, 9)])
+        journal = download_threads._PartJournal(self.path, self.file_size)
+        journal.open(resume=True)
+        journal.record(50, 59)
+        journal.close()
+
+        assert [(0, 19), (50, 59)] == download_threads._PartJournal(self.path, self.file_size).load()
+
+    def test_load__incomplete_last_line(self):
+        """A range that was only partially recorded when the process died is ignored"""
+        journal = self._write_journal([(0, 9)])
+        with open(journal.path, 'a') as f:
+            f.write('10 1')
+
+        assert [(0, 9)] == download_threads._PartJournal(self.path, self.file_size).load()
+
+    def test_load__different_file_size(self):
+        """A journal recorded for a different sized file is not trusted"""
+        self._write_journal([(0, 9)])
+        assert [] == download_threads._PartJournal(self.path, self.file_size + 1).load()
+
+    def test_load__file_size_mismatch(self):
+        """A journal is not trusted if the partial file is not the expected size"""
+        self._write_journal([(0, 9)])
+        with open(self.path, 'wb') as f:
+            f.truncate(10)
+
+        assert [] == download_threads._PartJournal(self.path, self.file_size).load()
+
+    def test_load__range_out_of_bounds(self):
+        self._write_journal([(0, 9), (90, 100)])
+        assert [] == download_threads._PartJournal(self.path, self.file_size).load()
+
+    def test_delete(self):
+        journal = self._write_journal([(0, 9)])
+        journal.delete()
+        assert not os.path.exists(journal.path)
+
+        # no error if already deleted
+        journal.delete()
+
+    def test_discard_partial_download(self):
+        journal = self._write_journal([(0, 9)])
+        download_threads.discard_partial_download(self.path)
+        assert not os.path.exists(self.path)
+        assert not os.path.exists(journal.path)
+
+    def test_discard_partial_download__no_journal(self):
+        """A partial download without a journal was not made by a multi threaded download and is kept"""
+        download_threads.discard_partial_download(self.path)
+        assert os.path.exists(self.path)
+
+
+class TestInOrderMd5:
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'foo')
+        self.data = os.urandom(download_threads.PART_WRITE_BUFFER_SIZE + 100)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_out_of_order(self):
+        """Parts completed out of order are hashed once the parts before them complete"""
+        md5 = download_threads._InOrderMd5(self.path)
+        size = len(self.data)
+        try:
+            md5.add(50, 99)
+            md5.add(200, size - 1)
+            md5.add(0, 49)
+
+            # the range starting at 100 is still missing
+            with pytest.raises(ValueError):
+                md5.hexdigest(size)
+
+            md5.add(100, 199)
+            assert hashlib.md5(self.data).hexdigest() == md5.hexdigest(size)
+        finally:
+            md5.close()
+
+    def test_file_shorter_than_range(self):
+        md5 = download_threads._InOrderMd5(self.path)
+        try:
+            with pytest.raises(ValueError):
+                md5.add(0, len(self.data))
+        finally:
+            md5.close()
+
+
 def test_pre_signed_url_expiration_time():
     url = "https://s3.amazonaws.com/examplebucket/test.txt" \
           "?X-Amz-Algorithm=AWS4-HMAC-SHA256" \
@@ -121,6 +480,93 @@ def test_pre_signed_url_expiration_time():
     assert expected == download_threads._pre_signed_url_expiration_time(url)
 
 
+def test_pre_signed_url_expiration_time__unsigned():
+    """A url without a recognizable expiration, e.g. of an external file, is treated as never expiring"""
+    assert datetime.datetime.max == download_threads._pre_signed_url_expiration_time("https://example.com/test.txt")
+
+
+def test_get_file_size():
+    """The size is taken from the Content-Range of a single byte range request made on the thread's session"""
+    url = 'http://foo.com/bar'
+    session = mock.MagicMock()
+    response = session.get.return_value.__enter__.return_value
+    response.status_code = 206
+    response.headers = {'Content-Range': 'bytes 0-0/12345', 'Content-Length': '1'}
+
+    with mock.patch.object(download_threads, '_get_thread_session', return_value=session):
+        assert 12345 == download_threads._get_file_size(url)
+    session.get.assert_called_once_with(url, headers={'Range': 'bytes=0-0'}, stream=True)
+
+
+def test_get_file_size__range_ignored():
+    session = mock.MagicMock()
+    response = session.get.return_value.__enter__.return_value
+    response.status_code = 200
+    response.headers = {'Content-Length': '12345'}
+
+    assert 12345 == download_threads._get_file_size('http://foo.com/bar', session=session)
+    assert not response.content.called
+
+
+class TestProbeRangeSupport:
+
+    def setup(self):
+        self.session = mock.MagicMock()
+        self.response = self.session.get.return_value.__enter__.return_value
+
+    def _probe(self, url, file_size=None):
+        return download_threads.probe_range_support(url, file_size=file_size, session=self.session)
+
+    @mock.patch.object(download_threads, '_range_support_by_host', {})
+    def test_supported(self):
+        """A host that honors a range request is remembered, the size of its files is probed only if unknown"""
+        self.response.status_code = 206
+        self.response.headers = {'Content-Range': 'bytes 0-0/12345'}
+
+        assert 12345 == self._probe('https://foo.com/bar')
+        self.session.get.assert_called_once_with('https://foo.com/bar', headers={'Range': 'bytes=0-0'}, stream=True)
+
+        assert 678 == self._probe('https://foo.com/baz', file_size=678)
+        assert 1 == self.session.get.call_count
+
+        assert 12345 == self._probe('https://foo.com/baz')
+        assert 2 == self.session.get.call_count
+
+    @mock.patch.object(download_threads, '_range_support_by_host', {})
+    def test_not_supported(self):
+        self.response.status_code = 200
+
+        assert self._probe('https://foo.com/bar', file_size=12345) is None
+        assert self._probe('https://foo.com/baz', file_size=12345) is None
+        assert 1 == self.session.get.call_count
+        assert not self.response.content.called
+
+        # a different host is probed
+        self.response.status_code = 206
+        self.response.headers = {'Content-Range': 'bytes 0-0/12345'}
+        assert 12345 == self._probe('https://bar.com/baz', file_size=12345)
+
+    @mock.patch.object(download_threads, '_range_support_by_host', {})
+    def test_unknown_total_size(self):
+        self.response.status_code = 206
+        self.response.headers = {'Content-Range': 'bytes 0-0/*'}
+
+        assert self._probe('https://foo.com/bar') is None
+        assert {('https', 'foo.com'): False} == download_threads._range_support_by_host
+
+    @mock.patch.object(download_threads, '_range_support_by_host', {})
+    def test_inconclusive(self):
+        """An error response or a url that isn't http tells us nothing about the host"""
+        self.response.status_code = 403
+        assert self._probe('https://foo.com/bar') is None
+
+        self.session.get.side_effect = requests.exceptions.ConnectionError()
+        assert self._probe('https://foo.com/bar') is None
+
+        assert self._probe('sftp://foo.com/bar') is None
+        assert {} == download_threads._range_support_by_host
+
+
 @mock.patch.object(download_threads, '_MultithreadedDownloader')
 def test_download_file(mock_multithreaded_downloader_init):
     """Verify that initiating a download instantiates a downloader and passes it the correct args.
@@ -147,18 +593,19 @@ def test_download_file(mock_multithreaded_downloader_init):
     with download_threads.shared_executor(mock_executor):
         download_file(syn, request, max_concurrent_parts=max_concurrent_parts)
 
-    mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_concurrent_parts)
+    mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_concurrent_parts,
+                                                               hedge=syn.hedge_downloads)
     mock_downloader.download_file.assert_called_once_with(request)
 
     # executor was passed in from the outside, so it should be managed from the outside
     assert not mock_executor.shutdown.called
 
 
-@mock.patch.object(download_threads, 'get_executor')
+@mock.patch.object(download_threads, 'get_transfer_job')
 @mock.patch.object(download_threads, '_MultithreadedDownloader')
-def test_download_file__executor_shutdown(mock_multithreaded_downloader_init, mock_get_executor):
-    """Verify that if no external executor is passed in the internally created one
-    is shutdown once the download is done"""
+def test_download_file__executor_shutdown(mock_multithreaded_downloader_init, mock_get_transfer_job):
+    """Verify that if no external executor is passed in the download runs as its own transfer job
+    whose executor is shutdown once the download is done"""
 
     max_threads = 5
     syn = mock.Mock(max_threads=max_threads)
@@ -174,8 +621,7 @@ def test_download_file__executor_shutdown(mock_multithreaded_downloader_init, mo
         path,
     )
 
-    mock_executor = mock.Mock()
-    mock_get_executor.return_value = mock_executor
+    mock_executor = mock_get_transfer_job.return_value.executor
 
     mock_downloader = mock.Mock()
     mock_multithreaded_downloader_init.return_value = mock_downloader
@@ -183,9 +629,12 @@ def test_download_file__executor_shutdown(mock_multithreaded_downloader_init, mo
     download_file(syn, request)
 
     # no max_concurrent_parts passed, should default to the number of client configured threads
-    mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_threads)
+    mock_multithreaded_downloader_init.assert_called_once_with(syn, mock_executor, max_threads,
+                                                               hedge=syn.hedge_downloads)
     mock_downloader.download_file.assert_called_once_with(request)
 
+    mock_get_transfer_job.assert_called_once_with(max_threads)
+
     # internally created executor should be shutdown
     assert mock_executor.shutdown.called
 
@@ -206,9 +655,14 @@ class MultithreadedDownloaderTests(TestCase):
                 mock.patch.object(download_threads, 'TransferStatus') as mock_transfer_status_init, \
                 mock.patch.object(download_threads, '_get_file_size') as mock_get_file_size, \
                 mock.patch.object(download_threads, '_generate_chunk_ranges') as mock_generate_chunk_ranges, \
+                mock.patch.object(download_threads, '_PartJournal') as mock_journal_init, \
+                mock.patch.object(download_threads, '_InOrderMd5') as mock_md5_init, \
+                mock.patch.object(download_threads, '_AdaptiveTransferController') as mock_controller_init, \
                 mock.patch.object(_MultithreadedDownloader, '_prep_file') as mock_prep_file, \
+                mock.patch.object(download_threads.os, 'open') as mock_os_open, \
+                mock.patch.object(download_threads.os, 'close') as mock_os_close, \
                 mock.patch.object(_MultithreadedDownloader, '_submit_chunks') as mock_submit_chunks, \
-                mock.patch.object(_MultithreadedDownloader, '_write_chunks') as mock_write_chunks, \
+                mock.patch.object(_MultithreadedDownloader, '_update_progress') as mock_update_progress, \
                 mock.patch('concurrent.futures.wait') as mock_futures_wait, \
                 mock.patch.object(_MultithreadedDownloader, '_check_for_errors') as mock_check_for_errors:
 
@@ -248,23 +702,42 @@ class MultithreadedDownloaderTests(TestCase):
             max_concurrent_parts = 5
             downloader = _MultithreadedDownloader(syn, executor, max_concurrent_parts)
 
-            downloader.download_file(request)
-
-            mock_prep_file.assert_called_once_with(request)
+            fd = mock_os_open.return_value
+            journal = mock_journal_init.return_value
+            journal.load.return_value = []
+            md5 = mock_md5_init.return_value
+            md5.hexdigest.return_value = 'abc123'
+
+            assert 'abc123' == downloader.download_file(request)
+            md5.hexdigest.assert_called_once_with(file_size)
+            md5.close.assert_called_once_with()
+
+            # nothing to resume, so a new file and journal are started
+            mock_journal_init.assert_called_once_with(path, file_size)
+            mock_prep_file.assert_called_once_with(request, file_size)
+            journal.open.assert_called_once_with(resume=False)
+            mock_generate_chunk_ranges.assert_called_once_with(file_size, [], part_size_provider=mock.ANY)
+            mock_os_open.assert_called_once_with(path, mock.ANY)
+
+            # the part size is chosen by the controller, starting from the configured concurrency
+            controller = mock_controller_init.return_value
+            mock_controller_init.assert_called_once_with(max_concurrent_parts, logger=syn.logger)
+            part_size_provider = mock_generate_chunk_ranges.call_args[1]['part_size_provider']
+            assert controller.part_size == part_size_provider()
 
             expected_submit_chunks_calls = [
-                mock.call(mock_url_provider, chunk_generator, set()),
-                mock.call(mock_url_provider, chunk_generator, set([second_future])),
-                mock.call(mock_url_provider, chunk_generator, set()),
+                mock.call(mock_url_provider, fd, controller, chunk_generator, set(), hedger=None),
+                mock.call(mock_url_provider, fd, controller, chunk_generator, set([second_future]), hedger=None),
+                mock.call(mock_url_provider, fd, controller, chunk_generator, set(), hedger=None),
             ]
             assert expected_submit_chunks_calls == mock_submit_chunks.call_args_list
 
-            expected_write_chunk_calls = [
-                mock.call(request, set(), transfer_status),
-                mock.call(request, set([first_future]), transfer_status),
-                mock.call(request, set([second_future, third_future]), transfer_status),
+            expected_update_progress_calls = [
+                mock.call(request, journal, md5, set(), transfer_status),
+                mock.call(request, journal, md5, set([first_future]), transfer_status),
+                mock.call(request, journal, md5, set([second_future, third_future]), transfer_status),
             ]
-            assert expected_write_chunk_calls == mock_write_chunks.call_args_list
+            assert expected_update_progress_calls == mock_update_progress.call_args_list
 
             expected_futures_wait_calls = [
                 mock.call(set([first_future, second_future]), return_when=concurrent.futures.FIRST_COMPLETED),
@@ -278,6 +751,56 @@ class MultithreadedDownloaderTests(TestCase):
             ]
             assert expected_check_for_errors_calls == mock_check_for_errors.call_args_list
 
+            # the descriptor shared by the part downloads is closed once the file is done
+            # and the journal is no longer needed
+            mock_os_close.assert_called_once_with(fd)
+            journal.delete.assert_called_once_with()
+
+    def test_download_file__resume(self):
+        """Test resuming a previously interrupted download, only the ranges missing from the journal
+        should be downloaded into the existing file"""
+
+        path = '/tmp/foo'
+        file_size = 100
+        request = DownloadRequest(1234, 'syn123', None, path, file_size=file_size)
+        completed_ranges = [(0, 9), (50, 59)]
+
+        with mock.patch.object(download_threads, 'PresignedUrlProvider'), \
+                mock.patch.object(download_threads, '_get_file_size') as mock_get_file_size, \
+                mock.patch.object(download_threads, '_PartJournal') as mock_journal_init, \
+                mock.patch.object(download_threads, '_InOrderMd5') as mock_md5_init, \
+                mock.patch.object(download_threads, '_generate_chunk_ranges') as mock_generate_chunk_ranges, \
+                mock.patch.object(download_threads, 'TransferStatus') as mock_transfer_status_init, \
+                mock.patch.object(_MultithreadedDownloader, '_prep_file') as mock_prep_file, \
+                mock.patch.object(download_threads.os, 'open'), \
+                mock.patch.object(download_threads.os, 'close'), \
+                mock.patch.object(_MultithreadedDownloader, '_submit_chunks') as mock_submit_chunks, \
+                mock.patch.object(_MultithreadedDownloader, '_update_progress'):
+
+            journal = mock_journal_init.return_value
+            journal.load.return_value = completed_ranges
+            transfer_status = TransferStatus(file_size)
+            mock_transfer_status_init.return_value = transfer_status
+            mock_submit_chunks.return_value = set()
+
+            downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
+            downloader.download_file(request)
+
+            # the size of the file is already known from the request
+            assert not mock_get_file_size.called
+            mock_journal_init.assert_called_once_with(path, file_size)
+
+            # the existing file is kept and appended to
+            assert not mock_prep_file.called
+            journal.open.assert_called_once_with(resume=True)
+            mock_generate_chunk_ranges.assert_called_once_with(file_size, completed_ranges,
+                                                               part_size_provider=mock.ANY)
+            assert 20 == transfer_status.transferred
+            journal.delete.assert_called_once_with()
+
+            # the previously completed parts are included in the md5
+            assert [mock.call(0, 9), mock.call(50, 59)] == mock_md5_init.return_value.add.call_args_list
+
     def test_download_file__error(self):
         """Test downloading a file when one of the file downloads generates an error.
         It should be surfaced raised in the entrant thread.
@@ -295,9 +818,11 @@ class MultithreadedDownloaderTests(TestCase):
                 mock.patch.object(download_threads, '_get_file_size') as mock_get_file_size, \
                 mock.patch.object(download_threads, '_generate_chunk_ranges') as mock_generate_chunk_ranges, \
                 mock.patch.object(download_threads, 'os') as mock_os, \
+                mock.patch.object(download_threads, '_PartJournal') as mock_journal_init, \
+                mock.patch.object(download_threads, '_InOrderMd5'), \
                 mock.patch.object(_MultithreadedDownloader, '_prep_file'), \
                 mock.patch.object(_MultithreadedDownloader, '_submit_chunks') as mock_submit_chunks, \
-                mock.patch.object(_MultithreadedDownloader, '_write_chunks'), \
+                mock.patch.object(_MultithreadedDownloader, '_update_progress'), \
                 mock.patch('concurrent.futures.wait') as mock_futures_wait:
 
             mock_url_info = mock.create_autospec(PresignedUrlInfo, url=url)
@@ -312,10 +837,17 @@ class MultithreadedDownloaderTests(TestCase):
             transfer_status = TransferStatus(file_size)
             mock_transfer_status_init.return_value = transfer_status
 
+            journal = mock_journal_init.return_value
+            journal.load.return_value = []
+
             exception = ValueError('failed!')
             part_future_1 = mock.create_autospec(concurrent.futures.Future)
             part_future_1.exception.return_value = exception
             part_future_2 = mock.create_autospec(concurrent.futures.Future)
+            part_future_2.done.return_value = True
+            part_future_2.cancelled.return_value = False
+            part_future_2.exception.return_value = None
+            part_future_2.result.return_value = (100, 50)
 
             # future 1 completed with an error.
             # should atempt to cancel future 2 as a result
@@ -327,24 +859,34 @@ class MultithreadedDownloaderTests(TestCase):
             max_concurrent_parts = 5
             downloader = _MultithreadedDownloader(syn, executor, max_concurrent_parts)
 
-            with pytest.raises(exception.__class__):
+            with pytest.raises(exception.__class__) as ex_info:
                 downloader.download_file(request)
 
-            # file should have been removed
-            mock_os.remove.assert_called_once_with(path)
+            # file should have been closed but kept along with its journal so the download can be resumed
+            mock_os.close.assert_called_once_with(mock_os.open.return_value)
+            assert not mock_os.remove.called
+            assert not journal.delete.called
+            journal.close.assert_called_once_with()
+
+            # the part that was still running when the error was raised finished, and is recorded
+            journal.record.assert_called_once_with(100, 149)
+            assert 50 == ex_info.value.progress
 
             # should have been an attempt to cancel the Future
             part_future_2.cancel.assert_called_once_with()
 
-    @mock.patch.object(download_threads, 'open')
-    def test_prep_file(self, mock_open):
-        """Should open and close the file to create/truncate it"""
-        path = '/tmp/foo'
-        request = DownloadRequest(None, None, None, path)
-        download_threads._MultithreadedDownloader._prep_file(request)
-        mock_open.assert_called_once_with(path, 'wb')
+    def test_prep_file(self):
+        """Should create the file preallocated to the full size of the download"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'foo')
+            with open(path, 'wb') as f:
+                f.write(b'some previous contents that should be truncated')
+
+            request = DownloadRequest(None, None, None, path)
+            download_threads._MultithreadedDownloader._prep_file(request, 10)
 
-        mock_open.return_value.close.assert_called_once_with()
+            with open(path, 'rb') as f:
+                assert b'\0' * 10 == f.read()
 
     def test_submit_chunks(self):
         """Verify chunks are submitted to the executor as expected, not exceeding the available
@@ -363,76 +905,186 @@ class MultithreadedDownloaderTests(TestCase):
         file_size = int(2.5 * download_threads.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE)
         chunk_range_generator = download_threads._generate_chunk_ranges(file_size)
 
+        fd = 3
+        controller = mock.Mock(concurrency=max_concurrent_parts)
+
         downloader = _MultithreadedDownloader(syn, executor, max_concurrent_parts)
-        submitted_futures = downloader._submit_chunks(url_provider, chunk_range_generator, pending_futures)
+        submitted_futures = downloader._submit_chunks(url_provider, fd, controller, chunk_range_generator,
+                                                      pending_futures)
 
         ranges = [r for r in download_threads._generate_chunk_ranges(file_size)][:expected_submit_count]
         expected_submits = [
             mock.call(
-                downloader._get_response_with_retry,
+                downloader._download_part,
                 url_provider,
+                fd,
                 start,
                 end,
+                controller,
             ) for start, end in ranges
         ]
         assert expected_submits == executor_submit.call_args_list
         assert set(executor_submit_side_effect) == submitted_futures
 
-    @mock.patch.object(download_threads, 'open')
-    def test_write_chunks__none_ready(self, mock_open):
-        """Verify that if there are no parts ready that nothing is written out"""
-        request = mock.Mock()
-        transfer_status = mock.Mock()
-        completed_futures = set()
-        downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
-        downloader._write_chunks(request, completed_futures, transfer_status)
-        assert not mock_open.called
+    def test_submit_chunks__concurrency_reduced(self):
+        """Verify nothing is submitted while more parts are in flight than the controller currently allows"""
+        executor = mock.Mock()
+        controller = mock.Mock(concurrency=2)
+        pending_futures = [mock.Mock()] * 3
+        chunk_range_generator = iter([(0, 9), (10, 19)])
+
+        downloader = _MultithreadedDownloader(mock.Mock(), executor, 5)
+        assert set() == downloader._submit_chunks(mock.Mock(), 3, controller, chunk_range_generator,
+                                                  pending_futures)
+        assert not executor.submit.called
+
+        # the ranges were not consumed
+        assert (0, 9) == next(chunk_range_generator)
 
     @mock.patch.object(download_threads, 'printTransferProgress')
-    @mock.patch.object(download_threads, 'open')
-    def test_write_chunks(self, mock_open, mock_print_transfer_progress):
-        """Verify expected behavior writing out chunks to disk"""
+    def test_update_progress(self, mock_print_transfer_progress):
+        """Verify transfer progress is advanced by the bytes written by each completed part"""
         request = mock.Mock(path='/tmp/foo')
 
-        chunks = [b'foo', b'bar', b'baz']
-        file_size = sum(len(d) for d in chunks)
+        part_sizes = [3, 5, 7]
+        file_size = sum(part_sizes)
         transfer_status = TransferStatus(file_size)
 
         completed_futures = []
-        expected_seeks = []
-        expected_writes = []
         expected_print_transfer_progresses = []
 
         byte_start = 0
-        for chunk in chunks:
-            future = mock.Mock(
-                result=mock.Mock(
-                    return_value=(
-                        byte_start,
-                        mock.Mock(content=chunk)
-                    )
-                )
-            )
-            completed_futures.append(future)
-            expected_seeks.append(mock.call(byte_start))
-            expected_writes.append(mock.call(chunk))
-
-            byte_start += len(chunk)
+        for part_size in part_sizes:
+            completed_futures.append(mock.Mock(result=mock.Mock(return_value=(byte_start, part_size))))
+            byte_start += part_size
             expected_print_transfer_progresses.append(
                 mock.call(byte_start, file_size, 'Downloading ', os.path.basename(request.path), dt=mock.ANY)
             )
 
+        journal = mock.Mock()
+        md5 = mock.Mock()
         downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
-        downloader._write_chunks(request, completed_futures, transfer_status)
-
-        # with open (as a context manager)
-        mock_write = mock_open.return_value.__enter__.return_value
-        assert expected_seeks == mock_write.seek.call_args_list
-        assert expected_writes == mock_write.write.call_args_list
+        downloader._update_progress(request, journal, md5, completed_futures, transfer_status)
 
-        assert sum(len(c) for c in chunks) == transfer_status.transferred
+        expected_ranges = [mock.call(0, 2), mock.call(3, 7), mock.call(8, 14)]
+        assert expected_ranges == journal.record.call_args_list
+        assert expected_ranges == md5.add.call_args_list
+        assert file_size == transfer_status.transferred
         assert expected_print_transfer_progresses == mock_print_transfer_progress.call_args_list
 
+    @staticmethod
+    def _mock_range_response(data):
+        response = mock.MagicMock()
+        stream = io.BytesIO(data)
+        response.raw.readinto.side_effect = stream.readinto
+        return response
+
+    @mock.patch.object(_MultithreadedDownloader, '_get_response_with_retry')
+    def test_download_part(self, mock_get_response_with_retry):
+        """Verify a part is streamed directly to its offset in the file"""
+        data = os.urandom(download_threads.PART_WRITE_BUFFER_SIZE * 2 + 10)
+        start = 5
+        end = start + len(data) - 1
+        mock_get_response_with_retry.return_value = (start, self._mock_range_response(data))
+        url_provider = mock.Mock()
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(end + 1)
+            fd = f.fileno()
+
+            controller = mock.Mock()
+            assert (start, len(data)) == _MultithreadedDownloader._download_part(url_provider, fd, start, end,
+                                                                                 controller)
+
+            f.seek(0)
+            assert b'\0' * start + data == f.read()
+
+        mock_get_response_with_retry.assert_called_once_with(url_provider, start, end, controller, None)
+        controller.part_completed.assert_called_once_with(len(data), mock.ANY)
+        assert not controller.part_failed.called
+
+    @mock.patch.object(_MultithreadedDownloader, '_get_response_with_retry')
+    def test_download_part__connection_ends_early(self, mock_get_response_with_retry):
+        """Verify that if a response ends before its full range is read only the remainder is re-requested"""
+        data = b'0123456789'
+        start = 0
+        end = len(data) - 1
+        mock_get_response_with_retry.side_effect = [
+            (0, self._mock_range_response(data[:4])),
+            (4, self._mock_range_response(data[4:])),
+        ]
+        url_provider = mock.Mock()
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(len(data))
+            assert (start, len(data)) == _MultithreadedDownloader._download_part(url_provider, f.fileno(), start, end)
+
+            f.seek(0)
+            assert data == f.read()
+
+        assert [mock.call(url_provider, 0, end, None, None), mock.call(url_provider, 4, end, None, None)] == \
+            mock_get_response_with_retry.call_args_list
+
+    @mock.patch.object(download_threads, '_get_new_session')
+    @mock.patch.object(_MultithreadedDownloader, '_get_response_with_retry')
+    def test_download_part__hedge(self, mock_get_response_with_retry, mock_get_new_session):
+        """Verify a hedge attempt is made on a new session and records its timing"""
+        data = b'0123456789'
+        mock_get_response_with_retry.return_value = (0, self._mock_range_response(data))
+        url_provider = mock.Mock()
+        attempt = download_threads._PartAttempt(0, 9, hedge=True)
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(len(data))
+            assert (0, len(data)) == _MultithreadedDownloader._download_part(url_provider, f.fileno(), 0, 9,
+                                                                             attempt=attempt)
+
+        session = mock_get_new_session.return_value
+        mock_get_response_with_retry.assert_called_once_with(url_provider, 0, 9, None, session)
+        session.close.assert_called_once_with()
+        assert attempt.started_at is not None
+        assert attempt.elapsed is not None
+
+    @mock.patch.object(_MultithreadedDownloader, '_get_response_with_retry')
+    def test_download_part__stopped(self, mock_get_response_with_retry):
+        """Verify an attempt stops writing once it is stopped, or does nothing if stopped before it starts"""
+        data = os.urandom(download_threads.PART_WRITE_BUFFER_SIZE * 3)
+        end = len(data) - 1
+        response = self._mock_range_response(data)
+        mock_get_response_with_retry.return_value = (0, response)
+        controller = mock.Mock()
+
+        attempt = download_threads._PartAttempt(0, end)
+        attempt.stopped.set()
+        assert (0, 0) == _MultithreadedDownloader._download_part(mock.Mock(), 3, 0, end, controller, attempt)
+        assert not mock_get_response_with_retry.called
+
+        attempt = download_threads._PartAttempt(0, end)
+        readinto = response.raw.readinto.side_effect
+
+        def stop_after_first_read(buffer):
+            attempt.stopped.set()
+            return readinto(buffer)
+        response.raw.readinto.side_effect = stop_after_first_read
+
+        with tempfile.TemporaryFile() as f:
+            f.truncate(len(data))
+            result = _MultithreadedDownloader._download_part(mock.Mock(), f.fileno(), 0, end, controller, attempt)
+
+        assert (0, download_threads.PART_WRITE_BUFFER_SIZE) == result
+        assert not controller.part_completed.called
+
+    @mock.patch.object(_MultithreadedDownloader, '_get_response_with_retry')
+    def test_download_part__exceed_max_retries(self, mock_get_response_with_retry):
+        """Verify a part whose connections keep ending without any data eventually fails"""
+        mock_get_response_with_retry.side_effect = lambda *args: (0, self._mock_range_response(b''))
+        url_provider = mock.Mock()
+
+        with tempfile.TemporaryFile() as f, pytest.raises(SynapseError):
+            _MultithreadedDownloader._download_part(url_provider, f.fileno(), 0, 9)
+
+        assert download_threads.MAX_RETRIES == mock_get_response_with_retry.call_count
+
     def test_check_for_errors__no_errors(self):
         """Verify check_for_errors when there were no errors"""
         downloader = _MultithreadedDownloader(mock.Mock(), mock.Mock(), 5)
@@ -524,3 +1176,22 @@ def test_shared_executor():
         assert executor == download_threads._thread_local.executor
 
     assert not hasattr(download_threads._thread_local, 'executor')
+
+
+def test_write_at():
+    """Verify bytes are written at the given offset, including when the OS only accepts part of a write"""
+    with tempfile.TemporaryFile() as f:
+        f.truncate(8)
+        fd = f.fileno()
+
+        pwrite = getattr(os, 'pwrite', None)
+        if pwrite:
+            # simulate short writes by only accepting up to 2 bytes per call
+            with mock.patch.object(download_threads.os, 'pwrite', side_effect=lambda fd, data, offset: pwrite(
+                    fd, data[:2], offset)):
+                download_threads._write_at(fd, memoryview(b'abcde'), 2)
+        else:
+            download_threads._write_at(fd, memoryview(b'abcde'), 2)
+
+        f.seek(0)
+        assert b'\0\0abcde\0' == f.read()
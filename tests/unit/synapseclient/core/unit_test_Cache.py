@@ -1,21 +1,29 @@
+import math
 import re
 import os
+import sqlite3
 import tempfile
 import time
 import random
-from unittest.mock import patch
+import shutil
+from unittest.mock import call, Mock, patch
 from collections import OrderedDict
 from multiprocessing import Process
 
+import pytest
+
 import synapseclient.core.cache as cache
+import synapseclient.core.cache_index as cache_index
+import synapseclient.core.checksum_index as checksum_index
 import synapseclient.core.utils as utils
+from synapseclient.core.lock import FILE_LOCKS_SUPPORTED
 
 
-def add_file_to_cache(i, cache_root_dir):
+def add_file_to_cache(i, cache_root_dir, write_cache_maps=False):
     """
     Helper function for use in test_cache_concurrent_access
     """
-    my_cache = cache.Cache(cache_root_dir=cache_root_dir)
+    my_cache = cache.Cache(cache_root_dir=cache_root_dir, write_cache_maps=write_cache_maps)
     file_handle_ids = [1001, 1002, 1003, 1004, 1005]
     random.shuffle(file_handle_ids)
     for file_handle_id in file_handle_ids:
@@ -25,9 +33,10 @@ def add_file_to_cache(i, cache_root_dir):
         my_cache.add(file_handle_id, file_path)
 
 
-def test_cache_concurrent_access():
+@pytest.mark.parametrize('write_cache_maps', [False, True])
+def test_cache_concurrent_access(write_cache_maps):
     cache_root_dir = tempfile.mkdtemp()
-    processes = [Process(target=add_file_to_cache, args=(i, cache_root_dir)) for i in range(20)]
+    processes = [Process(target=add_file_to_cache, args=(i, cache_root_dir, write_cache_maps)) for i in range(20)]
 
     for process in processes:
         process.start()
@@ -38,13 +47,17 @@ def test_cache_concurrent_access():
     my_cache = cache.Cache(cache_root_dir=cache_root_dir)
     file_handle_ids = [1001, 1002, 1003, 1004, 1005]
     for file_handle_id in file_handle_ids:
-        cache_map = my_cache._read_cache_map(my_cache.get_cache_dir(file_handle_id))
-        process_ids = set()
-        for path, iso_time in cache_map.items():
-            m = re.match("file_handle_%d_process_(\\d+).junk" % file_handle_id, os.path.basename(path))
-            if m:
-                process_ids.add(int(m.group(1)))
-        assert process_ids == set(range(20))
+        cache_maps = [my_cache._get_cache_map(str(file_handle_id))]
+        if write_cache_maps:
+            cache_maps.append(my_cache._read_cache_map(my_cache.get_cache_dir(file_handle_id)))
+
+        for cache_map in cache_maps:
+            process_ids = set()
+            for path, iso_time in cache_map.items():
+                m = re.match("file_handle_%d_process_(\\d+).junk" % file_handle_id, os.path.basename(path))
+                if m:
+                    process_ids.add(int(m.group(1)))
+            assert process_ids == set(range(20))
 
 
 def test_get_cache_dir():
@@ -107,7 +120,7 @@ def test_subsecond_timestamps():
     my_cache.add(file_handle_id=1234, path=path)
 
     with patch.object(cache, "_get_modified_time") as _get_modified_time_mock, \
-         patch.object(cache.Cache, "_read_cache_map") as _read_cache_map_mock:
+         patch.object(cache.Cache, "_get_cache_map") as _read_cache_map_mock:
 
         # this should be a match, 'cause we round microseconds to milliseconds
         _read_cache_map_mock.return_value = {path: "2015-05-05T21:34:55.001Z"}
@@ -293,3 +306,479 @@ def test_set_cache_root_dir():
     # test that manually assigning cache_root_dir expands the path
     my_cache.cache_root_dir = non_expanded_path + "2"
     assert expanded_path + "2" == my_cache.cache_root_dir
+
+
+def test_checksum_index():
+    """Each cache has its own checksum index under its cache root"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=os.path.join(tmp_dir, 'a'))
+    other_cache = cache.Cache(cache_root_dir=os.path.join(tmp_dir, 'b'))
+
+    assert os.path.join(tmp_dir, 'a', checksum_index.CHECKSUM_INDEX_FILE_NAME) == my_cache.checksum_index.path
+    assert os.path.join(tmp_dir, 'b', checksum_index.CHECKSUM_INDEX_FILE_NAME) == other_cache.checksum_index.path
+
+    my_cache.cache_root_dir = os.path.join(tmp_dir, 'c')
+    assert os.path.join(tmp_dir, 'c', checksum_index.CHECKSUM_INDEX_FILE_NAME) == my_cache.checksum_index.path
+
+
+def test_cache_map_not_written():
+    """The cached copies of a file handle are only recorded in the cache index by default"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path)
+
+    assert not os.path.exists(my_cache.get_cache_dir(101201))
+    assert os.path.exists(os.path.join(tmp_dir, cache_index.CACHE_INDEX_FILE_NAME))
+    assert utils.equal_paths(my_cache.get(101201), path)
+
+
+def test_write_cache_maps():
+    """With write_cache_maps the .cacheMap files read by other clients are kept up to date,
+    and copies cached by the other clients are found"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, write_cache_maps=True)
+
+    path1 = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+    path2 = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file2.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+    my_cache.add(file_handle_id=101201, path=path2)
+    my_cache.remove(file_handle_id=101201, path=path1)
+
+    cache_map = my_cache._read_cache_map(my_cache.get_cache_dir(101201))
+    assert [utils.normalize_path(path2)] == list(cache_map)
+
+    # a file cached by another client is only recorded in its .cacheMap
+    path3 = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file3.ext"))
+    cache_dir = my_cache.get_cache_dir(101202)
+    my_cache._write_cache_map(
+        cache_dir,
+        {utils.normalize_path(path3): cache.epoch_time_to_iso(math.floor(cache._get_modified_time(path3)))},
+    )
+    assert utils.equal_paths(my_cache.get(101202), path3)
+
+    # and is then in the index too
+    assert utils.normalize_path(path3) in cache.Cache(cache_root_dir=tmp_dir)._get_cache_map('101202')
+
+
+def test_migrate_cache_maps():
+    """The existing .cacheMap files are imported into a new cache index"""
+    tmp_dir = tempfile.mkdtemp()
+    legacy_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path = utils.touch(os.path.join(legacy_cache.get_cache_dir(101201), "file1.ext"))
+    legacy_cache._write_cache_map(
+        legacy_cache.get_cache_dir(101201),
+        {utils.normalize_path(path): cache.epoch_time_to_iso(math.floor(cache._get_modified_time(path)))},
+    )
+
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+    with patch.object(cache.Cache, "_read_cache_map", autospec=True, side_effect=cache.Cache._read_cache_map) \
+            as mock_read_cache_map:
+        assert utils.equal_paths(my_cache.get(101201), path)
+        assert my_cache.contains(101201, path)
+
+        # migrated once, when the index was created
+        assert 1 == mock_read_cache_map.call_count
+        assert utils.equal_paths(cache.Cache(cache_root_dir=tmp_dir).get(101201), path)
+        assert 1 == mock_read_cache_map.call_count
+
+
+def test_cache_index_unavailable():
+    """The .cacheMap files are used if the cache index can't be used"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    with patch.object(cache_index.sqlite3, "connect", side_effect=sqlite3.OperationalError("unable to open")):
+        path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+        my_cache.add(file_handle_id=101201, path=path)
+
+        assert [utils.normalize_path(path)] == list(my_cache._read_cache_map(my_cache.get_cache_dir(101201)))
+        assert utils.equal_paths(my_cache.get(101201), path)
+        assert [utils.normalize_path(path)] == my_cache.remove(101201)
+        assert my_cache.get(101201) is None
+
+
+def test_cache_index_locked():
+    """Opening the cache index is retried while its database is locked, e.g. by other processes creating it"""
+    tmp_dir = tempfile.mkdtemp()
+    connect = sqlite3.connect
+    locked = sqlite3.OperationalError("database is locked")
+    results = [locked, locked]
+
+    def connect_when_unlocked(*args, **kwargs):
+        if results:
+            raise results.pop()
+        return connect(*args, **kwargs)
+
+    with patch.object(cache_index.sqlite3, "connect", side_effect=connect_when_unlocked), \
+            patch.object(cache_index.time, "sleep") as mock_sleep:
+        my_cache = cache.Cache(cache_root_dir=tmp_dir)
+        path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+        my_cache.add(file_handle_id=101201, path=path)
+
+    assert 2 == mock_sleep.call_count
+    assert {utils.normalize_path(path)} == set(my_cache._index.get('101201'))
+    assert not os.path.exists(os.path.join(my_cache.get_cache_dir(101201), my_cache.cache_map_file_name))
+
+    with patch.object(cache_index.sqlite3, "connect", side_effect=locked), \
+            patch.object(cache_index.time, "sleep"):
+        my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+        assert my_cache._index.get('101201') is None
+        assert cache_index.CONNECT_ATTEMPTS == cache_index.sqlite3.connect.call_count
+
+
+def test_cache_index_execute_locked():
+    """A transaction on the cache index is retried while its database is locked, without disabling the index"""
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    path = utils.touch(os.path.join(my_cache.cache_root_dir, "not_in_cache", "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path)
+
+    index = my_cache._index
+    locked = sqlite3.OperationalError("database is locked")
+    results = [locked, locked]
+
+    def get_when_unlocked(connection):
+        if results:
+            raise results.pop()
+        return connection.execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0]
+
+    with patch.object(cache_index.time, "sleep") as mock_sleep:
+        assert 1 == index._execute(get_when_unlocked)
+        assert 2 == mock_sleep.call_count
+
+        # the database stays locked
+        statements = Mock(side_effect=locked)
+        assert index._execute(statements) is None
+        assert cache_index.CONNECT_ATTEMPTS == statements.call_count
+
+    assert not index._disabled
+    assert {utils.normalize_path(path)} == set(index.get('101201'))
+
+
+def test_cache_index_execute_corrupt():
+    """The cache index is disabled, with a warning, if its database is found to be corrupt"""
+    my_cache = cache.Cache(cache_root_dir=tempfile.mkdtemp())
+    index = my_cache._index
+
+    with patch.object(cache_index.logger, "warning") as mock_warning:
+        assert index._execute(Mock(side_effect=sqlite3.DatabaseError("database disk image is malformed"))) is None
+
+    assert index._disabled
+    assert mock_warning.called
+    assert index.get('101201') is None
+
+
+def test_cache_index_accesses_buffered():
+    """Lookups of cached files are written to the cache index in batches rather than in a transaction each"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+    path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+    my_cache.add(file_handle_id=101201, path=path)
+
+    # another index on the same database, e.g. in another process
+    other_index = cache_index.CacheIndex(my_cache._index.path, my_cache._index.root)
+
+    def hits():
+        return other_index.statistics()['hits']
+
+    assert utils.equal_paths(my_cache.get(101201), path)
+    assert 0 == hits()
+    assert 1 == my_cache.statistics()['hits']
+    assert 1 == hits()
+
+    with patch.object(cache_index, "ACCESS_FLUSH_SECONDS", 0):
+        assert utils.equal_paths(my_cache.get(101201), path)
+    assert 2 == hits()
+
+    # the accesses still buffered are written when the interpreter exits
+    assert utils.equal_paths(my_cache.get(101201), path)
+    assert 2 == hits()
+    cache_index._flush_at_exit()
+    assert 3 == hits()
+
+
+def test_cache_map_lock__index_unavailable():
+    """.cacheMap files are locked with the lock directories used by the other clients sharing them"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    with patch.object(cache_index.sqlite3, "connect", side_effect=sqlite3.OperationalError("unable to open")), \
+            patch.object(cache, "Lock", wraps=cache.Lock) as mock_lock, \
+            patch.object(cache, "FileLock") as mock_file_lock:
+        path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+        my_cache.add(file_handle_id=101201, path=path)
+        assert utils.equal_paths(my_cache.get(101201), path)
+
+    assert mock_lock.called
+    assert all(call(".cacheMap", dir=my_cache.get_cache_dir(101201)) == c for c in mock_lock.call_args_list)
+    assert not mock_file_lock.called
+
+
+def test_purge():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    path2 = utils.touch(os.path.join(my_cache.get_cache_dir(101202), "file2.ext"))
+    with patch.object(cache_index.time, "time", return_value=1000):
+        my_cache.add(file_handle_id=101201, path=path1)
+    with patch.object(cache_index.time, "time", return_value=2000):
+        my_cache.add(file_handle_id=101202, path=path2)
+
+    assert 1 == my_cache.purge(before_date=1500)
+    assert not os.path.exists(path1)
+    assert my_cache.get(101201) is None
+    assert utils.equal_paths(my_cache.get(101202), path2)
+
+
+def _add_file(my_cache, file_handle_id, path, size, access_time):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+    with patch.object(cache_index.time, "time", return_value=access_time):
+        my_cache.add(file_handle_id=file_handle_id, path=path)
+    return utils.normalize_path(path)
+
+
+def test_max_size():
+    """The least recently used files in the cache root are evicted when the cache is larger than its maximum size"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    paths = []
+    for i, file_handle_id in enumerate((101, 102, 103)):
+        os.makedirs(my_cache.get_cache_dir(file_handle_id))
+        paths.append(_add_file(
+            my_cache, file_handle_id, os.path.join(my_cache.get_cache_dir(file_handle_id), 'file.ext'), 100, 1000 + i
+        ))
+
+    # files outside the cache root are never evicted
+    outside_path = _add_file(my_cache, 104, os.path.join(tempfile.mkdtemp(), 'file.ext'), 1000, 1)
+
+    # 101 is used, so 102 is the least recently used file in the cache root
+    with patch.object(cache_index.time, "time", return_value=1010):
+        assert paths[0] == my_cache.get(101)
+
+    assert 300 == my_cache.size()
+    my_cache.max_size = 300
+    os.makedirs(my_cache.get_cache_dir(105))
+    new_path = _add_file(my_cache, 105, os.path.join(my_cache.get_cache_dir(105), 'file.ext'), 100, 1020)
+
+    # evicted until the cache is at most 90% of its maximum size
+    assert not os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+    assert my_cache.get(102) is None
+    assert all(os.path.exists(path) for path in (paths[0], new_path, outside_path))
+    assert 200 == my_cache.size()
+
+    statistics = my_cache.statistics()
+    assert 2 == statistics['evicted_files']
+    assert 200 == statistics['evicted_bytes']
+    assert 1 == statistics['hits']
+    assert 1 == statistics['misses']
+
+
+def test_evict():
+    """Files whose cache directories are locked aren't evicted"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    paths = []
+    for i, file_handle_id in enumerate((101, 102, 103)):
+        os.makedirs(my_cache.get_cache_dir(file_handle_id))
+        paths.append(_add_file(
+            my_cache, file_handle_id, os.path.join(my_cache.get_cache_dir(file_handle_id), 'file.ext'), 100, 1000 + i
+        ))
+
+    with pytest.raises(ValueError):
+        my_cache.evict()
+
+    with my_cache._cache_map_lock(my_cache.get_cache_dir(101)):
+        assert (2, 200) == my_cache.evict(max_size=100)
+
+    assert [True, False, False] == [os.path.exists(path) for path in paths]
+    assert (0, 0) == my_cache.evict(max_size=100)
+
+
+@pytest.mark.skipif(not FILE_LOCKS_SUPPORTED, reason="file locks are not supported")
+def test_evict__copying():
+    """A file isn't evicted while it is being copied out of the cache"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    os.makedirs(my_cache.get_cache_dir(101))
+    path = _add_file(my_cache, 101, os.path.join(my_cache.get_cache_dir(101), 'file.ext'), 100, 1000)
+
+    def copy_file(src, dst, copy_mode):
+        # evict from another cache, as another process would
+        assert (0, 0) == cache.Cache(cache_root_dir=tmp_dir).evict(max_size=0)
+        shutil.copy(src, dst)
+
+    with patch.object(cache.file_copy, 'copy_file', side_effect=copy_file):
+        my_cache.copy(101, path, os.path.join(tempfile.mkdtemp(), 'file.ext'))
+
+    assert (1, 100) == my_cache.evict(max_size=0)
+
+
+def test_size__migrated():
+    """The sizes of files migrated from .cacheMap files are found when they are needed"""
+    tmp_dir = tempfile.mkdtemp()
+    legacy_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path = os.path.join(legacy_cache.get_cache_dir(101201), "file1.ext")
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(b'0' * 10)
+    legacy_cache._write_cache_map(
+        legacy_cache.get_cache_dir(101201),
+        {utils.normalize_path(path): cache.epoch_time_to_iso(math.floor(cache._get_modified_time(path)))},
+    )
+
+    assert 10 == cache.Cache(cache_root_dir=tmp_dir).size()
+
+
+def test_size__running_total():
+    """The size of the cache is kept as a running total as files are added, removed and evicted"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, max_size=1000)
+
+    paths = []
+    for i, file_handle_id in enumerate((101, 102, 103)):
+        os.makedirs(my_cache.get_cache_dir(file_handle_id))
+        paths.append(_add_file(
+            my_cache, file_handle_id, os.path.join(my_cache.get_cache_dir(file_handle_id), 'file.ext'), 100, 1000 + i
+        ))
+    assert 300 == my_cache.size()
+
+    statements = []
+    my_cache._index._connect().set_trace_callback(statements.append)
+
+    # a copy of another file handle in the same file isn't counted twice, and files outside the root aren't counted
+    my_cache.add(104, paths[0])
+    _add_file(my_cache, 105, os.path.join(tempfile.mkdtemp(), 'file.ext'), 100, 1010)
+    assert 300 == my_cache.size()
+
+    # a file replaced with a different size
+    _add_file(my_cache, 102, paths[1], 50, 1020)
+    assert 250 == my_cache.size()
+
+    my_cache.remove(101)
+    assert 250 == my_cache.size()
+    my_cache.remove(104)
+    assert 150 == my_cache.size()
+
+    assert (1, 100) == my_cache.evict(max_size=100)
+    assert 50 == my_cache.size()
+
+    # the sizes of the files in the cache were never summed again
+    assert not any('SUM(' in statement for statement in statements)
+
+    # a cache upgraded from an index without a running total sums it once
+    connection = my_cache._index._connect()
+    with connection:
+        connection.execute('DROP TABLE cache_size')
+        connection.execute('PRAGMA user_version = 2')
+    assert 50 == cache.Cache(cache_root_dir=tmp_dir).size()
+
+
+@pytest.mark.parametrize('copy_mode', ['copy', 'link'])
+def test_copy(copy_mode):
+    """A cached file copied to a download location is added to the cache"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, copy_mode=copy_mode)
+
+    cached_path = os.path.join(my_cache.get_cache_dir(101), 'file.ext')
+    os.makedirs(os.path.dirname(cached_path))
+    with open(cached_path, 'w') as f:
+        f.write('data')
+    my_cache.add(101, cached_path)
+
+    download_path = os.path.join(tempfile.mkdtemp(), 'file.ext')
+    my_cache.copy(101, cached_path, download_path)
+
+    with open(download_path) as f:
+        assert 'data' == f.read()
+    assert {utils.normalize_path(cached_path), utils.normalize_path(download_path)} == \
+        set(my_cache._get_cache_map(101))
+    assert utils.normalize_path(download_path) == my_cache.get(101, os.path.dirname(download_path))
+
+
+def test_copy_mode__invalid():
+    with pytest.raises(ValueError):
+        cache.Cache(cache_root_dir=tempfile.mkdtemp(), copy_mode='symlink')
+
+
+@pytest.mark.parametrize('write_cache_maps', [False, True])
+def test_get_many(write_cache_maps):
+    """Many file handles are looked up at once, with the same results as looking each of them up"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir, write_cache_maps=write_cache_maps)
+
+    download_dir = os.path.join(tmp_dir, "download")
+    path1 = utils.touch(os.path.join(my_cache.get_cache_dir(101201), "file1.ext"))
+    path2 = utils.touch(os.path.join(download_dir, "file2.ext"))
+    path3 = utils.touch(os.path.join(my_cache.get_cache_dir(101203), "file3.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+    my_cache.add(file_handle_id=101202, path=path2)
+    my_cache.add(file_handle_id=101203, path=path3)
+    os.remove(path3)
+
+    file_handle_ids = [101201, '101202', 101203, 101204]
+    expected = [utils.normalize_path(path1), utils.normalize_path(path2), None, None]
+    with patch.object(my_cache, "_get_cache_map", wraps=my_cache._get_cache_map) as mock_get_cache_map:
+        assert expected == my_cache.get_many(file_handle_ids)
+    assert mock_get_cache_map.called == write_cache_maps
+    assert expected == [my_cache.get(file_handle_id) for file_handle_id in file_handle_ids]
+
+    # as with get, a cached copy elsewhere is returned if there is none in the given location
+    assert expected == my_cache.get_many(file_handle_ids, path=download_dir)
+    assert expected[:2] == my_cache.get_many([101201, 101202], path=path2)
+
+    assert {'hits': 8, 'misses': 6} == {k: v for k, v in my_cache.statistics().items() if k in ('hits', 'misses')}
+
+
+def test_get_many__batches():
+    """File handles are looked up in batches within the limit on the parameters of a query"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path = utils.touch(os.path.join(tmp_dir, "file.ext"))
+    file_handle_ids = list(range(1, cache_index.MAX_QUERY_FILE_HANDLE_IDS * 2 + 2))
+    for file_handle_id in file_handle_ids[::100]:
+        my_cache.add(file_handle_id=file_handle_id, path=path)
+
+    cached_paths = my_cache.get_many(file_handle_ids)
+    assert [file_handle_id for file_handle_id, cached_path in zip(file_handle_ids, cached_paths) if cached_path] == \
+        file_handle_ids[::100]
+
+
+def test_contains_many():
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    path1 = utils.touch(os.path.join(tmp_dir, "file1.ext"))
+    path2 = utils.touch(os.path.join(tmp_dir, "file2.ext"))
+    my_cache.add(file_handle_id=101201, path=path1)
+    my_cache.add(file_handle_id=101202, path=path2)
+
+    # modify the second file
+    new_time_stamp = cache._get_modified_time(path2) + 2
+    os.utime(path2, (new_time_stamp, new_time_stamp))
+
+    assert [True, False, False, False] == my_cache.contains_many(
+        [(101201, path1), (101202, path2), (101201, path2), (101203, path1)]
+    )
+
+
+def test_get_many__index_unavailable():
+    """The .cacheMap files are used if the cache index can't be used"""
+    tmp_dir = tempfile.mkdtemp()
+    my_cache = cache.Cache(cache_root_dir=tmp_dir)
+
+    with patch.object(cache_index.sqlite3, "connect", side_effect=sqlite3.OperationalError("unable to open")):
+        path = utils.touch(os.path.join(tmp_dir, "not_in_cache", "file1.ext"))
+        my_cache.add(file_handle_id=101201, path=path)
+
+        assert [utils.normalize_path(path), None] == my_cache.get_many([101201, 101202])
+        assert [True] == my_cache.contains_many([(101201, path)])
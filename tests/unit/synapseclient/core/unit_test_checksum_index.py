@@ -0,0 +1,152 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from unittest import mock
+
+from synapseclient.core import checksum_index
+from synapseclient.core.checksum_index import ChecksumIndex
+
+
+class TestChecksumIndex:
+
+    def setup(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = ChecksumIndex(os.path.join(self.tmp_dir.name, 'cache', checksum_index.CHECKSUM_INDEX_FILE_NAME))
+        self.data = os.urandom(1000)
+        self.md5_hex = hashlib.md5(self.data).hexdigest()
+        self.file_path = self._write('foo.bin', self.data, age=60)
+
+    def teardown(self):
+        self.tmp_dir.cleanup()
+
+    def _write(self, name, data, age=0):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        mtime = os.stat(path).st_mtime - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def _md5_for_file(self, path):
+        with mock.patch.object(checksum_index, 'MIN_INDEXED_SIZE', 0), \
+                mock.patch.object(checksum_index, '_hash_file', wraps=checksum_index._hash_file) as mock_hash_file:
+            md5_hex = self.index.md5_for_file(path)
+        return md5_hex, mock_hash_file.called
+
+    def test_get_put(self):
+        file_stat = os.stat(self.file_path)
+        assert self.index.get(file_stat) is None
+
+        self.index.put(file_stat, self.md5_hex, self.file_path)
+        assert self.md5_hex == self.index.get(file_stat)
+
+        self.index.clear()
+        assert self.index.get(file_stat) is None
+
+    def test_md5_for_file(self):
+        """A file is read the first time it is hashed and its MD5 taken from the index after that"""
+        assert (self.md5_hex, True) == self._md5_for_file(self.file_path)
+        assert (self.md5_hex, False) == self._md5_for_file(self.file_path)
+
+        # another index on the same database, e.g. in another process
+        self.index = ChecksumIndex(self.index.path)
+        assert (self.md5_hex, False) == self._md5_for_file(self.file_path)
+
+    def test_md5_for_file__modified(self):
+        """A file is hashed again if its size or modification time has changed"""
+        self._md5_for_file(self.file_path)
+
+        data = os.urandom(len(self.data))
+        self._write('foo.bin', data, age=30)
+        assert (hashlib.md5(data).hexdigest(), True) == self._md5_for_file(self.file_path)
+
+        data += b'bar'
+        self._write('foo.bin', data, age=30)
+        assert (hashlib.md5(data).hexdigest(), True) == self._md5_for_file(self.file_path)
+
+    def test_md5_for_file__recently_modified(self):
+        """The MD5 of a file modified within the timestamp resolution isn't recorded"""
+        file_path = self._write('bar.bin', self.data)
+        assert (self.md5_hex, True) == self._md5_for_file(file_path)
+        assert (self.md5_hex, True) == self._md5_for_file(file_path)
+
+    def test_md5_for_file__small_file(self):
+        with mock.patch.object(self.index, 'get') as mock_get, mock.patch.object(self.index, 'put') as mock_put:
+            assert self.md5_hex == self.index.md5_for_file(self.file_path)
+
+        mock_get.assert_not_called()
+        mock_put.assert_not_called()
+
+    def test_unusable_database(self):
+        """If the database can't be opened files are still hashed"""
+        self._write('cache', b'not a directory')
+        assert (self.md5_hex, True) == self._md5_for_file(self.file_path)
+        assert (self.md5_hex, True) == self._md5_for_file(self.file_path)
+
+    def test_record(self):
+        file_stat = os.stat(self.file_path)
+        self.index.record(self.file_path, file_stat, self.md5_hex)
+        assert self.md5_hex == self.index.get(file_stat)
+
+        # the file changed after its stat was taken
+        self._write('foo.bin', self.data + b'bar', age=60)
+        self.index.clear()
+        self.index.record(self.file_path, file_stat, self.md5_hex)
+        assert self.index.get(file_stat) is None
+
+    def test_prune(self):
+        """The MD5s of files that were deleted, or replaced by other files, are removed"""
+        deleted_path = self._write('deleted.bin', self.data, age=60)
+        replaced_path = self._write('replaced.bin', self.data, age=60)
+        stats = {path: os.stat(path) for path in (self.file_path, deleted_path, replaced_path)}
+        for path, file_stat in stats.items():
+            self.index.put(file_stat, self.md5_hex, path)
+
+        os.remove(deleted_path)
+        # a new file is written and renamed over the old one, so it has another inode
+        os.rename(self._write('new.bin', self.data, age=60), replaced_path)
+
+        assert 2 == self.index.prune()
+        assert self.md5_hex == self.index.get(stats[self.file_path])
+        assert self.index.get(stats[deleted_path]) is None
+        assert self.index.get(stats[replaced_path]) is None
+        assert 0 == self.index.prune()
+
+    def test_prune__interval(self):
+        """The index is pruned when it is first used if it hasn't been pruned recently"""
+        with mock.patch.object(self.index, 'prune', wraps=self.index.prune) as mock_prune:
+            self.index.get(os.stat(self.file_path))
+            self.index.get(os.stat(self.file_path))
+        assert 1 == mock_prune.call_count
+
+        # another index on the same database, e.g. in another process
+        index = ChecksumIndex(self.index.path)
+        with mock.patch.object(index, 'prune') as mock_prune:
+            index.get(os.stat(self.file_path))
+        mock_prune.assert_not_called()
+
+        index = ChecksumIndex(self.index.path)
+        with mock.patch.object(index, 'prune') as mock_prune, \
+                mock.patch.object(time, 'time', return_value=time.time() + checksum_index.PRUNE_INTERVAL_SECONDS + 1):
+            index.get(os.stat(self.file_path))
+        mock_prune.assert_called_once_with()
+
+    def test_upgrade_schema(self):
+        """MD5s recorded without their paths, before the schema was versioned, are kept until the index is pruned"""
+        file_stat = os.stat(self.file_path)
+        os.makedirs(os.path.dirname(self.index.path))
+        connection = sqlite3.connect(self.index.path)
+        connection.execute(
+            'CREATE TABLE md5 (device INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL, md5 TEXT NOT NULL, PRIMARY KEY (device, inode))'
+        )
+        connection.execute('INSERT INTO md5 VALUES (?, ?, ?, ?, ?)', checksum_index._stat_key(file_stat) + ('foo',))
+        connection.commit()
+        connection.close()
+
+        with mock.patch.object(self.index, 'prune'):
+            assert 'foo' == self.index.get(file_stat)
+        assert 1 == self.index.prune()
+        assert self.index.get(file_stat) is None
@@ -12,10 +12,11 @@ import requests
 
 import synapseclient.core.constants.concrete_types as concrete_types
 import synapseclient.core.multithread_download as multithread_download
-from synapseclient import File, Synapse
+from synapseclient import File, Folder, Synapse
 from synapseclient.core import sts_transfer
 from synapseclient import client
 from synapseclient.core import utils
+from synapseclient.core.download_urls import PresignedUrlStore
 from synapseclient.core.exceptions import SynapseHTTPError, SynapseMd5MismatchError, SynapseError, \
     SynapseFileNotFoundError
 
@@ -283,8 +284,11 @@ class Test__downloadFileHandle(unittest.TestCase):
                 destination="/myfakepath",
             )
 
-            mock_multi_thread_download.assert_called_once_with(123, 456, "FileEntity", "/myfakepath",
-                                                               expected_md5="someMD5")
+            mock_multi_thread_download.assert_called_once_with(
+                123, 456, "FileEntity", "/myfakepath",
+                expected_md5="someMD5",
+                file_size=multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE + 1,
+            )
 
     def _multithread_not_applicable(self, file_handle):
         with patch.object(os, "makedirs"), \
@@ -328,6 +332,49 @@ class Test__downloadFileHandle(unittest.TestCase):
         }
         self._multithread_not_applicable(file_handle)
 
+    def test_multithread_true__external_fileHandle(self):
+        """Files from other servers are downloaded multi threaded if the server honors range requests"""
+        file_size = multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE + 1
+        with patch.object(os, "makedirs"), \
+                patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
+                patch.object(self.syn, "_download_from_url_multi_threaded") as mock_multi_thread_download, \
+                patch.object(multithread_download, "probe_range_support", return_value=file_size) as mock_probe, \
+                patch.object(self.syn, "cache"):
+
+            mock_getFileHandleDownload.return_value = {
+                'fileHandle': {
+                    'id': '123',
+                    'concreteType': concrete_types.EXTERNAL_FILE_HANDLE,
+                    'contentMd5': 'someMD5',
+                },
+                'preSignedURL': 'https://foo.com/bar.txt',
+            }
+
+            self.syn.multi_threaded = True
+            self.syn._downloadFileHandle(
+                fileHandleId=123,
+                objectId=456,
+                objectType="FileEntity",
+                destination="/myfakepath",
+            )
+
+            mock_probe.assert_called_once_with('https://foo.com/bar.txt', file_size=None)
+            mock_multi_thread_download.assert_called_once_with(
+                123, 456, "FileEntity", "/myfakepath",
+                expected_md5="someMD5",
+                file_size=file_size,
+            )
+
+    def test_multithread_true__ranges_not_supported(self):
+        file_handle = {
+            'id': '123',
+            'concreteType': "org.sagebionetworks.repo.model.file.GoogleCloudFileHandle",
+            'contentMd5': 'someMD5',
+            'contentSize': multithread_download.SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE + 1,
+        }
+        with patch.object(multithread_download, "probe_range_support", return_value=None):
+            self._multithread_not_applicable(file_handle)
+
     def test_multithread_false__S3_fileHandle(self):
         with patch.object(os, "makedirs"), \
                 patch.object(self.syn, "_getFileHandleDownload") as mock_getFileHandleDownload, \
@@ -361,13 +408,13 @@ class Test_download_from_url_multi_threaded:
         self.syn = syn
 
     def test_md5_mismatch(self):
-        with patch.object(multithread_download, "download_file"), \
+        with patch.object(multithread_download, "download_file") as mock_download_file, \
              patch.object(utils, "md5_for_file") as mock_md5_for_file, \
                 patch.object(os, "remove") as mock_os_remove, \
                 patch.object(shutil, "move") as mock_move:
             path = os.path.abspath("/myfakepath")
 
-            mock_md5_for_file.return_value.hexdigest.return_value = "unexpetedMd5"
+            mock_download_file.return_value = "unexpetedMd5"
 
             pytest.raises(SynapseMd5MismatchError, self.syn._download_from_url_multi_threaded, file_handle_id=123,
                           object_id=456, object_type="FileEntity",
@@ -376,8 +423,11 @@ class Test_download_from_url_multi_threaded:
             mock_os_remove.assert_called_once_with(utils.temp_download_filename(path, 123))
             mock_move.assert_not_called()
 
+            # the md5 computed during the download is used rather than reading the file again
+            assert not mock_md5_for_file.called
+
     def test_md5_match(self):
-        with patch.object(multithread_download, "download_file"), \
+        with patch.object(multithread_download, "download_file") as mock_download_file, \
              patch.object(utils, "md5_for_file") as mock_md5_for_file, \
                 patch.object(os, "remove") as mock_os_remove, \
                 patch.object(shutil, "move") as mock_move:
@@ -385,7 +435,7 @@ class Test_download_from_url_multi_threaded:
 
             expected_md5 = "myExpectedMd5"
 
-            mock_md5_for_file.return_value.hexdigest.return_value = expected_md5
+            mock_download_file.return_value = expected_md5
 
             self.syn._download_from_url_multi_threaded(
                 file_handle_id=123,
@@ -397,6 +447,7 @@ class Test_download_from_url_multi_threaded:
 
             mock_os_remove.assert_not_called()
             mock_move.assert_called_once_with(utils.temp_download_filename(path, 123), path)
+            assert not mock_md5_for_file.called
 
 
 def test_download_end_early_retry(syn):
@@ -470,6 +521,7 @@ def test_download_md5_mismatch__not_local_file(syn):
          patch.object(utils, 'temp_download_filename', return_value=temp_destination) as mocked_temp_dest, \
             patch.object(client, 'open', new_callable=mock_open(), create=True) as mocked_open, \
             patch.object(os.path, 'exists', side_effect=[False, True]) as mocked_exists, \
+            patch.object(multithread_download, 'discard_partial_download') as mocked_discard_partial_download, \
             patch.object(shutil, 'move') as mocked_move, \
             patch.object(os, 'remove') as mocked_remove:
         # function under test
@@ -479,6 +531,9 @@ def test_download_md5_mismatch__not_local_file(syn):
         # assert temp_download_filename() called once
         mocked_temp_dest.assert_called_once_with(destination, None)
 
+        # any multi threaded partial download can't be resumed by a single threaded download
+        mocked_discard_partial_download.assert_called_once_with(temp_destination)
+
         # assert exists called 2 times
         assert [call(temp_destination), call(destination)] == mocked_exists.call_args_list
 
@@ -526,6 +581,22 @@ def test_download_file_entity__correct_local_state(syn):
         assert os.path.basename(mock_cache_path) == file_entity.files[0]
 
 
+def test_download_file_entity__copy_from_cache(syn):
+    """A cached file is copied to the download location with the cache, which records the copy"""
+    mock_cache_path = utils.normalize_path("/i/will/show/you/the/path/yi.txt")
+    download_location = tempfile.mkdtemp()
+    file_entity = File(parentId="syn123")
+    file_entity.dataFileHandleId = 123
+    with patch.object(syn.cache, 'get', return_value=mock_cache_path), \
+            patch.object(syn.cache, 'copy') as mock_copy:
+        syn._download_file_entity(downloadLocation=download_location, entity=file_entity, ifcollision="keep.both",
+                                  submission=None)
+
+    download_path = utils.normalize_path(os.path.join(download_location, 'yi.txt'))
+    mock_copy.assert_called_once_with(123, mock_cache_path, download_path)
+    assert download_path == file_entity.path
+
+
 def test_getFileHandleDownload__error_UNAUTHORIZED(syn):
     ret_val = {'requestedFiles': [{'failureCode': 'UNAUTHORIZED', }]}
     with patch.object(syn, "restPOST", return_value=ret_val):
@@ -536,3 +607,87 @@ def test_getFileHandleDownload__error_NOT_FOUND(syn):
     ret_val = {'requestedFiles': [{'failureCode': 'NOT_FOUND', }]}
     with patch.object(syn, "restPOST", return_value=ret_val):
         pytest.raises(SynapseFileNotFoundError, syn._getFileHandleDownload, '123', 'syn456')
+
+
+def test_getFileHandleDownload__url_from_get_download_urls(syn):
+    """A url resolved by get_download_urls is used rather than requesting it again"""
+    url = 'https://bucket.example.com/foo?X-Amz-Date=20990101T000000Z&X-Amz-Expires=3600'
+    file_result = {'fileHandleId': '123', 'fileHandle': {'id': '123'}, 'preSignedURL': url}
+    ret_val = {'requestedFiles': [file_result]}
+
+    with patch.object(syn, '_download_url_store', PresignedUrlStore()), \
+            patch.object(syn, "restPOST", return_value=ret_val) as mock_rest_post:
+        assert [file_result] == syn.get_download_urls([('123', 'syn456')])
+        assert file_result == syn._getFileHandleDownload('123', 'syn456')
+        assert 1 == mock_rest_post.call_count
+
+
+class TestOpen:
+
+    def setup(self):
+        self.file_entity = File(id='syn456', parentId='syn123', dataFileHandleId='123')
+        self.file_entity._update_file_handle({'id': '123', 'fileName': 'foo.txt', 'contentSize': 100})
+
+    def test_open__cached(self, syn):
+        """A file that's already in the cache is opened locally"""
+        with tempfile.NamedTemporaryFile() as temp_file, \
+                patch.object(syn.cache, 'get', return_value=temp_file.name), \
+                patch.object(client.remote_file, 'open_remote_file') as mock_open_remote_file, \
+                patch.object(syn, 'get') as mock_get:
+            with syn.open(self.file_entity) as f:
+                assert temp_file.name == f.name
+
+        assert not mock_get.called
+        assert not mock_open_remote_file.called
+
+    def test_open__remote(self, syn):
+        with patch.object(syn.cache, 'get', return_value=None), \
+                patch.object(client.remote_file, 'open_remote_file') as mock_open_remote_file, \
+                patch.object(syn, 'get', return_value=self.file_entity) as mock_get:
+            assert mock_open_remote_file.return_value == syn.open('syn456', version=2, block_size=1024)
+
+        mock_get.assert_called_once_with('syn456', version=2, downloadFile=False)
+        mock_open_remote_file.assert_called_once_with(
+            syn,
+            multithread_download.DownloadRequest(123, 'syn456', 'FileEntity', None, file_size=100),
+            block_size=1024,
+        )
+
+    def test_open__text(self, syn):
+        with tempfile.NamedTemporaryFile() as temp_file, \
+                patch.object(syn.cache, 'get', return_value=temp_file.name):
+            temp_file.write('foo\nbar\n'.encode('utf-8'))
+            temp_file.flush()
+
+            with syn.open(self.file_entity, 'r', encoding='utf-8') as f:
+                assert ['foo\n', 'bar\n'] == f.readlines()
+
+    def test_open__invalid(self, syn):
+        with pytest.raises(ValueError):
+            syn.open(self.file_entity, 'wb')
+
+        with patch.object(syn, 'get', return_value=Folder(id='syn123', parentId='syn1')):
+            with pytest.raises(ValueError):
+                syn.open('syn123')
+
+    def test_iter_content__cached(self, syn):
+        with tempfile.NamedTemporaryFile() as temp_file, \
+                patch.object(syn.cache, 'get', return_value=temp_file.name):
+            temp_file.write(b'foobar')
+            temp_file.flush()
+
+            assert [b'foob', b'ar'] == list(syn.iter_content(self.file_entity, chunk_size=4))
+
+    def test_iter_content__remote(self, syn):
+        self.file_entity._file_handle['contentMd5'] = 'abc'
+        with patch.object(syn.cache, 'get', return_value=None), \
+                patch.object(client.remote_file, 'iter_remote_content') as mock_iter_remote_content:
+            assert mock_iter_remote_content.return_value == syn.iter_content(self.file_entity, 10, max_threads=3)
+
+        mock_iter_remote_content.assert_called_once_with(
+            syn,
+            multithread_download.DownloadRequest(123, 'syn456', 'FileEntity', None, file_size=100),
+            10,
+            max_threads=3,
+            expected_md5='abc',
+        )
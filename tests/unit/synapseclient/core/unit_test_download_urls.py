@@ -0,0 +1,141 @@
+import datetime
+import json
+from unittest import mock
+
+from synapseclient.core import download_urls
+from synapseclient.core.download_urls import DownloadUrlRequest, PresignedUrlStore, _UrlCache
+
+
+def _signed_url(key, signed_at, expires_seconds=3600, prefix='Amz'):
+    return (f"https://bucket.example.com/{key}?X-{prefix}-Date={signed_at.strftime('%Y%m%dT%H%M%SZ')}"
+            f"&X-{prefix}-Expires={expires_seconds}")
+
+
+def _file_result(file_handle_id, url):
+    return {
+        'fileHandleId': file_handle_id,
+        'fileHandle': {'id': file_handle_id},
+        'preSignedURL': url,
+    }
+
+
+def test_download_url_request_of():
+    assert DownloadUrlRequest('123', 'syn1', 'FileEntity') == DownloadUrlRequest.of((123, 'syn1'))
+    assert DownloadUrlRequest('123', 'syn1', 'FileEntity') == DownloadUrlRequest.of((123, 'syn1', None))
+    assert DownloadUrlRequest('123', 'syn1', 'TableEntity') == DownloadUrlRequest.of(('123', 'syn1', 'TableEntity'))
+
+
+def test_url_expiration_time():
+    signed_at = datetime.datetime(2021, 1, 2, 3, 4, 5)
+    expected = signed_at + datetime.timedelta(seconds=30)
+
+    assert expected == download_urls.url_expiration_time(_signed_url('foo', signed_at, 30))
+    assert expected == download_urls.url_expiration_time(_signed_url('foo', signed_at, 30, prefix='Goog'))
+    assert download_urls.url_expiration_time('https://example.com/foo') is None
+
+
+class TestUrlCache:
+
+    def test_max_size(self):
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        cache = _UrlCache(2)
+        for i in range(3):
+            cache[i] = (later, i)
+
+        assert [1, 2] == list(cache.keys())
+
+    def test_prune_expired(self):
+        utcnow = datetime.datetime.utcnow()
+        cache = _UrlCache(10)
+        cache['expired'] = (utcnow - datetime.timedelta(seconds=1), 1)
+        cache['current'] = (utcnow + datetime.timedelta(hours=1), 2)
+
+        assert ['current'] == list(cache.keys())
+
+
+class TestPresignedUrlStore:
+
+    def setup(self):
+        self.syn = mock.Mock()
+        self.store = PresignedUrlStore()
+
+    def _mock_batch_responses(self, signed_at=None):
+        signed_at = signed_at or datetime.datetime.utcnow()
+
+        def rest_post(uri, body, endpoint):
+            requested_files = json.loads(body)['requestedFiles']
+            return {
+                'requestedFiles': [
+                    _file_result(f['fileHandleId'], _signed_url(f['fileHandleId'], signed_at))
+                    for f in requested_files
+                ]
+            }
+        self.syn.restPOST.side_effect = rest_post
+
+    def test_get_urls__batches(self):
+        """Verify that urls are requested in batches of the maximum size, and returned in the requested order"""
+        self._mock_batch_responses()
+        requested_files = [(i, f"syn{i}") for i in range(5)]
+
+        with mock.patch.object(download_urls, 'MAX_FILE_HANDLES_PER_BATCH_REQUEST', 2):
+            results = self.store.get_urls(self.syn, requested_files)
+
+        assert [str(i) for i in range(5)] == [r['fileHandleId'] for r in results]
+        assert 3 == self.syn.restPOST.call_count
+
+        first_body = json.loads(self.syn.restPOST.call_args_list[0][1]['body'])
+        assert {
+            'includeFileHandles': True,
+            'includePreSignedURLs': True,
+            'requestedFiles': [
+                {'fileHandleId': '0', 'associateObjectId': 'syn0', 'associateObjectType': 'FileEntity'},
+                {'fileHandleId': '1', 'associateObjectId': 'syn1', 'associateObjectType': 'FileEntity'},
+            ]
+        } == first_body
+        assert self.syn.fileHandleEndpoint == self.syn.restPOST.call_args_list[0][1]['endpoint']
+
+    def test_get_urls__cached(self):
+        """Verify that previously resolved urls are reused and only missing urls are requested"""
+        self._mock_batch_responses()
+        first_results = self.store.get_urls(self.syn, [(1, 'syn1'), (2, 'syn2')])
+        self.syn.restPOST.reset_mock()
+
+        results = self.store.get_urls(self.syn, [(2, 'syn2'), (3, 'syn3'), (1, 'syn1')])
+        assert [first_results[1], first_results[0]] == [results[0], results[2]]
+        assert '3' == results[1]['fileHandleId']
+
+        body = json.loads(self.syn.restPOST.call_args[1]['body'])
+        assert ['3'] == [f['fileHandleId'] for f in body['requestedFiles']]
+
+    def test_get_urls__refresh_before_expiry(self):
+        """Verify that a cached url without enough life left is requested again"""
+        self._mock_batch_responses(signed_at=datetime.datetime.utcnow() - datetime.timedelta(seconds=3590))
+        self.store.get_urls(self.syn, [(1, 'syn1')])
+
+        self.store.get_urls(self.syn, [(1, 'syn1')], min_remaining_life=datetime.timedelta(seconds=5))
+        assert 1 == self.syn.restPOST.call_count
+
+        self.store.get_urls(self.syn, [(1, 'syn1')], min_remaining_life=datetime.timedelta(seconds=30))
+        assert 2 == self.syn.restPOST.call_count
+
+    def test_get_urls__not_cached(self):
+        """Failures and urls that we can't tell the expiration of are not cached"""
+        self.syn.restPOST.return_value = {
+            'requestedFiles': [
+                {'fileHandleId': '1', 'failureCode': 'NOT_FOUND'},
+                _file_result('2', 'https://example.com/external'),
+            ]
+        }
+
+        for _ in range(2):
+            results = self.store.get_urls(self.syn, [(1, 'syn1'), (2, 'syn2')])
+            assert self.syn.restPOST.return_value['requestedFiles'] == results
+        assert 2 == self.syn.restPOST.call_count
+
+    def test_invalidate(self):
+        self._mock_batch_responses()
+        self.store.get_urls(self.syn, [(1, 'syn1')])
+
+        self.store.invalidate((1, 'syn1', 'FileEntity'))
+        self.store.get_urls(self.syn, [(1, 'syn1')])
+        assert 2 == self.syn.restPOST.call_count
@@ -0,0 +1,119 @@
+import os
+import shutil
+import stat
+import tempfile
+from unittest import mock
+
+import pytest
+
+from synapseclient.core import file_copy
+
+
+@pytest.fixture
+def src():
+    path = os.path.join(tempfile.mkdtemp(), 'src.txt')
+    with open(path, 'w') as f:
+        f.write('some data')
+    return path
+
+
+@pytest.fixture
+def dst():
+    return os.path.join(tempfile.mkdtemp(), 'dst.txt')
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_copy_file__copy(src, dst):
+    """The default mode makes a plain copy"""
+    with mock.patch.object(file_copy, '_reflink') as mock_reflink:
+        assert 'copy' == file_copy.copy_file(src, dst)
+
+    assert not mock_reflink.called
+    assert 'some data' == _read(dst)
+    assert not os.path.samefile(src, dst)
+
+
+@pytest.mark.parametrize('copy_mode', ['clone', 'link'])
+def test_copy_file__reflink(src, dst, copy_mode):
+    """A reflink is used in preference to any other way of copying"""
+    with mock.patch.object(file_copy, '_reflink', side_effect=lambda s, d: shutil.copy(s, d) or True) \
+            as mock_reflink, \
+            mock.patch.object(file_copy, '_hardlink') as mock_hardlink:
+        assert 'reflink' == file_copy.copy_file(src, dst, copy_mode)
+
+    # the clone is made at a temporary name, which is renamed to dst
+    mock_reflink.assert_called_once_with(src, mock.ANY)
+    assert os.path.dirname(dst) == os.path.dirname(mock_reflink.call_args[0][1])
+    assert not mock_hardlink.called
+
+
+def test_copy_file__clone(src, dst):
+    """A clone falls back to an independent copy, and never to a hardlink"""
+    with mock.patch.object(file_copy, '_reflink', return_value=False), \
+            mock.patch.object(file_copy, '_hardlink') as mock_hardlink:
+        copied = file_copy.copy_file(src, dst, 'clone')
+
+    assert copied in ('copy_file_range', 'copy')
+    assert not mock_hardlink.called
+    assert 'some data' == _read(dst)
+    assert not os.path.samefile(src, dst)
+
+
+def test_copy_file__hardlink(src, dst):
+    """A hardlink replaces any existing file and is read only"""
+    with open(dst, 'w') as f:
+        f.write('old data')
+
+    with mock.patch.object(file_copy, '_reflink', return_value=False):
+        assert 'hardlink' == file_copy.copy_file(src, dst, 'link')
+
+    assert os.path.samefile(src, dst)
+    assert not os.stat(dst).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert [] == [name for name in os.listdir(os.path.dirname(dst)) if name != 'dst.txt']
+
+    # copying again to the link leaves it alone
+    assert file_copy.copy_file(src, dst, 'link') is None
+
+
+def test_copy_file__hardlink_failed(src, dst):
+    """A link falls back to copying when a hardlink can't be made, e.g. across file systems"""
+    with mock.patch.object(file_copy, '_reflink', return_value=False), \
+            mock.patch.object(os, 'link', side_effect=OSError('Invalid cross-device link')), \
+            mock.patch.object(file_copy, '_copy_file_range', return_value=False):
+        assert 'copy' == file_copy.copy_file(src, dst, 'link')
+
+    assert 'some data' == _read(dst)
+    assert not os.path.samefile(src, dst)
+
+
+@pytest.mark.parametrize('copy_mode', ['copy', 'clone', 'link'])
+def test_copy_file__replaces_hardlink(src, dst, copy_mode):
+    """Copying to a path that is a hardlink of another file replaces the link rather than changing the other file"""
+    other = os.path.join(os.path.dirname(src), 'other.txt')
+    with open(other, 'w') as f:
+        f.write('other data')
+    os.link(other, dst)
+
+    file_copy.copy_file(src, dst, copy_mode)
+
+    assert 'some data' == _read(dst)
+    assert 'other data' == _read(other)
+    assert [] == [name for name in os.listdir(os.path.dirname(dst)) if name != 'dst.txt']
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason="copy_file_range is not available")
+def test_copy_file_range(src, dst):
+    os.chmod(src, 0o640)
+    assert file_copy._copy_file_range(src, dst)
+
+    assert 'some data' == _read(dst)
+    assert 0o640 == stat.S_IMODE(os.stat(dst).st_mode)
+
+
+def test_copy_file__invalid_mode(src, dst):
+    with pytest.raises(ValueError):
+        file_copy.copy_file(src, dst, 'symlink')
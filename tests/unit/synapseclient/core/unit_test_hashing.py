@@ -0,0 +1,103 @@
+import concurrent.futures
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+
+from synapseclient.core import hashing
+from synapseclient.core.checksum_index import ChecksumIndex
+from synapseclient.core.hashing import HashService
+
+
+def test_md5_of_file():
+    with tempfile.NamedTemporaryFile() as f:
+        data = os.urandom(10000)
+        f.write(data)
+        f.flush()
+
+        assert hashlib.md5(data).hexdigest() == hashing.md5_of_file(f.name, block_size=4096)
+
+
+class TestHashService:
+
+    def setup(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = ChecksumIndex(os.path.join(self.tmp_dir.name, 'checksums.sqlite'))
+        self.service = HashService(2, index=self.index)
+
+    def teardown(self):
+        self.service.shutdown()
+        self.tmp_dir.cleanup()
+
+    def _write(self, name, data, age=60):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        mtime = os.stat(path).st_mtime - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_submit(self):
+        """Files are hashed on the threads of the pool and their MD5s recorded in the index"""
+        files = {self._write(f"{i}.bin", os.urandom(1000 + i)): None for i in range(4)}
+        with mock.patch.object(hashing, 'INLINE_HASH_SIZE', 0):
+            futures = {path: self.service.submit(path) for path in files}
+
+        for path, future in futures.items():
+            with open(path, 'rb') as f:
+                md5_hex = hashlib.md5(f.read()).hexdigest()
+            assert md5_hex == future.result(timeout=30)
+            assert md5_hex == self.index.get(os.stat(path))
+
+        # no processes are started, which would re-run the __main__ module of a script without a guard
+        assert isinstance(self.service._executor, concurrent.futures.ThreadPoolExecutor)
+
+    def test_submit__indexed(self):
+        path = self._write('foo.bin', b'foo')
+        self.index.put(os.stat(path), 'bar', path)
+
+        with mock.patch.object(hashing, 'INLINE_HASH_SIZE', 0):
+            assert 'bar' == self.service.submit(path).result()
+        assert self.service._executor is None
+
+    def test_submit__index(self):
+        """The index submitted with a file is used rather than the index of the service, if any"""
+        path = self._write('foo.bin', b'foo')
+        index = ChecksumIndex(os.path.join(self.tmp_dir.name, 'other.sqlite'))
+        index.put(os.stat(path), 'bar', path)
+
+        with mock.patch.object(hashing, 'INLINE_HASH_SIZE', 0), HashService(2) as service:
+            assert 'bar' == service.submit(path, index).result()
+            assert 'bar' == self.service.submit(path, index).result()
+
+            # without an index the file is just hashed
+            assert hashlib.md5(b'foo').hexdigest() == service.submit(path).result(timeout=30)
+
+    def test_submit__small_file(self):
+        """Small files are hashed as they are submitted rather than being queued for the pool"""
+        path = self._write('foo.bin', b'foo')
+        future = self.service.submit(path)
+
+        assert future.done()
+        assert hashlib.md5(b'foo').hexdigest() == future.result()
+        assert self.service._executor is None
+
+    def test_submit__missing_file(self):
+        future = self.service.submit(os.path.join(self.tmp_dir.name, 'missing'))
+        with pytest.raises(FileNotFoundError):
+            future.result()
+
+
+def test_index_files():
+    index = mock.Mock()
+    with mock.patch.object(hashing, 'HashService') as mock_service_cls, \
+            mock.patch.object(hashing, '_iter_files', return_value=iter(['a', 'b/c'])) as mock_iter_files:
+        service = mock_service_cls.return_value.__enter__.return_value
+        assert 2 == hashing.index_files(['a', 'b'], index, max_workers=3)
+
+    mock_service_cls.assert_called_once_with(3, index=index)
+    mock_iter_files.assert_called_once_with(['a', 'b'])
+    assert [mock.call('a'), mock.call('b/c')] == service.submit.call_args_list
+    assert 2 == service.submit.return_value.result.call_count
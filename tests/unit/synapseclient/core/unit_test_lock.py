@@ -1,9 +1,15 @@
+import multiprocessing
+import os
 import random
+import tempfile
 import time
 from threading import Thread
 from datetime import timedelta
 
-from synapseclient.core.lock import Lock
+import pytest
+
+from synapseclient.core.exceptions import SynapseFileCacheError
+from synapseclient.core.lock import FILE_LOCKS_SUPPORTED, FileLock, Lock
 
 
 def test_lock():
@@ -78,3 +84,91 @@ def test_multithreaded():
 
     for key in counts:
         assert counts[key] == set(range(NUMBER_OF_TIMES_PER_THREAD))
+
+
+requires_file_locks = pytest.mark.skipif(not FILE_LOCKS_SUPPORTED, reason="file locks are not supported")
+
+
+@requires_file_locks
+def test_file_lock():
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = FileLock("foo", dir=lock_dir)
+    user2_lock = FileLock("foo", dir=lock_dir)
+
+    assert user1_lock.acquire()
+    assert not user2_lock.acquire()
+
+    user1_lock.release()
+
+    with user2_lock:
+        assert user2_lock.held
+        assert not user1_lock.acquire()
+    assert not user2_lock.held
+
+
+@requires_file_locks
+def test_file_lock__shared():
+    """Shared locks are held at once, but not with an exclusive lock"""
+    lock_dir = tempfile.mkdtemp()
+    reader1_lock = FileLock("foo", dir=lock_dir, shared=True)
+    reader2_lock = FileLock("foo", dir=lock_dir, shared=True)
+    writer_lock = FileLock("foo", dir=lock_dir)
+
+    assert reader1_lock.acquire()
+    assert reader2_lock.acquire()
+    assert not writer_lock.acquire()
+
+    reader1_lock.release()
+    reader2_lock.release()
+
+    assert writer_lock.acquire()
+    assert not reader1_lock.acquire()
+    writer_lock.release()
+
+
+@requires_file_locks
+def test_file_lock__blocking():
+    """A blocking acquire waits for the lock to be released"""
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = FileLock("foo", dir=lock_dir)
+    user2_lock = FileLock("foo", dir=lock_dir)
+
+    user1_lock.acquire()
+    releaser = Thread(target=lambda: (time.sleep(0.2), user1_lock.release()))
+    releaser.start()
+
+    start = time.time()
+    assert user2_lock.blocking_acquire()
+    assert time.time() - start >= 0.1
+    releaser.join()
+    user2_lock.release()
+
+
+@requires_file_locks
+def test_file_lock__timeout():
+    lock_dir = tempfile.mkdtemp()
+    user1_lock = FileLock("foo", dir=lock_dir)
+    user2_lock = FileLock("foo", dir=lock_dir, default_blocking_timeout=timedelta(seconds=0.2))
+
+    with user1_lock:
+        with pytest.raises(SynapseFileCacheError):
+            user2_lock.blocking_acquire()
+        assert not user2_lock.held
+
+
+def _exit_holding_lock(lock_dir):
+    FileLock("foo", dir=lock_dir).acquire()
+    os._exit(0)
+
+
+@requires_file_locks
+def test_file_lock__process_exit():
+    """A lock is released when the process holding it exits without releasing it"""
+    lock_dir = tempfile.mkdtemp()
+    process = multiprocessing.Process(target=_exit_holding_lock, args=(lock_dir,))
+    process.start()
+    process.join()
+
+    lock = FileLock("foo", dir=lock_dir, default_blocking_timeout=timedelta(seconds=5))
+    with lock:
+        assert lock.held
@@ -0,0 +1,190 @@
+import hashlib
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from synapseclient.core import remote_file
+from synapseclient.core.exceptions import SynapseError, SynapseHTTPError, SynapseMd5MismatchError
+from synapseclient.core.multithread_download.download_threads import DownloadRequest, PresignedUrlInfo
+from synapseclient.core.remote_file import RemoteFile
+
+
+class _RangeSession:
+    """A fake requests session serving byte ranges of some data, recording the ranges requested"""
+
+    def __init__(self, data, status_codes=()):
+        self.data = data
+        self.ranges = []
+        self.urls = []
+        self._status_codes = list(status_codes)
+
+    def get(self, url, headers, stream):
+        start, end = (int(i) for i in headers['Range'][len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        self.urls.append(url)
+
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.status_code = self._status_codes.pop(0) if self._status_codes else 206
+        response.content = self.data[start:end + 1] if response.status_code == 206 else self.data
+        return response
+
+    def close(self):
+        pass
+
+
+class TestRemoteFile:
+
+    def setup(self):
+        self.data = bytes(range(256)) * 40
+        self.url_provider = mock.Mock()
+        self.url_provider.get_info.return_value = PresignedUrlInfo('foo.bin', 'http://foo.com/1', None)
+        self.url_provider.refresh_info.return_value = PresignedUrlInfo('foo.bin', 'http://foo.com/2', None)
+
+    def _open(self, session, **kwargs):
+        with mock.patch.object(remote_file, '_get_new_session', return_value=session):
+            return RemoteFile(self.url_provider, len(self.data), name='foo.bin', **kwargs)
+
+    def test_read(self):
+        session = _RangeSession(self.data)
+        with self._open(session, block_size=1000, max_read_ahead_blocks=0) as f:
+            assert self.data[:10] == f.read(10)
+            assert 10 == f.tell()
+            assert self.data[10:2500] == f.read(2490)
+            assert self.data[2500:] == f.read()
+            assert b'' == f.read(1)
+
+        assert f.closed
+        assert [(i * 1000, min(i * 1000 + 999, len(self.data) - 1)) for i in range(11)] == session.ranges
+
+    def test_seek(self):
+        session = _RangeSession(self.data)
+        with self._open(session, block_size=1000) as f:
+            assert len(self.data) - 8 == f.seek(-8, os.SEEK_END)
+            assert self.data[-8:] == f.read()
+            assert 100 == f.seek(100)
+            assert 150 == f.seek(50, os.SEEK_CUR)
+            assert self.data[150:160] == f.read(10)
+
+            with pytest.raises(ValueError):
+                f.seek(-1)
+
+        assert [(10000, 10239), (0, 999)] == session.ranges
+
+    def test_block_cache(self):
+        """Recently read blocks are served from memory and the least recently used are evicted"""
+        session = _RangeSession(self.data)
+        with self._open(session, block_size=1000, cache_blocks=2, max_read_ahead_blocks=0) as f:
+            for offset in (0, 5000, 10, 8000, 5010, 20):
+                f.seek(offset)
+                assert self.data[offset:offset + 10] == f.read(10)
+
+        # reading the first block again kept it, so the next miss evicted the second block instead
+        assert [(0, 999), (5000, 5999), (8000, 8999), (5000, 5999), (0, 999)] == session.ranges
+
+    def test_read_ahead(self):
+        """Sequential reads fetch increasingly many blocks ahead, a random read starts over"""
+        session = _RangeSession(self.data)
+        with self._open(session, block_size=500, max_read_ahead_blocks=4) as f:
+            assert self.data[:5000] == f.read(5000)
+            f.seek(9000)
+            assert self.data[9000:9100] == f.read(100)
+
+        assert [(0, 499), (500, 1499), (1500, 2999), (3000, 5499), (9000, 9499)] == session.ranges
+
+    def test_readinto_buffered(self):
+        session = _RangeSession(self.data)
+        with io.BufferedReader(self._open(session, block_size=1000), buffer_size=64) as f:
+            f.seek(1234)
+            assert self.data[1234:1334] == f.read(100)
+
+    def test_refresh_rejected_url(self):
+        session = _RangeSession(self.data, status_codes=[403])
+        with self._open(session) as f:
+            assert self.data[:10] == f.read(10)
+
+        assert ['http://foo.com/1', 'http://foo.com/2'] == session.urls
+        self.url_provider.refresh_info.assert_called_once_with()
+
+    def test_url_rejected_after_refresh(self):
+        session = _RangeSession(self.data, status_codes=[403, 403])
+        with self._open(session) as f:
+            with pytest.raises(SynapseHTTPError):
+                f.read(10)
+
+    def test_range_not_supported(self):
+        session = _RangeSession(self.data, status_codes=[200])
+        with self._open(session) as f:
+            with pytest.raises(SynapseError, match='does not support range requests'):
+                f.read(10)
+
+    def test_closed(self):
+        f = self._open(_RangeSession(self.data))
+        f.close()
+        with pytest.raises(ValueError):
+            f.read(1)
+
+
+def test_open_remote_file():
+    client = mock.Mock()
+    request = DownloadRequest(123, 'syn456', 'FileEntity', None)
+    url_info = PresignedUrlInfo('foo.bin', 'http://foo.com/1', None)
+
+    with mock.patch.object(remote_file, 'PresignedUrlProvider') as mock_provider_cls, \
+            mock.patch.object(remote_file, '_get_file_size', return_value=1234) as mock_get_file_size:
+        mock_provider_cls.return_value.get_info.return_value = url_info
+        f = remote_file.open_remote_file(client, request, block_size=100)
+
+    mock_provider_cls.assert_called_once_with(client, request)
+    mock_get_file_size.assert_called_once_with(url_info.url)
+    assert 1234 == f.size
+    assert 'foo.bin' == f.name
+    f.close()
+
+
+class TestIterRemoteContent:
+
+    def setup(self):
+        self.data = bytes(range(256)) * 40
+        self.request = DownloadRequest(123, 'syn456', 'FileEntity', None, file_size=len(self.data))
+        self.url_info = PresignedUrlInfo('foo.bin', 'http://foo.com/1', None)
+
+    def _iter(self, session, chunk_size, **kwargs):
+        with mock.patch.object(remote_file, 'PresignedUrlProvider') as mock_provider_cls:
+            mock_provider_cls.return_value.get_info.return_value = self.url_info
+            return remote_file.iter_remote_content(mock.Mock(), self.request, chunk_size, **kwargs)
+
+    def test_stream(self):
+        response = mock.MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_content.return_value = iter([self.data[:1000], self.data[1000:]])
+        session = mock.MagicMock()
+        session.__enter__.return_value = session
+        session.get.return_value = response
+
+        with mock.patch.object(remote_file, '_get_new_session', return_value=session):
+            chunks = list(self._iter(session, 1000, expected_md5=hashlib.md5(self.data).hexdigest()))
+
+        assert self.data == b''.join(chunks)
+        session.get.assert_called_once_with(self.url_info.url, stream=True)
+        response.iter_content.assert_called_once_with(1000)
+
+    def test_prefetched_ranges(self):
+        """Ranges are fetched in parallel but the chunks are yielded in order"""
+        session = _RangeSession(self.data)
+        with mock.patch.object(remote_file, '_get_thread_session', return_value=session), \
+                mock.patch.object(remote_file, 'SYNAPSE_DEFAULT_DOWNLOAD_PART_SIZE', 3000):
+            chunks = list(self._iter(session, 1000, max_threads=3))
+
+        assert self.data == b''.join(chunks)
+        assert all(len(chunk) <= 1000 for chunk in chunks)
+        assert [(0, 2999), (3000, 5999), (6000, 8999), (9000, 10239)] == sorted(session.ranges)
+
+    def test_md5_mismatch(self):
+        session = _RangeSession(self.data)
+        with mock.patch.object(remote_file, '_get_thread_session', return_value=session):
+            chunks = self._iter(session, 1000, max_threads=2, expected_md5='foo')
+            with pytest.raises(SynapseMd5MismatchError):
+                list(chunks)
@@ -504,12 +504,9 @@ class TestIsStorageLocationStsEnabled:
             if sts_enabled:
                 location['stsEnabled'] = sts_enabled
 
-            syn.restGET.return_value = location
+            syn._get_upload_destination.return_value = location
             assert (
                 bool(sts_enabled) ==
                 sts_transfer.is_storage_location_sts_enabled(syn, entity_id, storage_location_id))
 
-            syn.restGET.assert_called_with(
-                f'/entity/{entity_id}/uploadDestination/{storage_location_id}',
-                endpoint=syn.fileHandleEndpoint,
-            )
+            syn._get_upload_destination.assert_called_with(entity_id, storage_location_id)
@@ -0,0 +1,187 @@
+import threading
+from unittest import mock
+
+import pytest
+
+import synapseclient.core.config
+from synapseclient.core import transfer_scheduler
+from synapseclient.core.transfer_scheduler import (
+    FILE_TASK,
+    PART_TASK,
+    TransferJob,
+    TransferScheduler,
+    _FairQueue,
+    _Task,
+)
+
+TIMEOUT = 10
+
+
+def _task(job, kind, priority, name):
+    return _Task(job, kind, priority, lambda: name, (), {})
+
+
+class TestFairQueue:
+
+    def test_priority_order_within_job(self):
+        job = TransferJob(None, 10, 10)
+        queue = _FairQueue(FILE_TASK)
+        for priority, name in [(3, 'c'), (1, 'a'), (2, 'b'), (1, 'a2')]:
+            queue.put(_task(job, FILE_TASK, priority, name))
+
+        # equal priorities are taken in the order they were queued
+        assert ['a', 'a2', 'b', 'c'] == [queue.get()._fn() for _ in range(4)]
+        assert queue.get() is None
+
+    def test_fair_between_jobs(self):
+        """The job with the fewest running tasks is taken from, and tied jobs take turns"""
+        job_1 = TransferJob(None, 10, 10)
+        job_2 = TransferJob(None, 10, 10)
+        queue = _FairQueue(PART_TASK)
+        for i in range(3):
+            queue.put(_task(job_1, PART_TASK, 0, f"1-{i}"))
+            queue.put(_task(job_2, PART_TASK, 0, f"2-{i}"))
+
+        assert ['1-0', '2-0', '1-1', '2-1'] == [queue.get()._fn() for _ in range(4)]
+
+        job_2._running[PART_TASK] = 1
+        assert '1-2' == queue.get()._fn()
+
+    def test_job_at_limit(self):
+        job_1 = TransferJob(None, 1, 1)
+        job_2 = TransferJob(None, 2, 2)
+        queue = _FairQueue(PART_TASK)
+        queue.put(_task(job_1, PART_TASK, 0, 'job_1'))
+        job_1._running[PART_TASK] = 1
+
+        assert queue.get() is None
+
+        queue.put(_task(job_2, PART_TASK, 0, 'job_2'))
+        assert 'job_2' == queue.get()._fn()
+
+    def test_remove(self):
+        job = TransferJob(None, 1, 1)
+        queue = _FairQueue(FILE_TASK)
+        task = _task(job, FILE_TASK, 0, 'a')
+        queue.put(task)
+
+        assert [task] == queue.remove(job)
+        assert queue.get() is None
+
+
+class TestTransferScheduler:
+
+    def setup(self):
+        self.scheduler = TransferScheduler()
+
+    def test_file_waiting_on_parts(self):
+        """A file task waiting on its parts completes even with a single thread for each"""
+        job = self.scheduler.job(1, max_concurrent_files=1)
+
+        def file_task(file_number):
+            part_futures = [job.executor.submit(lambda p: (file_number, p), p) for p in range(3)]
+            return [f.result(timeout=TIMEOUT) for f in part_futures]
+
+        file_futures = [job.submit_file(file_task, i) for i in range(3)]
+        assert [[(i, p) for p in range(3)] for i in range(3)] == [f.result(timeout=TIMEOUT) for f in file_futures]
+
+    def test_parts_of_started_files_first(self):
+        """Queued parts are run in the order their files were started"""
+        job = self.scheduler.job(1, max_concurrent_files=2)
+        order = []
+
+        block_parts = threading.Event()
+        parts_blocked = threading.Event()
+        files_submitted = threading.Barrier(3)
+
+        def blocking_part():
+            parts_blocked.set()
+            block_parts.wait(TIMEOUT)
+
+        blocker = job.executor.submit(blocking_part)
+        assert parts_blocked.wait(TIMEOUT)
+
+        def file_task(name):
+            futures = [job.executor.submit(order.append, f"{name}-{p}") for p in range(2)]
+            files_submitted.wait(TIMEOUT)
+            return [f.result(timeout=TIMEOUT) for f in futures]
+
+        first = job.submit_file(file_task, 'first')
+        second = job.submit_file(file_task, 'second')
+        files_submitted.wait(TIMEOUT)
+
+        block_parts.set()
+        for future in (blocker, first, second):
+            future.result(timeout=TIMEOUT)
+
+        # both files were in progress, whichever started first has both of its parts run first
+        started_first = order[0].split('-')[0]
+        started_second = 'second' if started_first == 'first' else 'first'
+        assert [f"{started_first}-0", f"{started_first}-1", f"{started_second}-0", f"{started_second}-1"] == order
+
+    def test_part_submitting_part(self):
+        """A part submitted from a part task is run immediately rather than queued"""
+        job = self.scheduler.job(1)
+
+        def part_task():
+            return job.executor.submit(lambda: 'nested').result(timeout=TIMEOUT)
+
+        assert 'nested' == job.executor.submit(part_task).result(timeout=TIMEOUT)
+
+    def test_job_context_cancels_on_error(self):
+        job = self.scheduler.job(1, max_concurrent_files=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(TIMEOUT)
+
+        with pytest.raises(ValueError):
+            with job:
+                running = job.submit_file(blocking)
+                assert started.wait(TIMEOUT)
+                queued = job.submit_file(lambda: None)
+                release.set()
+                raise ValueError()
+
+        assert running.done()
+        assert queued.cancelled() or queued.done()
+
+    def test_cancel(self):
+        job = self.scheduler.job(1, max_concurrent_files=1)
+        job._running[FILE_TASK] = 1  # the job is at its limit so the task stays queued
+
+        future = job.submit_file(lambda: None)
+        job.cancel()
+        assert future.cancelled()
+
+    def test_executor_shutdown(self):
+        job = self.scheduler.job(2)
+        release = threading.Event()
+
+        future = job.executor.submit(release.wait, TIMEOUT)
+        release.set()
+        job.executor.shutdown(wait=True)
+        assert future.done()
+
+        with pytest.raises(RuntimeError):
+            job.executor.submit(lambda: None)
+
+
+def test_get_transfer_job__single_threaded():
+    with mock.patch.object(synapseclient.core.config, 'single_threaded', True):
+        job = transfer_scheduler.get_transfer_job(5)
+
+    # tasks are run as they are submitted
+    thread = threading.current_thread()
+    assert thread == job.submit_file(threading.current_thread).result()
+    assert thread == job.executor.submit(threading.current_thread).result()
+
+
+def test_get_transfer_job():
+    with mock.patch.object(synapseclient.core.config, 'single_threaded', False):
+        job = transfer_scheduler.get_transfer_job(2)
+
+    assert transfer_scheduler.get_scheduler() is job._scheduler
+    assert 'foo' == job.submit_file(lambda: 'foo').result(timeout=TIMEOUT)
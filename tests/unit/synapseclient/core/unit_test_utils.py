@@ -1,15 +1,16 @@
 # unit tests for utils.py
 
 import base64
+import hashlib
 import os
 import re
 from shutil import rmtree
 import tempfile
 
 import pytest
-from unittest.mock import patch, mock_open
+from unittest.mock import Mock, patch, mock_open
 
-from synapseclient.core import constants, utils
+from synapseclient.core import checksum_index, constants, utils
 
 
 def test_is_url():
@@ -26,6 +27,25 @@ def test_is_url():
     assert not utils.is_url('c:/WINDOWS/ugh/ugh.ugh')
 
 
+def test_md5_for_file():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(b'foo')
+        f.flush()
+
+        # no checksum index is used by default, so the MD5 returned can be updated
+        md5 = utils.md5_for_file(f.name)
+        md5.update(b'bar')
+        assert hashlib.md5(b'foobar').hexdigest() == md5.hexdigest()
+
+        index = Mock(spec=checksum_index.ChecksumIndex)
+        index.md5_for_file.return_value = hashlib.md5(b'foo').hexdigest()
+        md5 = utils.md5_for_file(f.name, block_size=1, index=index)
+
+        index.md5_for_file.assert_called_once_with(f.name, 1)
+        assert hashlib.md5(b'foo').hexdigest() == md5.hexdigest()
+        assert hashlib.md5(b'foo').digest() == md5.digest()
+
+
 def test_windows_file_urls():
     url = 'file:///c:/WINDOWS/clock.avi'
     assert utils.is_url(url)
@@ -64,6 +84,24 @@ def test_humanizeBytes__None():
         utils.humanizeBytes(None)
 
 
+def test_parse_bytes():
+    for (size, expected_bytes) in [
+        ('0', 0),
+        ('10', 10),
+        ('10 bytes', 10),
+        ('1kB', 2 ** 10),
+        ('1.5MB', int((2 ** 20) * 1.5)),
+        ('2 gb', 2 * 2 ** 30),
+        ('1T', 2 ** 40),
+        (utils.humanizeBytes(2 ** 30), 2 ** 30),
+    ]:
+        assert utils.parse_bytes(size) == expected_bytes
+
+    for invalid_size in ('', 'GB', '-1', '10 XB', 'ten'):
+        with pytest.raises(ValueError):
+            utils.parse_bytes(invalid_size)
+
+
 def test_id_of():
     assert utils.id_of(1) == '1'
     assert utils.id_of('syn12345') == 'syn12345'
@@ -1,6 +1,10 @@
 from concurrent.futures import Future
 import hashlib
+import io
 import json
+import os
+import tempfile
+import threading
 
 import pytest
 from unittest import mock
@@ -14,6 +18,7 @@ import synapseclient.core.upload.multipart_upload as multipart_upload
 from synapseclient.core.upload.multipart_upload import (
     DEFAULT_PART_SIZE,
     MIN_PART_SIZE,
+    _FilePartProvider,
     _multipart_upload,
     multipart_copy,
     multipart_upload_file,
@@ -270,7 +275,7 @@ class TestUploadAttempt:
                 mock_session.put.call_args_list ==
                 expected_put_calls)
 
-            assert result == part_number
+            assert result == (part_number, len(chunk))
 
             if refresh_url_response:
                 refresh_urls.assert_called_once_with(
@@ -428,8 +433,8 @@ class TestUploadAttempt:
             as create_synapse_upload,\
             mock.patch.object(upload, '_fetch_pre_signed_part_urls')\
             as fetch_pre_signed_urls,\
-            mock.patch.object(pool_provider, 'get_executor')\
-            as get_executor,\
+            mock.patch.object(multipart_upload, 'get_transfer_job')\
+            as get_transfer_job,\
             mock.patch.object(upload, '_get_thread_session')\
             as get_session,\
             mock.patch.object(syn, 'restPUT')\
@@ -441,7 +446,7 @@ class TestUploadAttempt:
             create_synapse_upload.return_value = upload_status
             fetch_pre_signed_urls.return_value = pre_signed_urls
 
-            get_executor.return_value.submit.side_effect = futures
+            get_transfer_job.return_value.executor.submit.side_effect = futures
 
             upload_response = {
                 'state': 'COMPLETED'
@@ -484,13 +489,13 @@ class TestUploadAttempt:
             as create_synapse_upload,\
             mock.patch.object(upload, '_fetch_pre_signed_part_urls')\
             as fetch_pre_signed_urls,\
-            mock.patch.object(pool_provider, 'get_executor')\
-                as get_executor:
+            mock.patch.object(multipart_upload, 'get_transfer_job')\
+                as get_transfer_job:
 
             create_synapse_upload.return_value = upload_status
             fetch_pre_signed_urls.return_value = pre_signed_urls
 
-            get_executor.return_value.submit.return_value = future
+            get_transfer_job.return_value.executor.submit.return_value = future
 
             with pytest.raises(expected_raised_exception):
                 upload()
@@ -530,8 +535,8 @@ class TestUploadAttempt:
             as create_synapse_upload,\
             mock.patch.object(upload, '_fetch_pre_signed_part_urls')\
             as fetch_pre_signed_urls,\
-            mock.patch.object(pool_provider, 'get_executor')\
-                as get_executor:
+            mock.patch.object(multipart_upload, 'get_transfer_job')\
+                as get_transfer_job:
             create_synapse_upload.return_value = upload_status_response
 
             upload_result = upload()
@@ -540,7 +545,7 @@ class TestUploadAttempt:
             # we should have been able to short circuit any further
             # upload work and have returned immediately
             assert not fetch_pre_signed_urls.called
-            assert not get_executor.called
+            assert not get_transfer_job.called
 
     def test_all_parts_completed(self, syn):
         """Verify that if all the parts are already complete but
@@ -566,8 +571,8 @@ class TestUploadAttempt:
             as create_synapse_upload,\
             mock.patch.object(upload, '_fetch_pre_signed_part_urls')\
             as fetch_pre_signed_urls,\
-            mock.patch.object(pool_provider, 'get_executor')\
-            as get_executor,\
+            mock.patch.object(multipart_upload, 'get_transfer_job')\
+            as get_transfer_job,\
                 mock.patch.object(upload._syn, 'restPUT') as restPUT:
 
             create_synapse_upload.return_value = create_status_response
@@ -582,7 +587,7 @@ class TestUploadAttempt:
             # we should have been able to short circuit any further
             # upload work and have returned immediately
             assert not fetch_pre_signed_urls.called
-            assert not get_executor.called
+            assert not get_transfer_job.called
 
 
 class TestMultipartUpload:
@@ -1072,3 +1077,176 @@ class TestMultipartUpload:
                 max_threads,
                 False,
             )
+
+
+class TestFilePartProvider:
+
+    def setup(self):
+        self.data = bytes(range(256)) * 4
+        fd, self.file_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def teardown(self):
+        os.remove(self.file_path)
+
+    def test_get_part__mapped(self):
+        with _FilePartProvider(self.file_path, 300) as part_provider:
+            parts = [part_provider.get_part(i) for i in range(1, 5)]
+
+            assert all(isinstance(part, memoryview) for part in parts)
+            assert [self.data[i:i + 300] for i in range(0, 1024, 300)] == [bytes(part) for part in parts]
+            assert hashlib.md5(self.data[300:600]).hexdigest() == hashlib.md5(parts[1]).hexdigest()
+
+            # the map is left for garbage collection while its parts are still referenced
+            part_provider.close()
+            assert self.data[:300] == bytes(parts[0])
+
+    def test_get_part__not_mapped(self):
+        """Files that can't be mapped are read part by part"""
+        with mock.patch.object(multipart_upload.mmap, 'mmap', side_effect=OSError()):
+            with _FilePartProvider(self.file_path, 300) as part_provider:
+                part = part_provider.get_part(2)
+
+        assert self.data[300:600] == part
+        assert isinstance(part, bytes)
+
+    def test_get_part__truncated(self):
+        """Parts of a file truncated since it was mapped are read from the file rather than the map"""
+        with _FilePartProvider(self.file_path, 300) as part_provider:
+            os.truncate(self.file_path, 400)
+
+            assert isinstance(part_provider.get_part(1), memoryview)
+            part = part_provider.get_part(2)
+            assert self.data[300:400] == part
+            assert isinstance(part, bytes)
+            assert b'' == part_provider.get_part(3)
+
+    def test_get_part__empty_file(self):
+        with open(self.file_path, 'wb'):
+            pass
+
+        with _FilePartProvider(self.file_path, 300) as part_provider:
+            assert b'' == part_provider.get_part(1)
+
+
+def test_as_readinto():
+    data = b'foobarbaz'
+    for readable in (io.BytesIO(data), [b'foo', b'', b'barbaz'], mock.Mock(spec=['read'], read=io.BytesIO(data).read)):
+        view = memoryview(bytearray(4))
+        reader = multipart_upload._as_readinto(readable)
+
+        parts = []
+        while True:
+            length = multipart_upload._read_fully(reader, view)
+            if not length:
+                break
+            parts.append(bytes(view[:length]))
+        assert [b'foob', b'arba', b'z'] == parts
+
+
+class TestStreamPartBuffers:
+
+    def test_bounded(self):
+        """Reading a part waits for a buffer to be released once all of them are in use"""
+        part_buffers = multipart_upload._StreamPartBuffers(io.BytesIO(b'foobar'), 3, 1)
+        assert b'foo' == part_buffers.read_part(1)
+
+        read_second = threading.Thread(target=part_buffers.read_part, args=(2,))
+        read_second.start()
+        read_second.join(0.1)
+        assert read_second.is_alive()
+
+        part_buffers.release(1)
+        read_second.join(5)
+        assert b'bar' == part_buffers.get_part(2)
+        assert hashlib.md5(b'foobar').hexdigest() == part_buffers.md5.hexdigest()
+        assert part_buffers.at_end()
+
+
+class TestMultipartUploadStream:
+
+    def setup(self):
+        self.syn = mock.Mock()
+        self.data = bytes(range(256)) * 4
+        self.md5_hex = hashlib.md5(self.data).hexdigest()
+        self.uploaded = {}
+
+    def _upload(self, readable, file_size, md5_hex, parts_state='0000'):
+        def handle_part(attempt, part_number):
+            self.uploaded[part_number] = bytes(attempt._part_request_body_provider_fn(part_number))
+            return part_number, len(self.uploaded[part_number])
+
+        with mock.patch.object(multipart_upload, 'MIN_PART_SIZE', 300), \
+                mock.patch.object(multipart_upload.UploadAttempt, '_create_synapse_upload',
+                                  return_value={'uploadId': '1', 'partsState': parts_state}), \
+                mock.patch.object(multipart_upload.UploadAttempt, '_fetch_pre_signed_part_urls'), \
+                mock.patch.object(multipart_upload.UploadAttempt, '_handle_part', autospec=True,
+                                  side_effect=handle_part), \
+                mock.patch.object(multipart_upload.UploadAttempt, '_complete_upload',
+                                  return_value={'state': 'COMPLETED', 'resultFileHandleId': '123'}) as complete, \
+                mock.patch.object(multipart_upload, 'printTransferProgress'):
+            try:
+                return multipart_upload.multipart_upload_stream(
+                    self.syn,
+                    readable,
+                    'foo.bin',
+                    file_size=file_size,
+                    md5_hex=md5_hex,
+                    part_size=300,
+                    max_threads=2,
+                )
+            finally:
+                self.completed = complete.called
+
+    def test_stream(self):
+        """Parts are uploaded as they are read, skipping parts that were already uploaded"""
+        chunks = (self.data[i:i + 100] for i in range(0, len(self.data), 100))
+        assert '123' == self._upload(chunks, len(self.data), self.md5_hex, parts_state='0100')
+
+        assert {1: self.data[:300], 3: self.data[600:900], 4: self.data[900:]} == self.uploaded
+        assert self.completed
+
+    def test_md5_mismatch(self):
+        with pytest.raises(SynapseUploadFailedException, match='MD5'):
+            self._upload(io.BytesIO(self.data), len(self.data), 'foo')
+        assert not self.completed
+
+    def test_stream_too_short(self):
+        with pytest.raises(SynapseUploadFailedException, match='ended'):
+            self._upload(io.BytesIO(self.data[:500]), len(self.data), self.md5_hex)
+        assert not self.completed
+
+    def test_stream_too_long(self):
+        with pytest.raises(SynapseUploadFailedException, match='expected'):
+            self._upload(io.BytesIO(self.data + b'foo'), len(self.data), self.md5_hex)
+        assert not self.completed
+
+    def test_part_failure(self):
+        with mock.patch.object(multipart_upload, 'MAX_RETRIES', 1), \
+                mock.patch.object(multipart_upload._StreamUploadAttempt, '_handle_part',
+                                  side_effect=ValueError()) as handle_part:
+            with pytest.raises(SynapseUploadFailedException):
+                self._upload(io.BytesIO(self.data), len(self.data), self.md5_hex)
+
+        assert not self.completed
+        # each part is retried on its own
+        assert handle_part.call_count % 2 == 0
+
+    def test_spooled(self):
+        """Without a size and MD5 the stream is copied to a temporary file that is removed after the upload"""
+        def upload(syn, dest_file_name, upload_request, part_fn, md5_fn, max_threads):
+            assert self.data == bytes(part_fn(1))
+            return '456'
+
+        with tempfile.TemporaryDirectory() as spool_dir, \
+                mock.patch.object(multipart_upload, '_multipart_upload', side_effect=upload) as mock_upload:
+            assert '456' == multipart_upload.multipart_upload_stream(
+                self.syn, iter([self.data]), 'foo.txt', spool_dir=spool_dir,
+            )
+            assert [] == os.listdir(spool_dir)
+
+        upload_request = mock_upload.call_args[0][2]
+        assert self.md5_hex == upload_request['contentMD5Hex']
+        assert len(self.data) == upload_request['fileSizeBytes']
+        assert 'text/plain' == upload_request['contentType']
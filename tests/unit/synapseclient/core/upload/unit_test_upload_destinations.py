@@ -0,0 +1,101 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from synapseclient.core.upload.upload_destinations import UploadDestinationCache
+
+
+class TestUploadDestinationCache:
+
+    def test_get(self):
+        """An UploadDestination is only retrieved once per entity and storage location"""
+        cache = UploadDestinationCache()
+        fetch = mock.Mock(return_value={'storageLocationId': 1})
+
+        assert {'storageLocationId': 1} == cache.get('syn1', None, fetch)
+        assert {'storageLocationId': 1} == cache.get('syn1', None, fetch)
+        assert 1 == fetch.call_count
+
+        cache.get('syn1', 2, fetch)
+        cache.get('syn2', None, fetch)
+        assert 3 == fetch.call_count
+
+    def test_get__copy(self):
+        """Changes made to a returned UploadDestination don't change the cached one"""
+        cache = UploadDestinationCache()
+        fetch = mock.Mock(return_value={'storageLocationId': 1})
+
+        cache.get('syn1', None, fetch)['storageLocationId'] = 2
+        assert {'storageLocationId': 1} == cache.get('syn1', None, fetch)
+
+    def test_get__expired(self):
+        """UploadDestinations are retrieved again once they have been cached for longer than the ttl"""
+        cache = UploadDestinationCache(ttl_seconds=60)
+        fetch = mock.Mock(return_value={'storageLocationId': 1})
+
+        with mock.patch.object(time, 'monotonic', return_value=1000):
+            cache.get('syn1', None, fetch)
+        with mock.patch.object(time, 'monotonic', return_value=1059):
+            cache.get('syn1', None, fetch)
+        assert 1 == fetch.call_count
+
+        with mock.patch.object(time, 'monotonic', return_value=1060):
+            cache.get('syn1', None, fetch)
+        assert 2 == fetch.call_count
+
+    def test_get__max_size(self):
+        """The oldest UploadDestinations are discarded once the cache is full"""
+        cache = UploadDestinationCache(max_size=2)
+        fetch = mock.Mock(return_value={})
+
+        for entity_id in ('syn1', 'syn2', 'syn3', 'syn2', 'syn1'):
+            cache.get(entity_id, None, fetch)
+
+        assert [mock.call()] * 4 == fetch.call_args_list
+
+    def test_get__error(self):
+        """A failure to retrieve an UploadDestination is raised and not cached"""
+        cache = UploadDestinationCache()
+        fetch = mock.Mock(side_effect=[ValueError('boom'), {'storageLocationId': 1}])
+
+        with pytest.raises(ValueError):
+            cache.get('syn1', None, fetch)
+        assert {'storageLocationId': 1} == cache.get('syn1', None, fetch)
+
+    def test_get__concurrent(self):
+        """Threads wanting an UploadDestination that is being retrieved wait for it instead of retrieving it too"""
+        cache = UploadDestinationCache()
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def fetch():
+            fetching.set()
+            release.wait()
+            return {'storageLocationId': 1}
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get('syn1', None, fetch)))
+        first.start()
+        fetching.wait()
+
+        second_fetch = mock.Mock()
+        second = threading.Thread(target=lambda: results.append(cache.get('syn1', None, second_fetch)))
+        second.start()
+
+        release.set()
+        first.join()
+        second.join()
+
+        assert [{'storageLocationId': 1}] * 2 == results
+        assert not second_fetch.called
+
+    def test_clear(self):
+        cache = UploadDestinationCache()
+        fetch = mock.Mock(return_value={})
+
+        cache.get('syn1', None, fetch)
+        cache.clear()
+        cache.get('syn1', None, fetch)
+        assert 2 == fetch.call_count
@@ -1,8 +1,12 @@
+import json
 import os
 
 from unittest import mock
 
+import pytest
+
 from synapseclient.core.constants import concrete_types
+from synapseclient.core.exceptions import SynapseHTTPError
 from synapseclient.core.upload import upload_functions
 
 
@@ -39,6 +43,129 @@ class TestUploadFileHandle:
             mimetype=None
         )
 
+    @mock.patch.object(upload_functions, 'upload_synapse_s3')
+    @mock.patch.object(upload_functions, 'copy_existing_file_handle')
+    def test_upload_handle__dedupe_copy(self, mock_copy_existing_file_handle, mock_upload_synapse_s3):
+        """Verify that a file handle copied with dedupe='copy' is returned without uploading the file"""
+        syn = mock.Mock()
+        location = {'concreteType': concrete_types.SYNAPSE_S3_UPLOAD_DESTINATION, 'storageLocationId': 1}
+        file_handle = mock_copy_existing_file_handle.return_value = {'id': '456'}
+
+        assert file_handle == upload_functions.upload_file_handle(
+            syn, 'syn_12345', '/tmp/upload_me', md5='abc', file_size=3, upload_destination=location, dedupe='copy'
+        )
+
+        mock_copy_existing_file_handle.assert_called_once_with(
+            syn, location, '/tmp/upload_me', md5='abc', file_size=3, mimetype=None
+        )
+        assert not mock_upload_synapse_s3.called
+
+    @mock.patch.object(upload_functions, 'upload_synapse_s3')
+    @mock.patch.object(upload_functions, 'copy_existing_file_handle')
+    def test_upload_handle__dedupe_copy_not_found(self, mock_copy_existing_file_handle, mock_upload_synapse_s3):
+        """Verify that a file is uploaded when there is no file handle to copy"""
+        syn = mock.Mock()
+        location = {'concreteType': concrete_types.SYNAPSE_S3_UPLOAD_DESTINATION, 'storageLocationId': 1}
+        mock_copy_existing_file_handle.return_value = None
+
+        assert mock_upload_synapse_s3.return_value == upload_functions.upload_file_handle(
+            syn, 'syn_12345', '/tmp/upload_me', upload_destination=location, dedupe='copy'
+        )
+        mock_upload_synapse_s3.assert_called_once_with(syn, '/tmp/upload_me', 1, mimetype=None, max_threads=None)
+
+    def test_upload_handle__dedupe_invalid(self):
+        with pytest.raises(ValueError):
+            upload_functions.upload_file_handle(mock.Mock(), 'syn_12345', '/tmp/upload_me', dedupe='link')
+
+
+class TestCopyExistingFileHandle:
+
+    location = {'concreteType': concrete_types.SYNAPSE_S3_UPLOAD_DESTINATION, 'storageLocationId': 1}
+
+    @staticmethod
+    def _bundle(entity_id, file_handle_id, storage_location_id=1, md5='abc', size=3):
+        return {
+            'entity': {'id': entity_id, 'dataFileHandleId': file_handle_id},
+            'fileHandles': [{
+                'id': file_handle_id,
+                'concreteType': concrete_types.S3_FILE_HANDLE,
+                'storageLocationId': storage_location_id,
+                'contentMd5': md5,
+                'contentSize': size,
+            }],
+        }
+
+    def test_copy(self):
+        """The first compatible file handle that can be copied is copied with the name of the local file"""
+        syn = mock.Mock()
+        syn.md5Query.return_value = [
+            {'id': 'syn1', 'versionNumber': 1},
+            {'id': 'syn2', 'versionNumber': 2},
+            {'id': 'syn3', 'versionNumber': 1},
+            {'id': 'syn4', 'versionNumber': 1},
+        ]
+        bundles = {
+            'syn1': SynapseHTTPError('403 Client Error: Forbidden'),
+            'syn2': self._bundle('syn2', '2', storage_location_id=2),
+            'syn3': self._bundle('syn3', '3'),
+            'syn4': self._bundle('syn4', '4'),
+        }
+
+        def get_bundle(entity_id, version, requestedObjects):
+            bundle = bundles[entity_id]
+            if isinstance(bundle, Exception):
+                raise bundle
+            return bundle
+
+        syn._getEntityBundle.side_effect = get_bundle
+        syn.restPOST.side_effect = [
+            {'copyResults': [{'originalFileHandleId': '3', 'failureCode': 'UNAUTHORIZED'}]},
+            {'copyResults': [{'originalFileHandleId': '4', 'newFileHandle': {'id': '5'}}]},
+        ]
+
+        file_handle = upload_functions.copy_existing_file_handle(
+            syn, self.location, '/tmp/data.csv', md5='abc', file_size=3
+        )
+
+        assert {'id': '5'} == file_handle
+        syn.cache.add.assert_called_once_with('5', '/tmp/data.csv')
+        syn.md5Query.assert_called_once_with('abc')
+        assert 2 == syn.restPOST.call_count
+        args, kwargs = syn.restPOST.call_args
+        assert '/filehandles/copy' == args[0]
+        assert syn.fileHandleEndpoint == kwargs['endpoint']
+        assert {
+            'copyRequests': [{
+                'originalFile': {'fileHandleId': '4', 'associateObjectId': 'syn4', 'associateObjectType': 'FileEntity'},
+                'newContentType': 'text/csv',
+                'newFileName': 'data.csv',
+            }]
+        } == json.loads(kwargs['body'])
+
+    def test_not_found(self):
+        """None is returned if no file handle has the same content"""
+        syn = mock.Mock()
+        syn.md5Query.return_value = [{'id': 'syn1', 'versionNumber': 1}]
+        syn._getEntityBundle.return_value = self._bundle('syn1', '1', size=4)
+
+        assert upload_functions.copy_existing_file_handle(
+            syn, self.location, '/tmp/data.csv', md5='abc', file_size=3
+        ) is None
+        assert not syn.restPOST.called
+
+    @mock.patch.object(upload_functions, 'md5_for_file')
+    @mock.patch.object(os.path, 'getsize')
+    def test_hash_file(self, mock_getsize, mock_md5_for_file):
+        """The MD5 and size of the file are calculated if they aren't known"""
+        syn = mock.Mock()
+        syn.md5Query.return_value = []
+        mock_md5_for_file.return_value.hexdigest.return_value = 'abc'
+
+        assert upload_functions.copy_existing_file_handle(syn, self.location, '/tmp/data.csv') is None
+        mock_md5_for_file.assert_called_once_with('/tmp/data.csv', index=syn.cache.checksum_index)
+        mock_getsize.assert_called_once_with('/tmp/data.csv')
+        syn.md5Query.assert_called_once_with('abc')
+
 
 @mock.patch.object(upload_functions, 'sts_transfer')
 @mock.patch.object(upload_functions, 'S3ClientWrapper')
@@ -28,6 +28,7 @@ from synapseclient import (
     SubmissionViewSchema,
     Synapse,
 )
+from synapseclient.core.cache import Cache
 from synapseclient.core.exceptions import (
     SynapseAuthenticationError,
     SynapseError,
@@ -37,6 +38,7 @@ from synapseclient.core.exceptions import (
     SynapseUnmetAccessRestrictions,
 )
 from synapseclient.core.upload import upload_functions
+from synapseclient.core.upload.upload_destinations import UploadDestinationCache
 import synapseclient.core.utils as utils
 from synapseclient.client import DEFAULT_STORAGE_LOCATION_ID
 from synapseclient.core.constants import concrete_types
@@ -1189,6 +1191,74 @@ class TestSetStorageLocation:
         self.mock_restPOST.assert_not_called()
 
 
+class TestGetUploadDestination:
+
+    @pytest.fixture(autouse=True)
+    def upload_destination_cache(self, syn):
+        # the session's Synapse is shared by other tests, each of these starts with an empty cache
+        with patch.object(syn, '_upload_destination_cache', UploadDestinationCache()):
+            yield
+
+    def test_default(self, syn):
+        """The default UploadDestination of an entity is retrieved once and cached"""
+        destination = {'storageLocationId': 1, 'stsEnabled': False}
+        with patch.object(syn, 'restGET', return_value=destination) as mock_restGET:
+            assert destination == syn._getDefaultUploadDestination(Folder(id='syn123', parentId='syn1'))
+            assert destination == syn._get_upload_destination('syn123')
+
+        mock_restGET.assert_called_once_with('/entity/syn123/uploadDestination', endpoint=syn.fileHandleEndpoint)
+
+    def test_storage_location(self, syn):
+        """UploadDestinations of specific storage locations are cached separately from the default"""
+        with patch.object(syn, 'restGET', side_effect=lambda uri, endpoint: {'uri': uri}) as mock_restGET:
+            assert {'uri': '/entity/syn123/uploadDestination/1'} == syn._get_upload_destination('syn123', 1)
+            assert {'uri': '/entity/syn123/uploadDestination'} == syn._get_upload_destination('syn123')
+            assert {'uri': '/entity/syn123/uploadDestination/1'} == syn._get_upload_destination('syn123', 1)
+
+        assert 2 == mock_restGET.call_count
+
+    def test_set_storage_location(self, syn):
+        """Cached UploadDestinations are retrieved again after a storage location is set"""
+        with patch.object(syn, 'restGET', return_value={'storageLocationId': 1}) as mock_restGET, \
+                patch.object(syn, 'getProjectSetting', return_value=None), \
+                patch.object(syn, 'restPOST'):
+            syn._getDefaultUploadDestination('syn123')
+            syn._getDefaultUploadDestination('syn123')
+            assert 1 == mock_restGET.call_count
+
+            syn.setStorageLocation('syn123', 333)
+            syn._getDefaultUploadDestination('syn123')
+            assert 2 == mock_restGET.call_count
+
+    def test_set_storage_location__concurrent_upload(self, syn):
+        """An UploadDestination retrieved while a storage location is being set isn't kept"""
+        with patch.object(syn, 'restGET', return_value={'storageLocationId': 1}) as mock_restGET, \
+                patch.object(syn, 'getProjectSetting', return_value=None), \
+                patch.object(syn, 'restPOST') as mock_restPOST:
+            mock_restPOST.side_effect = lambda *args, **kwargs: syn._get_upload_destination('syn123')
+            # an upload retrieves the destination while the setting is saved
+            syn.setStorageLocation('syn123', 333)
+            mock_restPOST.assert_called_once()
+            assert 1 == mock_restGET.call_count
+
+            syn._getDefaultUploadDestination('syn123')
+            assert 2 == mock_restGET.call_count
+
+    def test_update_container(self, syn):
+        """Cached UploadDestinations are retrieved again after a container, which may have been moved, is updated"""
+        with patch.object(syn, 'restGET', return_value={'storageLocationId': 1}) as mock_restGET, \
+                patch.object(syn, 'restPUT', side_effect=lambda uri, body, params: json.loads(body)):
+            syn._getDefaultUploadDestination('syn123')
+
+            syn._updateEntity(File(id='syn2', parentId='syn123', dataFileHandleId='1'), incrementVersion=False)
+            syn._getDefaultUploadDestination('syn123')
+            assert 1 == mock_restGET.call_count
+
+            syn._updateEntity(Folder(id='syn123', parentId='syn3'))
+            syn._getDefaultUploadDestination('syn123')
+            assert 2 == mock_restGET.call_count
+
+
 @patch('synapseclient.core.sts_transfer.get_sts_credentials')
 def test_get_sts_storage_token(mock_get_sts_credentials, syn):
     """Verify get_sts_storage_token passes through to the underlying function as expected"""
@@ -1775,18 +1845,24 @@ def test_get_transfer_config(mock_config_dict):
     # note that RawConfigParser lower cases its option values so we
     # simulate that behavior in our mocked values here
 
-    default_values = {'max_threads': client.DEFAULT_NUM_THREADS, 'use_boto_sts_transfers': False}
+    default_values = {
+        'max_threads': client.DEFAULT_NUM_THREADS,
+        'use_boto_sts_transfers': False,
+        'hedge_downloads': False,
+    }
 
     for config_dict, expected_values in [
         # empty values get defaults
         ({}, default_values),
-        ({'max_threads': '', 'use_boto_sts': ''}, default_values),
-        ({'max_thraeds': None, 'use_boto_sts': None}, default_values),
+        ({'max_threads': '', 'use_boto_sts': '', 'hedge_downloads': ''}, default_values),
+        ({'max_thraeds': None, 'use_boto_sts': None, 'hedge_downloads': None}, default_values),
 
         # explicit values should be parsed
         ({'max_threads': '1', 'use_boto_sts': 'True'}, {'max_threads': 1, 'use_boto_sts_transfers': True}),
         ({'max_threads': '7', 'use_boto_sts': 'true'}, {'max_threads': 7, 'use_boto_sts_transfers': True}),
         ({'max_threads': '100', 'use_boto_sts': 'false'}, {'max_threads': 100, 'use_boto_sts_transfers': False}),
+        ({'hedge_downloads': 'True'}, {'hedge_downloads': True}),
+        ({'hedge_downloads': 'false'}, {'hedge_downloads': False}),
     ]:
         mock_config_dict.return_value = config_dict
         syn = Synapse(skip_checks=True)
@@ -1805,6 +1881,35 @@ def test_get_transfer_config(mock_config_dict):
         with pytest.raises(ValueError):
             Synapse(skip_checks=True)
 
+    # invalid value for hedge_downloads should raise an error
+    for invalid_hedge_value in ('yes', '1'):
+        mock_config_dict.return_value = {'hedge_downloads': invalid_hedge_value}
+        with pytest.raises(ValueError):
+            Synapse(skip_checks=True)
+
+
+@patch('synapseclient.Synapse._get_config_section_dict')
+def test_get_cache_config(mock_config_dict):
+    """Verify reading cache.write_cache_maps, cache.max_size and cache.copy_mode from synapseConfig"""
+
+    for config_dict, expected_values in [
+        ({}, {'write_cache_maps': False, 'max_size': None, 'copy_mode': 'copy'}),
+        ({'write_cache_maps': '', 'max_size': ''}, {'write_cache_maps': False, 'max_size': None}),
+        ({'write_cache_maps': 'True'}, {'write_cache_maps': True}),
+        ({'write_cache_maps': 'false'}, {'write_cache_maps': False}),
+        ({'max_size': '100GB'}, {'max_size': 100 * 2 ** 30}),
+        ({'copy_mode': 'link'}, {'copy_mode': 'link'}),
+    ]:
+        mock_config_dict.return_value = config_dict
+        syn = Synapse(skip_checks=True)
+        for k, v in expected_values.items():
+            assert v == getattr(syn.cache, k)
+
+    for invalid_config_dict in ({'write_cache_maps': 'yes'}, {'max_size': 'lots'}, {'copy_mode': 'symlink'}):
+        mock_config_dict.return_value = invalid_config_dict
+        with pytest.raises(ValueError):
+            Synapse(skip_checks=True)
+
 
 @patch('synapseclient.Synapse._get_config_section_dict')
 def test_transfer_config_values_overridable(mock_config_dict):
@@ -1938,6 +2043,7 @@ def test_store__existing_processed_as_update(syn):
             expected_update_properties,
             True,  # createOrUpdate
             None,  # versionLabel
+            generatedBy=None,
         )
 
         mock_set_annotations.assert_called_once_with(expected_annotations)
@@ -2037,10 +2143,11 @@ def test_store__409_processed_as_update(syn):
             expected_update_properties,
             True,  # createOrUpdate
             None,  # versionLabel
+            generatedBy=None,
         )
 
         mock_set_annotations.assert_called_once_with(expected_annotations)
-        mock_createEntity.assert_called_once_with(expected_create_properties)
+        mock_createEntity.assert_called_once_with(expected_create_properties, generatedBy=None)
         mock_findEntityId.assert_called_once_with(file_name, parent_id)
 
 
@@ -2132,6 +2239,362 @@ def test_store__existing_no_update(syn):
         assert not mock_updatentity.called
 
 
+def test_store__not_return_fresh(syn):
+    """Test that a new File stored without returning a fresh entity isn't looked up before or read after it is
+    stored, and that its provenance is set as it is created"""
+
+    file_handle = {'id': '456', 'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle'}
+    created_properties = {
+        'id': 'syn123',
+        'etag': 'etag_1',
+        'name': 'fake_file.txt',
+        'parentId': 'syn122',
+        'concreteType': 'org.sagebionetworks.repo.model.FileEntity',
+        'dataFileHandleId': '456',
+        'versionNumber': 1,
+    }
+
+    with patch.object(syn, '_getEntityBundle') as mock_get_entity_bundle, \
+            patch.object(synapseclient.client, 'upload_file_handle', return_value=file_handle), \
+            patch.object(syn, 'restPOST', return_value={'id': '789'}) as mock_rest_post, \
+            patch.object(syn, '_createEntity', return_value=created_properties) as mock_create_entity, \
+            patch.object(syn, 'set_annotations') as mock_set_annotations, \
+            patch.object(syn, 'setProvenance') as mock_set_provenance, \
+            patch.object(syn, '_getEntity') as mock_get_entity, \
+            patch.object(syn, 'get') as mock_get:
+
+        mock_set_annotations.return_value = Annotations('syn123', 'etag_2', {'foo': ['bar']})
+
+        f = File('/fake_file.txt', parent='syn122', foo='bar')
+        stored = syn.store(f, used=['syn1'], createOrUpdate=False, returnFresh=False)
+
+    # the activity is created before the entity, which is created generated by it
+    mock_rest_post.assert_called_once_with('/activity', body=ANY)
+    assert ['syn1'] == [u['reference']['targetId'] for u in json.loads(mock_rest_post.call_args[1]['body'])['used']]
+    mock_create_entity.assert_called_once_with(ANY, generatedBy='789')
+    assert '456' == mock_create_entity.call_args[0][0]['dataFileHandleId']
+
+    assert not mock_get_entity_bundle.called
+    assert not mock_set_provenance.called
+    assert not mock_get_entity.called
+    assert not mock_get.called
+
+    assert 'syn123' == stored.id
+    assert 'etag_2' == stored.etag
+    assert 1 == stored.versionNumber
+    assert ['bar'] == stored.foo
+    assert '/fake_file.txt' == stored.path
+    assert '456' == stored.dataFileHandleId
+
+
+def test_store__not_return_fresh__create_or_update(syn):
+    """Test that a File that may be an update is still looked up before it is stored"""
+
+    with patch.object(syn, '_getEntityBundle', return_value=None) as mock_get_entity_bundle, \
+            patch.object(synapseclient.client, 'upload_file_handle', return_value={'id': '456'}), \
+            patch.object(syn, '_createEntity', return_value={'id': 'syn123', 'etag': 'etag_1'}), \
+            patch.object(syn, 'set_annotations', return_value=Annotations('syn123', 'etag_2', {})), \
+            patch.object(syn, 'get') as mock_get:
+
+        f = File('/fake_file.txt', parent='syn122')
+        syn.store(f, returnFresh=False)
+
+    mock_get_entity_bundle.assert_called_once_with(f)
+    assert not mock_get.called
+
+
+def test_store_entity__bundle(syn):
+    """Test that a File whose bundle was already retrieved isn't looked up again before it is updated"""
+    existing = {
+        'id': 'syn123',
+        'etag': 'etag_1',
+        'name': 'fake_file.txt',
+        'parentId': 'syn122',
+        'concreteType': 'org.sagebionetworks.repo.model.FileEntity',
+        'dataFileHandleId': '123',
+        'versionNumber': 1,
+    }
+    bundle = {'entity': existing, 'fileHandles': [], 'annotations': {}}
+
+    with patch.object(syn, '_getEntityBundle') as mock_get_entity_bundle, \
+            patch.object(synapseclient.client, 'upload_file_handle', return_value={'id': '456'}) as mock_upload, \
+            patch.object(syn, '_updateEntity', side_effect=lambda properties, *args, **kwargs: properties) \
+            as mock_update_entity, \
+            patch.object(syn, 'set_annotations', return_value=Annotations('syn123', 'etag_2', {})):
+
+        f = File('/fake_file.txt', parent='syn122')
+        stored = syn._store_entity(f, returnFresh=False, bundle=bundle)
+
+    assert not mock_get_entity_bundle.called
+    mock_upload.assert_called_once()
+    assert 'syn123' == mock_update_entity.call_args[0][0]['id']
+    assert '456' == stored.dataFileHandleId
+
+
+def test_store__dedupe(syn):
+    """Test that the dedupe mode of a store is used to upload its file"""
+
+    file_handle = {'id': '456', 'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle'}
+    created_properties = {
+        'id': 'syn123',
+        'etag': 'etag_1',
+        'name': 'fake_file.txt',
+        'parentId': 'syn122',
+        'concreteType': 'org.sagebionetworks.repo.model.FileEntity',
+        'dataFileHandleId': '456',
+        'versionNumber': 1,
+    }
+
+    with patch.object(synapseclient.client, 'upload_file_handle', return_value=file_handle) as mock_upload, \
+            patch.object(syn, '_createEntity', return_value=created_properties), \
+            patch.object(syn, 'set_annotations', return_value=Annotations('syn123', 'etag_2', {})):
+        f = File('/fake_file.txt', parent='syn122')
+        syn.store(f, createOrUpdate=False, returnFresh=False, dedupe='copy')
+
+    assert 'copy' == mock_upload.call_args[1]['dedupe']
+
+    with pytest.raises(ValueError):
+        syn.store(File('/fake_file.txt', parent='syn122'), dedupe='link')
+
+
+def test_store__dedupe_copied_file_handle_cached(syn):
+    """A file whose file handle was copied isn't uploaded when its entity is stored again"""
+    path = os.path.join(tempfile.mkdtemp(), 'file.txt')
+    with open(path, 'w') as f:
+        f.write('data')
+    md5 = utils.md5_for_file(path).hexdigest()
+
+    file_handle = {
+        'id': '999',
+        'concreteType': concrete_types.S3_FILE_HANDLE,
+        'storageLocationId': 1,
+        'contentMd5': md5,
+        'contentSize': 4,
+    }
+    bundles = {
+        # the entity whose file handle is copied, and the entity stored with the copy
+        'syn9': {'entity': {'id': 'syn9', 'dataFileHandleId': '9'}, 'fileHandles': [{**file_handle, 'id': '9'}]},
+        'syn123': {'entity': {'id': 'syn123', 'dataFileHandleId': '999'}, 'fileHandles': [file_handle]},
+    }
+    properties = {
+        'id': 'syn123',
+        'etag': 'etag_1',
+        'name': 'file.txt',
+        'parentId': 'syn122',
+        'concreteType': 'org.sagebionetworks.repo.model.FileEntity',
+        'dataFileHandleId': '999',
+        'versionNumber': 1,
+    }
+
+    with patch.object(syn, 'cache', Cache(cache_root_dir=tempfile.mkdtemp())), \
+            patch.object(syn, '_getDefaultUploadDestination', return_value={
+                'concreteType': concrete_types.SYNAPSE_S3_UPLOAD_DESTINATION, 'storageLocationId': 1
+            }), \
+            patch.object(syn, 'md5Query', return_value=[{'id': 'syn9', 'versionNumber': 1}]), \
+            patch.object(syn, '_getEntityBundle', side_effect=lambda entity, **kwargs: bundles[utils.id_of(entity)]), \
+            patch.object(syn, 'restPOST', return_value={'copyResults': [{'newFileHandle': file_handle}]}) \
+            as mock_rest_post, \
+            patch.object(upload_functions, 'upload_synapse_s3') as mock_upload, \
+            patch.object(syn, '_createEntity', return_value=properties), \
+            patch.object(syn, '_updateEntity', return_value=properties) as mock_update_entity, \
+            patch.object(syn, 'set_annotations', return_value=Annotations('syn123', 'etag_2', {})):
+
+        stored = syn.store(File(path, parent='syn122'), createOrUpdate=False, returnFresh=False, dedupe='copy')
+        syn.store(stored, returnFresh=False, dedupe='copy')
+
+    # the file handle is only copied by the first store
+    assert not mock_upload.called
+    assert 1 == mock_rest_post.call_count
+    assert '999' == mock_update_entity.call_args[0][0]['dataFileHandleId']
+
+
+class TestStoreMany:
+
+    def test_store_many(self, syn):
+        """New entities are created without being looked up, existing ones are updated, and the
+        children and upload destination of each parent are only retrieved once"""
+        new_file = File('/tmp/new.txt', parentId='syn1')
+        existing_file = File('/tmp/existing.txt', parentId='syn1')
+        other_file = File('/tmp/other.txt', parentId='syn2')
+        entities = [new_file, existing_file, other_file]
+
+        upload_destinations = {'syn1': {'storageLocationId': 1}, 'syn2': {'storageLocationId': 2}}
+        children = {'syn1': [{'name': 'existing.txt', 'id': 'syn10'}], 'syn2': []}
+
+        def store_entity(entity, **kwargs):
+            return File(entity.path, id=f"{entity.name}_id", parentId=entity.parentId)
+
+        with patch.object(syn, 'getChildren', side_effect=lambda parent_id: iter(children[parent_id])) \
+                as mock_get_children, \
+                patch.object(syn, '_getDefaultUploadDestination', side_effect=upload_destinations.get) \
+                as mock_get_upload_destination, \
+                patch.object(syn, '_store_entity', side_effect=store_entity) as mock_store_entity, \
+                patch.object(syn, '_saveActivity') as mock_save_activity:
+            results = syn.store_many(entities, forceVersion=False)
+
+        assert 2 == mock_get_children.call_count
+        assert 2 == mock_get_upload_destination.call_count
+        assert not mock_save_activity.called
+
+        assert entities == [r.entity for r in results]
+        assert ['new.txt_id', 'existing.txt_id', 'other.txt_id'] == [r.stored.id for r in results]
+        assert all(r.error is None for r in results)
+
+        expected_kwargs = dict(createOrUpdate=True, forceVersion=False, generatedBy=None, returnFresh=False)
+        assert sorted([
+            call(new_file, known_new=True, upload_destination=upload_destinations['syn1'], **expected_kwargs),
+            call(existing_file, known_new=False, upload_destination=upload_destinations['syn1'], **expected_kwargs),
+            call(other_file, known_new=True, upload_destination=upload_destinations['syn2'], **expected_kwargs),
+        ], key=str) == sorted(mock_store_entity.call_args_list, key=str)
+
+    def test_store_many__errors(self, syn):
+        """An error storing an entity is reported without stopping the others from being stored"""
+        entities = [Folder('a', parentId='syn1'), Folder('b', parentId='syn1')]
+        error = SynapseHTTPError('boom')
+
+        def store_entity(entity, **kwargs):
+            if entity.name == 'a':
+                raise error
+            return entity
+
+        with patch.object(syn, 'getChildren', return_value=iter([])), \
+                patch.object(syn, '_store_entity', side_effect=store_entity):
+            results = syn.store_many(entities)
+
+        assert [(entities[0], None, error), (entities[1], entities[1], None)] == results
+
+    def test_store_many__created_since_listed(self, syn):
+        """A new file that conflicts with one created since its parent was listed is updated without being
+        uploaded again"""
+        file = File('/tmp/a.txt', parentId='syn1')
+        conflict = SynapseHTTPError(response=DictObject({'status_code': 409}))
+        existing = {
+            'id': 'syn10',
+            'etag': 'etag_1',
+            'name': 'a.txt',
+            'parentId': 'syn1',
+            'concreteType': 'org.sagebionetworks.repo.model.FileEntity',
+            'dataFileHandleId': '123',
+            'versionNumber': 1,
+        }
+        bundle = {'entity': existing, 'annotations': {'id': 'syn10', 'etag': 'etag_1', 'annotations': {}}}
+
+        with patch.object(syn, 'getChildren', return_value=iter([])), \
+                patch.object(syn, '_getDefaultUploadDestination', return_value={'storageLocationId': 1}), \
+                patch.object(client, 'upload_file_handle', return_value={'id': '456'}) as mock_upload, \
+                patch.object(syn, '_createEntity', side_effect=conflict), \
+                patch.object(syn, 'findEntityId', return_value='syn10'), \
+                patch.object(syn, '_getEntityBundle', return_value=bundle) as mock_get_entity_bundle, \
+                patch.object(syn, '_updateEntity', side_effect=lambda properties, *args, **kwargs: properties) \
+                as mock_update_entity, \
+                patch.object(syn, 'set_annotations', return_value=Annotations('syn10', 'etag_2', {})):
+            results = syn.store_many([file])
+
+        assert results[0].error is None
+        assert 'syn10' == results[0].stored.id
+        mock_upload.assert_called_once()
+        mock_get_entity_bundle.assert_called_once_with('syn10', requestedObjects=ANY)
+        assert '456' == mock_update_entity.call_args[0][0]['dataFileHandleId']
+
+    def test_store_many__provenance(self, syn):
+        """Provenance is stored as one Activity that generated all the entities"""
+        entities = [Folder('a', parentId='syn1'), Folder('b', parentId='syn1')]
+
+        with patch.object(syn, 'getChildren', return_value=iter([])), \
+                patch.object(syn, '_saveActivity', return_value={'id': '123'}) as mock_save_activity, \
+                patch.object(syn, '_store_entity') as mock_store_entity:
+            syn.store_many(entities, used=['syn2'], activityName='foo')
+
+        mock_save_activity.assert_called_once()
+        assert 'foo' == mock_save_activity.call_args[0][0]['name']
+        assert ['123', '123'] == [c[1]['generatedBy'] for c in mock_store_entity.call_args_list]
+
+    def test_store_many__provenance_not_stored(self, syn):
+        """The Activity is deleted if none of the entities it generated could be stored"""
+        entities = [Folder('a', parentId='syn1'), Folder('b', parentId='syn1')]
+
+        with patch.object(syn, 'getChildren', return_value=iter([])), \
+                patch.object(syn, '_saveActivity', return_value={'id': '123'}) as mock_save_activity, \
+                patch.object(syn, '_store_entity', side_effect=SynapseHTTPError('boom')), \
+                patch.object(syn, 'restDELETE') as mock_rest_delete:
+            results = syn.store_many(entities, used=['syn2'])
+
+        assert all(r.error for r in results)
+        mock_save_activity.assert_called_once()
+        mock_rest_delete.assert_called_once_with('/activity/123')
+
+    def test_store_many__provenance_self_storing(self, syn):
+        """Objects that store themselves can't be stored with provenance"""
+        with patch.object(syn, '_saveActivity') as mock_save_activity, \
+                patch.object(syn, 'store') as mock_store, \
+                patch.object(syn, '_store_entity') as mock_store_entity:
+            with pytest.raises(ValueError):
+                syn.store_many([Folder('a', parentId='syn1'), Schema(name='table', parent='syn1')], used=['syn2'])
+
+        assert not mock_save_activity.called
+        assert not mock_store.called
+        assert not mock_store_entity.called
+
+    def test_store_many__self_storing(self, syn):
+        """Objects that store themselves are stored by store"""
+        schema = Schema(name='table', parent='syn1')
+
+        with patch.object(syn, 'store') as mock_store, \
+                patch.object(syn, '_store_entity') as mock_store_entity:
+            results = syn.store_many([schema])
+
+        mock_store.assert_called_once_with(schema, createOrUpdate=True, forceVersion=True)
+        assert mock_store.return_value == results[0].stored
+        assert not mock_store_entity.called
+
+
+class TestFileEntityNeedsUpload:
+
+    bundle = {
+        'entity': {'id': 'syn123', 'dataFileHandleId': '456'},
+        'fileHandles': [
+            {'id': '456', 'concreteType': 'org.sagebionetworks.repo.model.file.S3FileHandle'},
+        ],
+    }
+
+    def test_new_entity(self, syn):
+        assert syn._file_entity_needs_upload(File('/tmp/foo', parentId='syn1'), None)
+        assert not syn._file_entity_needs_upload(File('/tmp/foo', parentId='syn1', dataFileHandleId='456'), None)
+
+    @staticmethod
+    def _contains_many(contained_file_handle_ids, looked_up):
+        def contains_many(file_handle_ids_and_paths):
+            file_handle_ids_and_paths = list(file_handle_ids_and_paths)
+            looked_up.append(file_handle_ids_and_paths)
+            return [file_handle_id in contained_file_handle_ids for file_handle_id, _ in file_handle_ids_and_paths]
+        return contains_many
+
+    def test_unchanged_file(self, syn):
+        looked_up = []
+        with patch.object(syn.cache, 'contains_many', side_effect=self._contains_many({'456'}, looked_up)):
+            assert not syn._file_entity_needs_upload(File('/tmp/foo', parentId='syn1'), self.bundle)
+        assert [[('456', '/tmp/foo')]] == looked_up
+
+    def test_modified_file(self, syn):
+        with patch.object(syn.cache, 'contains_many', side_effect=self._contains_many(set(), [])):
+            assert syn._file_entity_needs_upload(File('/tmp/foo', parentId='syn1'), self.bundle)
+
+    def test_file_already_uploaded(self, syn):
+        """A modified file that has already been uploaded to the entity's file handle isn't uploaded again"""
+        entity = File('/tmp/foo', parentId='syn1', dataFileHandleId='789')
+        looked_up = []
+        with patch.object(syn.cache, 'contains_many', side_effect=self._contains_many({'789'}, looked_up)):
+            assert not syn._file_entity_needs_upload(entity, self.bundle)
+        assert [[('456', '/tmp/foo'), ('789', '/tmp/foo')]] == looked_up
+
+    def test_not_synapse_store(self, syn):
+        with patch.object(syn.cache, 'contains_many', side_effect=self._contains_many({'456'}, [])):
+            assert syn._file_entity_needs_upload(
+                File('/tmp/foo', parentId='syn1', synapseStore=False),
+                self.bundle
+            )
+
+
 def test_get_submission_with_annotations(syn):
     """Verify a getSubmission with annotation entityBundleJSON that
     uses the old style annotations is converted to bundle v2 style
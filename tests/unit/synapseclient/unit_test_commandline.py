@@ -28,6 +28,7 @@ def test_command_sync(syn):
     assert args.dryRun is False
     assert args.sendMessages is False
     assert args.retries == 4
+    assert args.dedupe is None
 
     with patch.object(synapseutils, "syncToSynapse") as mockedSyncToSynapse:
         cmdline.sync(args, syn)
@@ -35,7 +36,8 @@ def test_command_sync(syn):
                                                     manifestFile=args.manifestFile,
                                                     dryRun=args.dryRun,
                                                     sendMessages=args.sendMessages,
-                                                    retries=args.retries)
+                                                    retries=args.retries,
+                                                    dedupe=args.dedupe)
 
 
 def test_migrate(syn):
@@ -133,6 +135,20 @@ def test_get_multi_threaded_flag():
     assert args.multiThreaded
 
 
+@pytest.mark.parametrize('parallel', [False, True])
+def test_cat(syn, parallel):
+    """The file is streamed to stdout as bytes"""
+    parser = cmdline.build_parser()
+    args = parser.parse_args(['cat', 'syn123', '-v', '2'] + (['--parallel'] if parallel else []))
+
+    with patch.object(syn, 'iter_content', return_value=iter([b'foo', b'bar'])) as mock_iter_content, \
+            patch.object(cmdline.sys, 'stdout') as mock_stdout:
+        cmdline.cat(args, syn)
+
+    mock_iter_content.assert_called_once_with('syn123', version=2, max_threads=syn.max_threads if parallel else 1)
+    assert [call(b'foo'), call(b'bar')] == mock_stdout.buffer.write.call_args_list
+
+
 @patch('builtins.print')
 def test_get_sts_token(mock_print):
     """Test getting an STS token."""
@@ -151,6 +167,65 @@ def test_get_sts_token(mock_print):
     mock_print.assert_called_once_with(expected_output)
 
 
+@patch('builtins.print')
+def test_index_checksums(mock_print):
+    parser = cmdline.build_parser()
+    args = parser.parse_args(['index-checksums', 'foo', 'bar.txt', '--threads', '4'])
+
+    syn = Mock()
+    with patch.object(cmdline.hashing, 'index_files', return_value=3) as mock_index_files:
+        cmdline.index_checksums(args, syn)
+
+    mock_index_files.assert_called_once_with(['foo', 'bar.txt'], syn.cache.checksum_index, max_workers=4)
+    mock_print.assert_called_once_with("Indexed the checksums of 3 files")
+
+
+@patch('builtins.print')
+def test_cache_stats(mock_print):
+    parser = cmdline.build_parser()
+    args = parser.parse_args(['cache', 'stats'])
+    assert cmdline.cache_stats == args.func
+
+    syn = Mock()
+    syn.cache.cache_root_dir = '/tmp/cache'
+    syn.cache.max_size = 2 ** 30
+    syn.cache.size.return_value = 2 ** 20
+    syn.cache.statistics.return_value = {'hits': 3, 'misses': 1, 'evicted_files': 2, 'evicted_bytes': 2 ** 10}
+    cmdline.cache_stats(args, syn)
+
+    assert [
+        call("Cache location: /tmp/cache"),
+        call("Size: 1.0MB of 1.0GB"),
+        call("Hits: 3, misses: 1, hit rate: 75.0%"),
+        call("Evicted 2 files, reclaiming 1.0kB"),
+    ] == mock_print.call_args_list
+
+
+@patch('builtins.print')
+def test_cache_evict(mock_print):
+    parser = cmdline.build_parser()
+    syn = Mock()
+    syn.cache.evict.return_value = (2, 2 ** 20)
+
+    args = parser.parse_args(['cache', 'evict', '--max-size', '10GB'])
+    cmdline.cache_evict(args, syn)
+    syn.cache.evict.assert_called_once_with(10 * 2 ** 30)
+    mock_print.assert_called_once_with("Evicted 2 files, reclaiming 1.0MB")
+
+    # by default the cache is reduced to its configured maximum size
+    args = parser.parse_args(['cache', 'evict'])
+    cmdline.cache_evict(args, syn)
+    syn.cache.evict.assert_called_with(None)
+
+
+def test_cache__no_command():
+    """A cache command is required, rather than the cache command doing nothing"""
+    parser = cmdline.build_parser()
+    with patch('sys.stderr'), pytest.raises(SystemExit) as ex_info:
+        parser.parse_args(['cache'])
+    assert 2 == ex_info.value.code
+
+
 def test_authenticate_login__success(syn):
     """Verify happy path for _authenticate_login"""
 
@@ -583,7 +583,7 @@ def test_downloadTableColumns(syn, downloadLocation):
             patch.object(client, 'zipfile'), \
             patch.object(client, 'extract_zip_file_to_directory') as mock_extract_zip_file_to_directory:
 
-        mock_cache.get.side_effect = cached_paths
+        mock_cache.get_many.return_value = cached_paths
         mock_async.return_value = mock_async_response
         mock_ensure_dir.return_value = mock_cache.get_cache_dir.return_value = '/tmp/download'
         mock_download_file_handle.return_value = zip_file_path
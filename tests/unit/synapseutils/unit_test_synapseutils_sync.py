@@ -1,3 +1,4 @@
+import concurrent.futures
 import csv
 from concurrent.futures import Future
 import os
@@ -9,15 +10,16 @@ import tempfile
 import threading
 
 import pytest
-from unittest.mock import ANY, patch, create_autospec, Mock, call
+from unittest.mock import patch, create_autospec, Mock, call, ANY
 
 import synapseutils
-from synapseutils.sync import _FolderSync, _PendingProvenance, _SyncUploader, _SyncUploadItem
+from synapseutils.sync import _FolderSync, _SyncUploader, _SyncUploadItem
 from synapseclient import Activity, File, Folder, Project, Schema, Synapse
+from synapseclient.core import hashing
 from synapseclient.core.cumulative_transfer_progress import CumulativeTransferProgress
 from synapseclient.core.exceptions import SynapseHTTPError
 from synapseclient.core.utils import id_of
-from synapseclient.core.pool_provider import get_executor
+from synapseclient.core.transfer_scheduler import get_transfer_job
 
 
 def test_readManifest__sync_order_with_home_directory(syn):
@@ -397,6 +399,7 @@ def test_manifest_upload(syn):
         assert used == expected_used
         assert executed == expected_executed
 
+    uploader_init.assert_called_once_with(syn, ANY, dedupe=None)
     uploader_init.return_value.upload.assert_called_once_with(upload_items)
 
 
@@ -527,98 +530,149 @@ class TestSyncUploader:
             _SyncUploader._order_items(items)
         assert 'not being uploaded' in str(cm_ex.value)
 
-    def test_upload_item_success(self, syn):
-        """Test successfully uploading an item"""
-
+    def test_prepare_item__new_file(self, syn):
+        """A file that isn't yet in Synapse is uploaded to the upload destination of its parent"""
         uploader = _SyncUploader(syn, Mock())
+        item = _SyncUploadItem(File(path='/tmp/file', parentId='syn123'), [], [], {})
+        upload_destination = {'concreteType': 'org.sagebionetworks.repo.model.file.S3UploadDestination'}
 
-        used = ['foo']
-        executed = ['bar']
-        item = _SyncUploadItem(
-            File(path='/tmp/file', parentId='syn123'),
-            used,
-            executed,
-            {'forceVersion': True},
-        )
+        with patch.object(syn, '_getEntityBundle', return_value=None) as mock_get_bundle, \
+                patch.object(syn, '_getDefaultUploadDestination', return_value=upload_destination):
+            assert (None, upload_destination) == uploader._prepare_item(item)
 
-        finished_items = {}
-        mock_condition = create_autospec(threading.Condition())
-        pending_provenance = _PendingProvenance()
-        pending_provenance.update(set([item.entity.path]))
-        abort_event = threading.Event()
-        progress = CumulativeTransferProgress('Test Upload')
+        mock_get_bundle.assert_called_once_with(item.entity)
 
-        mock_stored_entity = Mock()
+    def test_prepare_item__unchanged_file(self, syn):
+        """A file that is already stored in Synapse is committed without being uploaded"""
+        uploader = _SyncUploader(syn, Mock())
+        item = _SyncUploadItem(File(path='/tmp/file', parentId='syn123'), [], [], {})
+        bundle = {'entity': {'id': 'syn456', 'dataFileHandleId': '789'}, 'fileHandles': []}
 
-        with patch.object(syn, 'store') as mock_store, \
-                patch.object(uploader._file_semaphore, 'release') as mock_release:
+        with patch.object(syn, '_getEntityBundle', return_value=bundle), \
+                patch.object(syn.cache, 'contains_many', side_effect=lambda pairs: [True for _ in pairs]) \
+                as mock_contains_many, \
+                patch.object(syn, '_getDefaultUploadDestination') as mock_get_destination:
+            assert (bundle, None) == uploader._prepare_item(item)
 
-            mock_store.return_value = mock_stored_entity
+        mock_contains_many.assert_called_once()
+        assert not mock_get_destination.called
 
-            uploader._upload_item(
-                item,
-                used,
-                executed,
-                finished_items,
-                pending_provenance,
-                mock_condition,
-                abort_event,
-                progress,
-            )
+    def test_prepare_item__not_stored(self, syn):
+        """A file that isn't stored in Synapse has no bytes to upload"""
+        uploader = _SyncUploader(syn, Mock())
+        item = _SyncUploadItem(File(path='/tmp/file', parentId='syn123', synapseStore=False), [], [], {})
 
-        mock_store.assert_called_once_with(item.entity, used=used, executed=executed, **item.store_kwargs)
+        with patch.object(syn, '_getEntityBundle', return_value=None) as mock_get_bundle, \
+                patch.object(syn, '_getDefaultUploadDestination') as mock_get_destination:
+            assert (None, None) == uploader._prepare_item(item)
 
-        # item should be finished and removed from pending provenance
-        assert mock_stored_entity == finished_items[item.entity.path]
-        assert len(pending_provenance._pending) == 0
+        mock_get_bundle.assert_called_once_with(item.entity)
+        assert not mock_get_destination.called
 
-        # should have notified the condition to let anything waiting on this provenance to continue
-        mock_condition.notifyAll.assert_called_once_with()
+    def test_upload_item(self, syn):
+        """The uploaded file handle is set on the entity, once its file has been hashed"""
+        uploader = _SyncUploader(syn, Mock(), dedupe='copy')
+        item = _SyncUploadItem(File(path='/tmp/file', parentId='syn123'), [], [], {})
+        upload_destination = {'storageLocationId': 1}
+        file_handle = {'id': '456', 'contentMd5': 'abc', 'concreteType': 'S3FileHandle'}
+        hash_future = Future()
 
-        assert not abort_event.is_set()
+        def upload(*args, **kwargs):
+            assert hash_future.done()
+            return file_handle
 
-        mock_release.assert_called_once_with()
+        with patch.object(synapseutils.sync, 'upload_file_handle', side_effect=upload) as mock_upload, \
+                patch.object(concurrent.futures, 'wait', side_effect=lambda fs: fs[0].set_result('foo')) as mock_wait:
+            uploader._upload_item(
+                item,
+                upload_destination,
+                CumulativeTransferProgress('Test Upload'),
+                hash_future=hash_future,
+            )
 
-    def test_upload_item__failure(self, syn):
-        """Verify behavior if an item upload fails.
-        Exception should be raised, and appropriate threading controls should be released/notified."""
+        mock_wait.assert_called_once_with([hash_future])
+        mock_upload.assert_called_once_with(
+            syn,
+            'syn123',
+            '/tmp/file',
+            md5=None,
+            file_size=None,
+            mimetype=None,
+            max_threads=syn.max_threads,
+            upload_destination=upload_destination,
+            dedupe='copy',
+        )
+        assert '456' == item.entity.dataFileHandleId
+        assert 'abc' == item.entity.md5
 
+    def test_commit_item(self, syn):
+        """An item is committed by storing it with its provenance, reusing the bundle of its preparation"""
         uploader = _SyncUploader(syn, Mock())
-
+        used = ['syn1']
+        executed = ['syn2']
         item = _SyncUploadItem(
             File(path='/tmp/file', parentId='syn123'),
-            [],
-            [],
-            {'forceVersion': True},
+            used,
+            executed,
+            {'forceVersion': True, 'activityName': 'name', 'activityDescription': 'description'},
         )
+        bundle = {'entity': {'id': 'syn456', 'dataFileHandleId': '789'}, 'fileHandles': []}
+
+        with patch.object(syn, '_saveActivity', return_value={'id': '1'}) as mock_save_activity, \
+                patch.object(syn, '_store_entity') as mock_store_entity:
+            stored = uploader._commit_item(item, bundle, used, executed, CumulativeTransferProgress('Test Upload'))
+
+        activity = mock_save_activity.call_args[0][0]
+        assert 'name' == activity['name']
+        assert 'description' == activity['description']
+        assert [('syn1', False), ('syn2', True)] == [(u['reference']['targetId'], u['wasExecuted'])
+                                                     for u in activity['used']]
+        mock_store_entity.assert_called_once_with(
+            item.entity,
+            generatedBy='1',
+            returnFresh=False,
+            bundle=bundle,
+            known_new=False,
+            forceVersion=True,
+        )
+        assert mock_store_entity.return_value == stored
 
-        finished_items = {}
-        mock_condition = create_autospec(threading.Condition())
-        pending_provenance = set([item.entity.path])
-        abort_event = threading.Event()
-        progress = CumulativeTransferProgress('Test Upload')
-
-        with pytest.raises(ValueError), \
-                patch.object(syn, 'store') as mock_store, \
-                patch.object(uploader._file_semaphore, 'release') as mock_release:
+    def test_commit_item__new(self, syn):
+        """An item that wasn't found by its preparation is created without being looked up again"""
+        uploader = _SyncUploader(syn, Mock())
+        item = _SyncUploadItem(File(path='/tmp/file', parentId='syn123'), [], [], {})
+
+        with patch.object(syn, '_saveActivity') as mock_save_activity, \
+                patch.object(syn, '_store_entity') as mock_store_entity, \
+                patch.object(syn, '_getEntityBundle') as mock_get_bundle:
+            uploader._commit_item(item, None, [], [], CumulativeTransferProgress('Test Upload'))
+
+        assert not mock_save_activity.called
+        assert not mock_get_bundle.called
+        mock_store_entity.assert_called_once_with(
+            item.entity,
+            generatedBy=None,
+            returnFresh=False,
+            bundle=None,
+            known_new=True,
+        )
 
-            mock_store.side_effect = ValueError('Falure during upload')
+    def test_hash_items(self, syn):
+        """Only large files that are stored in Synapse are hashed ahead of their upload"""
+        hash_service = Mock()
+        uploader = _SyncUploader(syn, Mock(), hash_service=hash_service)
+        items = [
+            _SyncUploadItem(File(path='/tmp/large', parentId='syn123'), [], [], {}),
+            _SyncUploadItem(File(path='/tmp/small', parentId='syn123'), [], [], {}),
+            _SyncUploadItem(File(path='/tmp/link', parentId='syn123', synapseStore=False), [], [], {}),
+        ]
 
-            uploader._upload_item(
-                item,
-                item.used,
-                item.executed,
-                finished_items,
-                pending_provenance,
-                mock_condition,
-                abort_event,
-                progress,
-            )
+        sizes = {'/tmp/large': hashing.INLINE_HASH_SIZE, '/tmp/small': 1, '/tmp/link': hashing.INLINE_HASH_SIZE}
+        with patch('os.path.getsize', side_effect=sizes.get):
+            hash_futures = uploader._hash_items(items)
 
-        # abort event should have been raised and we shoudl have released threading locks
-        assert abort_event.is_set()
-        mock_release.assert_called_once_with()
-        mock_condition.notifyAll.assert_called_once_with()
+        hash_service.submit.assert_called_once_with('/tmp/large', syn.cache.checksum_index)
+        assert {'/tmp/large': hash_service.submit.return_value} == hash_futures
 
     def test_abort(self):
         """Verify abort behavior.
@@ -630,9 +684,11 @@ class TestSyncUploader:
         future_3 = create_autospec(future_spec)
 
         future_1.done.return_value = True
+        future_1.cancelled.return_value = False
         future_1.exception.return_value = None
 
         ex = ValueError('boom')
+        future_2.cancelled.return_value = False
         future_2.exception.return_value = ex
 
         future_3.done.return_value = False
@@ -645,6 +701,19 @@ class TestSyncUploader:
         assert cm_ex.value.__cause__ == ex
         future_3.cancel.assert_called_once_with()
 
+    def test_abort__cancelled(self):
+        """A cancelled Future isn't the cause of an abort"""
+        cancelled = Future()
+        cancelled.cancel()
+        failed = Future()
+        ex = ValueError('boom')
+        failed.set_exception(ex)
+
+        with pytest.raises(ValueError) as cm_ex:
+            _SyncUploader._abort([cancelled, failed])
+
+        assert cm_ex.value.__cause__ == ex
+
     def test_upload__error(self, syn):
         """Verify that if an item upload fails the error is raised in the main thread
         and any running Futures are cancelled"""
@@ -653,33 +722,36 @@ class TestSyncUploader:
         item_2 = _SyncUploadItem(File(path='/tmp/bar', parentId='syn123'), [], [], {})
         items = [item_1, item_2]
 
-        def syn_store_side_effect(entity, *args, **kwargs):
-            if entity.path == entity.path:
-                raise ValueError()
-            return Mock()
-
-        uploader = _SyncUploader(syn, get_executor())
+        uploader = _SyncUploader(syn, get_transfer_job())
         original_abort = uploader._abort
 
         def abort_side_effect(futures):
             return original_abort(futures)
 
-        with patch.object(syn, 'store') as mock_syn_store, \
-                patch.object(uploader, '_abort') as mock_abort:
+        with patch.object(uploader, '_prepare_item', return_value=(None, {})), \
+                patch.object(uploader, '_upload_item', side_effect=ValueError('Failure during upload')), \
+                patch.object(uploader, '_abort') as mock_abort, \
+                patch.object(syn, '_store_entity') as mock_syn_store:
 
-            mock_syn_store.side_effect = syn_store_side_effect
             mock_abort.side_effect = abort_side_effect
-            with pytest.raises(ValueError):
+            with pytest.raises(ValueError) as cm_ex:
                 uploader.upload(items)
 
-            # it would be aborted with Futures
-            mock_abort.assert_called_once_with([ANY])
-            isinstance(mock_abort.call_args_list[0][0], Future)
+            assert 'Failure during upload' == str(cm_ex.value.__cause__)
+
+            # it would be aborted with the Futures of the items submitted before the failure was noticed
+            mock_abort.assert_called_once()
+            futures = mock_abort.call_args_list[0][0][0]
+            assert 2 <= len(futures) <= 4
+            assert all(isinstance(f, Future) for f in futures)
+
+        # nothing is committed if its upload failed
+        assert not mock_syn_store.called
 
     @patch('os.path.isfile')
     def test_upload(self, mock_os_isfile, syn):
         """Ensure that an upload including multiple items which depend on each other through
-        provenance are all uploaded and in the expected order."""
+        provenance are all uploaded, and committed in the expected order with their provenance."""
         mock_os_isfile.return_value = True
 
         item_1 = _SyncUploadItem(
@@ -702,57 +774,71 @@ class TestSyncUploader:
         )
 
         items = [
+            item_3,
             item_1,
             item_2,
-            item_3,
         ]
 
-        convert_provenance_calls = 2 * len(items)
-        convert_provenance_condition = threading.Condition()
-
         mock_stored_entities = {
             item_1.entity.path: Mock(),
             item_2.entity.path: Mock(),
             item_3.entity.path: Mock(),
         }
 
-        uploader = _SyncUploader(syn, get_executor())
-
-        convert_provenance_original = uploader._convert_provenance
+        # the last item's upload is held until the first item is committed, so the
+        # commit of the first item can't be waiting on the upload of the others
+        item_1_committed = threading.Event()
+        uploaded = []
 
-        def patched_convert_provenance(provenance, finished_items):
-            # we hack the convert_provenance method as a way of ensuring that
-            # the first item doesn't finish storing until the items that depend on it
-            # have finished one trip through the wait loop. that way we ensure that
-            # our locking logic is being exercised.
-            nonlocal convert_provenance_calls
-            with convert_provenance_condition:
-                convert_provenance_calls -= 1
-
-                if convert_provenance_calls == 0:
-                    convert_provenance_condition.notifyAll()
-
-            return convert_provenance_original(provenance, finished_items)
+        def upload_item(item, upload_destination, progress, hash_future=None):
+            if item is item_3:
+                assert item_1_committed.wait(timeout=10)
+            uploaded.append(item.entity.path)
 
         def syn_store_side_effect(entity, *args, **kwargs):
             if entity.path == item_1.entity.path:
-                with convert_provenance_condition:
-                    if convert_provenance_calls > 0:
-                        convert_provenance_condition.wait_for(lambda: convert_provenance_calls == 0)
-
+                item_1_committed.set()
             return mock_stored_entities[entity.path]
 
-        with patch.object(uploader, '_convert_provenance') as mock_convert_provenance, \
-                patch.object(syn, 'store') as mock_syn_store:
+        uploader = _SyncUploader(syn, get_transfer_job(), max_pending_items=2)
+        with patch.object(uploader, '_prepare_item', return_value=(None, {})), \
+                patch.object(uploader, '_upload_item', side_effect=upload_item), \
+                patch.object(syn, '_provenance_activity', return_value=None) as mock_provenance_activity, \
+                patch.object(syn, '_store_entity') as mock_syn_store:
 
-            mock_convert_provenance.side_effect = patched_convert_provenance
             mock_syn_store.side_effect = syn_store_side_effect
-
             uploader.upload(items)
 
-        # all three of our items should have been stored
+        assert {i.entity.path for i in items} == set(uploaded)
+
+        # all three of our items should have been stored in provenance order
         stored = [args[0][0].path for args in mock_syn_store.call_args_list]
-        assert [i.entity.path for i in items] == stored
+        assert [item_1.entity.path, item_2.entity.path, item_3.entity.path] == stored
+
+        # the provenance of each item is the entity of the item it depends on
+        used = [args[0][1] for args in mock_provenance_activity.call_args_list]
+        assert [] == used[0]
+        assert [mock_stored_entities[item_1.entity.path]] == used[1]
+        assert [mock_stored_entities[item_2.entity.path]] == used[2]
+
+    def test_upload__not_uploaded(self, syn):
+        """Items that don't need their bytes uploaded go straight to their commit"""
+        item = _SyncUploadItem(File(path='/tmp/foo', parentId='syn123'), [], [], {})
+
+        uploader = _SyncUploader(syn, get_transfer_job())
+        with patch.object(uploader, '_prepare_item', return_value=(None, None)), \
+                patch.object(uploader, '_upload_item') as mock_upload_item, \
+                patch.object(syn, '_store_entity') as mock_syn_store:
+            uploader.upload([item])
+
+        assert not mock_upload_item.called
+        mock_syn_store.assert_called_once_with(
+            item.entity,
+            generatedBy=None,
+            returnFresh=False,
+            bundle=None,
+            known_new=True,
+        )
 
 
 class TestGetFileEntityProvenanceDict: